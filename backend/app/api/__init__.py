@@ -1,6 +1,6 @@
 from typing import List, Optional
 from datetime import datetime
-from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi import APIRouter, Depends, HTTPException, Request, UploadFile, File, Form
 from google.cloud import firestore
 from app.core.firebase import get_db
 from app.core.auth import get_current_user
@@ -11,7 +11,7 @@ from app.schemas.erp import (
 )
 from app.schemas.accounting import (
     AccountCreate, JournalEntryCreate, 
-    PaymentVoucherCreate, ReceiptVoucherCreate, CreditNoteCreate
+    PaymentVoucherCreate, ReceiptVoucherCreate, CreditNoteCreate, BudgetCreate
 )
 from app.services.inventory import InventoryService
 from app.services.accounting import AccountingService
@@ -104,19 +104,22 @@ router.include_router(ops_router, prefix="/warehouse/ops", tags=["Warehouse Oper
 # ===================== ITEMS =====================
 @router.get("/inventory/items")
 @router.get("/items")
-async def get_items(limit: int = 200):
-    """Get items with pagination for performance."""
+async def get_items(limit: int = 200, user: dict = Depends(get_current_user)):
+    """Get the company's items with pagination for performance."""
     db = get_db()
-    docs = db.collection("items").limit(limit).stream()
+    docs = db.collection("items").where("company_id", "==", user.get("company_id")).limit(limit).stream()
     return [{"id": doc.id, **doc.to_dict()} for doc in docs]
 
 @router.post("/items")
-async def create_item(data: ItemCreate):
+async def create_item(data: ItemCreate, user: dict = Depends(get_current_user)):
     db = get_db()
+    company_id = user.get("company_id")
     item_data = data.model_dump()
-    item_data.update({"current_qty": "0.0000", "total_value": "0.0000", "current_wac": "0.0000"})
+    item_data.update({"company_id": company_id, "current_qty": "0.0000", "total_value": "0.0000", "current_wac": "0.0000"})
     doc_ref = db.collection("items").document()
     doc_ref.set(item_data)
+    from app.services.item_index import get_item_index
+    get_item_index().upsert(company_id, doc_ref.id, item_data)
     return {"id": doc_ref.id, **item_data}
 
 # ===================== WAREHOUSES =====================
@@ -164,6 +167,213 @@ async def create_delivery(data: DeliveryNoteCreate):
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+@router.post("/inventory/recost")
+async def recost_inventory(payload: dict, user: dict = Depends(get_current_user)):
+    """Re-cost the stock ledger of items from a date forward and book the COGS difference (Admin only).
+    Payload: {"item_ids": [...], "from_date": "YYYY-MM-DD"} or {"run_id": "..."} to resume a run."""
+    if user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Admin only")
+    from app.services.recosting import get_recost_service
+    from starlette.concurrency import run_in_threadpool
+    service = get_recost_service()
+    try:
+        if payload.get("run_id"):
+            return await run_in_threadpool(service.resume, payload["run_id"])
+        if not payload.get("item_ids") or not payload.get("from_date"):
+            raise ValueError("item_ids and from_date are required")
+        return await run_in_threadpool(
+            service.recost_items, user.get("company_id"), payload["item_ids"],
+            payload["from_date"], "manual"
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/inventory/recost/pending")
+async def list_pending_recosts(user: dict = Depends(get_current_user)):
+    """Re-costing runs left PENDING (e.g. after a back-dated GRN/DO); resume them with POST /inventory/recost."""
+    if user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Admin only")
+    from app.services.recosting import get_recost_service
+    return get_recost_service().list_pending(user.get("company_id"))
+
+@router.get("/inventory/cost-layers")
+async def get_cost_layers(item_id: str, warehouse_id: str, limit: int = 100, user: dict = Depends(get_current_user)):
+    """Open FIFO/FEFO cost layers of an item in a warehouse, in consumption order."""
+    from app.services.cost_layers import get_cost_layer_service
+    db = get_db()
+    item_snap = db.collection("items").document(item_id).get()
+    if not item_snap.exists or item_snap.to_dict().get("company_id") != user.get("company_id"):
+        raise HTTPException(status_code=404, detail="Item not found")
+    method = item_snap.to_dict().get("costing_method") or "FIFO"
+    return get_cost_layer_service().get_open_layers(item_id, warehouse_id, method, limit)
+
+@router.get("/inventory/expiring")
+async def get_expiring_stock(before: str, limit: int = 200, user: dict = Depends(get_current_user)):
+    """Open cost layers expiring on or before a date (FEFO picking / write-off review)."""
+    from app.services.cost_layers import get_cost_layer_service
+    return get_cost_layer_service().get_expiring_layers(user.get("company_id"), before, limit)
+
+@router.get("/inventory/valuation")
+async def get_inventory_valuation(
+    as_of: Optional[str] = None,
+    warehouse_id: Optional[str] = None,
+    reconcile: bool = True,
+    user: dict = Depends(get_current_user)
+):
+    """Stock quantity, WAC and value by item/warehouse/storage type at the end of a date, reconciled with GL 121."""
+    from app.services.valuation import get_valuation_service
+    from starlette.concurrency import run_in_threadpool
+    try:
+        return await run_in_threadpool(get_valuation_service().get_valuation, user.get("company_id"), as_of, warehouse_id, reconcile)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.post("/inventory/valuation/snapshots")
+async def take_stock_snapshot(as_of: str, user: dict = Depends(get_current_user)):
+    """Take (or retake) the stock snapshot used by as-of valuations (Admin only)."""
+    if user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Admin only")
+    from app.services.valuation import get_valuation_service
+    from starlette.concurrency import run_in_threadpool
+    try:
+        return await run_in_threadpool(get_valuation_service().take_snapshot, user.get("company_id"), as_of)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/inventory/analytics/movements")
+async def get_stock_movements(
+    from_date: str,
+    to_date: str,
+    item_id: Optional[str] = None,
+    warehouse_id: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    """In/out quantity and value per item/warehouse and source document type, from the stock rollups."""
+    from app.services.stock_rollups import get_stock_rollup_service
+    from starlette.concurrency import run_in_threadpool
+    try:
+        return await run_in_threadpool(
+            get_stock_rollup_service().get_movement_report, user.get("company_id"), from_date, to_date, item_id, warehouse_id
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/inventory/analytics/turnover")
+async def get_stock_turnover(
+    from_date: str,
+    to_date: str,
+    warehouse_id: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    """Inventory turnover and days of cover per item over a period."""
+    from app.services.stock_rollups import get_stock_rollup_service
+    from starlette.concurrency import run_in_threadpool
+    try:
+        return await run_in_threadpool(
+            get_stock_rollup_service().get_turnover_report, user.get("company_id"), from_date, to_date, warehouse_id
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/inventory/analytics/slow-movers")
+async def get_slow_movers(
+    as_of: Optional[str] = None,
+    window_days: int = 90,
+    min_cover_days: int = 180,
+    warehouse_id: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    """Items whose stock on hand covers at least `min_cover_days` at the recent issue rate."""
+    from app.services.stock_rollups import get_stock_rollup_service
+    from starlette.concurrency import run_in_threadpool
+    try:
+        return await run_in_threadpool(
+            get_stock_rollup_service().get_slow_movers, user.get("company_id"), as_of, window_days, min_cover_days, warehouse_id
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/inventory/analytics/dead-stock")
+async def get_dead_stock(
+    as_of: Optional[str] = None,
+    window_days: int = 365,
+    warehouse_id: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    """Items in stock with no issue during the last `window_days`."""
+    from app.services.stock_rollups import get_stock_rollup_service
+    from starlette.concurrency import run_in_threadpool
+    try:
+        return await run_in_threadpool(
+            get_stock_rollup_service().get_dead_stock, user.get("company_id"), as_of, window_days, warehouse_id
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.post("/inventory/analytics/rebuild")
+async def rebuild_stock_rollups(
+    from_date: Optional[str] = None,
+    to_date: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    """Backfill the per-item stock movement rollups from the stock ledger (Admin only)."""
+    if user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Admin only")
+    from app.services.stock_rollups import get_stock_rollup_service
+    from starlette.concurrency import run_in_threadpool
+    start = datetime.fromisoformat(from_date).date() if from_date else None
+    end = datetime.fromisoformat(to_date).date() if to_date else None
+    return await run_in_threadpool(get_stock_rollup_service().rebuild, user.get("company_id"), start, end)
+
+@router.post("/inventory/reorder/run")
+async def run_reorder_engine(
+    history_days: int = 90,
+    method: str = "SES",
+    alpha: float = 0.3,
+    service_level: float = 0.95,
+    review_days: int = 14,
+    user: dict = Depends(get_current_user)
+):
+    """Forecast demand and compute reorder points / suggested quantities for every item and warehouse."""
+    if user.get("role") not in ["admin", "manager"]:
+        raise HTTPException(status_code=403, detail="Manager or Admin required")
+    from app.services.reorder import get_reorder_service
+    from starlette.concurrency import run_in_threadpool
+    try:
+        return await run_in_threadpool(
+            get_reorder_service().run, user.get("company_id"), history_days, method.upper(), alpha, service_level, review_days
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/inventory/reorder/suggestions")
+async def get_reorder_suggestions(
+    run_id: Optional[str] = None,
+    status: Optional[str] = "OPEN",
+    user: dict = Depends(get_current_user)
+):
+    """Reorder suggestions of a run (default: the latest run)."""
+    from app.services.reorder import get_reorder_service
+    return get_reorder_service().get_suggestions(user.get("company_id"), run_id, status)
+
+@router.post("/inventory/reorder/purchase-orders")
+async def create_reorder_purchase_orders(payload: dict, user: dict = Depends(get_current_user)):
+    """Create draft purchase orders (one per supplier) from reorder suggestions.
+    Payload: {"run_id": "...", "suggestion_ids": [...]} (omit suggestion_ids to order every open suggestion)."""
+    if user.get("role") not in ["admin", "manager"]:
+        raise HTTPException(status_code=403, detail="Manager or Admin required")
+    from app.services.reorder import get_reorder_service
+    from starlette.concurrency import run_in_threadpool
+    try:
+        if not payload.get("run_id"):
+            raise ValueError("run_id is required")
+        return await run_in_threadpool(
+            get_reorder_service().create_purchase_orders, user.get("company_id"), payload["run_id"],
+            payload.get("suggestion_ids"), user.get("email")
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @router.post("/inventory/return/sales")
 async def create_sales_return(data: ReturnCreate):
     service = IntegrationService()
@@ -189,7 +399,9 @@ async def create_journal(data: JournalEntryCreate, user: dict = Depends(get_curr
     try:
         # Ensure company_id is set from user token
         data.company_id = user.get("company_id")
-        je_id = service.create_journal_entry(data)
+        # Large imports post thousands of lines (chunked storage); keep the event loop free
+        from starlette.concurrency import run_in_threadpool
+        je_id = await run_in_threadpool(service.create_journal_entry, data)
         return {"message": "Journal Entry Posted", "id": je_id}
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -315,6 +527,76 @@ async def get_general_ledger(
         to_date=end
     )
 
+@router.get("/reports/income-by-dimension")
+async def get_income_by_dimension(
+    from_month: str,
+    to_month: str,
+    dimension: str = "cost_center_id",
+    user: dict = Depends(get_current_user)
+):
+    """Income statement per branch/cost center (or another dimension) from the ledger cube."""
+    from app.services.ledger_cube import get_ledger_cube_service
+    try:
+        return get_ledger_cube_service().get_income_statement_by(user.get("company_id"), from_month, to_month, dimension)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/reports/expense-by-category")
+async def get_expense_by_category(
+    from_month: str,
+    to_month: str,
+    group_by: str = "account",
+    dimension: Optional[str] = None,
+    value: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    """Expense totals per expense account (or parent account), optionally for one dimension value."""
+    from app.services.ledger_cube import get_ledger_cube_service
+    try:
+        return get_ledger_cube_service().get_expense_by_category(
+            user.get("company_id"), from_month, to_month, group_by, dimension, value
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/accounting/budgets")
+async def list_budgets(user: dict = Depends(get_current_user)):
+    from app.services.ledger_cube import get_ledger_cube_service
+    return get_ledger_cube_service().list_budgets(user.get("company_id"))
+
+@router.post("/accounting/budgets")
+async def create_budget(data: BudgetCreate, user: dict = Depends(get_current_user)):
+    if user.get("role") not in ["admin", "manager"]:
+        raise HTTPException(status_code=403, detail="Manager or Admin required")
+    from app.services.ledger_cube import get_ledger_cube_service
+    try:
+        return get_ledger_cube_service().save_budget(user.get("company_id"), data.model_dump())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.put("/accounting/budgets/{budget_id}")
+async def update_budget(budget_id: str, data: BudgetCreate, user: dict = Depends(get_current_user)):
+    if user.get("role") not in ["admin", "manager"]:
+        raise HTTPException(status_code=403, detail="Manager or Admin required")
+    from app.services.ledger_cube import get_ledger_cube_service
+    try:
+        return get_ledger_cube_service().save_budget(user.get("company_id"), data.model_dump(), budget_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/reports/budget-vs-actual/{budget_id}")
+async def get_budget_vs_actual(
+    budget_id: str,
+    from_month: Optional[str] = None,
+    to_month: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    from app.services.ledger_cube import get_ledger_cube_service
+    try:
+        return get_ledger_cube_service().get_budget_vs_actual(user.get("company_id"), budget_id, from_month, to_month)
+    except ValueError as e:
+        raise HTTPException(status_code=404 if "not found" in str(e) else 400, detail=str(e))
+
 @router.get("/reports/aging/{report_type}")
 async def get_aging_report(report_type: str, user: dict = Depends(get_current_user)):
     service = ReportingService()
@@ -342,41 +624,162 @@ async def get_audit_logs(limit: int = 50):
 
 # --- Document Lifecycle ---
 @router.post("/accounting/void/{je_id}")
-async def void_journal_entry(je_id: str, reason: str = "Voided by user"):
+async def void_journal_entry(je_id: str, reason: str = "Voided by user", user: dict = Depends(get_current_user)):
     """Void a posted journal entry by creating a reversal."""
     try:
-        lifecycle = get_lifecycle_service()
+        lifecycle = get_lifecycle_service(user.get("uid", "system"), user.get("company_id"))
         reversal_id = lifecycle.void_journal_entry(je_id, reason)
         return {"status": "voided", "reversal_je_id": reversal_id}
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+@router.post("/accounting/void-bulk")
+async def void_journal_entries(data: dict, user: dict = Depends(get_current_user)):
+    """Void many journal entries. Body: {"je_ids": [...], "reason": "..."}"""
+    if user.get("role") not in ["admin", "manager"]:
+        raise HTTPException(status_code=403, detail="Manager or Admin required")
+    je_ids = data.get("je_ids") or []
+    if not je_ids:
+        raise HTTPException(status_code=400, detail="je_ids is required")
+    from starlette.concurrency import run_in_threadpool
+    lifecycle = get_lifecycle_service(user.get("uid", "system"), user.get("company_id"))
+    return await run_in_threadpool(lifecycle.void_journal_entries, je_ids, data.get("reason", "Voided by user"))
+
 # --- Fiscal Period Management ---
 @router.post("/fiscal/close-period")
-async def close_fiscal_period(year: int, month: int):
+async def close_fiscal_period(year: int, month: int, user: dict = Depends(get_current_user)):
     """Close a fiscal period (lock transactions for that month)."""
+    if user.get("role") not in ["admin", "manager"]:
+        raise HTTPException(status_code=403, detail="Manager or Admin required")
     try:
-        fiscal = get_fiscal_service()
+        fiscal = get_fiscal_service(user.get("uid", "system"), user.get("company_id"))
         period_id = fiscal.close_period(year, month)
         return {"status": "closed", "period_id": period_id}
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @router.post("/fiscal/reopen-period")
-async def reopen_fiscal_period(year: int, month: int):
+async def reopen_fiscal_period(year: int, month: int, user: dict = Depends(get_current_user)):
     """Reopen a closed fiscal period (admin only)."""
+    if user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Admin only")
     try:
-        fiscal = get_fiscal_service()
+        fiscal = get_fiscal_service(user.get("uid", "system"), user.get("company_id"))
         period_id = fiscal.reopen_period(year, month)
         return {"status": "reopened", "period_id": period_id}
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+@router.post("/fiscal/close-year")
+async def close_fiscal_year(
+    year: int,
+    retained_earnings_account_id: Optional[str] = None,
+    redo: bool = False,
+    user: dict = Depends(get_current_user)
+):
+    """Year-end close: zero revenue/expense into retained earnings and lock all 12 periods."""
+    if user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Admin only")
+    from starlette.concurrency import run_in_threadpool
+    try:
+        fiscal = get_fiscal_service(user.get("uid", "system"), user.get("company_id"))
+        return await run_in_threadpool(fiscal.close_year, year, retained_earnings_account_id, redo)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.post("/fiscal/opening-balances/import")
+async def import_opening_balances(
+    kind: str = Form(...),
+    effective_date: str = Form(...),
+    clearing_account_id: Optional[str] = Form(None),
+    job_id: Optional[str] = Form(None),
+    validate_only: bool = Form(False),
+    file: UploadFile = File(...),
+    user: dict = Depends(get_current_user)
+):
+    """
+    Load opening balances from CSV/XLSX (kind: gl | ar | ap | stock).
+    Validates the whole file before writing; resend with job_id to resume a failed import.
+    """
+    if user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Admin only")
+    from app.services.opening_balances import get_opening_balance_loader
+    from starlette.concurrency import run_in_threadpool
+    loader = get_opening_balance_loader(user.get("company_id"), user.get("email"))
+    try:
+        effective = datetime.fromisoformat(effective_date).date()
+        return await run_in_threadpool(
+            loader.load, kind, file.file, file.filename or "upload.csv", effective,
+            clearing_account_id, job_id, validate_only
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/fiscal/archives")
+async def list_period_archives(user: dict = Depends(get_current_user)):
+    """Closed months moved out of the hot ledger/journal collections."""
+    from app.services.archive import get_archive_service
+    return get_archive_service().list_archives(user.get("company_id"))
+
+@router.post("/fiscal/archives/run")
+async def archive_closed_periods(keep_months: int = 3, period: Optional[str] = None, user: dict = Depends(get_current_user)):
+    """Archive one closed month (period=YYYY-MM) or every closed month older than keep_months (Admin only)."""
+    if user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Admin only")
+    from app.services.archive import get_archive_service
+    from starlette.concurrency import run_in_threadpool
+    service = get_archive_service()
+    try:
+        if period:
+            return await run_in_threadpool(service.archive_period, user.get("company_id"), period)
+        return await run_in_threadpool(service.archive_closed_periods, user.get("company_id"), keep_months)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.post("/fiscal/archives/{period}/restore")
+async def restore_period_archive(period: str, user: dict = Depends(get_current_user)):
+    """Move an archived month back to the hot collections (Admin only)."""
+    if user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Admin only")
+    from app.services.archive import get_archive_service
+    from starlette.concurrency import run_in_threadpool
+    try:
+        return await run_in_threadpool(get_archive_service().restore_period, user.get("company_id"), period)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/fiscal/archives/{period}/rows")
+async def get_archived_rows(
+    period: str,
+    kind: str = "stock_ledger",
+    item_id: Optional[str] = None,
+    account_id: Optional[str] = None,
+    limit: int = 500,
+    user: dict = Depends(get_current_user)
+):
+    """Drill down into an archived month (kind: stock_ledger | journal_entries)."""
+    from app.services.archive import get_archive_service, KINDS
+    if kind not in KINDS:
+        raise HTTPException(status_code=400, detail=f"kind must be one of {sorted(KINDS)}")
+    rows = []
+    for snap in get_archive_service().iter_archived(
+        user.get("company_id"), kind, periods=[period], item_id=item_id, account_id=account_id
+    ):
+        data = snap.to_dict()
+        if item_id and data.get("item_id") != item_id:
+            continue
+        if account_id and account_id not in (data.get("flat_account_ids") or {l.get("account_id") for l in data.get("lines", [])}):
+            continue
+        rows.append({"id": snap.id, **data})
+        if len(rows) >= limit:
+            break
+    return rows
+
 @router.get("/fiscal/periods")
-async def get_fiscal_periods():
+async def get_fiscal_periods(user: dict = Depends(get_current_user)):
     """Get all fiscal periods and their status."""
     db = get_db()
-    docs = db.collection("fiscal_periods").stream()
+    docs = db.collection("fiscal_periods").where("company_id", "==", user.get("company_id")).stream()
     return [{"id": doc.id, **doc.to_dict()} for doc in docs]
 
 # --- User & Employee Management ---
@@ -474,25 +877,132 @@ async def reseed_all(user: dict = Depends(get_current_user)):
     return {"status": "success", "message": "System reseeded with consistent data"}
 
 @router.get("/reports/export/{report_type}")
-async def export_report(report_type: str, user: dict = Depends(get_current_user)):
-    service = ReportingService()
-    csv_content = await service.export_to_csv(report_type, user.get("company_id"))
+async def export_report(
+    report_type: str,
+    format: str = "csv",
+    columns: Optional[str] = None,
+    from_date: Optional[str] = None,
+    to_date: Optional[str] = None,
+    account_id: Optional[str] = None,
+    customer_id: Optional[str] = None,
+    aging_type: Optional[str] = None,
+    currency: str = "IQD",
+    user: dict = Depends(get_current_user)
+):
+    """Export a report/ledger as csv | ndjson (streamed) or xlsx (constant-memory workbook)."""
     from fastapi.responses import StreamingResponse
-    import io
+    from starlette.background import BackgroundTask
+    from starlette.concurrency import run_in_threadpool
+    from app.services.exports import get_export_service
+    service = get_export_service()
+    params = {"account_id": account_id, "customer_id": customer_id, "aging_type": aging_type}
+    filename = f"{report_type}_{datetime.now().strftime('%Y%m%d')}"
+    try:
+        start = datetime.fromisoformat(from_date) if from_date else None
+        end = datetime.fromisoformat(to_date) if to_date else None
+        selected = [c.strip() for c in columns.split(",") if c.strip()] if columns else None
+
+        if format.lower() == "xlsx":
+            path = await run_in_threadpool(
+                service.build_xlsx, report_type, user.get("company_id"), selected,
+                start, end, currency, **params
+            )
+            try:
+                return StreamingResponse(
+                    service.iter_file(path),
+                    media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                    headers={"Content-Disposition": f"attachment; filename={filename}.xlsx"},
+                    # Runs after a complete response; iter_file's own cleanup covers aborted ones
+                    background=BackgroundTask(service.remove_file, path)
+                )
+            except Exception:
+                service.remove_file(path)
+                raise
+
+        chunks, media_type = service.stream(
+            report_type, user.get("company_id"), fmt=format, columns=selected,
+            from_date=start, to_date=end, **params
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    extension = "ndjson" if format.lower() == "ndjson" else "csv"
     return StreamingResponse(
-        io.StringIO(csv_content),
-        media_type="text/csv",
-        headers={"Content-Disposition": f"attachment; filename={report_type}_{datetime.now().strftime('%Y%m%d')}.csv"}
+        chunks,
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename={filename}.{extension}"}
     )
 @router.get("/reports/dashboard")
-async def get_dashboard_stats():
+async def get_dashboard_stats(user: dict = Depends(get_current_user)):
     service = ReportingService()
-    return await service.get_dashboard_stats()
+    return await service.get_dashboard_stats(user.get("company_id"))
 
 @router.get("/reports/weekly-trend")
-async def get_weekly_trend():
+async def get_weekly_trend(user: dict = Depends(get_current_user)):
     service = ReportingService()
-    return await service.get_weekly_revenue()
+    return await service.get_weekly_revenue(user.get("company_id"))
+
+@router.post("/admin/replay")
+async def replay_derived_state(
+    dry_run: bool = True,
+    run_id: Optional[str] = None,
+    workers: Optional[int] = None,
+    user: dict = Depends(get_current_user)
+):
+    """Recompute account balances, item stock/WAC and open-item balances from the ledgers (dry run by default)."""
+    if user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Admin only")
+    from app.services.replay import get_replay_service
+    from starlette.concurrency import run_in_threadpool
+    service = get_replay_service(user.get("company_id"), workers=workers)
+    return await run_in_threadpool(service.run, dry_run, run_id)
+
+@router.post("/admin/integrity-scan")
+async def run_integrity_scan(
+    workers: Optional[int] = None,
+    user: dict = Depends(get_current_user)
+):
+    """Scan the company's journals and stock ledger for double-entry integrity issues (Admin only).
+    The all-companies scan is only available from integrity_scan.py."""
+    if user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Admin only")
+    if not user.get("company_id"):
+        raise HTTPException(status_code=400, detail="User has no company")
+    from app.services.integrity import get_integrity_service
+    from starlette.concurrency import run_in_threadpool
+    service = get_integrity_service(user.get("company_id"))
+    return await run_in_threadpool(service.scan, False, workers)
+
+@router.post("/reports/rollups/rebuild")
+async def rebuild_daily_rollups(
+    from_date: Optional[str] = None,
+    to_date: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    """Backfill daily KPI rollups from journal/stock history (Admin only)."""
+    if user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Admin only")
+    from app.services.rollups import get_rollup_service
+    from starlette.concurrency import run_in_threadpool
+    service = get_rollup_service()
+    start = datetime.fromisoformat(from_date).date() if from_date else None
+    end = datetime.fromisoformat(to_date).date() if to_date else None
+    return await run_in_threadpool(service.rebuild, user.get("company_id"), start, end)
+
+@router.post("/reports/cube/rebuild")
+async def rebuild_ledger_cube(
+    from_month: Optional[str] = None,
+    to_month: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    """Recompute the monthly account x dimension cube from journal history (Admin only)."""
+    if user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Admin only")
+    from app.services.ledger_cube import get_ledger_cube_service
+    from starlette.concurrency import run_in_threadpool
+    try:
+        return await run_in_threadpool(get_ledger_cube_service().rebuild, user.get("company_id"), from_month, to_month)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 # --- Inventory Actions ---
 @router.post("/inventory/transfer")
@@ -530,20 +1040,56 @@ async def get_stock_history(item_id: str = None, limit: int = 50):
 # --- Multi-Currency ---
 
 @router.get("/currency/rate")
-async def get_exchange_rate():
-    """Get current USD/IQD exchange rate."""
+async def get_exchange_rate(at: Optional[str] = None):
+    """Get USD/IQD exchange rate (current, or effective on `at` YYYY-MM-DD)."""
     service = get_currency_service()
-    rate = service.get_current_rate()
-    return {"from": "USD", "to": "IQD", "rate": str(rate)}
+    rate = service.get_rate(at=at) if at else service.get_current_rate()
+    return {"from": "USD", "to": "IQD", "rate": str(rate), "at": at}
 
 @router.post("/currency/rate")
-async def set_exchange_rate(rate: float, user: dict = Depends(get_current_user)):
-    """Update exchange rate (Admin only)."""
+async def set_exchange_rate(rate: float, effective_date: Optional[str] = None, user: dict = Depends(get_current_user)):
+    """Update exchange rate (Admin only). Back-dated rates only extend the history."""
     if user.get("role") != "admin":
         raise HTTPException(status_code=403, detail="Admin only")
     from decimal import Decimal
     service = get_currency_service()
-    return service.set_rate(Decimal(str(rate)))
+    return service.set_rate(Decimal(str(rate)), effective_date=effective_date)
+
+@router.post("/currency/revaluation")
+async def run_fx_revaluation(
+    period: str,
+    gain_account_id: str,
+    loss_account_id: Optional[str] = None,
+    dry_run: bool = False,
+    user: dict = Depends(get_current_user)
+):
+    """Period-end FX revaluation (one balanced JE + auto-reversal next period). Use dry_run to preview."""
+    if user.get("role") not in ["admin", "manager"]:
+        raise HTTPException(status_code=403, detail="Manager or Admin required")
+    from app.services.fx_revaluation import get_fx_revaluation_service
+    from starlette.concurrency import run_in_threadpool
+    service = get_fx_revaluation_service()
+    try:
+        return await run_in_threadpool(
+            service.revalue, user.get("company_id"), period, gain_account_id, loss_account_id, dry_run, user.get("email")
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.post("/currency/revaluation/post-reversals")
+async def post_fx_reversals(user: dict = Depends(get_current_user)):
+    """Post revaluation reversals that have fallen due (run daily or at period open)."""
+    if user.get("role") not in ["admin", "manager"]:
+        raise HTTPException(status_code=403, detail="Manager or Admin required")
+    from app.services.fx_revaluation import get_fx_revaluation_service
+    service = get_fx_revaluation_service()
+    return service.post_due_reversals(user.get("company_id"))
+
+@router.get("/currency/history")
+async def get_exchange_rate_history(limit: int = 30):
+    """Recent USD/IQD rate history (newest first)."""
+    service = get_currency_service()
+    return service.get_rate_history(limit)
 
 # --- Quotations & Sales Orders ---
 
@@ -561,12 +1107,23 @@ async def create_quotation(data: dict):
     return {"status": "created", "id": quo_id}
 
 @router.post("/quotations/{quo_id}/convert")
-async def convert_quotation_to_order(quo_id: str):
-    """Convert quotation to sales order."""
+async def convert_quotation_to_order(quo_id: str, user: dict = Depends(get_current_user)):
+    """Convert quotation to sales order (reserves the stock of its lines)."""
     service = get_quotation_service()
-    so_id = service.convert_to_sales_order(quo_id)
+    try:
+        so_id = service.convert_to_sales_order(quo_id, user.get("company_id"))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return {"status": "converted", "sales_order_id": so_id}
 
+@router.post("/sales-orders/{so_id}/cancel")
+async def cancel_sales_order(so_id: str, user: dict = Depends(get_current_user)):
+    """Cancel a sales order and release its reserved stock."""
+    try:
+        return get_quotation_service().cancel_sales_order(so_id, user.get("company_id"))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @router.get("/sales-orders")
 async def list_sales_orders(status: str = None, limit: int = 50):
     """List all sales orders."""
@@ -589,7 +1146,7 @@ async def download_sales_invoice(so_id: str):
         data['id'] = so_id
         
         pdf_service = PDFService()
-        pdf_bytes = pdf_service.generate_invoice(data, type="SALES INVOICE")
+        pdf_bytes = await pdf_service.render(data, type="SALES INVOICE")
         
         from fastapi.responses import Response
         return Response(
@@ -614,7 +1171,7 @@ async def download_purchase_invoice(po_id: str):
         data['id'] = po_id
         
         pdf_service = PDFService()
-        pdf_bytes = pdf_service.generate_invoice(data, type="PURCHASE ORDER")
+        pdf_bytes = await pdf_service.render(data, type="PURCHASE ORDER")
         
         from fastapi.responses import Response
         return Response(
@@ -625,6 +1182,71 @@ async def download_purchase_invoice(po_id: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.post("/documents/pdf/batch")
+async def download_pdf_batch(payload: dict, user: dict = Depends(get_current_user)):
+    """
+    Render many invoices/orders/statements in parallel into one ZIP or merged PDF.
+    Body: {"mode": "zip"|"merged",
+           "documents": [{"collection": "invoices"|"sales_orders"|"purchase_orders", "id": "..."}],
+           "statements": {"customer_ids": [...], "from_date": "...", "to_date": "..."}}
+    """
+    from app.services.pdf import PDFService
+    from fastapi.responses import Response
+
+    titles = {"invoices": "SALES INVOICE", "sales_orders": "SALES INVOICE", "purchase_orders": "PURCHASE ORDER"}
+    mode = payload.get("mode", "zip")
+    documents = []
+
+    db = get_db()
+    requested = payload.get("documents") or []
+    refs = []
+    for item in requested:
+        if item.get("collection") not in titles:
+            raise HTTPException(status_code=400, detail=f"Unsupported collection: {item.get('collection')}")
+        refs.append(db.collection(item["collection"]).document(item["id"]))
+    snaps = {(s.reference.parent.id, s.id): s for s in (db.get_all(refs) if refs else [])}
+    for item in requested:
+        snap = snaps.get((item["collection"], item["id"]))
+        if not snap or not snap.exists:
+            raise HTTPException(status_code=404, detail=f"{item['collection']}/{item['id']} not found")
+        data = snap.to_dict()
+        if data.get("company_id") and data.get("company_id") != user.get("company_id"):
+            raise HTTPException(status_code=403, detail="Document belongs to another company")
+        data["id"] = snap.id
+        documents.append(("invoice", data, titles[item["collection"]]))
+
+    statements = payload.get("statements") or {}
+    if statements.get("customer_ids"):
+        reporting = ReportingService()
+        try:
+            from_date = datetime.fromisoformat(statements["from_date"])
+            to_date = datetime.fromisoformat(statements["to_date"])
+        except (KeyError, ValueError):
+            raise HTTPException(status_code=400, detail="statements.from_date and statements.to_date are required (ISO dates)")
+        for customer_id in statements["customer_ids"]:
+            try:
+                data = await reporting.get_customer_statement(user.get("company_id"), customer_id, from_date, to_date)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            data["id"] = f"statement_{customer_id}"
+            documents.append(("statement", data, "CUSTOMER STATEMENT"))
+
+    pdf_service = PDFService()
+    try:
+        content = await pdf_service.render_batch(documents, mode=mode)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if mode == "merged":
+        media_type, filename = "application/pdf", "documents.pdf"
+    else:
+        media_type, filename = "application/zip", "documents.zip"
+    return Response(
+        content=content,
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
 # --- Invoices (Sales) ---
 from app.services.invoices import get_invoice_service
 from app.schemas.invoices import InvoiceCreate
@@ -907,10 +1529,10 @@ async def list_purchase_orders(status: Optional[str] = None, limit: int = 50):
     return service.list_purchase_orders(status, limit)
 
 @router.post("/purchase-orders")
-async def create_purchase_order(data: dict):
+async def create_purchase_order(data: dict, user: dict = Depends(get_current_user)):
     """Create a new purchase order."""
     service = get_purchase_order_service()
-    po_id = service.create_purchase_order(data)
+    po_id = service.create_purchase_order({**data, "created_by": user.get("email")}, company_id=user.get("company_id"))
     return {"status": "created", "id": po_id}
 
 @router.post("/purchase-orders/{po_id}/approve")
@@ -924,30 +1546,67 @@ async def approve_purchase_order(po_id: str, user: dict = Depends(get_current_us
 # --- Fixed Assets ---
 
 @router.get("/assets")
-async def list_fixed_assets(status: Optional[str] = "ACTIVE"):
+async def list_fixed_assets(status: Optional[str] = "ACTIVE", user: dict = Depends(get_current_user)):
     """List all fixed assets."""
     service = get_fixed_asset_service()
-    return service.list_assets(status)
+    return service.list_assets(status, company_id=user.get("company_id"))
 
 @router.post("/assets")
-async def create_fixed_asset(data: dict):
+async def create_fixed_asset(data: dict, user: dict = Depends(get_current_user)):
     """Register a new fixed asset."""
     service = get_fixed_asset_service()
+    data["company_id"] = user.get("company_id")
     asset_id = service.create_asset(data)
     return {"status": "created", "id": asset_id}
 
 @router.get("/assets/summary")
-async def get_asset_summary():
+async def get_asset_summary(user: dict = Depends(get_current_user)):
     """Get depreciation summary for all assets."""
     service = get_fixed_asset_service()
-    return service.get_depreciation_summary()
+    return service.get_depreciation_summary(company_id=user.get("company_id"))
+
+@router.post("/assets/depreciation-run")
+async def run_depreciation(
+    period: str,
+    expense_account_id: Optional[str] = None,
+    accumulated_account_id: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    """Month-end depreciation for all active assets, posted to the GL (idempotent per period)."""
+    if user.get("role") not in ["admin", "manager"]:
+        raise HTTPException(status_code=403, detail="Manager or Admin required")
+    service = get_fixed_asset_service()
+    try:
+        period = service.normalize_period(period)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    from starlette.concurrency import run_in_threadpool
+    try:
+        return await run_in_threadpool(
+            service.run_depreciation,
+            user.get("company_id"), period, expense_account_id, accumulated_account_id, user.get("email")
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/assets/{asset_id}/schedule")
+async def get_depreciation_schedule(asset_id: str, user: dict = Depends(get_current_user)):
+    """Projected depreciation schedule for an asset."""
+    service = get_fixed_asset_service()
+    try:
+        return service.get_depreciation_schedule(asset_id, company_id=user.get("company_id"))
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
 
 @router.post("/assets/{asset_id}/depreciate")
 async def record_depreciation(asset_id: str, period: str = None):
     """Record monthly depreciation for an asset."""
     service = get_fixed_asset_service()
     amount = service.calculate_monthly_depreciation(asset_id)
-    entry_id = service.record_depreciation(asset_id, amount, period)
+    try:
+        entry_id = service.record_depreciation(asset_id, amount, period)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return {"status": "recorded", "amount": str(amount), "entry_id": entry_id}
 # --- Scheduling & Ecosystem ---
 
@@ -98,8 +98,18 @@ async def get_journal(journal_id: str, user: dict = Depends(get_current_user)):
     db = get_db()
     doc = db.collection("journal_entries").document(journal_id).get()
     if not doc.exists:
-        raise HTTPException(status_code=404, detail="Journal entry not found")
-    return {"id": doc.id, **doc.to_dict()}
+        # Closed months may have been moved to the period archive
+        from app.services.archive import get_archive_service
+        archived = get_archive_service().get_archived_journal(user.get("company_id"), journal_id)
+        if not archived:
+            raise HTTPException(status_code=404, detail="Journal entry not found")
+        data = archived
+    else:
+        data = {"id": doc.id, **doc.to_dict()}
+    if data.get("lines_chunked"):
+        from app.services.journal_lines import get_journal_line_store
+        data["lines"] = get_journal_line_store().lines_of(journal_id, data)
+    return data
 
 @router.get("/suppliers")
 async def list_suppliers(
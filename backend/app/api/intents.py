@@ -4,7 +4,7 @@ from google.cloud import firestore
 from app.core.firebase import get_db
 from app.core.auth import get_current_user
 from app.schemas.erp import (
-    IntentCreate, Intent, IntentStatus
+    IntentCreate, Intent, IntentStatus, IntentType
 )
 from datetime import datetime
 
@@ -63,6 +63,17 @@ async def create_intent(data: IntentCreate, user: dict = Depends(get_current_use
     })
     
     doc_ref = db.collection("intents").document()
+
+    # Reserve the items before the intent exists: GIVE holds stock, GET is expected stock
+    from app.services.reservations import get_reservation_service
+    lines = [{**item, "warehouse_id": item.get("warehouse_id") or data.warehouse_id} for item in intent_data["items"]]
+    try:
+        get_reservation_service().place(
+            company_id, "INTENT", doc_ref.id, lines, "OUT" if data.type == IntentType.GIVE else "IN"
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
     doc_ref.set(intent_data)
     
     return {"id": doc_ref.id, **intent_data}
@@ -83,4 +94,8 @@ async def update_intent_status(
         raise HTTPException(status_code=404, detail="Intent not found")
         
     doc_ref.update({"status": status})
+    if status in (IntentStatus.REJECTED, IntentStatus.DONE):
+        # Rejected: the promise is void; done: any stock not consumed by a delivery note is freed
+        from app.services.reservations import get_reservation_service
+        get_reservation_service().release(company_id, "INTENT", intent_id)
     return {"status": "success"}
@@ -5,7 +5,8 @@ from app.core.firebase import get_db
 from app.core.auth import get_current_user
 from app.schemas.erp import (
     TransferCreate, AdjustmentCreate, AdjustmentStatus,
-    GRNCreate, DeliveryNoteCreate
+    GRNCreate, DeliveryNoteCreate,
+    CycleCountCreate, CycleCountScanBatch
 )
 from datetime import datetime
 
@@ -52,9 +53,40 @@ async def create_outbound(data: DeliveryNoteCreate, user: dict = Depends(get_cur
     from app.services.inventory import InventoryService
     inventory_service = InventoryService()
     
-    result_id = inventory_service.create_delivery_note(data)
+    try:
+        result_id = inventory_service.create_delivery_note(data)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return {"status": "success", "id": result_id}
 
+@router.post("/outbound/drafts")
+async def save_outbound_draft(data: DeliveryNoteCreate, draft_id: Optional[str] = None, user: dict = Depends(get_current_user)):
+    """Save a draft Delivery Note and reserve its stock (pass draft_id to edit an existing draft)."""
+    from app.services.inventory import InventoryService
+    try:
+        return InventoryService().save_delivery_note_draft(data, user.get("company_id"), draft_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.post("/outbound/drafts/{draft_id}/post")
+async def post_outbound_draft(draft_id: str, user: dict = Depends(get_current_user)):
+    """Post a draft Delivery Note; its reservation is consumed."""
+    from app.services.inventory import InventoryService
+    try:
+        je_id = InventoryService().post_delivery_note_draft(draft_id, user.get("company_id"))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"status": "success", "id": je_id}
+
+@router.post("/outbound/drafts/{draft_id}/cancel")
+async def cancel_outbound_draft(draft_id: str, user: dict = Depends(get_current_user)):
+    """Cancel a draft Delivery Note and release its reservation."""
+    from app.services.inventory import InventoryService
+    try:
+        return InventoryService().cancel_delivery_note_draft(draft_id, user.get("company_id"))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @router.get("/inbound")
 async def get_inbound(
     warehouse_id: Optional[str] = None,
@@ -182,29 +214,95 @@ async def create_adjustment(data: AdjustmentCreate, user: dict = Depends(get_cur
     doc_ref.set(adj_data)
     return {"id": doc_ref.id, **adj_data}
 
+# ===================== CYCLE COUNTS =====================
+@router.post("/cycle-counts")
+async def start_cycle_count(data: CycleCountCreate, user: dict = Depends(get_current_user)):
+    """Open a cycle count and freeze the expected quantities of the warehouse (or of item_ids)."""
+    from app.services.cycle_counts import get_cycle_count_service
+    from starlette.concurrency import run_in_threadpool
+    try:
+        return await run_in_threadpool(
+            get_cycle_count_service().start,
+            user.get("company_id"), data.warehouse_id, data.item_ids, user.get("uid"), data.notes
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/cycle-counts")
+async def list_cycle_counts(limit: int = 50, user: dict = Depends(get_current_user)):
+    from app.services.cycle_counts import get_cycle_count_service
+    return get_cycle_count_service().list_sessions(user.get("company_id"), limit)
+
+@router.get("/cycle-counts/{session_id}")
+async def get_cycle_count(session_id: str, user: dict = Depends(get_current_user)):
+    from app.services.cycle_counts import get_cycle_count_service
+    try:
+        return get_cycle_count_service().get_session(user.get("company_id"), session_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@router.post("/cycle-counts/{session_id}/scans")
+async def record_cycle_count_scans(session_id: str, data: CycleCountScanBatch, user: dict = Depends(get_current_user)):
+    """Submit a batch of scans (by item_id, barcode or SKU); repeated scans of an item are summed."""
+    from app.services.cycle_counts import get_cycle_count_service
+    try:
+        return get_cycle_count_service().record_scans(
+            user.get("company_id"), session_id, [s.model_dump() for s in data.scans], data.mode
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/cycle-counts/{session_id}/variances")
+async def get_cycle_count_variances(session_id: str, include_uncounted: bool = False, user: dict = Depends(get_current_user)):
+    """Counted vs book quantity per line, with movements during the count replayed from the ledger."""
+    from app.services.cycle_counts import get_cycle_count_service
+    from starlette.concurrency import run_in_threadpool
+    try:
+        return await run_in_threadpool(
+            get_cycle_count_service().compute_variances, user.get("company_id"), session_id, include_uncounted
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.post("/cycle-counts/{session_id}/post")
+async def post_cycle_count(session_id: str, include_uncounted: bool = False, user: dict = Depends(get_current_user)):
+    """Post the variances as stock adjustments with one inventory-variance journal entry (Admin/Manager)."""
+    if user.get("role") not in ["admin", "manager"]:
+        raise HTTPException(status_code=403, detail="Manager or Admin required")
+    from app.services.cycle_counts import get_cycle_count_service
+    from starlette.concurrency import run_in_threadpool
+    try:
+        return await run_in_threadpool(
+            get_cycle_count_service().post, user.get("company_id"), session_id, user.get("uid"), include_uncounted
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.post("/cycle-counts/{session_id}/cancel")
+async def cancel_cycle_count(session_id: str, user: dict = Depends(get_current_user)):
+    from app.services.cycle_counts import get_cycle_count_service
+    try:
+        return get_cycle_count_service().cancel(user.get("company_id"), session_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @router.get("/stock")
 async def get_item_stock(
     item_id: str,
     warehouse_id: Optional[str] = None,
     user: dict = Depends(get_current_user)
 ):
-    """Calculate current stock balance for an item."""
+    """Current stock balance for an item (maintained balances, no ledger scan)."""
     db = get_db()
     company_id = user.get("company_id")
-    
-    query = db.collection("stock_ledger")\
-        .where("company_id", "==", company_id)\
-        .where("item_id", "==", item_id)
-    
+
     if warehouse_id:
-        query = query.where("warehouse_id", "==", warehouse_id)
-        
-    docs = query.stream()
-    total_qty = 0.0
-    for doc in docs:
-        try:
-            total_qty += float(doc.to_dict().get("quantity", 0))
-        except:
-            continue
-            
+        from app.services.stock_balances import get_stock_balance_service
+        stock = get_stock_balance_service().get_for_items(company_id, [item_id], warehouse_id).get(item_id, [])
+        total_qty = float(stock[0]["on_hand"]) if stock else 0.0
+    else:
+        snap = db.collection("items").document(item_id).get()
+        data = snap.to_dict() if snap.exists else {}
+        total_qty = float(data.get("current_qty", 0) or 0) if data.get("company_id") == company_id else 0.0
+
     return {"item_id": item_id, "warehouse_id": warehouse_id, "balance": total_qty}
@@ -45,8 +45,46 @@ async def create_product(data: ItemCreate, user: dict = Depends(get_current_user
     })
     doc_ref = db.collection("items").document()
     doc_ref.set(item_data)
+    from app.services.item_index import get_item_index
+    get_item_index().upsert(company_id, doc_ref.id, item_data)
     return {"id": doc_ref.id, **item_data}
 
+@router.get("/products/search")
+async def search_products(q: str, limit: int = 20, user: dict = Depends(get_current_user)):
+    """Prefix search on item names and SKUs (in-memory index)."""
+    from app.services.item_index import get_item_index
+    from starlette.concurrency import run_in_threadpool
+    return await run_in_threadpool(get_item_index().search, user.get("company_id"), q, min(limit, 100))
+
+@router.post("/resolve")
+async def resolve_scanned_codes(data: dict, user: dict = Depends(get_current_user)):
+    """
+    Map scanned barcodes / SKUs to items with their per-warehouse stock in one call.
+    Body: {"codes": ["..."], "warehouse_id": "<optional, limit stock to one warehouse>"} (max 500 codes).
+    """
+    from app.services.item_index import get_item_index
+    from app.services.stock_balances import get_stock_balance_service
+    from starlette.concurrency import run_in_threadpool
+    codes = data.get("codes") or []
+    if len(codes) > 500:
+        raise HTTPException(status_code=400, detail="At most 500 codes per request")
+    company_id = user.get("company_id")
+    index = get_item_index()
+    # First use of a company loads its catalog: keep it off the event loop
+    found = await run_in_threadpool(index.resolve, company_id, codes)
+    item_ids = [item["id"] for item in found.values() if item]
+    stock = await run_in_threadpool(
+        get_stock_balance_service().get_for_items, company_id, item_ids, data.get("warehouse_id")
+    ) if item_ids else {}
+    return {
+        "version": index.version(company_id),
+        "results": [
+            {"code": code, "item": item, "stock": stock.get(item["id"], []) if item else []}
+            for code, item in found.items()
+        ],
+        "unknown": [code for code, item in found.items() if not item]
+    }
+
 # ===================== WAREHOUSES =====================
 @router.get("/warehouses", response_model=List[Warehouse])
 async def list_warehouses(user: dict = Depends(get_current_user)):
@@ -82,3 +120,58 @@ async def create_uom(data: UOMCreate, user: dict = Depends(get_current_user)):
     doc_ref = db.collection("uoms").document()
     doc_ref.set(uom_data)
     return {"id": doc_ref.id, **uom_data}
+
+# ===================== STOCK LEVELS & LOW-STOCK ALERTS =====================
+@router.put("/stock-levels")
+async def set_stock_levels(data: dict, user: dict = Depends(get_current_user)):
+    """Set min/max for an item in a warehouse. Body: {item_id, warehouse_id, min_qty, max_qty} (null clears a level)."""
+    from app.services.stock_balances import get_stock_balance_service
+    if not data.get("item_id") or not data.get("warehouse_id"):
+        raise HTTPException(status_code=400, detail="item_id and warehouse_id are required")
+    try:
+        return get_stock_balance_service().set_levels(
+            user.get("company_id"), data["item_id"], data["warehouse_id"], data.get("min_qty"), data.get("max_qty")
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/low-stock")
+async def list_low_stock(warehouse_id: Optional[str] = None, limit: int = 500, user: dict = Depends(get_current_user)):
+    """Item/warehouse balances currently below their minimum."""
+    from app.services.stock_balances import get_stock_balance_service
+    return get_stock_balance_service().get_low_stock(user.get("company_id"), warehouse_id, limit)
+
+@router.get("/stock-alerts")
+async def list_stock_alerts(open_only: bool = False, limit: int = 50, user: dict = Depends(get_current_user)):
+    """Low-stock notification feed (raised and cleared alerts, newest first)."""
+    from app.services.stock_balances import get_stock_balance_service
+    return get_stock_balance_service().get_alerts(user.get("company_id"), open_only, limit)
+
+@router.post("/atp")
+async def bulk_atp(data: dict, user: dict = Depends(get_current_user)):
+    """
+    Available-to-promise for many item/warehouse pairs in one call.
+    Body: {"items": [{"item_id": "...", "warehouse_id": "..."}], "warehouse_id": "<default>"} (max 500 lines).
+    """
+    from app.services.stock_balances import get_stock_balance_service
+    lines = data.get("items") or []
+    if len(lines) > 500:
+        raise HTTPException(status_code=400, detail="At most 500 lines per request")
+    pairs = []
+    for line in lines:
+        wh = line.get("warehouse_id") or data.get("warehouse_id")
+        if not line.get("item_id") or not wh:
+            raise HTTPException(status_code=400, detail="Each line needs item_id and a warehouse_id")
+        pairs.append((line["item_id"], wh))
+    if not pairs:
+        return []
+    return get_stock_balance_service().get_atp(user.get("company_id"), pairs)
+
+@router.post("/stock-balances/rebuild")
+async def rebuild_stock_balances(user: dict = Depends(get_current_user)):
+    """Reset per-warehouse balances from the stock ledger and re-evaluate alerts (Admin only)."""
+    if user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Admin only")
+    from app.services.stock_balances import get_stock_balance_service
+    from starlette.concurrency import run_in_threadpool
+    return await run_in_threadpool(get_stock_balance_service().rebuild, user.get("company_id"))
@@ -13,4 +13,11 @@ class Settings(BaseSettings):
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
     ENVIRONMENT: str = "development"
 
+    # PDF rendering
+    PDF_WORKERS: int = 2
+    PDF_CACHE_DIR: str = ""
+    PDF_CACHE_MAX_ITEMS: int = 256
+    PDF_CACHE_MAX_DISK_MB: int = 512
+    PDF_FONT_PATH: str = ""
+
 settings = Settings()
@@ -63,6 +63,25 @@ def get_db():
     return _db
 
 
+def stream_paged(query, page_size: int = 500):
+    """
+    Yield documents of a query page by page using cursors.
+    Keeps memory bounded to one page and avoids the server-side timeout
+    of a single long-running stream on very large collections.
+    """
+    cursor = None
+    while True:
+        page_query = query.limit(page_size)
+        if cursor is not None:
+            page_query = page_query.start_after(cursor)
+        docs = list(page_query.stream())
+        for doc in docs:
+            yield doc
+        if len(docs) < page_size:
+            break
+        cursor = docs[-1]
+
+
 # Preload on import to avoid first-request latency
 try:
     init_firebase()
@@ -2,6 +2,7 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.api import router as api_router
 from app.core.firebase import init_firebase
+from app.services.pdf import shutdown_pdf_pool
 
 app = FastAPI(title="Iraqi ERP API (Firebase)", version="1.0.0", redirect_slashes=False)
 
@@ -18,6 +19,10 @@ app.add_middleware(
 async def startup_event():
     init_firebase()
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    shutdown_pdf_pool()
+
 @app.get("/")
 async def root():
     return {"message": "Welcome to Iraqi ERP API (Firebase)"}
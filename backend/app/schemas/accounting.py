@@ -45,6 +45,7 @@ class AccountBase(BaseModel):
     company_id: str
     active: bool = True
     subledger_type: Optional[str] = None
+    is_retained_earnings: bool = False  # Target of the year-end close
 
 class AccountCreate(AccountBase):
     pass
@@ -62,7 +63,12 @@ class JournalLineBase(BaseModel):
     debit: str = "0.0000"
     credit: str = "0.0000"
     memo: Optional[str] = None
+    # Optional dimensions (feed the ledger cube used by management reports)
     cost_center_id: Optional[str] = None
+    warehouse_id: Optional[str] = None
+    customer_id: Optional[str] = None
+    supplier_id: Optional[str] = None
+    project_id: Optional[str] = None
 
 class JournalEntryCreate(BaseModel):
     number: str
@@ -80,6 +86,29 @@ class JournalEntryCreate(BaseModel):
             raise ValueError(f"Journal does not balance. Total Debit: {total_debit}, Total Credit: {total_credit}")
         return self
 
+# --- Budgets ---
+
+class BudgetLine(BaseModel):
+    account_id: str
+    month: str  # YYYY-MM
+    amount: str
+    cost_center_id: Optional[str] = None
+    warehouse_id: Optional[str] = None
+    customer_id: Optional[str] = None
+    supplier_id: Optional[str] = None
+    project_id: Optional[str] = None
+
+    @field_validator("month")
+    @classmethod
+    def validate_month(cls, value: str) -> str:
+        datetime.strptime(value[:7], "%Y-%m")
+        return value[:7]
+
+class BudgetCreate(BaseModel):
+    name: str
+    fiscal_year: Optional[int] = None
+    lines: List[BudgetLine]
+
 # --- Vouchers ---
 
 class PaymentRequestCreate(BaseModel):
@@ -21,6 +21,11 @@ class StorageType(str, Enum):
     FROZEN = "FROZEN"
     OTHER = "OTHER"
 
+class CostingMethod(str, Enum):
+    WAC = "WAC"
+    FIFO = "FIFO"
+    FEFO = "FEFO"
+
 class IntentStatus(str, Enum):
     REQUESTED = "requested"
     GUARANTEED = "guaranteed"
@@ -59,6 +64,11 @@ class ItemBase(BaseModel):
     cogs_account_id: str
     revenue_account_id: str
     customer_id: Optional[str] = None
+    costing_method: CostingMethod = CostingMethod.WAC
+    # Replenishment (reorder suggestions)
+    lead_time_days: Optional[int] = None
+    order_multiple: Optional[str] = None
+    supplier_account_id: Optional[str] = None
 
 class ItemCreate(ItemBase):
     pass
@@ -124,6 +134,7 @@ class GRNLine(BaseModel):
     quantity: str
     unit_cost: str
     batch_number: Optional[str] = None
+    expiry_date: Optional[datetime] = None
 
 class GRNCreate(BaseModel):
     number: str
@@ -144,6 +155,9 @@ class DeliveryNoteCreate(BaseModel):
     date: Optional[datetime] = None
     lines: List[DeliveryNoteLine]
     customer_account_id: str
+    # Documents whose stock reservation the note consumes
+    sales_order_id: Optional[str] = None
+    intent_id: Optional[str] = None
 
 # --- Transfer & Adjustment Schemas ---
 class TransferLine(BaseModel):
@@ -174,11 +188,27 @@ class AdjustmentCreate(BaseModel):
     notes: Optional[str] = None
     status: AdjustmentStatus = AdjustmentStatus.DRAFT
 
+# --- Cycle Count Schemas ---
+class CycleCountCreate(BaseModel):
+    warehouse_id: str
+    item_ids: Optional[List[str]] = None  # None counts every item held in the warehouse
+    notes: Optional[str] = None
+
+class CycleCountScan(BaseModel):
+    item_id: Optional[str] = None
+    code: Optional[str] = None  # barcode or SKU
+    quantity: str = "1"
+
+class CycleCountScanBatch(BaseModel):
+    scans: List[CycleCountScan]
+    mode: str = "add"  # add (scanner stream) | set (recount)
+
 # --- Intent Schemas ---
 class IntentItem(BaseModel):
     item_id: str
     quantity: str
     note: Optional[str] = None
+    warehouse_id: Optional[str] = None
 
 class IntentBase(BaseModel):
     number: str
@@ -191,6 +221,8 @@ class IntentBase(BaseModel):
     delivery_guy: Optional[str] = None
     car_number: Optional[str] = None
     notes: Optional[str] = None
+    # Default warehouse of the items (stock reservation)
+    warehouse_id: Optional[str] = None
 
 class IntentCreate(IntentBase):
     items: List[IntentItem]
@@ -17,6 +17,8 @@ class ExpenseCreate(BaseModel):
     reference: Optional[str] = None
     vendor: Optional[str] = None
     notes: Optional[str] = None
+    cost_center_id: Optional[str] = None
+    project_id: Optional[str] = None
     # No tax/lines for simple expenses yet, can add later
 
 class Expense(ExpenseCreate):
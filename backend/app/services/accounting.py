@@ -3,6 +3,7 @@ from app.core.firebase import get_db
 from app.models.core import DocumentStatus
 from app.schemas.accounting import JournalEntryCreate, AccountCreate
 from .posting import PostingEngine
+from .ledger_cube import DIMENSIONS
 from google.cloud import firestore
 from decimal import Decimal
 
@@ -82,7 +83,8 @@ class AccountingService:
                     "account_id": line.account_id,
                     "debit": str(line.debit),
                     "credit": str(line.credit),
-                    "memo": line.memo or ""
+                    "memo": line.memo or "",
+                    **{d: getattr(line, d) for d in DIMENSIONS if getattr(line, d)}
                 })
 
             # Pre-fetch accounts for atomic balance updates
@@ -94,14 +96,17 @@ class AccountingService:
                 "date": data.date,
                 "description": data.description,
                 "status": "POSTED", 
-                "lines": lines_data,
+                "lines": posting_engine.journal_lines.inline(lines_data),
                 "flat_account_ids": account_ids,
                 "company_id": data.company_id,
                 "attachments": data.attachments
             })
 
             # Pass pre-fetched data to posting engine
-            posting_engine.post_journal_entry(transaction, je_ref.id, lines_data, accounts_data)
+            posting_engine.post_journal_entry(
+                transaction, je_ref.id, lines_data, accounts_data,
+                entry_date=data.date, company_id=data.company_id, source_type="MANUAL"
+            )
             return je_ref.id
 
         return _execute(transaction, self.db, self.posting_engine, data)
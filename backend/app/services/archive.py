@@ -0,0 +1,402 @@
+"""
+Period Archive Service
+Moves the stock ledger rows and journal entries of a closed fiscal month out of
+the hot collections into compressed archive chunks:
+
+    period_archives/{company}_{YYYY-MM}               status, counts, account_totals
+    period_archives/{id}/archive_chunks/{kind}_{n}    zlib-compressed JSON rows plus
+                                                      ids / account_ids / item_ids
+
+Only closed periods are archived; their data can no longer change. The summaries
+left behind keep balances and reports correct without the detail:
+
+- account balances live on the accounts (reports back-calculate openings from
+  them and only read journals dated after the opening date)
+- the stock valuation snapshot at the month end (taken when the period closed,
+  re-taken here if missing) anchors as-of valuations
+- daily and stock rollups are summaries already
+- account_totals on the archive record the month's debit/credit per account
+
+Readers that need the detail read through with `read_through`, which chains
+archived rows (snapshot-like objects) before the hot query. Hot rows whose ids
+are in the archive are skipped, so a reader never counts a row twice while an
+archive is purged or restored. Rows posted into an archived month later
+(year-end close entries and their reversals) stay hot until the month is
+archived again.
+
+    BUILDING -> ARCHIVED (hot rows deleted) -> restored on reopen (record deleted)
+
+Rows without a posting date (legacy stock rows) and DRAFT journals stay hot.
+Chunked journal entries are archived as their header; their line_chunks
+subcollection is left in place (the archived header still points at it).
+"""
+import json
+import zlib
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+from google.cloud import firestore
+from app.core.firebase import get_db, stream_paged
+from .periods import get_period_registry
+from .journal_lines import get_journal_line_store
+
+# Archived hot collection -> its date field
+KINDS = {
+    "stock_ledger": "posting_date",
+    "journal_entries": "date",
+}
+ARCHIVED_JOURNAL_STATUSES = ("POSTED", "VOIDED")
+ZERO = Decimal("0")
+
+
+def period_bounds(period: str) -> Tuple[datetime, datetime]:
+    """'YYYY-MM' -> [first instant, first instant of the next month)."""
+    year, month = int(period[:4]), int(period[5:7])
+    start = datetime(year, month, 1, tzinfo=timezone.utc)
+    end = datetime(year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+    return start, end
+
+
+def _aware(value: Optional[datetime]) -> Optional[datetime]:
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def _period_of(value) -> Optional[str]:
+    if not isinstance(value, datetime):
+        return None
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    return f"{value.year}-{value.month:02d}"
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {"__dt__": value.isoformat()}
+    return str(value)
+
+
+def _decode(obj: Dict[str, Any]):
+    if len(obj) == 1 and "__dt__" in obj:
+        return datetime.fromisoformat(obj["__dt__"])
+    return obj
+
+
+def pack(rows: List[Dict[str, Any]]) -> bytes:
+    return zlib.compress(json.dumps(rows, default=_encode, separators=(",", ":")).encode("utf-8"), 6)
+
+
+def unpack(blob: bytes) -> List[Dict[str, Any]]:
+    return json.loads(zlib.decompress(blob).decode("utf-8"), object_hook=_decode)
+
+
+class ArchivedSnapshot:
+    """Read-only stand-in for a DocumentSnapshot of an archived row."""
+    __slots__ = ("id", "_data")
+    exists = True
+    reference = None
+
+    def __init__(self, doc_id: str, data: Dict[str, Any]):
+        self.id = doc_id
+        self._data = data
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(self._data)
+
+
+class ArchiveService:
+    COLLECTION = "period_archives"
+    CHUNKS = "archive_chunks"
+    CHUNK_ROWS = 1000
+    # Firestore documents are capped at 1 MiB
+    MAX_BLOB_BYTES = 900_000
+    BATCH_WRITES = 400
+
+    def __init__(self):
+        self.db = get_db()
+
+    @staticmethod
+    def archive_id(company_id: str, period: str) -> str:
+        return f"{company_id}_{period}"
+
+    def _archive_ref(self, company_id: str, period: str):
+        return self.db.collection(self.COLLECTION).document(self.archive_id(company_id, period))
+
+    # ==========================================================================
+    # READ-THROUGH
+    # ==========================================================================
+    def archived_periods(self, company_id: str) -> List[str]:
+        query = self.db.collection(self.COLLECTION)\
+            .where("company_id", "==", company_id)\
+            .where("status", "==", "ARCHIVED")
+        return sorted(snap.to_dict()["period"] for snap in query.stream())
+
+    def iter_archived(
+        self,
+        company_id: str,
+        kind: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        periods: Optional[List[str]] = None,
+        account_id: Optional[str] = None,
+        item_id: Optional[str] = None
+    ) -> Iterator[ArchivedSnapshot]:
+        """Archived rows of `kind` dated in [start, end], oldest period first."""
+        field = KINDS[kind]
+        start, end = _aware(start), _aware(end)
+        if periods is None:
+            periods = self.archived_periods(company_id)
+        for period in periods:
+            lo, hi = period_bounds(period)
+            if (start and hi <= start) or (end and lo > end):
+                continue
+            chunks = self._archive_ref(company_id, period).collection(self.CHUNKS)\
+                .where("kind", "==", kind).order_by("seq")
+            for chunk in chunks.stream():
+                meta = chunk.to_dict()
+                if account_id and account_id not in meta.get("account_ids", []):
+                    continue
+                if item_id and item_id not in meta.get("item_ids", []):
+                    continue
+                for row in unpack(meta["data"]):
+                    when = row.get(field)
+                    if (start and when < start) or (end and when > end):
+                        continue
+                    doc_id = row.pop("id")
+                    yield ArchivedSnapshot(doc_id, row)
+
+    def read_through(self, company_id: str, kind: str, hot: Iterable, start: Optional[datetime] = None,
+                     end: Optional[datetime] = None, **filters) -> Iterator:
+        """
+        Archived rows in range, then the hot snapshots minus the ones that are also
+        in the archive (a purge or restore in progress). Hot rows posted into an
+        archived month afterwards (year-end close, its reversals) are kept.
+        Archived months are closed and older than open ones, so date order is
+        kept for readers that stream the hot query by date.
+        """
+        periods = self.archived_periods(company_id)
+        if not periods:
+            yield from hot
+            return
+        yield from self.iter_archived(company_id, kind, start, end, periods, **filters)
+        archived = set(periods)
+        field = KINDS[kind]
+        archived_ids: Dict[str, set] = {}
+        for snap in hot:
+            period = _period_of((snap.to_dict() or {}).get(field))
+            if period in archived:
+                if period not in archived_ids:
+                    archived_ids[period] = self.archived_ids(company_id, kind, period)
+                if snap.id in archived_ids[period]:
+                    continue
+            yield snap
+
+    def archived_ids(self, company_id: str, kind: str, period: str) -> set:
+        """Ids of the rows of `kind` in a month's archive (read from the chunk metadata only)."""
+        chunks = self._archive_ref(company_id, period).collection(self.CHUNKS)\
+            .where("kind", "==", kind).select(["ids"])
+        return {doc_id for chunk in chunks.stream() for doc_id in chunk.to_dict().get("ids", [])}
+
+    def get_archived_journal(self, company_id: str, journal_id: str) -> Optional[Dict[str, Any]]:
+        """Drill-down to one archived journal entry by id."""
+        query = self.db.collection_group(self.CHUNKS)\
+            .where("company_id", "==", company_id)\
+            .where("ids", "array_contains", journal_id)\
+            .limit(1)
+        for chunk in query.stream():
+            meta = chunk.to_dict()
+            if meta.get("kind") != "journal_entries":
+                continue
+            for row in unpack(meta["data"]):
+                if row.get("id") == journal_id:
+                    return {**row, "archived": True, "archive_period": meta.get("period")}
+        return None
+
+    # ==========================================================================
+    # ARCHIVE
+    # ==========================================================================
+    def _hot_query(self, company_id: str, kind: str, period: str):
+        start, end = period_bounds(period)
+        field = KINDS[kind]
+        return self.db.collection(kind)\
+            .where("company_id", "==", company_id)\
+            .where(field, ">=", start)\
+            .where(field, "<", end)
+
+    def _write_chunks(self, archive_ref, company_id: str, period: str, kind: str, rows: List[Dict[str, Any]], seq: int) -> int:
+        """Write rows as one chunk, halving it until the compressed blob fits in a document."""
+        blob = pack(rows)
+        if len(blob) > self.MAX_BLOB_BYTES and len(rows) > 1:
+            middle = len(rows) // 2
+            seq = self._write_chunks(archive_ref, company_id, period, kind, rows[:middle], seq)
+            return self._write_chunks(archive_ref, company_id, period, kind, rows[middle:], seq)
+        payload = {
+            "company_id": company_id,
+            "period": period,
+            "kind": kind,
+            "seq": seq,
+            "count": len(rows),
+            "ids": [r["id"] for r in rows],
+            "data": blob
+        }
+        if kind == "journal_entries":
+            payload["account_ids"] = sorted({
+                a for r in rows for a in (r.get("flat_account_ids") or [l.get("account_id") for l in r.get("lines", [])]) if a
+            })
+        else:
+            payload["item_ids"] = sorted({r.get("item_id") for r in rows if r.get("item_id")})
+        archive_ref.collection(self.CHUNKS).document(f"{kind}_{seq:05d}").set(payload)
+        return seq + 1
+
+    def _ensure_stock_snapshot(self, company_id: str, period: str):
+        from .valuation import get_valuation_service
+        valuation = get_valuation_service()
+        _, end = period_bounds(period)
+        last_day = (end - timedelta(days=1)).date()
+        snap = self.db.collection(valuation.SNAPSHOTS_COLLECTION).document(valuation.snapshot_id(company_id, last_day)).get()
+        if not snap.exists or snap.to_dict().get("status") != "READY":
+            valuation.take_snapshot(company_id, last_day)
+
+    def archive_period(self, company_id: str, period: str) -> Dict[str, Any]:
+        """
+        Archive one closed month and delete its hot rows. Re-running finishes an
+        interrupted run (a BUILDING archive is rebuilt, an ARCHIVED one re-purged).
+        """
+        year, month = int(period[:4]), int(period[5:7])
+        period = f"{year}-{month:02d}"
+        if not get_period_registry().is_closed(company_id, date(year, month, 1)):
+            raise ValueError(f"Fiscal period {period} is not closed")
+
+        archive_ref = self._archive_ref(company_id, period)
+        existing = archive_ref.get()
+        state = existing.to_dict() if existing.exists else {}
+        if state.get("status") != "ARCHIVED":
+            self._ensure_stock_snapshot(company_id, period)
+            state = self._build(archive_ref, company_id, period)
+        purged = self._purge(archive_ref, company_id, period)
+        archive_ref.update({"purged_at": firestore.SERVER_TIMESTAMP, "hot_rows_deleted": firestore.Increment(purged)})
+        return {"period": period, "status": "ARCHIVED", "counts": state.get("counts"), "hot_rows_deleted": purged}
+
+    def _build(self, archive_ref, company_id: str, period: str) -> Dict[str, Any]:
+        # A previous attempt may have left chunks behind
+        for old in archive_ref.collection(self.CHUNKS).stream():
+            old.reference.delete()
+        archive_ref.set({"company_id": company_id, "period": period, "status": "BUILDING",
+                         "started_at": firestore.SERVER_TIMESTAMP})
+
+        counts: Dict[str, int] = {}
+        chunks: Dict[str, int] = {}
+        account_totals: Dict[str, List[Decimal]] = {}
+        stock_totals = {"in_qty": ZERO, "out_qty": ZERO, "in_value": ZERO, "out_value": ZERO}
+        for kind in KINDS:
+            seq, rows, count = 0, [], 0
+            for snap in stream_paged(self._hot_query(company_id, kind, period), page_size=1000):
+                data = snap.to_dict()
+                if kind == "journal_entries":
+                    if data.get("status") not in ARCHIVED_JOURNAL_STATUSES:
+                        continue
+                    for acc_id, total in get_journal_line_store().account_totals(snap.id, data).items():
+                        bucket = account_totals.setdefault(acc_id, [ZERO, ZERO])
+                        bucket[0] += total["debit"]
+                        bucket[1] += total["credit"]
+                else:
+                    qty = Decimal(str(data.get("quantity", "0") or "0"))
+                    rate = Decimal(str((data.get("unit_cost") if qty > 0 else data.get("valuation_rate")) or "0"))
+                    side = "in" if qty > 0 else "out"
+                    stock_totals[f"{side}_qty"] += abs(qty)
+                    stock_totals[f"{side}_value"] += abs(qty * rate)
+                rows.append({"id": snap.id, **data})
+                count += 1
+                if len(rows) >= self.CHUNK_ROWS:
+                    seq = self._write_chunks(archive_ref, company_id, period, kind, rows, seq)
+                    rows = []
+            if rows:
+                seq = self._write_chunks(archive_ref, company_id, period, kind, rows, seq)
+            counts[kind] = count
+            chunks[kind] = seq
+
+        state = {
+            "company_id": company_id,
+            "period": period,
+            "status": "ARCHIVED",
+            "counts": counts,
+            "chunks": chunks,
+            "account_totals": {
+                acc_id: {"debit": str(d), "credit": str(c)} for acc_id, (d, c) in account_totals.items() if acc_id
+            },
+            "stock_totals": {k: str(v) for k, v in stock_totals.items()},
+            "archived_at": firestore.SERVER_TIMESTAMP
+        }
+        archive_ref.set(state)
+        return state
+
+    def _purge(self, archive_ref, company_id: str, period: str) -> int:
+        """Delete the hot rows that are in the archive (ids are read back from the chunks)."""
+        deleted = 0
+        batch, pending = self.db.batch(), 0
+        for chunk in archive_ref.collection(self.CHUNKS).stream():
+            meta = chunk.to_dict()
+            for doc_id in meta.get("ids", []):
+                batch.delete(self.db.collection(meta["kind"]).document(doc_id))
+                pending += 1
+                deleted += 1
+                if pending >= self.BATCH_WRITES:
+                    batch.commit()
+                    batch, pending = self.db.batch(), 0
+        if pending:
+            batch.commit()
+        return deleted
+
+    def archive_closed_periods(self, company_id: str, keep_months: int = 3, today: Optional[date] = None) -> Dict[str, Any]:
+        """Archive every closed month older than the last `keep_months` months (the hot window)."""
+        if keep_months < 0:
+            raise ValueError("keep_months cannot be negative")
+        today = today or datetime.now(timezone.utc).date()
+        index = today.year * 12 + today.month - 1 - keep_months
+        cutoff = f"{index // 12}-{index % 12 + 1:02d}"
+        done = set(self.archived_periods(company_id))
+        closed = sorted(p for p in get_period_registry().closed_periods(company_id) if p < cutoff and p not in done)
+        results = [self.archive_period(company_id, period) for period in closed]
+        return {"company_id": company_id, "hot_from": cutoff, "archived": results}
+
+    # ==========================================================================
+    # RESTORE
+    # ==========================================================================
+    def restore_period(self, company_id: str, period: str) -> Dict[str, Any]:
+        """Put an archived month back into the hot collections (before reopening it)."""
+        archive_ref = self._archive_ref(company_id, period)
+        snap = archive_ref.get()
+        if not snap.exists:
+            return {"period": period, "restored": 0}
+
+        restored = 0
+        batch, pending = self.db.batch(), 0
+        chunk_refs = []
+        for chunk in archive_ref.collection(self.CHUNKS).stream():
+            meta = chunk.to_dict()
+            chunk_refs.append(chunk.reference)
+            for row in unpack(meta["data"]):
+                doc_id = row.pop("id")
+                batch.set(self.db.collection(meta["kind"]).document(doc_id), row)
+                pending += 1
+                restored += 1
+                if pending >= self.BATCH_WRITES:
+                    batch.commit()
+                    batch, pending = self.db.batch(), 0
+        if pending:
+            batch.commit()
+
+        # Rows are hot again: drop the archive (readers stop reading through it)
+        archive_ref.delete()
+        for ref in chunk_refs:
+            ref.delete()
+        return {"period": period, "restored": restored}
+
+    def list_archives(self, company_id: str) -> List[Dict[str, Any]]:
+        query = self.db.collection(self.COLLECTION).where("company_id", "==", company_id)
+        return sorted(({"id": s.id, **s.to_dict()} for s in query.stream()), key=lambda a: a.get("period", ""))
+
+
+def get_archive_service() -> ArchiveService:
+    return ArchiveService()
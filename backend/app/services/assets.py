@@ -1,13 +1,24 @@
-from decimal import Decimal
-from datetime import datetime, date
-from app.core.firebase import get_db
+from decimal import Decimal, ROUND_HALF_UP
+from datetime import datetime, date, timezone
+from calendar import monthrange
+from typing import Dict, Any, List, Optional, Tuple
+from app.core.firebase import get_db, stream_paged
 from google.cloud import firestore
+from .posting import PostingEngine
+from .rollups import as_day
+
+CENT = Decimal("0.01")
 
 class FixedAssetService:
     """Service for managing fixed assets and depreciation (الأصول الثابتة والاندثار)."""
     
+    RUNS_COLLECTION = "depreciation_runs"
+    # Writes per batch (Firestore hard limit is 500)
+    BATCH_SIZE = 400
+
     def __init__(self):
         self.db = get_db()
+        self.posting_engine = PostingEngine()
     
     def create_asset(self, data: dict) -> str:
         """Register a new fixed asset."""
@@ -23,6 +34,12 @@ class FixedAssetService:
             "depreciation_method": data.get("depreciation_method", "STRAIGHT_LINE"),
             "accumulated_depreciation": "0",
             "current_value": str(data.get("purchase_value", "0")),
+            "declining_rate": str(data["declining_rate"]) if data.get("declining_rate") else None,  # Annual rate; default double-declining
+            "expense_account_id": data.get("expense_account_id"),
+            "accumulated_account_id": data.get("accumulated_account_id"),
+            "depreciated_months": 0,
+            "last_depreciation_period": None,
+            "company_id": data.get("company_id"),
             "status": "ACTIVE",  # ACTIVE, DISPOSED, SOLD
             "location": data.get("location", ""),
             "notes": data.get("notes", ""),
@@ -31,9 +48,11 @@ class FixedAssetService:
         doc_ref.set(asset)
         return doc_ref.id
     
-    def list_assets(self, status: str = "ACTIVE", limit: int = 100) -> list:
+    def list_assets(self, status: str = "ACTIVE", limit: int = 100, company_id: Optional[str] = None) -> list:
         """List fixed assets."""
         query = self.db.collection("fixed_assets")
+        if company_id:
+            query = query.where("company_id", "==", company_id)
         if status:
             query = query.where("status", "==", status)
         docs = query.limit(limit).stream()
@@ -57,8 +76,16 @@ class FixedAssetService:
         monthly_dep = (purchase_value - salvage_value) / useful_life_months
         return monthly_dep.quantize(Decimal("0.01"))
     
-    def record_depreciation(self, asset_id: str, amount: Decimal, period: str) -> str:
-        """Record a depreciation entry for an asset."""
+    def record_depreciation(self, asset_id: str, amount: Decimal, period: Optional[str] = None) -> str:
+        """Record a depreciation entry for an asset (period defaults to the current month).
+        Raises ValueError when the asset is already depreciated for the period."""
+        period = self.normalize_period(period or datetime.now(timezone.utc).strftime("%Y-%m"))
+        asset_ref = self.db.collection("fixed_assets").document(asset_id)
+        asset_doc = asset_ref.get()
+        last = asset_doc.to_dict().get("last_depreciation_period") if asset_doc.exists else None
+        if last and last >= period:
+            raise ValueError(f"Asset already depreciated through {last}")
+
         doc_ref = self.db.collection("depreciation_entries").document()
         entry = {
             "asset_id": asset_id,
@@ -68,23 +95,23 @@ class FixedAssetService:
         }
         doc_ref.set(entry)
         
-        # Update accumulated depreciation on asset
-        asset_ref = self.db.collection("fixed_assets").document(asset_id)
-        asset_doc = asset_ref.get()
+        # Update accumulated depreciation and the run tracking fields on asset
         if asset_doc.exists:
             current_acc = Decimal(str(asset_doc.to_dict().get("accumulated_depreciation", "0")))
             purchase_val = Decimal(str(asset_doc.to_dict().get("purchase_value", "0")))
             new_acc = current_acc + amount
             asset_ref.update({
                 "accumulated_depreciation": str(new_acc),
-                "current_value": str(purchase_val - new_acc)
+                "current_value": str(purchase_val - new_acc),
+                "depreciated_months": int(asset_doc.to_dict().get("depreciated_months") or 0) + 1,
+                "last_depreciation_period": period
             })
         
         return doc_ref.id
     
-    def get_depreciation_summary(self) -> dict:
+    def get_depreciation_summary(self, company_id: Optional[str] = None) -> dict:
         """Get total depreciation across all assets."""
-        assets = self.list_assets()
+        assets = self.list_assets(company_id=company_id)
         total_purchase = Decimal("0")
         total_accumulated = Decimal("0")
         total_current = Decimal("0")
@@ -101,6 +128,274 @@ class FixedAssetService:
             "asset_count": len(assets)
         }
 
+    # ==========================================================================
+    # BULK DEPRECIATION
+    # ==========================================================================
+    @staticmethod
+    def normalize_period(period: str) -> str:
+        """'2026-2' / '2026-02' -> '2026-02'. Periods are compared as strings, so only YYYY-MM is accepted."""
+        try:
+            year, month = (int(p) for p in str(period).strip().split("-"))
+        except ValueError:
+            raise ValueError("period must be YYYY-MM")
+        if not 1 <= month <= 12 or not 1900 <= year <= 9999:
+            raise ValueError("period must be YYYY-MM")
+        return f"{year:04d}-{month:02d}"
+
+    @staticmethod
+    def period_bounds(period: str) -> Tuple[date, date]:
+        """'2026-02' -> (2026-02-01, 2026-02-28)."""
+        year, month = (int(p) for p in period.split("-"))
+        return date(year, month, 1), date(year, month, monthrange(year, month)[1])
+
+    @staticmethod
+    def period_amount(asset: Dict[str, Any], accumulated: Decimal, months_done: int) -> Decimal:
+        """
+        Depreciation for the next month of an asset, given its state.
+        STRAIGHT_LINE: (cost - salvage) / life.
+        DECLINING_BALANCE: book value * annual rate / 12 (default 2 / life-in-years),
+        switching to straight-line over the remaining life when that is larger.
+        Never depreciates below salvage value.
+        """
+        cost = Decimal(str(asset.get("purchase_value", "0")))
+        salvage = Decimal(str(asset.get("salvage_value", "0")))
+        life = int(asset.get("useful_life_months") or 0)
+        remaining = cost - salvage - accumulated
+        if life <= 0 or remaining <= 0:
+            return Decimal("0")
+
+        months_left = life - months_done
+        if months_left <= 1:
+            return remaining.quantize(CENT, rounding=ROUND_HALF_UP)
+
+        if asset.get("depreciation_method") == "DECLINING_BALANCE":
+            annual_rate = Decimal(str(asset.get("declining_rate") or 0)) or (Decimal("24") / Decimal(life))
+            declining = (cost - accumulated) * annual_rate / Decimal("12")
+            amount = max(declining, remaining / months_left)
+        else:
+            amount = (cost - salvage) / life
+
+        return min(amount, remaining).quantize(CENT, rounding=ROUND_HALF_UP)
+
+    def run_depreciation(
+        self,
+        company_id: str,
+        period: str,
+        default_expense_account_id: Optional[str] = None,
+        default_accumulated_account_id: Optional[str] = None,
+        user_email: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Month-end depreciation for every active asset of a company.
+
+        1. Streams active assets once and computes all period amounts in memory.
+        2. Posts one journal entry per (expense, accumulated depreciation) account pair
+           via PostingEngine (deterministic JE ids, so a retried run never double-posts).
+        3. Writes depreciation_entries + asset updates in batched writes.
+
+        Idempotent per (company, period): a completed run returns its stored result,
+        and an interrupted run resumes (assets already stamped with the period are skipped).
+        A run that skipped assets for missing accounts ends PARTIAL; running it again
+        (after the accounts are set) is a new pass that posts only the remaining assets.
+        Amounts are computed per asset in Decimal so they match record_depreciation and
+        the schedule to the cent.
+        """
+        period = self.normalize_period(period)
+        period_start, period_end = self.period_bounds(period)
+        run_ref = self.db.collection(self.RUNS_COLLECTION).document(f"{company_id}_{period}")
+        run_snap = run_ref.get()
+        run = run_snap.to_dict() if run_snap.exists else {}
+        if run.get("status") == "COMPLETED":
+            return {**run, "already_completed": True}
+        # An interrupted pass resumes under its own number (its JEs are already posted);
+        # a finished PARTIAL pass is followed by a new one with its own JEs
+        run_pass = int(run.get("pass") or 1) + (1 if run.get("status") == "PARTIAL" else 0)
+
+        run_ref.set({
+            "company_id": company_id,
+            "period": period,
+            "pass": run_pass,
+            "status": "RUNNING",
+            "started_at": firestore.SERVER_TIMESTAMP,
+            "started_by": user_email
+        }, merge=True)
+
+        # --- PHASE 1: Stream & compute ---
+        query = self.db.collection("fixed_assets")\
+            .where("company_id", "==", company_id)\
+            .where("status", "==", "ACTIVE")
+
+        postings = []  # (asset_id, asset, amount)
+        pair_totals: Dict[Tuple[str, str], Decimal] = {}
+        skipped = {"already_posted": 0, "not_in_service": 0, "fully_depreciated": 0, "missing_accounts": 0}
+
+        for snap in stream_paged(query):
+            asset = snap.to_dict()
+            last = asset.get("last_depreciation_period")
+            if last and last >= period:
+                skipped["already_posted"] += 1
+                continue
+            if asset.get("purchase_date") and as_day(asset["purchase_date"]) > period_end:
+                skipped["not_in_service"] += 1
+                continue
+
+            accumulated = Decimal(str(asset.get("accumulated_depreciation", "0")))
+            amount = self.period_amount(asset, accumulated, int(asset.get("depreciated_months") or 0))
+            if amount <= 0:
+                skipped["fully_depreciated"] += 1
+                continue
+
+            pair = (
+                asset.get("expense_account_id") or default_expense_account_id,
+                asset.get("accumulated_account_id") or default_accumulated_account_id
+            )
+            if not pair[0] or not pair[1]:
+                skipped["missing_accounts"] += 1
+                continue
+
+            postings.append((snap.id, asset, amount))
+            pair_totals[pair] = pair_totals.get(pair, Decimal("0")) + amount
+
+        # --- PHASE 2: GL (one JE per account pair) ---
+        entry_date = datetime(period_end.year, period_end.month, period_end.day, tzinfo=timezone.utc)
+        journal_ids = {}
+        for (expense_id, accum_id), total in sorted(pair_totals.items()):
+            journal_ids[(expense_id, accum_id)] = self._post_depreciation_je(
+                company_id, period, entry_date, expense_id, accum_id, total, run_pass
+            )
+
+        # --- PHASE 3: Entries & asset updates (batched) ---
+        batch = self.db.batch()
+        pending = 0
+        for asset_id, asset, amount in postings:
+            pair = (
+                asset.get("expense_account_id") or default_expense_account_id,
+                asset.get("accumulated_account_id") or default_accumulated_account_id
+            )
+            purchase_value = Decimal(str(asset.get("purchase_value", "0")))
+            new_acc = Decimal(str(asset.get("accumulated_depreciation", "0"))) + amount
+
+            batch.set(self.db.collection("depreciation_entries").document(f"{asset_id}_{period}"), {
+                "asset_id": asset_id,
+                "company_id": company_id,
+                "amount": str(amount),
+                "period": period,
+                "journal_entry_id": journal_ids[pair],
+                "created_at": firestore.SERVER_TIMESTAMP
+            })
+            batch.update(self.db.collection("fixed_assets").document(asset_id), {
+                "accumulated_depreciation": str(new_acc),
+                "current_value": str(purchase_value - new_acc),
+                "depreciated_months": int(asset.get("depreciated_months") or 0) + 1,
+                "last_depreciation_period": period
+            })
+            pending += 2
+            if pending >= self.BATCH_SIZE:
+                batch.commit()
+                batch = self.db.batch()
+                pending = 0
+        if pending:
+            batch.commit()
+
+        result = {
+            "company_id": company_id,
+            "period": period,
+            "pass": run_pass,
+            "status": "PARTIAL" if skipped["missing_accounts"] else "COMPLETED",
+            "assets_depreciated": len(postings),
+            "total_depreciation": str(sum(pair_totals.values(), Decimal("0"))),
+            "journal_entry_ids": sorted(journal_ids.values()),
+            "skipped": skipped
+        }
+        run_ref.set({**result, "completed_at": firestore.SERVER_TIMESTAMP}, merge=True)
+        return result
+
+    def _post_depreciation_je(self, company_id: str, period: str, entry_date: datetime,
+                              expense_id: str, accum_id: str, total: Decimal, run_pass: int = 1) -> str:
+        """Post (once per run pass) the summarized depreciation JE for one account pair."""
+        je_id = f"DEP_{company_id}_{period}_{expense_id}_{accum_id}"
+        je_ref = self.db.collection("journal_entries").document(je_id if run_pass == 1 else f"{je_id}_P{run_pass}")
+        transaction = self.db.transaction()
+
+        @firestore.transactional
+        def _execute(transaction):
+            # PHASE 1: READ
+            if je_ref.get(transaction=transaction).exists:
+                return je_ref.id
+            accounts_data = self.posting_engine.get_accounts_for_transaction(transaction, [expense_id, accum_id])
+
+            # PHASE 2: CALC
+            lines = [
+                {"account_id": expense_id, "debit": str(total), "credit": "0", "memo": f"Depreciation {period}"},
+                {"account_id": accum_id, "debit": "0", "credit": str(total), "memo": f"Accumulated depreciation {period}"}
+            ]
+
+            # PHASE 3: WRITE
+            transaction.set(je_ref, {
+                "number": f"JE-DEP-{period}",
+                "date": entry_date,
+                "description": f"Depreciation run {period}",
+                "status": "DRAFT",
+                "lines": self.posting_engine.journal_lines.inline(lines),
+                "company_id": company_id,
+                "source_doc_id": f"{company_id}_{period}",
+                "source_doc_type": "DEPRECIATION",
+                "created_at": firestore.SERVER_TIMESTAMP
+            })
+            self.posting_engine.post_journal_entry(
+                transaction, je_ref.id, lines, accounts_data,
+                entry_date=entry_date, company_id=company_id, source_type="DEPRECIATION"
+            )
+            return je_ref.id
+
+        return _execute(transaction)
+
+    def get_depreciation_schedule(self, asset_id: str, company_id: Optional[str] = None) -> Dict[str, Any]:
+        """Project the remaining month-by-month schedule of an asset from its current state (no writes)."""
+        snap = self.db.collection("fixed_assets").document(asset_id).get()
+        if not snap.exists:
+            raise ValueError("Asset not found")
+        asset = snap.to_dict()
+        if company_id and asset.get("company_id") and asset.get("company_id") != company_id:
+            raise ValueError("Asset not found")
+
+        accumulated = Decimal(str(asset.get("accumulated_depreciation", "0")))
+        cost = Decimal(str(asset.get("purchase_value", "0")))
+        months_done = int(asset.get("depreciated_months") or 0)
+
+        if asset.get("last_depreciation_period"):
+            year, month = (int(p) for p in asset["last_depreciation_period"].split("-"))
+            month += 1
+        else:
+            start = as_day(asset.get("purchase_date")) if asset.get("purchase_date") else as_day()
+            year, month = start.year, start.month
+        if month > 12:
+            year, month = year + 1, 1
+
+        rows = []
+        life = int(asset.get("useful_life_months") or 0)
+        while months_done < life:
+            amount = self.period_amount(asset, accumulated, months_done)
+            if amount <= 0:
+                break
+            accumulated += amount
+            months_done += 1
+            rows.append({
+                "period": f"{year}-{month:02d}",
+                "depreciation": str(amount),
+                "accumulated_depreciation": str(accumulated),
+                "book_value": str(cost - accumulated)
+            })
+            month += 1
+            if month > 12:
+                year, month = year + 1, 1
+
+        return {
+            "asset_id": asset_id,
+            "method": asset.get("depreciation_method", "STRAIGHT_LINE"),
+            "schedule": rows
+        }
+
 
 def get_fixed_asset_service() -> FixedAssetService:
     return FixedAssetService()
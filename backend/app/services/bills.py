@@ -1,4 +1,4 @@
-from datetime import datetime
+from datetime import datetime, timezone
 from decimal import Decimal
 from typing import Optional
 from google.cloud import firestore
@@ -14,6 +14,37 @@ class BillService:
         self.collection = self.db.collection("bills")
         self.posting_engine = PostingEngine()
 
+    def create_bill(self, data: BillCreate, user: dict) -> str:
+        """Record a supplier bill and post it: Dr Expenses / Cr Accounts Payable."""
+        company_id = user.get("company_id")
+
+        # 1. Totals
+        total = sum((Decimal(str(line.total)) for line in data.lines), Decimal("0"))
+        if total <= 0:
+            raise ValueError("Bill total must be positive")
+
+        # 2. Dates (the journal entry is dated like the bill)
+        bill_date = data.date or datetime.now(timezone.utc)
+        due_date = data.due_date or bill_date
+
+        # 3. Bill document (written with its journal entry below)
+        doc_ref = self.collection.document()
+        bill_data = {
+            "bill_number": data.bill_number or f"BILL-{datetime.now().strftime('%Y%m%d%H%M%S')}",
+            "supplier_id": data.supplier_id,
+            "date": bill_date,
+            "due_date": due_date,
+            "lines": [line.model_dump() for line in data.lines],
+            "notes": data.notes or "",
+            "total": str(total),
+            "paid_amount": "0",
+            "remaining_amount": str(total),
+            "status": BillStatus.POSTED.value,
+            "company_id": company_id,
+            "created_by": user.get("email"),
+            "created_at": firestore.SERVER_TIMESTAMP
+        }
+
         # 4. Accounting Transaction (Inside Firestore Transaction for safety)
         transaction = self.db.transaction()
         
@@ -61,10 +92,10 @@ class BillService:
             
             transaction.set(je_ref, {
                 "number": f"JE-BILL-{bill_data['bill_number']}",
-                "date": firestore.SERVER_TIMESTAMP,
+                "date": bill_date,
                 "description": f"Bill from {supplier_data.get('name')}",
                 "status": "POSTED",
-                "lines": je_lines_dict,
+                "lines": self.posting_engine.journal_lines.inline(je_lines_dict),
                 "company_id": company_id,
                 "source_doc_id": doc_ref.id,
                 "source_doc_type": "BILL"
@@ -74,7 +105,11 @@ class BillService:
             account_ids = list(set(line["account_id"] for line in je_lines_dict))
             accounts_data = self.posting_engine.get_accounts_for_transaction(transaction, account_ids)
             
-            self.posting_engine.post_journal_entry(transaction, je_ref.id, je_lines_dict, accounts_data)
+            self.posting_engine.post_journal_entry(
+                transaction, je_ref.id, je_lines_dict, accounts_data,
+                entry_date=bill_date, company_id=company_id, source_type="BILL",
+                dimensions={"supplier_id": data.supplier_id}
+            )
             
             bill_data["journal_id"] = je_ref.id
             bill_data["supplier_name"] = supplier_data.get("name")
@@ -0,0 +1,191 @@
+"""
+Cost Layers Service
+FIFO / FEFO costing for items with costing_method FIFO or FEFO.
+
+Every receipt of such an item opens a layer in cost_layers with its own cost,
+batch and expiry. Issues consume open layers in order, so the cost of a sale is
+known without scanning the stock ledger:
+
+    FIFO    oldest receipt first (received_at)
+    FEFO    earliest expiry first (expiry_key, then received_at)
+
+Open layers are found with an indexed query on (item_id, warehouse_id, is_open)
+and read one page at a time, so an item with thousands of open layers only
+reads the few layers an issue actually touches.
+
+Planning (reads) and applying (writes) are separate so both fit the
+read-before-write rule of Firestore transactions: plan every issue in PHASE 1,
+apply the plans in PHASE 3.
+"""
+from decimal import Decimal
+from typing import Any, Dict, List, Optional
+from google.cloud import firestore
+from app.core.firebase import get_db
+from .rollups import as_datetime, as_day
+
+ZERO = Decimal("0")
+# Sort key of layers without expiry (picked last under FEFO)
+NO_EXPIRY_KEY = "9999-12-31"
+
+
+class CostLayerService:
+    COLLECTION = "cost_layers"
+    LAYER_METHODS = {"FIFO", "FEFO"}
+    PAGE_SIZE = 50
+
+    def __init__(self):
+        self.db = get_db()
+
+    @classmethod
+    def uses_layers(cls, item_data: Optional[Dict[str, Any]]) -> bool:
+        return bool(item_data) and item_data.get("costing_method") in cls.LAYER_METHODS
+
+    @staticmethod
+    def expiry_key(expiry_date) -> str:
+        return as_day(expiry_date).isoformat() if expiry_date else NO_EXPIRY_KEY
+
+    def _open_query(self, item_id: str, warehouse_id: str, method: str, batch_number: Optional[str] = None):
+        query = (self.db.collection(self.COLLECTION)
+                 .where("item_id", "==", item_id)
+                 .where("warehouse_id", "==", warehouse_id))
+        if batch_number:
+            query = query.where("batch_number", "==", batch_number)
+        query = query.where("is_open", "==", True)
+        if method == "FEFO":
+            query = query.order_by("expiry_key")
+        return query.order_by("received_at")
+
+    # ==========================================================================
+    # PLAN (reads only - PHASE 1)
+    # ==========================================================================
+    def plan_consumption(
+        self,
+        transaction,
+        item_id: str,
+        warehouse_id: str,
+        quantity: Decimal,
+        method: str,
+        batch_number: Optional[str] = None,
+        planned: Optional[Dict[str, Decimal]] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Pick the open layers that cover `quantity` (positive) in costing order.
+        `planned` (layer id -> qty) carries quantities already taken by earlier
+        plans of the same transaction, so several lines can draw from one item.
+        Raises ValueError when the open layers do not cover the quantity.
+        """
+        planned = planned if planned is not None else {}
+        needed = Decimal(str(quantity))
+        slices = []
+        query = self._open_query(item_id, warehouse_id, method, batch_number)
+        cursor = None
+
+        while needed > ZERO:
+            page_query = query.limit(self.PAGE_SIZE)
+            if cursor is not None:
+                page_query = page_query.start_after(cursor)
+            page = list(page_query.get(transaction=transaction))
+            for snap in page:
+                layer = snap.to_dict()
+                available = Decimal(str(layer.get("remaining_qty", "0"))) - planned.get(snap.id, ZERO)
+                if available <= ZERO:
+                    continue
+                take = min(available, needed)
+                planned[snap.id] = planned.get(snap.id, ZERO) + take
+                slices.append({
+                    "layer_id": snap.id,
+                    "quantity": take,
+                    "unit_cost": Decimal(str(layer.get("unit_cost", "0"))),
+                    # Remaining before this slice (after earlier plans of the transaction)
+                    "remaining_qty": available,
+                    "batch_number": layer.get("batch_number"),
+                    "expiry_date": layer.get("expiry_date"),
+                })
+                needed -= take
+                if needed <= ZERO:
+                    break
+            if len(page) < self.PAGE_SIZE:
+                break
+            cursor = page[-1]
+
+        if needed > ZERO:
+            batch_note = f" batch {batch_number}" if batch_number else ""
+            raise ValueError(f"Insufficient stock in cost layers for item {item_id}{batch_note} (short {needed})")
+        return slices
+
+    @staticmethod
+    def plan_cost(slices: List[Dict[str, Any]]) -> Decimal:
+        return sum((s["quantity"] * s["unit_cost"] for s in slices), ZERO)
+
+    # ==========================================================================
+    # APPLY (writes only - PHASE 3)
+    # ==========================================================================
+    def apply_consumption(self, transaction, slices: List[Dict[str, Any]]):
+        """
+        Reduce the planned layers. Slices must be passed in planning order: the
+        last slice of a layer carries its final remaining quantity.
+        """
+        final: Dict[str, Decimal] = {}
+        for s in slices:
+            final[s["layer_id"]] = s["remaining_qty"] - s["quantity"]
+        for layer_id, left in final.items():
+            transaction.update(self.db.collection(self.COLLECTION).document(layer_id), {
+                "remaining_qty": str(left),
+                "is_open": left > ZERO,
+                "updated_at": firestore.SERVER_TIMESTAMP
+            })
+
+    def add_layer(
+        self,
+        transaction,
+        item_data: Dict[str, Any],
+        item_id: str,
+        warehouse_id: str,
+        quantity: Decimal,
+        unit_cost: Decimal,
+        received_at=None,
+        batch_number: Optional[str] = None,
+        expiry_date=None,
+        source_document_id: Optional[str] = None,
+        layer_id: Optional[str] = None
+    ) -> str:
+        """Open a layer for a receipt (write-only, safe after other writes)."""
+        ref = self.db.collection(self.COLLECTION).document(layer_id) if layer_id else self.db.collection(self.COLLECTION).document()
+        transaction.set(ref, {
+            "company_id": item_data.get("company_id"),
+            "item_id": item_id,
+            "warehouse_id": warehouse_id,
+            "batch_number": batch_number,
+            "expiry_date": as_datetime(expiry_date) if expiry_date else None,
+            "expiry_key": self.expiry_key(expiry_date),
+            "received_at": as_datetime(received_at),
+            "unit_cost": str(unit_cost),
+            "original_qty": str(quantity),
+            "remaining_qty": str(quantity),
+            "is_open": True,
+            "source_document_id": source_document_id,
+            "created_at": firestore.SERVER_TIMESTAMP
+        })
+        return ref.id
+
+    # ==========================================================================
+    # READS
+    # ==========================================================================
+    def get_open_layers(self, item_id: str, warehouse_id: str, method: str = "FIFO", limit: int = 100) -> List[Dict[str, Any]]:
+        """Open layers of an item in a warehouse, in consumption order."""
+        docs = self._open_query(item_id, warehouse_id, method).limit(limit).stream()
+        return [{"id": d.id, **d.to_dict()} for d in docs]
+
+    def get_expiring_layers(self, company_id: str, before, limit: int = 200) -> List[Dict[str, Any]]:
+        """Open layers of a company expiring on or before `before` (earliest first)."""
+        query = (self.db.collection(self.COLLECTION)
+                 .where("company_id", "==", company_id)
+                 .where("is_open", "==", True)
+                 .where("expiry_key", "<=", self.expiry_key(before))
+                 .order_by("expiry_key")
+                 .limit(limit))
+        return [{"id": d.id, **d.to_dict()} for d in query.stream()]
+
+
+def get_cost_layer_service() -> CostLayerService:
+    return CostLayerService()
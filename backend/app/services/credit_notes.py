@@ -117,7 +117,7 @@ class CreditNoteService:
                 "date": cn_data["date"],
                 "description": f"Credit Note for {cust_data.get('name', 'Customer')}",
                 "status": "POSTED",
-                "lines": lines,
+                "lines": self.posting_engine.journal_lines.inline(lines),
                 "company_id": company_id,
                 "source_doc_id": doc_ref.id,
                 "source_doc_type": "CREDIT_NOTE"
@@ -130,7 +130,10 @@ class CreditNoteService:
             # NOW perform all writes
             je_ref = self.db.collection("journal_entries").document()
             transaction.set(je_ref, je_data)
-            self.posting_engine.post_journal_entry(transaction, je_ref.id, lines, accounts_data)
+            self.posting_engine.post_journal_entry(
+                transaction, je_ref.id, lines, accounts_data,
+                entry_date=cn_data["date"], company_id=company_id, source_type="CREDIT_NOTE"
+            )
 
             # Save CN
             cn_data["journal_entry_id"] = je_ref.id
@@ -1,58 +1,203 @@
 from decimal import Decimal
-from datetime import datetime
+from datetime import datetime, date, timezone
+from bisect import bisect_right
+from threading import Lock
+from time import monotonic
+from typing import Dict, List, Optional, Sequence, Tuple, Union
 from app.core.firebase import get_db
 from google.cloud import firestore
 
+DateLike = Union[date, datetime, str, None]
+
+# In-process rate store shared by all CurrencyService instances:
+# pair -> (sorted effective dates as ISO strings, rates aligned with the dates).
+# Entries are swapped whole under the lock and never mutated, so a reader can
+# use the tuple it got without holding the lock.
+_RATE_CACHE: Dict[str, Tuple[List[str], List[Decimal]]] = {}
+_LOADED_AT: Dict[str, float] = {}
+_CACHE_LOCK = Lock()
+
+
+def _day(value: DateLike) -> str:
+    """Normalize a date/datetime/ISO string (None = today UTC) to 'YYYY-MM-DD'."""
+    if value is None:
+        return datetime.now(timezone.utc).date().isoformat()
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc)
+        return value.date().isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    return str(value)[:10]
+
+
 class CurrencyService:
     """Service for multi-currency ledger operations (IQD/USD)."""
-    
+
     DEFAULT_RATE = Decimal("1480.00")  # 1 USD = 1480 IQD (market rate)
-    
+    # Other API processes pick up new rates within this window
+    CACHE_TTL_SECONDS = 300
+    # History date of the legacy single rate (applies before the first dated rate)
+    LEGACY_DATE = "0001-01-01"
+
     def __init__(self):
         self.db = get_db()
-    
+
+    # ==========================================================================
+    # RATE STORE
+    # ==========================================================================
+    @staticmethod
+    def _pair(from_currency: str, to_currency: str) -> str:
+        return f"{from_currency}_{to_currency}"
+
+    def _load_pair(self, pair: str) -> Tuple[List[str], List[Decimal]]:
+        """Load (or reuse) the sorted rate history of a pair."""
+        with _CACHE_LOCK:
+            cached = _RATE_CACHE.get(pair)
+            if cached is not None and monotonic() - _LOADED_AT.get(pair, 0) < self.CACHE_TTL_SECONDS:
+                return cached
+
+        rows = {}
+        for doc in self.db.collection("exchange_rate_history").where("pair", "==", pair).stream():
+            data = doc.to_dict()
+            rows[_day(data.get("date"))] = Decimal(str(data.get("rate")))
+
+        if self.LEGACY_DATE not in rows:
+            # Legacy single-rate document (before history was recorded). Once set_rate
+            # maintains it (effective_date set) it only mirrors the latest history rate.
+            snap = self.db.collection("exchange_rates").document(pair).get()
+            legacy = snap.to_dict() if snap.exists else {}
+            if legacy.get("rate") and (not rows or not legacy.get("effective_date")):
+                rows[self.LEGACY_DATE] = Decimal(str(legacy["rate"]))
+
+        dates = sorted(rows)
+        entry = (dates, [rows[d] for d in dates])
+        with _CACHE_LOCK:
+            _RATE_CACHE[pair] = entry
+            _LOADED_AT[pair] = monotonic()
+        return entry
+
+    @staticmethod
+    def _lookup(entry: Tuple[List[str], List[Decimal]], day: str) -> Optional[Decimal]:
+        """Rate effective on `day` (latest rate at or before it; earliest rate if day predates history)."""
+        dates, rates = entry
+        if not dates:
+            return None
+        idx = bisect_right(dates, day) - 1
+        return rates[max(idx, 0)]
+
+    def get_rate(self, from_currency: str = "USD", to_currency: str = "IQD", at: DateLike = None) -> Decimal:
+        """Units of `to_currency` per 1 `from_currency` effective on `at` (default: today)."""
+        if from_currency == to_currency:
+            return Decimal("1")
+        day = _day(at)
+
+        direct = self._lookup(self._load_pair(self._pair(from_currency, to_currency)), day)
+        if direct:
+            return direct
+        inverse = self._lookup(self._load_pair(self._pair(to_currency, from_currency)), day)
+        if inverse:
+            return Decimal("1") / inverse
+
+        if (from_currency, to_currency) == ("USD", "IQD"):
+            return self.DEFAULT_RATE
+        if (from_currency, to_currency) == ("IQD", "USD"):
+            return Decimal("1") / self.DEFAULT_RATE
+        raise ValueError(f"No exchange rate for {from_currency}/{to_currency}")
+
     def get_current_rate(self, from_currency: str = "USD", to_currency: str = "IQD") -> Decimal:
         """Get the current exchange rate. Returns IQD per 1 USD by default."""
         try:
-            doc = self.db.collection("exchange_rates").document(f"{from_currency}_{to_currency}").get()
-            if doc.exists:
-                return Decimal(str(doc.to_dict().get("rate", self.DEFAULT_RATE)))
-            return self.DEFAULT_RATE
+            return self.get_rate(from_currency, to_currency)
         except Exception:
             return self.DEFAULT_RATE
-    
-    def set_rate(self, rate: Decimal, from_currency: str = "USD", to_currency: str = "IQD") -> dict:
-        """Update the exchange rate. Admin only."""
-        doc_id = f"{from_currency}_{to_currency}"
-        data = {
+
+    def set_rate(self, rate: Decimal, from_currency: str = "USD", to_currency: str = "IQD", effective_date: DateLike = None) -> dict:
+        """Record a rate effective from `effective_date` (default today). Admin only."""
+        pair = self._pair(from_currency, to_currency)
+        day = _day(effective_date)
+        dates, rates = self._load_pair(pair)
+
+        history = {
+            "pair": pair,
             "from_currency": from_currency,
             "to_currency": to_currency,
             "rate": str(rate),
-            "updated_at": firestore.SERVER_TIMESTAMP
+            "date": day,
+            "created_at": firestore.SERVER_TIMESTAMP
         }
-        self.db.collection("exchange_rates").document(doc_id).set(data)
-        return {"status": "updated", "rate": str(rate)}
-    
-    def convert(self, amount: Decimal, from_currency: str, to_currency: str) -> Decimal:
-        """Convert an amount between currencies."""
+        batch = self.db.batch()
+        batch.set(self.db.collection("exchange_rate_history").document(f"{pair}_{day}"), history)
+        if dates and dates[0] == self.LEGACY_DATE and day != self.LEGACY_DATE:
+            # Keep the legacy rate as history: exchange_rates is overwritten below
+            batch.set(self.db.collection("exchange_rate_history").document(f"{pair}_{self.LEGACY_DATE}"), {
+                **history, "rate": str(rates[0]), "date": self.LEGACY_DATE
+            })
+        if not dates or day >= dates[-1]:
+            # exchange_rates keeps the latest rate for existing readers
+            batch.set(self.db.collection("exchange_rates").document(pair), {
+                "from_currency": from_currency,
+                "to_currency": to_currency,
+                "rate": str(rate),
+                "effective_date": day,
+                "updated_at": firestore.SERVER_TIMESTAMP
+            })
+        batch.commit()
+
+        # Refresh the local store (no reload): copy, update, swap
+        with _CACHE_LOCK:
+            cached_dates, cached_rates = _RATE_CACHE.get(pair, ([], []))
+            dates, rates = list(cached_dates), list(cached_rates)
+            idx = bisect_right(dates, day)
+            if idx and dates[idx - 1] == day:
+                rates[idx - 1] = Decimal(str(rate))
+            else:
+                dates.insert(idx, day)
+                rates.insert(idx, Decimal(str(rate)))
+            _RATE_CACHE[pair] = (dates, rates)
+            _LOADED_AT[pair] = monotonic()
+
+        return {"status": "updated", "rate": str(rate), "effective_date": day}
+
+    # ==========================================================================
+    # CONVERSION
+    # ==========================================================================
+    def convert(self, amount: Decimal, from_currency: str, to_currency: str, at: DateLike = None) -> Decimal:
+        """Convert an amount between currencies at the rate effective on `at` (default: today)."""
         if from_currency == to_currency:
             return amount
-        
-        rate = self.get_current_rate(from_currency, to_currency)
-        
-        if from_currency == "USD" and to_currency == "IQD":
-            return amount * rate
-        elif from_currency == "IQD" and to_currency == "USD":
-            return amount / rate
-        
-        return amount  # Unsupported pair
-    
-    def get_rate_history(self, limit: int = 30) -> list:
+        return Decimal(str(amount)) * self.get_rate(from_currency, to_currency, at)
+
+    def convert_many(
+        self,
+        amounts: Sequence[Decimal],
+        from_currency: str,
+        to_currency: str,
+        at: Union[DateLike, Sequence[DateLike]] = None
+    ) -> List[Decimal]:
+        """
+        Convert a list of amounts in one call.
+        `at` is a single date for all amounts, or a list of per-amount dates
+        (e.g. invoice dates); each distinct date is resolved once.
+        """
+        if from_currency == to_currency:
+            return [Decimal(str(a)) for a in amounts]
+
+        if at is None or isinstance(at, (date, datetime, str)):
+            rate = self.get_rate(from_currency, to_currency, at)
+            return [Decimal(str(a)) * rate for a in amounts]
+
+        days = [_day(d) for d in at]
+        if len(days) != len(amounts):
+            raise ValueError("amounts and dates must have the same length")
+        rates = {day: self.get_rate(from_currency, to_currency, day) for day in set(days)}
+        return [Decimal(str(a)) * rates[day] for a, day in zip(amounts, days)]
+
+    def get_rate_history(self, limit: int = 30, from_currency: str = "USD", to_currency: str = "IQD") -> list:
         """Get historical exchange rates for charting."""
-        docs = self.db.collection("exchange_rate_history")\
-            .order_by("date", direction=firestore.Query.DESCENDING)\
-            .limit(limit).stream()
-        return [{"date": d.to_dict().get("date"), "rate": d.to_dict().get("rate")} for d in docs]
+        dates, rates = self._load_pair(self._pair(from_currency, to_currency))
+        rows = [{"date": d, "rate": str(r)} for d, r in zip(dates, rates)]
+        return list(reversed(rows))[:limit]
 
 
 def get_currency_service() -> CurrencyService:
@@ -0,0 +1,483 @@
+"""
+Cycle Count Service
+Counting sessions for one warehouse:
+
+    cycle_counts/{id}                 warehouse_id, status, started_at, journal_entry_id
+    cycle_counts/{id}/lines/{item}    expected_qty (frozen), snapshot_at, counted_units,
+                                      scan_count, counted_at, posted, adjustment_*
+
+Start freezes the expected quantity of every item from its stock balance;
+snapshot_at is the read time of that balance, so it is exactly the point in
+the ledger the frozen figure stands for. Scans are aggregated per item in
+memory and written as one increment per item, so a scanner can stream
+thousands of scans a minute in a handful of batched writes. Counted quantities
+are kept as integer units of QTY_UNIT (4 decimal places, as amounts), so the
+increments add up exactly.
+
+Stock keeps moving while the warehouse is counted. The variance of a line is
+
+    counted_qty - (expected_qty + ledger movements between snapshot_at and counted_at)
+
+with the movements replayed from one stock_ledger query per session. Posting
+applies the variances in grouped transactions (each line is marked posted in
+the transaction that moves its stock, so an interrupted post resumes) and
+then books one summarized inventory-variance journal entry.
+
+    COUNTING -> POSTING -> POSTED
+             -> CANCELLED
+"""
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import Any, Dict, List, Optional
+from google.cloud import firestore
+from app.core.firebase import get_db, stream_paged
+from .posting import PostingEngine
+
+ZERO = Decimal("0")
+DOC_TYPE = "CYCLE_COUNT"
+# Account code of the inventory variance (shrinkage) expense; items' COGS account otherwise
+VARIANCE_ACCOUNT_CODE = "53"
+# Smallest countable quantity; counted_units is the counted quantity in these units
+QTY_UNIT = Decimal("0.0001")
+QTY_SCALE = Decimal(10000)
+
+
+class CycleCountService:
+    COLLECTION = "cycle_counts"
+    BATCH_WRITES = 450
+    # Items per posting transaction (item, ledger row, rollups, balance, alert, line per item)
+    POST_CHUNK = 40
+
+    def __init__(self):
+        self.db = get_db()
+        self.posting_engine = PostingEngine()
+
+    def _session(self, company_id: str, session_id: str, statuses=None) -> Dict[str, Any]:
+        snap = self.db.collection(self.COLLECTION).document(session_id).get()
+        session = snap.to_dict() if snap.exists else None
+        if not session or session.get("company_id") != company_id:
+            raise ValueError("Cycle count not found")
+        if statuses and session.get("status") not in statuses:
+            raise ValueError(f"Cycle count is {session.get('status')}")
+        return {"id": session_id, **session}
+
+    def _lines(self, session_id: str) -> List[Dict[str, Any]]:
+        ref = self.db.collection(self.COLLECTION).document(session_id).collection("lines")
+        return [{"id": s.id, **s.to_dict()} for s in stream_paged(ref, page_size=1000)]
+
+    @staticmethod
+    def _snapshot_line(item_id: str, balance_snap) -> Dict[str, Any]:
+        balance = balance_snap.to_dict() or {}
+        return {
+            "item_id": item_id,
+            "sku": balance.get("sku"),
+            "name": balance.get("name"),
+            "expected_qty": str(balance.get("qty") or "0"),
+            "snapshot_at": balance_snap.read_time,
+            "counted_units": 0,
+            "scan_count": 0,
+            "counted_at": None,
+            "posted": False
+        }
+
+    @staticmethod
+    def to_units(qty: Decimal) -> int:
+        """Quantity -> integer QTY_UNITs (raises ValueError on finer quantities)."""
+        units = qty * QTY_SCALE
+        if units != units.to_integral_value():
+            raise ValueError(f"Scanned quantity {qty} has more than 4 decimal places")
+        return int(units)
+
+    @staticmethod
+    def counted_quantity(line: Dict[str, Any]) -> Decimal:
+        """Counted quantity of a line."""
+        if "counted_units" in line:
+            return Decimal(int(line["counted_units"] or 0)) / QTY_SCALE
+        # Lines scanned before counted_units hold float sums: round off the float drift
+        units = (Decimal(str(line.get("counted_qty") or 0)) * QTY_SCALE).to_integral_value()
+        return units / QTY_SCALE
+
+    # ==========================================================================
+    # SESSION
+    # ==========================================================================
+    def start(self, company_id: str, warehouse_id: str, item_ids: Optional[List[str]] = None,
+              started_by: Optional[str] = None, notes: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Open a session and freeze the expected quantities of the warehouse
+        (every balance it holds, or only `item_ids`).
+        """
+        from .stock_balances import StockBalanceService
+        balances = StockBalanceService()
+        session_ref = self.db.collection(self.COLLECTION).document()
+
+        if item_ids:
+            ids = list(dict.fromkeys(item_ids))
+            refs = [self.db.collection(balances.COLLECTION).document(balances.balance_id(i, warehouse_id)) for i in ids]
+            snaps = list(self.db.get_all(refs))
+            by_id = {s.id: s for s in snaps}
+            lines = {i: self._snapshot_line(i, by_id[balances.balance_id(i, warehouse_id)]) for i in ids}
+        else:
+            query = self.db.collection(balances.COLLECTION)\
+                .where("company_id", "==", company_id)\
+                .where("warehouse_id", "==", warehouse_id)
+            lines = {s.to_dict()["item_id"]: self._snapshot_line(s.to_dict()["item_id"], s)
+                     for s in stream_paged(query, page_size=1000)}
+        if not lines:
+            raise ValueError("Nothing to count in this warehouse")
+
+        batch = self.db.batch()
+        pending = 0
+        for item_id, line in lines.items():
+            batch.set(session_ref.collection("lines").document(item_id), line)
+            pending += 1
+            if pending >= self.BATCH_WRITES:
+                batch.commit()
+                batch, pending = self.db.batch(), 0
+        session = {
+            "company_id": company_id,
+            "warehouse_id": warehouse_id,
+            "status": "COUNTING",
+            "scope": "ITEMS" if item_ids else "WAREHOUSE",
+            "line_count": len(lines),
+            "notes": notes,
+            "started_by": started_by,
+            "started_at": min(l["snapshot_at"] for l in lines.values()),
+            "journal_entry_id": None
+        }
+        batch.set(session_ref, session)
+        batch.commit()
+        return {"id": session_ref.id, **session}
+
+    def list_sessions(self, company_id: str, limit: int = 50) -> List[Dict[str, Any]]:
+        query = self.db.collection(self.COLLECTION)\
+            .where("company_id", "==", company_id)\
+            .order_by("started_at", direction=firestore.Query.DESCENDING)\
+            .limit(limit)
+        return [{"id": d.id, **d.to_dict()} for d in query.stream()]
+
+    def get_session(self, company_id: str, session_id: str) -> Dict[str, Any]:
+        session = self._session(company_id, session_id)
+        session["lines"] = self._lines(session_id)
+        return session
+
+    def cancel(self, company_id: str, session_id: str) -> Dict[str, Any]:
+        self._session(company_id, session_id, {"COUNTING"})
+        self.db.collection(self.COLLECTION).document(session_id).update({
+            "status": "CANCELLED", "cancelled_at": firestore.SERVER_TIMESTAMP
+        })
+        return {"id": session_id, "status": "CANCELLED"}
+
+    # ==========================================================================
+    # SCANS
+    # ==========================================================================
+    def _resolve_codes(self, company_id: str, codes: List[str]) -> Dict[str, str]:
+        """Barcode or SKU -> item id (from the in-memory item index)."""
+        from .item_index import get_item_index
+        return {code: item["id"] for code, item in get_item_index().resolve(company_id, codes).items() if item}
+
+    def record_scans(self, company_id: str, session_id: str, scans: List[Dict[str, Any]], mode: str = "add") -> Dict[str, Any]:
+        """
+        Add a batch of scans: [{item_id | code, quantity (default 1)}].
+        mode "add" accumulates (scanner streams), "set" replaces the counted
+        quantity (manual recount). Items outside the frozen snapshot are added
+        with the expected quantity of their balance at the time of the scan.
+        """
+        if mode not in ("add", "set"):
+            raise ValueError("mode must be 'add' or 'set'")
+        session = self._session(company_id, session_id, {"COUNTING"})
+
+        codes = sorted({s["code"] for s in scans if not s.get("item_id") and s.get("code")})
+        by_code = self._resolve_codes(company_id, codes) if codes else {}
+        totals: Dict[str, int] = {}
+        scan_counts: Dict[str, int] = {}
+        unknown = []
+        for scan in scans:
+            item_id = scan.get("item_id") or by_code.get(scan.get("code"))
+            if not item_id:
+                unknown.append(scan.get("code"))
+                continue
+            qty = Decimal(str(scan.get("quantity", "1")))
+            if qty < 0:
+                raise ValueError("Scanned quantity cannot be negative")
+            units = self.to_units(qty)
+            totals[item_id] = totals.get(item_id, 0) + units if mode == "add" else units
+            scan_counts[item_id] = scan_counts.get(item_id, 0) + 1
+
+        session_ref = self.db.collection(self.COLLECTION).document(session_id)
+        line_refs = {i: session_ref.collection("lines").document(i) for i in totals}
+        existing = {s.id: s.to_dict() for s in self.db.get_all(list(line_refs.values())) if s.exists} if line_refs else {}
+        new_ids = [i for i in totals if i not in existing]
+        new_lines = {}
+        if new_ids:
+            from .stock_balances import StockBalanceService
+            balances = StockBalanceService()
+            refs = [self.db.collection(balances.COLLECTION).document(balances.balance_id(i, session["warehouse_id"])) for i in new_ids]
+            # get_all does not keep order; key by balance id
+            snaps = {s.id: s for s in self.db.get_all(refs)}
+            for item_id in new_ids:
+                snap = snaps[balances.balance_id(item_id, session["warehouse_id"])]
+                new_lines[item_id] = {**self._snapshot_line(item_id, snap), "unexpected": True}
+
+        batch = self.db.batch()
+        pending = 0
+        for item_id, units in totals.items():
+            if item_id in new_lines:
+                batch.set(line_refs[item_id], new_lines[item_id], merge=True)
+            if mode == "add":
+                counted = {"counted_units": firestore.Increment(units), "scan_count": firestore.Increment(scan_counts[item_id])}
+            else:
+                # A manual recount replaces the scans so far
+                counted = {"counted_units": units, "scan_count": 1}
+            line = existing.get(item_id) or {}
+            if "counted_qty" in line and "counted_units" not in line:
+                # Line scanned before counted_units: carry its count over once
+                if mode == "add":
+                    counted["counted_units"] = firestore.Increment(units + self.to_units(self.counted_quantity(line)))
+                counted["counted_qty"] = firestore.DELETE_FIELD
+            batch.set(line_refs[item_id], {**counted, "counted_at": firestore.SERVER_TIMESTAMP}, merge=True)
+            pending += 2
+            if pending >= self.BATCH_WRITES:
+                batch.commit()
+                batch, pending = self.db.batch(), 0
+        if new_lines:
+            batch.update(session_ref, {"line_count": firestore.Increment(len(new_lines))})
+        batch.commit()
+        return {"items": len(totals), "scans": len(scans) - len(unknown), "new_lines": len(new_lines), "unknown_codes": unknown}
+
+    # ==========================================================================
+    # VARIANCES
+    # ==========================================================================
+    def _movements_during_count(self, session: Dict[str, Any], lines: List[Dict[str, Any]]) -> Dict[str, Decimal]:
+        """Per item, the ledger quantity posted after its snapshot and up to its last scan."""
+        windows = {l["item_id"]: (l["snapshot_at"], l.get("counted_at")) for l in lines if l.get("counted_at")}
+        if not windows:
+            return {}
+        query = self.db.collection("stock_ledger")\
+            .where("company_id", "==", session["company_id"])\
+            .where("warehouse_id", "==", session["warehouse_id"])\
+            .where("timestamp", ">", min(start for start, _ in windows.values()))\
+            .order_by("timestamp")
+        moved: Dict[str, Decimal] = {}
+        for snap in stream_paged(query, page_size=1000):
+            row = snap.to_dict()
+            window = windows.get(row.get("item_id"))
+            if not window or (row.get("source_document_type") == DOC_TYPE and row.get("source_document_id") == session["id"]):
+                continue
+            start, end = window
+            if start < row["timestamp"] <= end:
+                moved[row["item_id"]] = moved.get(row["item_id"], ZERO) + Decimal(row["quantity"])
+        return moved
+
+    def compute_variances(self, company_id: str, session_id: str, include_uncounted: bool = False) -> Dict[str, Any]:
+        """
+        Variance per line. Uncounted lines are skipped unless include_uncounted,
+        which treats them as counted zero (items that were not found).
+        """
+        session = self._session(company_id, session_id)
+        lines = self._lines(session_id)
+        moved = self._movements_during_count(session, lines)
+
+        rows = []
+        for line in lines:
+            counted = line.get("counted_at") is not None
+            if not counted and not include_uncounted:
+                continue
+            expected = Decimal(line["expected_qty"])
+            during = moved.get(line["item_id"], ZERO)
+            # Uncounted: compare against the book quantity now (the snapshot plus every later movement)
+            book = expected + during
+            counted_qty = self.counted_quantity(line) if counted else ZERO
+            rows.append({
+                "item_id": line["item_id"],
+                "sku": line.get("sku"),
+                "name": line.get("name"),
+                "expected_qty": str(expected),
+                "moved_during_count": str(during),
+                "book_qty": str(book),
+                "counted_qty": str(counted_qty),
+                "variance_qty": str(counted_qty - book),
+                "counted": counted,
+                "posted": bool(line.get("posted"))
+            })
+        if include_uncounted:
+            self._book_now(session, rows)
+        rows.sort(key=lambda r: abs(Decimal(r["variance_qty"])), reverse=True)
+        return {
+            "id": session_id,
+            "warehouse_id": session["warehouse_id"],
+            "status": session["status"],
+            "lines": rows,
+            "counted_lines": sum(1 for r in rows if r["counted"]),
+            "variance_lines": sum(1 for r in rows if Decimal(r["variance_qty"])),
+            "net_variance_qty": str(sum((Decimal(r["variance_qty"]) for r in rows), ZERO))
+        }
+
+    def _book_now(self, session: Dict[str, Any], rows: List[Dict[str, Any]]):
+        """Uncounted lines are compared with the current balance (nothing was scanned to anchor a window)."""
+        from .stock_balances import StockBalanceService
+        balances = StockBalanceService()
+        pending = [r for r in rows if not r["counted"]]
+        if not pending:
+            return
+        refs = [self.db.collection(balances.COLLECTION).document(balances.balance_id(r["item_id"], session["warehouse_id"])) for r in pending]
+        current = {s.id: s.to_dict() or {} for s in self.db.get_all(refs)}
+        for row in pending:
+            balance = current.get(balances.balance_id(row["item_id"], session["warehouse_id"]), {})
+            book = balances.figure(balance, "qty")
+            row["book_qty"] = str(book)
+            row["moved_during_count"] = str(book - Decimal(row["expected_qty"]))
+            row["variance_qty"] = str(-book)
+
+    # ==========================================================================
+    # POSTING
+    # ==========================================================================
+    def _post_chunk(self, session: Dict[str, Any], variances: Dict[str, Decimal]):
+        """One transaction: move the stock of a group of lines and mark them posted."""
+        posting_engine = self.posting_engine
+        session_ref = self.db.collection(self.COLLECTION).document(session["id"])
+        wh = session["warehouse_id"]
+        transaction = self.db.transaction()
+
+        @firestore.transactional
+        def _execute(transaction):
+            # PHASE 1: READ
+            line_refs = {i: session_ref.collection("lines").document(i) for i in variances}
+            posted = {s.id for s in self.db.get_all(list(line_refs.values()), transaction=transaction)
+                      if (s.to_dict() or {}).get("posted")}
+            todo = {i: q for i, q in variances.items() if i not in posted}
+            items_data = posting_engine.get_items_for_transaction(transaction, list(todo))
+            balances = posting_engine.balances.get_for_transaction(transaction, [(i, wh) for i in todo])
+            layer_plans, planned = {}, {}
+            for item_id, qty in todo.items():
+                item_data = items_data.get(item_id)
+                if not item_data:
+                    raise ValueError(f"Item {item_id} not found")
+                if qty < 0 and posting_engine.layers.uses_layers(item_data):
+                    layer_plans[item_id] = posting_engine.layers.plan_consumption(
+                        transaction, item_id, wh, -qty, item_data["costing_method"], None, planned
+                    )
+
+            # PHASE 3: WRITE
+            for item_id, qty in todo.items():
+                item_data = items_data[item_id]
+                wac = Decimal(item_data.get("current_wac", "0"))
+                rate = posting_engine.record_stock_movement(
+                    transaction, item_id, wh, qty, wac, session["id"], DOC_TYPE, item_data,
+                    consumed_layers=layer_plans.get(item_id), balances=balances
+                )
+                value = qty * (wac if qty > 0 else rate)
+                transaction.update(line_refs[item_id], {
+                    "posted": True,
+                    "adjustment_qty": str(qty),
+                    "adjustment_value": str(value),
+                    "inventory_account_id": item_data.get("inventory_account_id"),
+                    "cogs_account_id": item_data.get("cogs_account_id")
+                })
+            return len(todo)
+
+        return _execute(transaction)
+
+    def _variance_account(self, company_id: str) -> Optional[str]:
+        docs = list(self.db.collection("accounts")
+                    .where("company_id", "==", company_id)
+                    .where("code", "==", VARIANCE_ACCOUNT_CODE)
+                    .limit(1).stream())
+        return docs[0].id if docs else None
+
+    def _post_journal(self, session: Dict[str, Any]) -> Optional[str]:
+        """One journal entry for every posted line: inventory accounts against the variance account."""
+        company_id = session["company_id"]
+        variance_account = self._variance_account(company_id)
+        net: Dict[str, Decimal] = {}
+        for line in self._lines(session["id"]):
+            if not line.get("posted") or not line.get("adjustment_value"):
+                continue
+            value = Decimal(line["adjustment_value"])
+            net[line["inventory_account_id"]] = net.get(line["inventory_account_id"], ZERO) + value
+            offset = variance_account or line["cogs_account_id"]
+            net[offset] = net.get(offset, ZERO) - value
+        lines_data = [
+            {
+                "account_id": account_id,
+                "debit": str(amount) if amount > 0 else "0.0000",
+                "credit": str(-amount) if amount < 0 else "0.0000",
+                "description": f"Cycle count {session['id']} variance"
+            }
+            for account_id, amount in sorted(net.items()) if amount
+        ]
+
+        session_ref = self.db.collection(self.COLLECTION).document(session["id"])
+        je_ref = self.db.collection("journal_entries").document()
+        transaction = self.db.transaction()
+
+        @firestore.transactional
+        def _execute(transaction):
+            # PHASE 1: READ
+            current = session_ref.get(transaction=transaction).to_dict()
+            if current.get("status") == "POSTED":
+                return current.get("journal_entry_id")
+            accounts_data = self.posting_engine.get_accounts_for_transaction(
+                transaction, [l["account_id"] for l in lines_data]
+            )
+
+            # PHASE 3: WRITE
+            je_id = None
+            if lines_data:
+                je_id = je_ref.id
+                transaction.set(je_ref, {
+                    "number": f"JE-CC-{session['id'][:8].upper()}",
+                    "date": datetime.now(timezone.utc),
+                    "description": f"Inventory variance from cycle count of warehouse {session['warehouse_id']}",
+                    "status": "DRAFT",
+                    "source_document_type": DOC_TYPE,
+                    "source_document_id": session["id"],
+                    "company_id": company_id,
+                    "lines": self.posting_engine.journal_lines.inline(lines_data)
+                })
+                self.posting_engine.post_journal_entry(
+                    transaction, je_id, lines_data, accounts_data, company_id=company_id, source_type=DOC_TYPE
+                )
+            transaction.update(session_ref, {
+                "status": "POSTED",
+                "journal_entry_id": je_id,
+                "posted_at": firestore.SERVER_TIMESTAMP
+            })
+            return je_id
+
+        return _execute(transaction)
+
+    def post(self, company_id: str, session_id: str, posted_by: Optional[str] = None,
+             include_uncounted: bool = False) -> Dict[str, Any]:
+        """
+        Apply every non-zero variance as a stock movement (grouped transactions)
+        and book the summarized variance journal entry. Safe to re-run after a
+        failure: posted lines are skipped.
+        """
+        session = self._session(company_id, session_id, {"COUNTING", "POSTING"})
+        session_ref = self.db.collection(self.COLLECTION).document(session_id)
+        if session["status"] == "COUNTING":
+            report = self.compute_variances(company_id, session_id, include_uncounted)
+            variances = {r["item_id"]: r["variance_qty"] for r in report["lines"]
+                         if Decimal(r["variance_qty"]) and not r["posted"]}
+            # Freeze the variances: scans are refused from here on and a retry posts the same figures
+            session_ref.update({
+                "status": "POSTING",
+                "posted_by": posted_by,
+                "variances": variances
+            })
+            session["variances"] = variances
+        variances = {i: Decimal(q) for i, q in (session.get("variances") or {}).items()}
+
+        item_ids = sorted(variances)
+        moved = 0
+        for start in range(0, len(item_ids), self.POST_CHUNK):
+            chunk = {i: variances[i] for i in item_ids[start:start + self.POST_CHUNK]}
+            moved += self._post_chunk(session, chunk)
+
+        je_id = self._post_journal(session)
+        return {"id": session_id, "status": "POSTED", "adjusted_items": len(item_ids),
+                "moved_now": moved, "journal_entry_id": je_id}
+
+
+def get_cycle_count_service() -> CycleCountService:
+    return CycleCountService()
@@ -83,7 +83,7 @@ class ExpenseService:
                 "date": exp_data["date"],
                 "description": f"Expense: {data.description}",
                 "status": "POSTED",
-                "lines": lines,
+                "lines": self.posting_engine.journal_lines.inline(lines),
                 "company_id": company_id,
                 "source_doc_id": doc_ref.id,
                 "source_doc_type": "EXPENSE"
@@ -96,7 +96,11 @@ class ExpenseService:
             # NOW perform all writes
             je_ref = self.db.collection("journal_entries").document()
             transaction.set(je_ref, je_data)
-            self.posting_engine.post_journal_entry(transaction, je_ref.id, lines, accounts_data)
+            self.posting_engine.post_journal_entry(
+                transaction, je_ref.id, lines, accounts_data,
+                entry_date=exp_data["date"], company_id=company_id, source_type="EXPENSE",
+                dimensions={"cost_center_id": data.cost_center_id, "project_id": data.project_id}
+            )
             
             # Save Expense
             exp_data["journal_entry_id"] = je_ref.id
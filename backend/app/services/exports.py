@@ -0,0 +1,394 @@
+"""
+Report Export Engine
+Streams report rows from Firestore query cursors straight into the HTTP response
+(CSV or NDJSON), or into a constant-memory XLSX workbook.
+Memory stays bounded to one query page regardless of export size.
+"""
+import csv
+import json
+import os
+import tempfile
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+from app.core.firebase import get_db, stream_paged
+from .reporting import ReportingService
+from .journal_lines import get_journal_line_store
+
+
+class _EchoBuffer:
+    """File-like object whose write() returns the value, letting csv.writer emit lines lazily."""
+
+    def write(self, value):
+        return value
+
+
+def _fmt(value) -> Any:
+    """Serialize Firestore values (timestamps, Decimals) for export."""
+    if value is None:
+        return ""
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+class ExportService:
+    """Streams report and ledger exports in CSV / NDJSON."""
+
+    MEDIA_TYPES = {
+        "csv": "text/csv; charset=utf-8",
+        "ndjson": "application/x-ndjson"
+    }
+
+    # Available columns per report type (also the default column order)
+    COLUMNS = {
+        "journals": ["id", "number", "date", "description", "status", "source_doc_type", "total_debit", "total_credit"],
+        "journal_lines": ["journal_id", "number", "date", "status", "account_id", "debit", "credit", "memo"],
+        "stock_ledger": ["id", "timestamp", "item_id", "warehouse_id", "quantity", "unit_cost", "valuation_rate",
+                         "source_document_type", "source_document_id", "batch_number", "customer_id"],
+        "invoices": ["id", "invoice_number", "issue_date", "due_date", "customer_id", "customer_name", "status",
+                     "total", "paid_amount", "remaining_amount"],
+        "vouchers": ["id", "voucher_type", "number", "date", "party", "amount", "currency", "payment_method", "journal_id"],
+        "gl": ["journal_id", "date", "number", "description", "memo", "debit", "credit", "balance"],
+        "tb": ["account_id", "code", "name", "type", "debit", "credit", "net_balance"],
+        "inventory": ["id", "sku", "name", "barcode", "unit", "storage_type", "current_qty", "current_wac", "total_value"],
+        "audit": ["id", "timestamp", "user_id", "action", "collection", "document_id", "description"],
+        "aging": ["partner_id", "partner_name", "total", "current", "d30", "d60", "d90", "over90"],
+        "statement": ["journal_id", "date", "number", "description", "memo", "debit", "credit", "balance"],
+    }
+
+    # Numeric columns written as amounts in XLSX (everything else stays text)
+    AMOUNT_COLUMNS = {
+        "debit", "credit", "balance", "net_balance", "total", "total_debit", "total_credit",
+        "paid_amount", "remaining_amount", "amount", "unit_cost", "valuation_rate", "current_wac",
+        "total_value", "current", "d30", "d60", "d90", "over90",
+    }
+    QUANTITY_COLUMNS = {"quantity", "current_qty"}
+    DATE_COLUMNS = {"date", "timestamp", "issue_date", "due_date"}
+
+    # Excel number formats per currency (IQD has 3-decimal fils, shown whole; USD cents)
+    NUMBER_FORMATS = {
+        "IQD": '#,##0 "IQD";[Red]-#,##0 "IQD"',
+        "USD": '"$"#,##0.00;[Red]-"$"#,##0.00',
+    }
+    QUANTITY_FORMAT = "#,##0.####"
+    DATE_FORMAT = "yyyy-mm-dd hh:mm"
+
+    # URL aliases used by the frontend
+    ALIASES = {
+        "trial-balance": "tb",
+        "general-ledger": "gl",
+        "journal-lines": "journal_lines",
+        "stock-ledger": "stock_ledger",
+        "stock-movement": "stock_ledger",
+        "stock_movement": "stock_ledger",
+        "customer-statement": "statement",
+    }
+
+    def __init__(self):
+        self.db = get_db()
+        self.reporting = ReportingService()
+
+    # ==========================================================================
+    # SOURCES (generators of dict rows)
+    # ==========================================================================
+    def _date_query(self, collection: str, company_id: str, date_field: str,
+                    from_date: Optional[datetime], to_date: Optional[datetime]):
+        query = self.db.collection(collection).where("company_id", "==", company_id)
+        if from_date:
+            query = query.where(date_field, ">=", from_date)
+        if to_date:
+            query = query.where(date_field, "<=", to_date)
+        return query.order_by(date_field)
+
+    def _journal_docs(self, company_id, from_date, to_date):
+        hot = stream_paged(self._date_query("journal_entries", company_id, "date", from_date, to_date))
+        return self.reporting.archive.read_through(company_id, "journal_entries", hot, from_date, to_date)
+
+    def _iter_journals(self, company_id, from_date, to_date, **_):
+        for doc in self._journal_docs(company_id, from_date, to_date):
+            data = doc.to_dict()
+            # Posted headers carry their totals; older entries are summed from the lines
+            if "total_debit" not in data:
+                lines = get_journal_line_store().lines_of(doc.id, data)
+                data["total_debit"] = str(sum(Decimal(str(l.get("debit", "0"))) for l in lines))
+                data["total_credit"] = str(sum(Decimal(str(l.get("credit", "0"))) for l in lines))
+            yield {
+                "id": doc.id,
+                "number": data.get("number"),
+                "date": data.get("date"),
+                "description": data.get("description"),
+                "status": data.get("status"),
+                "source_doc_type": data.get("source_doc_type") or data.get("source_document_type"),
+                "total_debit": data["total_debit"],
+                "total_credit": data["total_credit"],
+            }
+
+    def _iter_journal_lines(self, company_id, from_date, to_date, **_):
+        for doc in self._journal_docs(company_id, from_date, to_date):
+            data = doc.to_dict()
+            for line in get_journal_line_store().iter_lines(doc.id, data):
+                yield {
+                    "journal_id": doc.id,
+                    "number": data.get("number"),
+                    "date": data.get("date"),
+                    "status": data.get("status"),
+                    "account_id": line.get("account_id"),
+                    "debit": line.get("debit", "0"),
+                    "credit": line.get("credit", "0"),
+                    "memo": line.get("memo") or line.get("description"),
+                }
+
+    def _legacy_stock_cutoff(self, company_id):
+        """Upper bound of legacy (timestamp-only) row timestamps: the timestamp of a dated row."""
+        first = list(self.db.collection("stock_ledger")
+                     .where("company_id", "==", company_id)
+                     .order_by("posting_date")
+                     .limit(1).stream())
+        return first[0].to_dict().get("timestamp") if first else None
+
+    def _iter_stock_ledger(self, company_id, from_date, to_date, **_):
+        # Rows from before posting_date existed only have a timestamp; they precede every dated row
+        cutoff = self._legacy_stock_cutoff(company_id)
+        if cutoff is None or from_date is None or from_date <= cutoff:
+            legacy_to = min(to_date, cutoff) if to_date and cutoff else (to_date or cutoff)
+            for doc in stream_paged(self._date_query("stock_ledger", company_id, "timestamp", from_date, legacy_to)):
+                data = doc.to_dict()
+                if data.get("posting_date") is None:
+                    yield {"id": doc.id, **data}
+
+        # Dated rows by posting date, like the archive (back-dated movements land in their period)
+        hot = stream_paged(self._date_query("stock_ledger", company_id, "posting_date", from_date, to_date))
+        for doc in self.reporting.archive.read_through(company_id, "stock_ledger", hot, from_date, to_date):
+            yield {"id": doc.id, **doc.to_dict()}
+
+    def _iter_invoices(self, company_id, from_date, to_date, **_):
+        for doc in stream_paged(self._date_query("invoices", company_id, "issue_date", from_date, to_date)):
+            yield {"id": doc.id, **doc.to_dict()}
+
+    def _iter_vouchers(self, company_id, from_date, to_date, **_):
+        sources = (
+            ("PV", "payment_vouchers", "voucher_number", "payee"),
+            ("RV", "receipt_vouchers", "receipt_number", "customer_id"),
+        )
+        for voucher_type, collection, number_field, party_field in sources:
+            for doc in stream_paged(self._date_query(collection, company_id, "date", from_date, to_date)):
+                data = doc.to_dict()
+                yield {
+                    "id": doc.id,
+                    "voucher_type": voucher_type,
+                    "number": data.get(number_field),
+                    "date": data.get("date"),
+                    "party": data.get(party_field),
+                    "amount": data.get("amount"),
+                    "currency": data.get("currency", "IQD"),
+                    "payment_method": data.get("payment_method"),
+                    "journal_id": data.get("journal_id"),
+                }
+
+    def _iter_gl(self, company_id, from_date, to_date, account_id: Optional[str] = None, **_):
+        if not account_id:
+            raise ValueError("account_id is required for the general ledger export")
+        return self.reporting.iter_general_ledger(company_id, account_id, from_date, to_date)
+
+    def _iter_tb(self, company_id, from_date, to_date, **_):
+        return self.reporting.iter_trial_balance(company_id)
+
+    def _iter_aging(self, company_id, from_date, to_date, aging_type: Optional[str] = None, **_):
+        return self.reporting.iter_aging(company_id, aging_type or "AR", as_of=to_date)
+
+    def _iter_statement(self, company_id, from_date, to_date, customer_id: Optional[str] = None, **_):
+        if not customer_id:
+            raise ValueError("customer_id is required for the statement export")
+        return self.reporting.iter_customer_statement(company_id, customer_id, from_date, to_date)
+
+    def _iter_inventory(self, company_id, from_date, to_date, **_):
+        query = self.db.collection("items").where("company_id", "==", company_id)
+        for doc in stream_paged(query):
+            yield {"id": doc.id, **doc.to_dict()}
+
+    def _iter_audit(self, company_id, from_date, to_date, **_):
+        query = self.db.collection("audit_logs").where("company_id", "==", company_id)
+        if from_date:
+            query = query.where("timestamp", ">=", from_date.isoformat())
+        if to_date:
+            query = query.where("timestamp", "<=", to_date.isoformat())
+        for doc in stream_paged(query.order_by("timestamp")):
+            yield {"id": doc.id, **doc.to_dict()}
+
+    # ==========================================================================
+    # PUBLIC API
+    # ==========================================================================
+    def resolve(self, report_type: str) -> str:
+        report_type = self.ALIASES.get(report_type, report_type)
+        if report_type not in self.COLUMNS:
+            raise ValueError(f"Unknown report type '{report_type}'. Available: {', '.join(sorted(self.COLUMNS))}")
+        return report_type
+
+    def select_columns(self, report_type: str, columns: Optional[List[str]] = None) -> List[str]:
+        available = self.COLUMNS[report_type]
+        if not columns:
+            return list(available)
+        unknown = [c for c in columns if c not in available]
+        if unknown:
+            raise ValueError(f"Unknown columns for {report_type}: {', '.join(unknown)}")
+        return list(columns)
+
+    def iter_rows(self, report_type: str, company_id: str, from_date: Optional[datetime] = None,
+                  to_date: Optional[datetime] = None, **params) -> Iterator[Dict[str, Any]]:
+        """Row generator for a report type (shared by CSV, NDJSON and XLSX writers)."""
+        report_type = self.resolve(report_type)
+        if from_date and from_date.tzinfo is None:
+            from_date = from_date.replace(tzinfo=timezone.utc)
+        if to_date and to_date.tzinfo is None:
+            to_date = to_date.replace(tzinfo=timezone.utc)
+        source = getattr(self, f"_iter_{report_type}")
+        return source(company_id, from_date, to_date, **params)
+
+    def stream(self, report_type: str, company_id: str, fmt: str = "csv", columns: Optional[List[str]] = None,
+               from_date: Optional[datetime] = None, to_date: Optional[datetime] = None, **params) -> Tuple[Iterator[str], str]:
+        """
+        Build a lazy text stream for StreamingResponse.
+        Validation happens eagerly so errors surface before the response starts.
+
+        Returns:
+            (chunk iterator, media type)
+        """
+        fmt = fmt.lower()
+        if fmt not in self.MEDIA_TYPES:
+            raise ValueError(f"Unsupported format '{fmt}'. Use csv or ndjson")
+        report_type = self.resolve(report_type)
+        cols = self.select_columns(report_type, columns)
+        rows = self.iter_rows(report_type, company_id, from_date, to_date, **params)
+
+        if fmt == "csv":
+            return self._csv_chunks(rows, cols), self.MEDIA_TYPES[fmt]
+        return self._ndjson_chunks(rows, cols), self.MEDIA_TYPES[fmt]
+
+    @staticmethod
+    def _csv_chunks(rows: Iterator[Dict[str, Any]], columns: List[str], rows_per_chunk: int = 200) -> Iterator[str]:
+        writer = csv.writer(_EchoBuffer())
+        # BOM so Excel opens UTF-8 (Arabic names) correctly
+        yield "\ufeff" + writer.writerow(columns)
+        chunk = []
+        for row in rows:
+            chunk.append(writer.writerow([_fmt(row.get(c)) for c in columns]))
+            if len(chunk) >= rows_per_chunk:
+                yield "".join(chunk)
+                chunk = []
+        if chunk:
+            yield "".join(chunk)
+
+    @staticmethod
+    def _ndjson_chunks(rows: Iterator[Dict[str, Any]], columns: List[str], rows_per_chunk: int = 200) -> Iterator[str]:
+        chunk = []
+        for row in rows:
+            chunk.append(json.dumps({c: _fmt(row.get(c)) for c in columns}, ensure_ascii=False, default=str) + "\n")
+            if len(chunk) >= rows_per_chunk:
+                yield "".join(chunk)
+                chunk = []
+        if chunk:
+            yield "".join(chunk)
+
+    def build_xlsx(self, report_type: str, company_id: str, columns: Optional[List[str]] = None,
+                   from_date: Optional[datetime] = None, to_date: Optional[datetime] = None,
+                   currency: str = "IQD", **params) -> str:
+        """
+        Write a report to a temporary .xlsx file using xlsxwriter's constant_memory mode
+        (rows are flushed to disk as they are written) and return the file path.
+        The file is removed if building fails; otherwise stream it with iter_file,
+        which deletes it once sent (or when the client goes away).
+        """
+        import xlsxwriter
+
+        report_type = self.resolve(report_type)
+        cols = self.select_columns(report_type, columns)
+        rows = self.iter_rows(report_type, company_id, from_date, to_date, **params)
+
+        handle = tempfile.NamedTemporaryFile(prefix=f"{report_type}_", suffix=".xlsx", delete=False)
+        handle.close()
+
+        try:
+            workbook = xlsxwriter.Workbook(handle.name, {"constant_memory": True, "remove_timezone": True})
+            try:
+                sheet = workbook.add_worksheet(report_type[:31])
+                header_fmt = workbook.add_format({"bold": True, "bg_color": "#f1f5f9", "bottom": 1})
+                amount_fmt = workbook.add_format({"num_format": self.NUMBER_FORMATS.get(currency.upper(), self.NUMBER_FORMATS["IQD"])})
+                qty_fmt = workbook.add_format({"num_format": self.QUANTITY_FORMAT})
+                date_fmt = workbook.add_format({"num_format": self.DATE_FORMAT})
+
+                # Column formats/widths must be set before rows are flushed
+                for idx, col in enumerate(cols):
+                    if col in self.AMOUNT_COLUMNS:
+                        sheet.set_column(idx, idx, 18, amount_fmt)
+                    elif col in self.QUANTITY_COLUMNS:
+                        sheet.set_column(idx, idx, 12, qty_fmt)
+                    elif col in self.DATE_COLUMNS:
+                        sheet.set_column(idx, idx, 18, date_fmt)
+                    else:
+                        sheet.set_column(idx, idx, 22)
+
+                sheet.freeze_panes(1, 0)
+                sheet.write_row(0, 0, cols, header_fmt)
+
+                # Resolve the cell writer per column once, not per cell
+                writers = []
+                for col_idx, col in enumerate(cols):
+                    if col in self.AMOUNT_COLUMNS:
+                        writers.append((col_idx, col, "number", amount_fmt))
+                    elif col in self.QUANTITY_COLUMNS:
+                        writers.append((col_idx, col, "number", qty_fmt))
+                    elif col in self.DATE_COLUMNS:
+                        writers.append((col_idx, col, "date", date_fmt))
+                    else:
+                        writers.append((col_idx, col, "text", None))
+
+                row_idx = 1
+                for row in rows:
+                    for col_idx, col, kind, cell_fmt in writers:
+                        value = row.get(col)
+                        if value is None or value == "":
+                            continue
+                        if kind == "number":
+                            sheet.write_number(row_idx, col_idx, float(value), cell_fmt)
+                        elif kind == "date" and isinstance(value, datetime):
+                            sheet.write_datetime(row_idx, col_idx, value, cell_fmt)
+                        else:
+                            sheet.write_string(row_idx, col_idx, str(_fmt(value)))
+                    row_idx += 1
+
+                if row_idx > 1:
+                    sheet.autofilter(0, 0, row_idx - 1, len(cols) - 1)
+            finally:
+                workbook.close()
+        except BaseException:
+            # Nothing will stream this file: remove the partial workbook
+            self.remove_file(handle.name)
+            raise
+
+        return handle.name
+
+    @staticmethod
+    def remove_file(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def iter_file(self, path: str, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+        """Stream a built export and delete it afterwards, also when streaming stops early."""
+        try:
+            with open(path, "rb") as handle:
+                while True:
+                    chunk = handle.read(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+        finally:
+            self.remove_file(path)
+
+
+def get_export_service() -> ExportService:
+    return ExportService()
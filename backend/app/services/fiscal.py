@@ -2,24 +2,36 @@
 Fiscal Period & Opening Balances Service
 Handles period closing and opening balance entries.
 """
-from datetime import datetime, date
+from datetime import datetime, date, timedelta, timezone
 from decimal import Decimal
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 from google.cloud import firestore
-from app.core.firebase import get_db
+from app.core.firebase import get_db, stream_paged
 from app.core.audit import get_audit_logger
 from app.models.core import DocumentStatus
+from .periods import get_period_registry
+from .posting import PostingEngine
+from .valuation import get_valuation_service
+from .archive import ArchiveService
+from .journal_lines import get_journal_line_store
 
 class FiscalService:
     """Manages fiscal periods and opening balances."""
     
     PERIODS_COLLECTION = "fiscal_periods"
+    YEAR_CLOSINGS_COLLECTION = "year_closings"
+    CLOSING_SOURCE_TYPE = "YEAR_END_CLOSE"
+    # Lines per closing JE: keeps each JE doc well under 1 MiB and each posting
+    # transaction (JE + account updates + rollup) under the 500-write limit
+    CLOSING_CHUNK_LINES = 400
     
     def __init__(self, user_id: str = "system", company_id: str = "default"):
         self.db = get_db()
         self.audit = get_audit_logger(user_id, company_id)
         self.user_id = user_id
         self.company_id = company_id
+        self.periods = get_period_registry()
+        self.posting_engine = PostingEngine()
     
     def close_period(self, year: int, month: int) -> str:
         """
@@ -51,6 +63,14 @@ class FiscalService:
         }
         
         period_ref.set(period_data)
+        self.periods.mark(self.company_id, year, month, closed=True)
+
+        # Closed periods no longer change: snapshot stock as of the last day
+        try:
+            last_day = (date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1))
+            get_valuation_service().take_snapshot(self.company_id, last_day)
+        except Exception as e:
+            print(f"[Fiscal] Stock snapshot for {year}-{month:02d} failed: {e}")
         
         self.audit.log_action(
             action="CLOSE_PERIOD",
@@ -63,17 +83,8 @@ class FiscalService:
         return period_key
     
     def is_period_open(self, transaction_date: date) -> bool:
-        """Check if a transaction date falls within an open period."""
-        year = transaction_date.year
-        month = transaction_date.month
-        
-        period_key = f"{self.company_id}_{year}_{month:02d}"
-        period_doc = self.db.collection(self.PERIODS_COLLECTION).document(period_key).get()
-        
-        if not period_doc.exists:
-            return True  # Period not explicitly closed = open
-        
-        return period_doc.to_dict().get("status") != "CLOSED"
+        """Check if a transaction date falls within an open period (served from the in-memory registry)."""
+        return not self.periods.is_closed(self.company_id, transaction_date)
     
     def reopen_period(self, year: int, month: int) -> str:
         """Reopen a closed period (admin only)."""
@@ -83,12 +94,18 @@ class FiscalService:
         existing = period_ref.get()
         if not existing.exists:
             raise ValueError(f"Period {year}-{month:02d} does not exist")
+
+        # An archived month must be back in the hot collections before it can change again
+        restored = ArchiveService().restore_period(self.company_id, f"{year}-{month:02d}")
+        if restored["restored"]:
+            print(f"[Fiscal] Restored {restored['restored']} archived rows of {year}-{month:02d}")
         
         period_ref.update({
             "status": "OPEN",
             "reopened_at": firestore.SERVER_TIMESTAMP,
             "reopened_by": self.user_id
         })
+        self.periods.mark(self.company_id, year, month, closed=False)
         
         self.audit.log_action(
             action="REOPEN_PERIOD",
@@ -125,18 +142,32 @@ class FiscalService:
                 "description": "Opening Balance"
             })
         
+        entry_date = datetime(effective_date.year, effective_date.month, effective_date.day, tzinfo=timezone.utc)
         je_ref = self.db.collection("journal_entries").document()
         je_data = {
             "number": je_number,
-            "date": firestore.SERVER_TIMESTAMP,
+            "date": entry_date,
             "description": f"Opening Balances as of {effective_date.isoformat()}",
-            "status": DocumentStatus.POSTED,
+            "status": DocumentStatus.DRAFT,
             "source_document_type": "OPENING_BALANCE",
             "company_id": self.company_id,
-            "lines": lines
+            "lines": self.posting_engine.journal_lines.inline(lines)
         }
         
-        je_ref.set(je_data)
+        # Post through PostingEngine so account balances and rollups move with the JE
+        transaction = self.db.transaction()
+
+        @firestore.transactional
+        def _execute(transaction):
+            accounts_data = self.posting_engine.get_accounts_for_transaction(transaction, [l["account_id"] for l in lines])
+            transaction.set(je_ref, je_data)
+            self.posting_engine.post_journal_entry(
+                transaction, je_ref.id, lines, accounts_data,
+                entry_date=entry_date, company_id=self.company_id, source_type="OPENING_BALANCE"
+            )
+
+        _execute(transaction)
+        je_data["status"] = DocumentStatus.POSTED
         
         self.audit.log_create(
             collection="journal_entries",
@@ -147,6 +178,277 @@ class FiscalService:
         
         return je_ref.id
 
+    # ==========================================================================
+    # YEAR-END CLOSE
+    # ==========================================================================
+    def _year_end(self, year: int) -> datetime:
+        return datetime(year, 12, 31, 23, 59, 59, tzinfo=timezone.utc)
+
+    def _resolve_retained_earnings(self, account_id: Optional[str]) -> str:
+        if account_id:
+            snap = self.db.collection("accounts").document(account_id).get()
+            if not snap.exists or snap.to_dict().get("company_id") != self.company_id:
+                raise ValueError("Retained earnings account not found")
+            return account_id
+        query = self.db.collection("accounts")\
+            .where("company_id", "==", self.company_id)\
+            .where("is_retained_earnings", "==", True)\
+            .limit(1)
+        snaps = list(query.stream())
+        if not snaps:
+            raise ValueError("No retained earnings account: pass retained_earnings_account_id or flag an equity account with is_retained_earnings")
+        return snaps[0].id
+
+    def _closing_balances(self, year: int) -> Dict[str, Decimal]:
+        """
+        REVENUE/EXPENSE balances at year end in one streamed pass:
+        current balance minus movements dated after the year end.
+        """
+        balances = {}
+        accounts_query = self.db.collection("accounts")\
+            .where("company_id", "==", self.company_id)\
+            .where("type", "in", ["REVENUE", "EXPENSE"])
+        for snap in stream_paged(accounts_query):
+            data = snap.to_dict()
+            if data.get("is_group"):
+                continue
+            balances[snap.id] = Decimal(str(data.get("balance", "0")))
+
+        later_query = self.db.collection("journal_entries")\
+            .where("company_id", "==", self.company_id)\
+            .where("date", ">", self._year_end(year))
+        later = ArchiveService().read_through(
+            self.company_id, "journal_entries", stream_paged(later_query), self._year_end(year) + timedelta(microseconds=1)
+        )
+        for je in later:
+            data = je.to_dict()
+            if data.get("status") not in ("POSTED", "VOIDED"):
+                continue
+            for line in get_journal_line_store().iter_lines(je.id, data):
+                acc_id = line.get("account_id")
+                if acc_id in balances:
+                    balances[acc_id] -= Decimal(str(line.get("debit", "0"))) - Decimal(str(line.get("credit", "0")))
+
+        return {acc_id: bal for acc_id, bal in balances.items() if bal}
+
+    def _post_closing_chunk(self, je_id: str, number: str, description: str, lines: list, entry_date: datetime,
+                            extra: Dict[str, Any] = None, voids: Optional[str] = None) -> bool:
+        """
+        Post one closing (or reversal) JE through PostingEngine. Returns False if it already exists.
+        voids: id of the POSTED entry this one reverses; it is marked VOIDED in the same transaction.
+        """
+        je_ref = self.db.collection("journal_entries").document(je_id)
+        void_ref = self.db.collection("journal_entries").document(voids) if voids else None
+        transaction = self.db.transaction()
+
+        @firestore.transactional
+        def _execute(transaction):
+            # PHASE 1: READ
+            exists = je_ref.get(transaction=transaction).exists
+            original = void_ref.get(transaction=transaction) if void_ref else None
+            void_original = original is not None and original.exists and original.to_dict().get("status") == "POSTED"
+            accounts_data = {} if exists else self.posting_engine.get_accounts_for_transaction(
+                transaction, [l["account_id"] for l in lines]
+            )
+
+            # PHASE 3: WRITE
+            if void_original:
+                transaction.update(void_ref, {
+                    "status": DocumentStatus.VOIDED,
+                    "voided_at": firestore.SERVER_TIMESTAMP,
+                    "voided_by": self.user_id,
+                    "voided_reason": "Year-end close re-run",
+                    "reversal_je_id": je_id
+                })
+            if exists:
+                return False
+            transaction.set(je_ref, {
+                "number": number,
+                "date": entry_date,
+                "description": description,
+                "status": "DRAFT",
+                "lines": self.posting_engine.journal_lines.inline(lines),
+                "company_id": self.company_id,
+                "source_doc_type": self.CLOSING_SOURCE_TYPE,
+                "created_by": self.user_id,
+                "created_at": firestore.SERVER_TIMESTAMP,
+                **(extra or {})
+            })
+            self.posting_engine.post_journal_entry(
+                transaction, je_ref.id, lines, accounts_data,
+                entry_date=entry_date, company_id=self.company_id,
+                source_type=self.CLOSING_SOURCE_TYPE, allow_closed_period=True
+            )
+            return True
+
+        return _execute(transaction)
+
+    def _reverse_closing(self, closing: Dict[str, Any], year: int):
+        """Reverse a previous year-end close entry by entry (posted as reversals, originals VOIDED)."""
+        for je_id in closing.get("journal_entry_ids", []):
+            je_ref = self.db.collection("journal_entries").document(je_id)
+            snap = je_ref.get()
+            if not snap.exists:
+                continue
+            data = snap.to_dict()
+            rev_id = f"{je_id}_REV"
+            if data.get("status") == "POSTED":
+                reversed_lines = [
+                    {**l, "debit": l.get("credit", "0"), "credit": l.get("debit", "0"), "memo": f"Reversal: {l.get('memo', '')}"}
+                    for l in get_journal_line_store().iter_lines(je_id, data)
+                ]
+                self._post_closing_chunk(
+                    rev_id, f"REV-{data.get('number', je_id)}", f"Reversal of year-end close {year}",
+                    reversed_lines, self._year_end(year), {"reversal_of": je_id}, voids=je_id
+                )
+
+    def _plan_closing(self, closing_ref, year: int, run: int, re_account_id: str) -> Dict[str, Any]:
+        """Build the balanced closing chunks from the Dec 31 balances and store them before anything is posted."""
+        balances = self._closing_balances(year)
+        closing_lines = []
+        for acc_id, balance in sorted(balances.items()):
+            closing_lines.append({
+                "account_id": acc_id,
+                "debit": str(-balance) if balance < 0 else "0",
+                "credit": str(balance) if balance > 0 else "0",
+                "memo": f"Year-end close {year}"
+            })
+
+        parts = []
+        net_income = Decimal("0")
+        for idx in range(0, len(closing_lines), self.CLOSING_CHUNK_LINES):
+            chunk = closing_lines[idx:idx + self.CLOSING_CHUNK_LINES]
+            offset = sum(Decimal(l["debit"]) - Decimal(l["credit"]) for l in chunk)
+            net_income += offset
+            if offset:
+                chunk = chunk + [{
+                    "account_id": re_account_id,
+                    "debit": str(-offset) if offset < 0 else "0",
+                    "credit": str(offset) if offset > 0 else "0",
+                    "memo": f"Net result {year} to retained earnings"
+                }]
+            part = idx // self.CLOSING_CHUNK_LINES + 1
+            parts.append({"part": part, "je_id": f"YEC_{self.company_id}_{year}_R{run}_{part:03d}", "lines": chunk})
+
+        batch = self.db.batch()
+        plan_ids = {f"R{run}_{part['part']:03d}" for part in parts}
+        # A planning attempt interrupted before it was recorded may have left other parts of this run
+        for stale in closing_ref.collection("plan").where("run", "==", run).stream():
+            if stale.id not in plan_ids:
+                batch.delete(stale.reference)
+        for part in parts:
+            batch.set(closing_ref.collection("plan").document(f"R{run}_{part['part']:03d}"), {"run": run, **part})
+        batch.commit()
+        plan = {"parts": parts, "accounts_closed": len(closing_lines), "net_income": str(net_income)}
+        closing_ref.update({
+            "planned_run": run,
+            "planned_parts": len(parts),
+            "accounts_closed": plan["accounts_closed"],
+            "net_income": plan["net_income"]
+        })
+        return plan
+
+    def _load_plan(self, closing_ref, run: int) -> Dict[str, Any]:
+        """The chunks stored by _plan_closing for this run."""
+        closing = closing_ref.get().to_dict()
+        parts = sorted(
+            (snap.to_dict() for snap in closing_ref.collection("plan").where("run", "==", run).stream()),
+            key=lambda p: p["part"]
+        )
+        if len(parts) != closing.get("planned_parts"):
+            raise ValueError(f"Year-end close plan of run {run} is incomplete; close again with redo after checking year_closings")
+        return {"parts": parts, "accounts_closed": closing.get("accounts_closed", 0), "net_income": closing.get("net_income", "0")}
+
+    def close_year(self, year: int, retained_earnings_account_id: Optional[str] = None, redo: bool = False) -> Dict[str, Any]:
+        """
+        Year-end close: zero every REVENUE/EXPENSE account into retained earnings.
+
+        1. Streams the accounts once and back-calculates balances at Dec 31.
+        2. Builds the closing lines in memory and splits them into chunks of
+           CLOSING_CHUNK_LINES, each balanced against retained earnings.
+        3. Stores the planned chunks under year_closings/{id}/plan, then posts
+           each chunk via PostingEngine (deterministic ids). An interrupted run
+           resumes from the stored plan: balances already include the parts
+           posted before the interruption, so they are not recomputed.
+        4. Marks all 12 periods of the year closed.
+
+        redo=True reverses the previous close of the year and closes again.
+        """
+        closing_ref = self.db.collection(self.YEAR_CLOSINGS_COLLECTION).document(f"{self.company_id}_{year}")
+        closing_snap = closing_ref.get()
+        closing = closing_snap.to_dict() if closing_snap.exists else {}
+        run = int(closing.get("run", 0))
+
+        if closing.get("status") == "COMPLETED":
+            if not redo:
+                raise ValueError(f"Year {year} is already closed (use redo to reverse and close again)")
+            self._reverse_closing(closing, year)
+            run += 1
+        elif not closing:
+            run = 1
+
+        re_account_id = self._resolve_retained_earnings(retained_earnings_account_id)
+        closing_ref.set({
+            "company_id": self.company_id,
+            "year": year,
+            "run": run,
+            "status": "RUNNING",
+            "retained_earnings_account_id": re_account_id,
+            "started_at": firestore.SERVER_TIMESTAMP,
+            "started_by": self.user_id
+        }, merge=True)
+
+        if closing.get("planned_run") == run:
+            plan = self._load_plan(closing_ref, run)
+        else:
+            plan = self._plan_closing(closing_ref, year, run, re_account_id)
+
+        # Post the planned chunks (parts posted before an interruption are skipped)
+        entry_date = self._year_end(year)
+        journal_ids = []
+        for part in plan["parts"]:
+            self._post_closing_chunk(
+                part["je_id"], f"JE-YEC-{year}-{run}-{part['part']:03d}",
+                f"Year-end close {year} (part {part['part']})", part["lines"], entry_date
+            )
+            journal_ids.append(part["je_id"])
+
+        # Close all periods of the year
+        batch = self.db.batch()
+        for month in range(1, 13):
+            batch.set(self.db.collection(self.PERIODS_COLLECTION).document(f"{self.company_id}_{year}_{month:02d}"), {
+                "company_id": self.company_id,
+                "year": year,
+                "month": month,
+                "status": "CLOSED",
+                "closed_at": firestore.SERVER_TIMESTAMP,
+                "closed_by": self.user_id
+            })
+        batch.commit()
+        for month in range(1, 13):
+            self.periods.mark(self.company_id, year, month, closed=True)
+
+        result = {
+            "company_id": self.company_id,
+            "year": year,
+            "run": run,
+            "status": "COMPLETED",
+            "accounts_closed": plan["accounts_closed"],
+            "net_income": plan["net_income"],
+            "journal_entry_ids": journal_ids,
+            "retained_earnings_account_id": re_account_id
+        }
+        closing_ref.set({**result, "completed_at": firestore.SERVER_TIMESTAMP}, merge=True)
+
+        self.audit.log_action(
+            action="CLOSE_YEAR",
+            collection=self.YEAR_CLOSINGS_COLLECTION,
+            doc_id=f"{self.company_id}_{year}",
+            after=result,
+            description=f"Year-end close {year} (run {run})"
+        )
+        return result
+
 
 def get_fiscal_service(user_id: str = "system", company_id: str = "default") -> FiscalService:
     """Factory function to get a fiscal service instance."""
@@ -0,0 +1,335 @@
+"""
+FX Revaluation Service
+Period-end revaluation of foreign-currency balances to the closing rate.
+
+- Foreign-currency accounts (account.currency != base): the ledger stores base
+  (IQD) amounts, so the foreign balance is derived by converting every line back
+  at the rate effective on its journal date; the adjustment is
+  foreign_balance * closing_rate - book_balance.
+- Open foreign-currency invoices/bills booked on base-currency control accounts
+  (AR/AP): remaining_amount * (closing_rate - rate_on_issue_date).
+
+All adjustments are posted as ONE balanced journal through PostingEngine, with a
+DRAFT reversal dated the first day of the next period that post_due_reversals()
+posts when it falls due.
+"""
+from datetime import datetime, timezone, timedelta
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Dict, Any, List, Optional
+from google.cloud import firestore
+from app.core.firebase import get_db, stream_paged
+from .posting import PostingEngine
+from .currency import CurrencyService
+from .reporting import ReportingService
+
+PRECISION = Decimal("0.0001")
+
+
+class FXRevaluationService:
+    BASE_CURRENCY = "IQD"
+    REVAL_TYPE = "FX_REVAL"
+    REVERSAL_TYPE = "FX_REVAL_REVERSAL"
+
+    # Open items (same status sets as the aging report)
+    OPEN_ITEMS = {
+        "invoices": {"statuses": ["ISSUED", "OVERDUE"], "partner": "customers", "partner_field": "customer_id",
+                     "account_field": "ar_account_id", "control_code": "122", "date_field": "issue_date", "sign": 1},
+        "bills": {"statuses": ["POSTED", "OVERDUE"], "partner": "suppliers", "partner_field": "supplier_id",
+                  "account_field": "ap_account_id", "control_code": "21", "date_field": "date", "sign": -1},
+    }
+
+    def __init__(self):
+        self.db = get_db()
+        self.posting_engine = PostingEngine()
+        self.currency = CurrencyService()
+        self.reporting = ReportingService()
+
+    @staticmethod
+    def period_bounds(period: str):
+        """'2026-03' -> (end of period, first instant of next period), both UTC."""
+        year, month = (int(p) for p in period.split("-"))
+        next_start = datetime(year + (month == 12), month % 12 + 1, 1, tzinfo=timezone.utc)
+        return next_start - timedelta(microseconds=1), next_start
+
+    # ==========================================================================
+    # CALCULATION (read-only)
+    # ==========================================================================
+    def _revalue_accounts(self, company_id: str, as_of: datetime, accounts: Dict[str, Dict[str, Any]]) -> List[Dict[str, Any]]:
+        results = []
+        for acc_id, acc in accounts.items():
+            currency = acc.get("currency") or self.BASE_CURRENCY
+            if currency == self.BASE_CURRENCY or acc.get("is_group"):
+                continue
+
+            amounts, dates = [], []
+            for _, je, line in self.reporting._iter_account_entries(company_id, acc_id, to_date=as_of):
+                if je.get("source_doc_type") in (self.REVAL_TYPE, self.REVERSAL_TYPE):
+                    continue
+                amounts.append(Decimal(str(line.get("debit", "0"))) - Decimal(str(line.get("credit", "0"))))
+                dates.append(je.get("date"))
+            if not amounts:
+                continue
+
+            book = sum(amounts, Decimal("0"))
+            foreign = sum(self.currency.convert_many(amounts, self.BASE_CURRENCY, currency, dates), Decimal("0"))
+            closing_rate = self.currency.get_rate(currency, self.BASE_CURRENCY, as_of)
+            adjustment = (foreign * closing_rate - book).quantize(PRECISION, rounding=ROUND_HALF_UP)
+            if adjustment:
+                results.append({
+                    "source": "account",
+                    "account_id": acc_id,
+                    "account_code": acc.get("code"),
+                    "currency": currency,
+                    "foreign_balance": str(foreign.quantize(PRECISION, rounding=ROUND_HALF_UP)),
+                    "book_balance": str(book),
+                    "closing_rate": str(closing_rate),
+                    "adjustment": adjustment
+                })
+        return results
+
+    def _revalue_open_items(self, company_id: str, as_of: datetime, accounts: Dict[str, Dict[str, Any]]) -> List[Dict[str, Any]]:
+        results = []
+        for collection, cfg in self.OPEN_ITEMS.items():
+            control_id = next((aid for aid, a in accounts.items() if a.get("code") == cfg["control_code"]), None)
+
+            query = self.db.collection(collection)\
+                .where("company_id", "==", company_id)\
+                .where("status", "in", cfg["statuses"])
+            items = []
+            for doc in stream_paged(query):
+                data = doc.to_dict()
+                currency = data.get("currency") or self.BASE_CURRENCY
+                remaining = Decimal(str(data.get("remaining_amount", "0") or "0"))
+                if currency == self.BASE_CURRENCY or remaining <= 0:
+                    continue
+                items.append((doc.id, data, currency, remaining))
+            if not items:
+                continue
+
+            # Control accounts per partner (one batched read)
+            partner_ids = sorted({d.get(cfg["partner_field"]) for _, d, _, _ in items if d.get(cfg["partner_field"])})
+            partner_accounts = {}
+            for i in range(0, len(partner_ids), 300):
+                refs = [self.db.collection(cfg["partner"]).document(pid) for pid in partner_ids[i:i + 300]]
+                for snap in self.db.get_all(refs):
+                    if snap.exists:
+                        partner_accounts[snap.id] = snap.to_dict().get(cfg["account_field"])
+
+            # Group by currency so each currency is converted in one call
+            by_currency: Dict[str, list] = {}
+            for item in items:
+                by_currency.setdefault(item[2], []).append(item)
+
+            for currency, group in by_currency.items():
+                closing_rate = self.currency.get_rate(currency, self.BASE_CURRENCY, as_of)
+                remaining = [r for _, _, _, r in group]
+                booked = self.currency.convert_many(
+                    remaining, currency, self.BASE_CURRENCY, [d.get(cfg["date_field"]) or d.get("created_at") for _, d, _, _ in group]
+                )
+                for (doc_id, data, _, amount), book in zip(group, booked):
+                    account_id = partner_accounts.get(data.get(cfg["partner_field"])) or control_id
+                    # Foreign-currency control accounts are already revalued at account level
+                    if not account_id or (accounts.get(account_id, {}).get("currency") or self.BASE_CURRENCY) != self.BASE_CURRENCY:
+                        continue
+                    # Assets (AR) gain when the rate rises; liabilities (AP) lose
+                    adjustment = ((amount * closing_rate - book) * cfg["sign"]).quantize(PRECISION, rounding=ROUND_HALF_UP)
+                    if adjustment:
+                        results.append({
+                            "source": collection,
+                            "document_id": doc_id,
+                            "account_id": account_id,
+                            "currency": currency,
+                            "remaining_amount": str(amount),
+                            "closing_rate": str(closing_rate),
+                            "adjustment": adjustment
+                        })
+        return results
+
+    def calculate(self, company_id: str, period: str, gain_account_id: str, loss_account_id: Optional[str] = None) -> Dict[str, Any]:
+        """Compute revaluation details and the balanced journal lines (no writes)."""
+        loss_account_id = loss_account_id or gain_account_id
+        as_of, _ = self.period_bounds(period)
+
+        accounts = {
+            doc.id: doc.to_dict()
+            for doc in self.db.collection("accounts").where("company_id", "==", company_id).stream()
+        }
+        for acc_id in (gain_account_id, loss_account_id):
+            if acc_id not in accounts:
+                raise ValueError(f"FX gain/loss account {acc_id} not found")
+
+        details = self._revalue_accounts(company_id, as_of, accounts) + self._revalue_open_items(company_id, as_of, accounts)
+
+        # Net per account (adjustment is debit-positive)
+        per_account: Dict[str, Decimal] = {}
+        for row in details:
+            per_account[row["account_id"]] = per_account.get(row["account_id"], Decimal("0")) + row["adjustment"]
+
+        lines = []
+        for acc_id, amount in sorted(per_account.items()):
+            if not amount:
+                continue
+            lines.append({
+                "account_id": acc_id,
+                "debit": str(amount) if amount > 0 else "0",
+                "credit": str(-amount) if amount < 0 else "0",
+                "memo": f"FX revaluation {period}"
+            })
+
+        net = sum(per_account.values(), Decimal("0"))
+        if net > 0:
+            lines.append({"account_id": gain_account_id, "debit": "0", "credit": str(net), "memo": f"Unrealized FX gain {period}"})
+        elif net < 0:
+            lines.append({"account_id": loss_account_id, "debit": str(-net), "credit": "0", "memo": f"Unrealized FX loss {period}"})
+
+        return {
+            "company_id": company_id,
+            "period": period,
+            "as_of": as_of.isoformat(),
+            "net_gain_loss": str(net),
+            "lines": lines,
+            "details": [{**row, "adjustment": str(row["adjustment"])} for row in details]
+        }
+
+    # ==========================================================================
+    # POSTING
+    # ==========================================================================
+    def revalue(
+        self,
+        company_id: str,
+        period: str,
+        gain_account_id: str,
+        loss_account_id: Optional[str] = None,
+        dry_run: bool = False,
+        user_email: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Run the revaluation for a period. Posts one journal (idempotent per company/period)
+        plus a DRAFT reversal on the first day of the next period.
+        Reversals of earlier periods due by the period end are posted first, so the
+        balances being revalued no longer carry the previous adjustment; a dry run
+        refuses while any is outstanding.
+        """
+        as_of, next_start = self.period_bounds(period)
+        due = self._due_reversals(company_id, as_of)
+        if due and dry_run:
+            raise ValueError(f"{len(due)} earlier FX revaluation reversal(s) are not posted yet; run without dry_run to post them")
+        if due:
+            self.post_due_reversals(company_id, as_of)
+
+        result = self.calculate(company_id, period, gain_account_id, loss_account_id)
+        if dry_run or not result["lines"]:
+            return {**result, "dry_run": dry_run, "journal_entry_id": None}
+
+        lines = result["lines"]
+        reversed_lines = self._reversal_lines(lines)
+
+        je_ref = self.db.collection("journal_entries").document(f"FXR_{company_id}_{period}")
+        rev_ref = self.db.collection("journal_entries").document(f"FXR_{company_id}_{period}_REV")
+        transaction = self.db.transaction()
+
+        @firestore.transactional
+        def _execute(transaction):
+            # PHASE 1: READ
+            if je_ref.get(transaction=transaction).exists:
+                return False
+            accounts_data = self.posting_engine.get_accounts_for_transaction(transaction, [l["account_id"] for l in lines])
+
+            # PHASE 3: WRITE
+            transaction.set(je_ref, {
+                "number": f"JE-FXR-{period}",
+                "date": as_of,
+                "description": f"FX revaluation {period}",
+                "status": "DRAFT",
+                "lines": self.posting_engine.journal_lines.inline(lines),
+                "company_id": company_id,
+                "source_doc_id": f"{company_id}_{period}",
+                "source_doc_type": self.REVAL_TYPE,
+                "created_by": user_email,
+                "created_at": firestore.SERVER_TIMESTAMP
+            })
+            self.posting_engine.post_journal_entry(
+                transaction, je_ref.id, lines, accounts_data,
+                entry_date=as_of, company_id=company_id, source_type=self.REVAL_TYPE
+            )
+            transaction.set(rev_ref, {
+                "number": f"JE-FXR-{period}-REV",
+                "date": next_start,
+                "description": f"Auto-reversal of FX revaluation {period}",
+                "status": "DRAFT",
+                "lines": self.posting_engine.journal_lines.inline(reversed_lines),
+                "line_count": len(reversed_lines),
+                "company_id": company_id,
+                "source_doc_id": je_ref.id,
+                "source_doc_type": self.REVERSAL_TYPE,
+                "reversal_of": je_ref.id,
+                "created_by": user_email,
+                "created_at": firestore.SERVER_TIMESTAMP
+            })
+            return True
+
+        posted = _execute(transaction)
+        return {
+            **result,
+            "dry_run": False,
+            "already_posted": not posted,
+            "journal_entry_id": je_ref.id,
+            "reversal_entry_id": rev_ref.id
+        }
+
+    @staticmethod
+    def _reversal_lines(lines: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return [{**l, "debit": l["credit"], "credit": l["debit"], "memo": f"Reversal: {l.get('memo', '')}"} for l in lines]
+
+    def _due_reversals(self, company_id: str, as_of: datetime) -> list:
+        """DRAFT revaluation reversals dated on or before as_of."""
+        query = self.db.collection("journal_entries")\
+            .where("company_id", "==", company_id)\
+            .where("source_doc_type", "==", self.REVERSAL_TYPE)\
+            .where("status", "==", "DRAFT")
+        due = []
+        for snap in query.stream():
+            entry_date = snap.to_dict().get("date")
+            if entry_date and entry_date.tzinfo is None:
+                entry_date = entry_date.replace(tzinfo=timezone.utc)
+            if not entry_date or entry_date <= as_of:
+                due.append(snap)
+        return due
+
+    def post_due_reversals(self, company_id: str, as_of: Optional[datetime] = None) -> Dict[str, Any]:
+        """Post DRAFT revaluation reversals whose date has arrived."""
+        as_of = as_of or datetime.now(timezone.utc)
+        posted = []
+        for snap in self._due_reversals(company_id, as_of):
+            ref = snap.reference
+            transaction = self.db.transaction()
+
+            @firestore.transactional
+            def _execute(transaction):
+                # PHASE 1: READ (re-check so concurrent runs post once)
+                current = ref.get(transaction=transaction).to_dict()
+                if current.get("status") != "DRAFT":
+                    return False
+                lines = current.get("lines", [])
+                if not lines and current.get("reversal_of"):
+                    # Large reversals are stored without lines; rebuild them from the original
+                    original_ref = self.db.collection("journal_entries").document(current["reversal_of"])
+                    original = original_ref.get(transaction=transaction).to_dict() or {}
+                    lines = self._reversal_lines(self.posting_engine.journal_lines.lines_of(original_ref.id, original))
+                accounts_data = self.posting_engine.get_accounts_for_transaction(transaction, [l["account_id"] for l in lines])
+
+                # PHASE 3: WRITE
+                self.posting_engine.post_journal_entry(
+                    transaction, ref.id, lines, accounts_data,
+                    entry_date=current.get("date"), company_id=company_id, source_type=self.REVERSAL_TYPE
+                )
+                return True
+
+            if _execute(transaction):
+                posted.append(ref.id)
+
+        return {"company_id": company_id, "posted": posted}
+
+
+def get_fx_revaluation_service() -> FXRevaluationService:
+    return FXRevaluationService()
@@ -93,14 +93,14 @@ class IntegrationService:
             "description": f"Sales Return: {data.reason}",
             "status": DocumentStatus.DRAFT,
             "source_document_type": "RETURN",
-            "lines": lines_data
+            "lines": self.posting_engine.journal_lines.inline(lines_data)
         })
         
         # Pre-fetch accounts
         account_ids = list(set(line["account_id"] for line in lines_data))
         accounts_data = self.posting_engine.get_accounts_for_transaction(transaction, account_ids)
         
-        self.posting_engine.post_journal_entry(transaction, je_id, lines_data, accounts_data)
+        self.posting_engine.post_journal_entry(transaction, je_id, lines_data, accounts_data, source_type="RETURN")
         return je_id
 
     async def create_purchase_return(self, data: ReturnCreate):
@@ -153,14 +153,14 @@ class IntegrationService:
             "description": f"Purchase Return: {data.reason}",
             "status": DocumentStatus.DRAFT,
             "source_document_type": "PURCHASE_RETURN",
-            "lines": lines_data
+            "lines": self.posting_engine.journal_lines.inline(lines_data)
         })
         
         # Pre-fetch accounts
         account_ids = list(set(line["account_id"] for line in lines_data))
         accounts_data = self.posting_engine.get_accounts_for_transaction(transaction, account_ids)
 
-        self.posting_engine.post_journal_entry(transaction, je_id, lines_data, accounts_data)
+        self.posting_engine.post_journal_entry(transaction, je_id, lines_data, accounts_data, source_type="PURCHASE_RETURN")
         return je_id
 
     async def create_stock_transfer(self, data: TransferCreate):
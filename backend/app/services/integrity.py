@@ -1,17 +1,234 @@
 """
 Data Integrity & Idempotency Service
 Prevents duplicate postings and ensures atomic transactions.
+
+The integrity scan (IntegrityService.scan) checks existing data for broken
+double-entry invariants. journal_entries and stock_ledger are split into
+document-id ranges (same partitioning as the replay engine) and streamed by a
+process pool, so memory stays bounded by page size, not tenant size:
+
+    unbalanced_entry        POSTED/VOIDED entry whose debits != credits
+    missing_account         line pointing at an account that does not exist
+    foreign_account         line pointing at another company's account
+    missing_company_id      POSTED entry without company_id (global scan only)
+    missing_line_chunks     chunked entry whose line chunks do not add up to its line_count
+    orphan_stock_source     stock_ledger row whose source document does not exist
+    untraceable_stock_row   stock_ledger row without a source document id
+    unknown_stock_source_type  stock_ledger row with a source type the scan cannot resolve
+    duplicate_number        journal entries of one company sharing a number
 """
+import os
+import uuid
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from typing import Optional
+from decimal import Decimal
+from typing import Any, Dict, List, Optional, Tuple
 from google.cloud import firestore
-from app.core.firebase import get_db
+from app.core.firebase import get_db, stream_paged
+from .replay import key_ranges, _range_query
+from .journal_lines import get_journal_line_store
+
+BALANCE_TOLERANCE = Decimal("0.0001")
+# Issues kept per type by each worker (all issues are counted)
+ISSUE_LIMIT = 1000
+# stock_ledger source_document_type -> collection holding the source document
+STOCK_SOURCE_COLLECTIONS = {
+    "GRN": "journal_entries",
+    "DO": "journal_entries",
+    "RETURN": "journal_entries",
+    "PURCHASE_RETURN": "journal_entries",
+    "GRN_VOID": "journal_entries",
+    "DO_VOID": "journal_entries",
+    "OPENING_BALANCE": "opening_balance_imports",
+    "TRF": "transfers",
+    "ADJ": "adjustments",
+    "CYCLE_COUNT": "cycle_counts",
+}
+# Legacy transfer rows (IntegrationService.create_stock_transfer) carry no source id
+UNSOURCED_STOCK_TYPES = {"TRANSFER_IN", "TRANSFER_OUT"}
+EXISTS_BATCH = 300
+EXISTS_CACHE_MAX = 50000
+
+
+class _Issues:
+    """Per-worker issue collector: counts everything, keeps the first ISSUE_LIMIT of each type."""
+
+    def __init__(self):
+        self.counts: Counter = Counter()
+        self.items: Dict[str, List[Dict[str, Any]]] = {}
+
+    def add(self, kind: str, **details):
+        self.counts[kind] += 1
+        bucket = self.items.setdefault(kind, [])
+        if len(bucket) < ISSUE_LIMIT:
+            bucket.append(details)
+
+    def result(self, rows: int) -> Dict[str, Any]:
+        return {"rows": rows, "counts": dict(self.counts), "issues": self.items}
+
+
+# account id -> company_id, loaded once by IntegrityService.scan and handed to each worker
+_OWNERS: Optional[Dict[str, Optional[str]]] = None
+
+
+def _init_scan_worker(owners: Dict[str, Optional[str]]):
+    global _OWNERS
+    _OWNERS = owners
+
+
+def _account_owners(company_id: Optional[str]) -> Dict[str, Optional[str]]:
+    """account id -> company_id (only the two fields are fetched)."""
+    query = get_db().collection("accounts")
+    if company_id is not None:
+        query = query.where("company_id", "==", company_id)
+    owners = {}
+    for snap in stream_paged(query.select(["company_id"]), page_size=1000):
+        owners[snap.id] = (snap.to_dict() or {}).get("company_id")
+    return owners
+
+
+# ==============================================================================
+# SCAN WORKERS (top-level so they can run in spawned processes)
+# ==============================================================================
+def scan_journal_range(company_id: Optional[str], lo: Optional[str], hi: Optional[str]) -> Dict[str, Any]:
+    """Balance, account and company checks over one id range of journal_entries."""
+    owners = _OWNERS if _OWNERS is not None else _account_owners(company_id)
+    issues = _Issues()
+    rows = 0
+    for je in stream_paged(_range_query("journal_entries", company_id, lo, hi), page_size=1000):
+        data = je.to_dict()
+        rows += 1
+        status = data.get("status")
+        je_company = data.get("company_id")
+        if status not in ("POSTED", "VOIDED"):
+            continue
+
+        if not je_company and status == "POSTED":
+            issues.add("missing_company_id", journal_entry_id=je.id, number=data.get("number"),
+                       source_type=data.get("source_doc_type") or data.get("source_document_type"))
+
+        total_debit = Decimal("0")
+        total_credit = Decimal("0")
+        line_count = 0
+        for idx, line in enumerate(get_journal_line_store().iter_lines(je.id, data)):
+            line_count += 1
+            total_debit += Decimal(str(line.get("debit", "0") or "0"))
+            total_credit += Decimal(str(line.get("credit", "0") or "0"))
+            acc_id = line.get("account_id")
+            if acc_id not in owners:
+                issues.add("missing_account", journal_entry_id=je.id, company_id=je_company,
+                           line=idx, account_id=acc_id)
+            elif je_company and owners[acc_id] and owners[acc_id] != je_company:
+                issues.add("foreign_account", journal_entry_id=je.id, company_id=je_company,
+                           line=idx, account_id=acc_id, account_company_id=owners[acc_id])
+
+        if data.get("lines_chunked") and line_count != data.get("line_count"):
+            issues.add("missing_line_chunks", journal_entry_id=je.id, company_id=je_company,
+                       line_count=data.get("line_count"), lines_found=line_count)
+        if abs(total_debit - total_credit) > BALANCE_TOLERANCE:
+            issues.add("unbalanced_entry", journal_entry_id=je.id, company_id=je_company,
+                       number=data.get("number"), total_debit=str(total_debit),
+                       total_credit=str(total_credit), difference=str(total_debit - total_credit))
+    return issues.result(rows)
+
+
+def scan_stock_range(company_id: Optional[str], lo: Optional[str], hi: Optional[str]) -> Dict[str, Any]:
+    """Source-document checks over one id range of stock_ledger (existence looked up in batches)."""
+    db = get_db()
+    issues = _Issues()
+    known: Dict[Tuple[str, str], bool] = {}
+    pending: Dict[Tuple[str, str], List[Tuple[str, Dict[str, Any]]]] = {}
+    rows = 0
+
+    def flush():
+        keys = list(pending)
+        for start in range(0, len(keys), EXISTS_BATCH):
+            chunk = keys[start:start + EXISTS_BATCH]
+            refs = [db.collection(coll).document(doc_id) for coll, doc_id in chunk]
+            found = {snap.reference.path for snap in db.get_all(refs) if snap.exists}
+            for key, ref in zip(chunk, refs):
+                if len(known) >= EXISTS_CACHE_MAX:
+                    known.clear()
+                known[key] = ref.path in found
+        for key, refs in pending.items():
+            if not known[key]:
+                for row_id, row in refs:
+                    issues.add("orphan_stock_source", stock_ledger_id=row_id, **row)
+        pending.clear()
+
+    for snap in stream_paged(_range_query("stock_ledger", company_id, lo, hi), page_size=1000):
+        data = snap.to_dict()
+        rows += 1
+        doc_type = data.get("source_document_type")
+        doc_id = data.get("source_document_id")
+        row = {"company_id": data.get("company_id"), "item_id": data.get("item_id"),
+               "source_document_type": doc_type, "source_document_id": doc_id}
+        if not doc_id:
+            if doc_type not in UNSOURCED_STOCK_TYPES:
+                issues.add("untraceable_stock_row", stock_ledger_id=snap.id, **row)
+            continue
+
+        if doc_type not in STOCK_SOURCE_COLLECTIONS:
+            issues.add("unknown_stock_source_type", stock_ledger_id=snap.id, **row)
+            continue
+
+        key = (STOCK_SOURCE_COLLECTIONS[doc_type], doc_id)
+        if key in known:
+            if not known[key]:
+                issues.add("orphan_stock_source", stock_ledger_id=snap.id, **row)
+            continue
+        pending.setdefault(key, []).append((snap.id, row))
+        if len(pending) >= EXISTS_BATCH:
+            flush()
+    flush()
+    return issues.result(rows)
+
+
+def scan_duplicate_numbers(company_id: Optional[str]) -> Dict[str, Any]:
+    """
+    Stream journal numbers in (company_id, number) order and compare neighbours,
+    so duplicates are found in constant memory.
+    """
+    query = get_db().collection("journal_entries")
+    if company_id is not None:
+        query = query.where("company_id", "==", company_id)
+    else:
+        query = query.order_by("company_id")
+    query = query.order_by("number").select(["company_id", "number", "status"])
+
+    issues = _Issues()
+    rows = 0
+    group: List[Dict[str, Any]] = []
+    group_key = None
+    occurrences = 0
+
+    def close_group():
+        if occurrences > 1:
+            issues.add("duplicate_number", company_id=group_key[0], number=group_key[1],
+                       journal_entries=group, occurrences=occurrences)
+
+    for snap in stream_paged(query, page_size=1000):
+        data = snap.to_dict() or {}
+        rows += 1
+        key = (data.get("company_id"), data.get("number"))
+        if key != group_key:
+            close_group()
+            group, group_key, occurrences = [], key, 0
+        occurrences += 1
+        if len(group) < 20:
+            group.append({"id": snap.id, "status": data.get("status")})
+    close_group()
+    return issues.result(rows)
 
 class IntegrityService:
     """Ensures data integrity and prevents duplicate operations."""
     
     IDEMPOTENCY_COLLECTION = "idempotency_keys"
     KEY_EXPIRY_HOURS = 24  # Keys expire after 24 hours
+    SCAN_REPORTS_COLLECTION = "integrity_reports"
+    SAVED_ISSUES_PER_TYPE = 50
     
     def __init__(self, company_id: str = "default"):
         self.db = get_db()
@@ -97,8 +314,6 @@ class IntegrityService:
         Validate that debits equal credits in a journal entry.
         Essential for double-entry integrity.
         """
-        from decimal import Decimal
-        
         total_debit = Decimal("0")
         total_credit = Decimal("0")
         
@@ -108,6 +323,73 @@ class IntegrityService:
         
         return total_debit == total_credit
 
+    # ==========================================================================
+    # INTEGRITY SCAN
+    # ==========================================================================
+    def scan(
+        self,
+        global_scan: bool = False,
+        workers: Optional[int] = None,
+        partitions: Optional[int] = None,
+        save: bool = True
+    ) -> Dict[str, Any]:
+        """
+        Run every integrity check in parallel and return a JSON-serializable report.
+        global_scan=True covers all companies and is the only mode that can see
+        entries missing company_id; it is only for the integrity_scan.py CLI, never
+        for a request made on behalf of one company.
+        """
+        company_id = None if global_scan else self.company_id
+        workers = workers or min(8, os.cpu_count() or 2)
+        ranges = key_ranges(partitions or workers * 2)
+        scan_id = uuid.uuid4().hex[:12]
+        started = datetime.utcnow()
+
+        # Every journal range checks lines against the same accounts: load them once
+        owners = _account_owners(company_id)
+
+        # spawn: gRPC channels of the parent's Firestore client are not fork-safe
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx,
+                                 initializer=_init_scan_worker, initargs=(owners,)) as pool:
+            # The number scan re-reads journal_entries, so its rows are not counted
+            futures = [(None, pool.submit(scan_duplicate_numbers, company_id))]
+            futures += [("journal_entries", pool.submit(scan_journal_range, company_id, lo, hi)) for lo, hi in ranges]
+            futures += [("stock_ledger", pool.submit(scan_stock_range, company_id, lo, hi)) for lo, hi in ranges]
+
+            scanned: Counter = Counter()
+            counts: Counter = Counter()
+            issues: Dict[str, List[Dict[str, Any]]] = {}
+            for collection, future in futures:
+                part = future.result()
+                if collection:
+                    scanned[collection] += part["rows"]
+                counts.update(part["counts"])
+                for kind, items in part["issues"].items():
+                    bucket = issues.setdefault(kind, [])
+                    bucket.extend(items[:ISSUE_LIMIT - len(bucket)])
+
+        report = {
+            "scan_id": scan_id,
+            "scope": "global" if global_scan else company_id,
+            "started_at": started.isoformat() + "Z",
+            "duration_seconds": round((datetime.utcnow() - started).total_seconds(), 2),
+            "partitions": len(ranges),
+            "rows_scanned": dict(scanned),
+            "issue_counts": dict(counts),
+            "total_issues": sum(counts.values()),
+            "issues": issues
+        }
+        if save:
+            # Firestore documents are capped at 1 MiB: store counts and a sample
+            self.db.collection(self.SCAN_REPORTS_COLLECTION).document(scan_id).set({
+                **{k: v for k, v in report.items() if k != "issues"},
+                "company_id": company_id,
+                "issues_sample": {kind: items[:self.SAVED_ISSUES_PER_TYPE] for kind, items in issues.items()},
+                "created_at": firestore.SERVER_TIMESTAMP
+            })
+        return report
+
 
 def get_integrity_service(company_id: str = "default") -> IntegrityService:
     """Factory function to get an integrity service instance."""
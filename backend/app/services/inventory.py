@@ -4,11 +4,46 @@ from app.core.firebase import get_db
 from app.models.core import DocumentStatus
 from app.schemas.erp import GRNCreate, DeliveryNoteCreate
 from .posting import PostingEngine
+from .recosting import StockRecostService
+from .valuation import InventoryValuationService
+from .reservations import ReservationService
+from .rollups import as_datetime
 
 class InventoryService:
     def __init__(self):
         self.db = get_db()
         self.posting_engine = PostingEngine()
+        self.recosting = StockRecostService()
+        self.valuation = InventoryValuationService()
+        self.reservations = ReservationService()
+
+    def _recost_if_back_dated(self, data, je_id: str, label: str):
+        """Re-cost later movements of the document's items when it was dated in the past.
+        Runs after the document is committed, so a failure never fails the posting: the
+        run is left PENDING in recost_runs for /inventory/recost to resume.
+        """
+        if data.date is None or as_datetime(data.date) >= as_datetime():
+            return
+        reference = f"{label} {data.number} ({je_id})"
+        item_ids = sorted(set(line.item_id for line in data.lines))
+        company_id = None
+        run_id = None
+        try:
+            company_id = self.db.collection("items").document(item_ids[0]).get().to_dict().get("company_id")
+            self.valuation.invalidate_from(company_id, data.date)
+            item_ids = [item_id for item_id in item_ids if self.recosting.has_later_rows(item_id, data.date)]
+            if not item_ids:
+                return
+            run_id = self.recosting.queue(company_id, item_ids, data.date, reference)
+            self.recosting.resume(run_id)
+        except Exception as e:
+            print(f"[Recost] {reference}: re-costing failed, left pending: {e}")
+            try:
+                if run_id is None:
+                    run_id = self.recosting.queue(company_id, item_ids, data.date, reference)
+                self.db.collection(self.recosting.RUNS_COLLECTION).document(run_id).update({"error": str(e)})
+            except Exception as record_error:
+                print(f"[Recost] {reference}: could not record pending run: {record_error}")
 
     def create_goods_receipt(self, data: GRNCreate):
         """Standard Goods Receipt using Firestore Transaction.
@@ -31,6 +66,9 @@ class InventoryService:
                 if not snap.exists:
                     raise ValueError(f"Item {item_id} not found")
                 items_data_map[item_id] = snap.to_dict()
+            balances = posting_engine.balances.get_for_transaction(
+                transaction, [(line.item_id, line.warehouse_id) for line in data.lines]
+            )
 
             # Check Supplier Account
             supplier_acc_id = str(data.supplier_account_id)
@@ -49,6 +87,7 @@ class InventoryService:
             # ==============================================================================
             je_ref = db.collection("journal_entries").document()
             je_id = je_ref.id
+            posting_date = as_datetime(data.date)
             
             total_value = Decimal("0")
             lines_data = []
@@ -79,13 +118,18 @@ class InventoryService:
                 # Prepare Stock Ledger Entry
                 ledger_entry = {
                     "timestamp": firestore.SERVER_TIMESTAMP,
+                    "posting_date": posting_date,
                     "item_id": item_id,
                     "warehouse_id": line.warehouse_id,
                     "quantity": str(qty),
                     "unit_cost": str(cost),
                     "valuation_rate": str(new_wac),
+                    "running_qty": str(new_qty),
+                    "running_value": str(new_val),
                     "source_document_id": je_id,
                     "source_document_type": "GRN",
+                    "batch_number": line.batch_number,
+                    "expiry_date": line.expiry_date,
                     "description": f"GRN In: {line.quantity} @ {line.unit_cost}",
                     "company_id": items_data_map[item_id].get("company_id")
                 }
@@ -93,7 +137,10 @@ class InventoryService:
                 # Prepare Item Update (will be deduped/applied last)
                 stock_moves_to_write.append({
                     "item_id": item_id,
-                    "ledger": ledger_entry
+                    "line": line,
+                    "ledger": ledger_entry,
+                    "quantity": qty,
+                    "unit_value": cost
                 })
 
                 # Accounting Lines
@@ -130,18 +177,38 @@ class InventoryService:
                 })
             
             # 2. Add Stock Ledger Entries
-            for move in stock_moves_to_write:
+            company_id = items_data_map[unique_item_ids[0]].get("company_id")
+            for idx, move in enumerate(stock_moves_to_write):
                 led_ref = db.collection("stock_ledger").document()
                 transaction.set(led_ref, move["ledger"])
+                posting_engine.rollups.apply_stock(transaction, company_id, posting_date, move["quantity"], move["unit_value"], "GRN")
+                posting_engine.stock_rollups.apply(
+                    transaction, company_id, move["ledger"]["item_id"], move["ledger"]["warehouse_id"],
+                    posting_date, move["quantity"], move["unit_value"], "GRN"
+                )
+                posting_engine.balances.apply(
+                    transaction, balances, company_id, move["ledger"]["item_id"], move["ledger"]["warehouse_id"],
+                    move["quantity"], items_data_map[move["ledger"]["item_id"]]
+                )
+                # FIFO/FEFO items: one cost layer per receipt line
+                if posting_engine.layers.uses_layers(items_data_map[move["item_id"]]):
+                    line = move["line"]
+                    posting_engine.layers.add_layer(
+                        transaction, items_data_map[move["item_id"]], move["item_id"], line.warehouse_id,
+                        move["quantity"], move["unit_value"], received_at=posting_date,
+                        batch_number=line.batch_number, expiry_date=line.expiry_date,
+                        source_document_id=je_id, layer_id=f"{je_id}_{idx}"
+                    )
             
             # 3. Save Journal
             transaction.set(je_ref, {
                 "number": f"JE-GRN-{data.number}",
-                "date": firestore.SERVER_TIMESTAMP,
+                "date": data.date or firestore.SERVER_TIMESTAMP,
                 "description": f"Automated Journal for GRN {data.number}",
                 "status": "DRAFT",
                 "source_document_type": "GRN",
-                "lines": lines_data
+                "company_id": company_id,
+                "lines": posting_engine.journal_lines.inline(lines_data)
             })
 
             # 4. Post Journal (pass lines for balance check, avoiding re-read)
@@ -149,7 +216,10 @@ class InventoryService:
             account_ids = list(set(line["account_id"] for line in lines_data))
             accounts_data = posting_engine.get_accounts_for_transaction(transaction, account_ids)
             
-            posting_engine.post_journal_entry(transaction, je_id, lines_data, accounts_data)
+            posting_engine.post_journal_entry(
+                transaction, je_id, lines_data, accounts_data,
+                entry_date=posting_date, company_id=company_id, source_type="GRN"
+            )
             
             # --- AP SUBLEDGER LINK ---
             if getattr(data, "supplier_id", None):
@@ -170,7 +240,7 @@ class InventoryService:
                     "bill_number": f"BILL-{data.number}",
                     "supplier_id": data.supplier_id,
                     "supplier_name": supplier_name,
-                    "date": firestore.SERVER_TIMESTAMP,
+                    "date": data.date or firestore.SERVER_TIMESTAMP,
                     "due_date": firestore.SERVER_TIMESTAMP, # Simplification: due now
                     "total": str(total_value),
                     "paid_amount": "0.0000",
@@ -184,19 +254,39 @@ class InventoryService:
 
             return je_id
 
-        return _execute(transaction, self.db, self.posting_engine, data)
+        je_id = _execute(transaction, self.db, self.posting_engine, data)
+        self._recost_if_back_dated(data, je_id, "GRN")
+        return je_id
+
+    def _delivery_reservation_ids(self, data: DeliveryNoteCreate, draft_id: str = None) -> list:
+        """Reservations a delivery note consumes: its draft, sales order and intent."""
+        rid = self.reservations.reservation_id
+        return [rid(kind, source_id) for kind, source_id in (
+            ("DO", draft_id), ("SO", data.sales_order_id), ("INTENT", data.intent_id)
+        ) if source_id]
 
-    def create_delivery_note(self, data: DeliveryNoteCreate):
+    def create_delivery_note(self, data: DeliveryNoteCreate, draft_id: str = None):
         """Standard Delivery Note (Sale) using Firestore Transaction.
         Refactored to strictly separate READs and WRITEs.
+        Raises ValueError when a line needs more than the item holds, or more than
+        the warehouse holds beyond what other documents have reserved (the note's own
+        draft / sales order / intent reservation is consumed, so it counts as free).
         """
         transaction = self.db.transaction()
+        reservation_ids = self._delivery_reservation_ids(data, draft_id)
         
         @firestore.transactional
-        def _execute(transaction, db, posting_engine, data):
+        def _execute(transaction, db, posting_engine, data, draft_id):
             # ==============================================================================
             # PHASE 1: READ ALL DATA
             # ==============================================================================
+            # A draft is posted once: its status flips in this transaction
+            draft_ref = db.collection("delivery_notes").document(draft_id) if draft_id else None
+            if draft_ref:
+                draft = draft_ref.get(transaction=transaction).to_dict() or {}
+                if draft.get("status") != "DRAFT":
+                    raise ValueError(f"Delivery note is {draft.get('status')}")
+
             unique_item_ids = list(set(line.item_id for line in data.lines))
             items_data_map = {}
             
@@ -206,12 +296,31 @@ class InventoryService:
                 if not snap.exists:
                     raise ValueError(f"Item {item_id} not found")
                 items_data_map[item_id] = snap.to_dict()
+            balances = posting_engine.balances.get_for_transaction(
+                transaction, [(line.item_id, line.warehouse_id) for line in data.lines]
+            )
+            reservations = self.reservations.read_for_transaction(
+                transaction, reservation_ids, items_data_map[unique_item_ids[0]].get("company_id")
+            )
+            own_reserved = self.reservations.own_reserved(reservations)
+
+            # FIFO/FEFO items: pick the cost layers each line consumes
+            layer_plans = {}
+            planned = {}
+            for idx, line in enumerate(data.lines):
+                item = items_data_map[line.item_id]
+                if posting_engine.layers.uses_layers(item):
+                    layer_plans[idx] = posting_engine.layers.plan_consumption(
+                        transaction, line.item_id, line.warehouse_id, Decimal(str(line.quantity)),
+                        item["costing_method"], line.batch_number, planned
+                    )
 
             # ==============================================================================
             # PHASE 2: CALCULATE (In-Memory)
             # ==============================================================================
             je_ref = db.collection("journal_entries").document()
             je_id = je_ref.id
+            posting_date = as_datetime(data.date)
             
             total_revenue = Decimal("0")
             total_cogs = Decimal("0")
@@ -219,8 +328,9 @@ class InventoryService:
             
             temp_items_state = {k: v.copy() for k, v in items_data_map.items()}
             stock_moves_to_write = []
+            free_left = {}
 
-            for line in data.lines:
+            for idx, line in enumerate(data.lines):
                 qty = Decimal(str(line.quantity)) # Positive for logic, negative for update
                 item_id = line.item_id
                 
@@ -229,14 +339,32 @@ class InventoryService:
                 # Use current WAC for COGS
                 wac = Decimal(temp_items_state[item_id].get("current_wac", "0"))
                 
-                # Check negative stock? (Optional, skipping for now to allow overdrafts if needed, or fail)
+                # Overselling: item on hand, then warehouse stock not reserved by other documents
                 if current_qty < qty:
-                     # We can choose to fail here
-                     pass
+                    raise ValueError(f"Insufficient stock for item {item_id}: on hand {current_qty}, requested {qty}")
+                balance_key = (item_id, line.warehouse_id)
+                balance = balances.get(posting_engine.balances.balance_id(*balance_key))
+                if balance:
+                    if balance_key not in free_left:
+                        free_left[balance_key] = posting_engine.balances.free_qty(balance) + own_reserved.get(balance_key, Decimal("0"))
+                    if free_left[balance_key] < qty:
+                        raise ValueError(
+                            f"Insufficient available stock for item {item_id} in warehouse {line.warehouse_id}: "
+                            f"available {free_left[balance_key]}, requested {qty}"
+                        )
+                    free_left[balance_key] -= qty
 
                 new_qty = current_qty - qty
-                # OUT means value decreases by (qty * WAC)
-                new_val = current_val - (qty * wac)
+                if idx in layer_plans:
+                    # FIFO/FEFO: cost of the consumed layers; WAC follows the remaining value
+                    layer_cost = posting_engine.layers.plan_cost(layer_plans[idx])
+                    new_val = current_val - layer_cost
+                    wac = layer_cost / qty if qty else wac
+                    if new_qty:
+                        temp_items_state[item_id]["current_wac"] = str(new_val / new_qty)
+                else:
+                    # OUT means value decreases by (qty * WAC)
+                    new_val = current_val - (qty * wac)
                 
                 # WAC does NOT change on OUT, filters only updates keys
                 temp_items_state[item_id]["current_qty"] = str(new_qty)
@@ -245,20 +373,28 @@ class InventoryService:
                 # Ledger
                 ledger_entry = {
                     "timestamp": firestore.SERVER_TIMESTAMP,
+                    "posting_date": posting_date,
                     "item_id": item_id,
                     "warehouse_id": line.warehouse_id,
                     "quantity": str(-qty), # Negative
                     "unit_cost": "0",
                     "valuation_rate": str(wac),
+                    "running_qty": str(new_qty),
+                    "running_value": str(new_val),
                     "source_document_id": je_id,
                     "source_document_type": "DO",
+                    "batch_number": line.batch_number,
+                    "cost_layers": [
+                        {"layer_id": l["layer_id"], "quantity": str(l["quantity"]), "unit_cost": str(l["unit_cost"])}
+                        for l in layer_plans.get(idx, [])
+                    ],
                     "description": f"Sale Out: {line.quantity}",
                     "company_id": items_data_map[item_id].get("company_id")
                 }
-                stock_moves_to_write.append({"ledger": ledger_entry})
+                stock_moves_to_write.append({"ledger": ledger_entry, "quantity": -qty, "unit_value": wac})
                 
                 # Accounting
-                line_cogs = qty * wac
+                line_cogs = layer_cost if idx in layer_plans else qty * wac
                 total_cogs += line_cogs
                 
                 # Simplified Revenue: Cost + 30% margin override
@@ -313,22 +449,40 @@ class InventoryService:
                 # Ensure we only update what changed
                 transaction.update(ref, {
                     "current_qty": stats["current_qty"],
-                    "total_value": stats["total_value"]
+                    "total_value": stats["total_value"],
+                    "current_wac": stats.get("current_wac", "0.0000")
                 })
+            # All slices at once: two lines may draw from the same layer
+            posting_engine.layers.apply_consumption(transaction, [s for plan in layer_plans.values() for s in plan])
             
             # 2. Ledger
+            company_id = items_data_map[unique_item_ids[0]].get("company_id")
             for move in stock_moves_to_write:
                 led_ref = db.collection("stock_ledger").document()
                 transaction.set(led_ref, move["ledger"])
+                posting_engine.rollups.apply_stock(transaction, company_id, posting_date, move["quantity"], move["unit_value"], "DO")
+                posting_engine.stock_rollups.apply(
+                    transaction, company_id, move["ledger"]["item_id"], move["ledger"]["warehouse_id"],
+                    posting_date, move["quantity"], move["unit_value"], "DO"
+                )
+                posting_engine.balances.apply(
+                    transaction, balances, company_id, move["ledger"]["item_id"], move["ledger"]["warehouse_id"],
+                    move["quantity"], items_data_map[move["ledger"]["item_id"]]
+                )
+            self.reservations.consume(
+                transaction, balances, reservations, company_id,
+                self.reservations.totals([line.model_dump() for line in data.lines])
+            )
                 
             # 3. Journal
             transaction.set(je_ref, {
                 "number": f"JE-DO-{data.number}",
-                "date": firestore.SERVER_TIMESTAMP,
+                "date": data.date or firestore.SERVER_TIMESTAMP,
                 "description": f"Automated Journal for DO {data.number}",
                 "status": "DRAFT",
                 "source_document_type": "DO",
-                "lines": lines_data
+                "company_id": company_id,
+                "lines": posting_engine.journal_lines.inline(lines_data)
             })
 
             # 4. Post (pass lines for balance check, avoiding re-read)
@@ -336,11 +490,70 @@ class InventoryService:
             account_ids = list(set(line["account_id"] for line in lines_data))
             accounts_data = posting_engine.get_accounts_for_transaction(transaction, account_ids)
             
-            posting_engine.post_journal_entry(transaction, je_id, lines_data, accounts_data)
+            posting_engine.post_journal_entry(
+                transaction, je_id, lines_data, accounts_data,
+                entry_date=posting_date, company_id=company_id, source_type="DO"
+            )
+            if draft_ref:
+                transaction.update(draft_ref, {
+                    "status": "POSTED",
+                    "journal_entry_id": je_id,
+                    "posted_at": firestore.SERVER_TIMESTAMP
+                })
             
             return je_id
 
-        return _execute(transaction, self.db, self.posting_engine, data)
+        je_id = _execute(transaction, self.db, self.posting_engine, data, draft_id)
+        self._recost_if_back_dated(data, je_id, "DO")
+        return je_id
+
+    # ==========================================================================
+    # DRAFT DELIVERY NOTES (reserve now, post later)
+    # ==========================================================================
+    def save_delivery_note_draft(self, data: DeliveryNoteCreate, company_id: str, draft_id: str = None) -> dict:
+        """Create or update a DRAFT delivery note and reserve its lines.
+        A draft issued against a sales order or intent relies on that document's reservation."""
+        ref = self.db.collection("delivery_notes").document(draft_id) if draft_id else self.db.collection("delivery_notes").document()
+        if draft_id:
+            existing = ref.get().to_dict()
+            if not existing or existing.get("company_id") != company_id:
+                raise ValueError("Delivery note not found")
+            if existing.get("status") != "DRAFT":
+                raise ValueError("Only draft delivery notes can be edited")
+
+        if not data.sales_order_id and not data.intent_id:
+            self.reservations.place(company_id, "DO", ref.id, [l.model_dump() for l in data.lines], "OUT")
+        elif draft_id:
+            self.reservations.release(company_id, "DO", ref.id)
+
+        payload = {**data.model_dump(), "company_id": company_id, "status": "DRAFT",
+                   "updated_at": firestore.SERVER_TIMESTAMP}
+        if not draft_id:
+            payload["created_at"] = firestore.SERVER_TIMESTAMP
+        ref.set(payload, merge=True)
+        return {"id": ref.id, "status": "DRAFT"}
+
+    def post_delivery_note_draft(self, draft_id: str, company_id: str) -> str:
+        """Post a draft delivery note; the posting transaction consumes its reservation and marks it POSTED."""
+        ref = self.db.collection("delivery_notes").document(draft_id)
+        draft = ref.get().to_dict()
+        if not draft or draft.get("company_id") != company_id:
+            raise ValueError("Delivery note not found")
+        if draft.get("status") != "DRAFT":
+            raise ValueError(f"Delivery note is {draft.get('status')}")
+        fields = DeliveryNoteCreate.model_fields
+        return self.create_delivery_note(DeliveryNoteCreate(**{k: v for k, v in draft.items() if k in fields}), draft_id=draft_id)
+
+    def cancel_delivery_note_draft(self, draft_id: str, company_id: str) -> dict:
+        ref = self.db.collection("delivery_notes").document(draft_id)
+        draft = ref.get().to_dict()
+        if not draft or draft.get("company_id") != company_id:
+            raise ValueError("Delivery note not found")
+        if draft.get("status") != "DRAFT":
+            raise ValueError(f"Delivery note is {draft.get('status')}")
+        self.reservations.release(company_id, "DO", draft_id)
+        ref.update({"status": "CANCELLED", "cancelled_at": firestore.SERVER_TIMESTAMP})
+        return {"id": draft_id, "status": "CANCELLED"}
 
     def create_stock_transfer_v2(self, data: 'TransferCreate', doc_id: str):
         """Moves stock between warehouses for multiple items."""
@@ -350,8 +563,22 @@ class InventoryService:
         def _execute(transaction, db, posting_engine, data, doc_id):
             item_ids = [line.item_id for line in data.items]
             items_data = posting_engine.get_items_for_transaction(transaction, item_ids)
+            balances = posting_engine.balances.get_for_transaction(
+                transaction, [(i, wh) for i in item_ids for wh in (data.from_warehouse_id, data.to_warehouse_id)]
+            )
+
+            # FIFO/FEFO items move their layers (cost, batch, expiry) to the target
+            layer_plans = {}
+            planned = {}
+            for idx, line in enumerate(data.items):
+                item_data = items_data.get(line.item_id)
+                if posting_engine.layers.uses_layers(item_data):
+                    layer_plans[idx] = posting_engine.layers.plan_consumption(
+                        transaction, line.item_id, data.from_warehouse_id, Decimal(str(line.quantity)),
+                        item_data["costing_method"], line.batch_number, planned
+                    )
             
-            for line in data.items:
+            for idx, line in enumerate(data.items):
                 qty = Decimal(str(line.quantity))
                 item_id = line.item_id
                 item_data = items_data.get(item_id)
@@ -362,14 +589,28 @@ class InventoryService:
                     transaction, item_id, data.from_warehouse_id, -qty, Decimal("0"), 
                     doc_id, "TRF", item_data, 
                     batch_number=line.batch_number, 
-                    customer_id=data.customer_id
+                    customer_id=data.customer_id,
+                    consumed_layers=layer_plans.get(idx),
+                    balances=balances
                 )
                 # 2. IN to target
+                if idx in layer_plans:
+                    for layer in layer_plans[idx]:
+                        posting_engine.record_stock_movement(
+                            transaction, item_id, data.to_warehouse_id, layer["quantity"], layer["unit_cost"],
+                            doc_id, "TRF", item_data,
+                            batch_number=layer["batch_number"],
+                            customer_id=data.customer_id,
+                            expiry_date=layer["expiry_date"],
+                            balances=balances
+                        )
+                    continue
                 posting_engine.record_stock_movement(
                     transaction, item_id, data.to_warehouse_id, qty, Decimal(item_data["current_wac"]), 
                     doc_id, "TRF", item_data, 
                     batch_number=line.batch_number, 
-                    customer_id=data.customer_id
+                    customer_id=data.customer_id,
+                    balances=balances
                 )
             return True
             
@@ -383,8 +624,21 @@ class InventoryService:
         def _execute(transaction, db, posting_engine, data, doc_id):
             item_ids = [line.item_id for line in data.items]
             items_data = posting_engine.get_items_for_transaction(transaction, item_ids)
+            balances = posting_engine.balances.get_for_transaction(transaction, [(i, data.warehouse_id) for i in item_ids])
+
+            # FIFO/FEFO items: decreases consume layers, increases open one at WAC
+            layer_plans = {}
+            planned = {}
+            for idx, line in enumerate(data.items):
+                item_data = items_data.get(line.item_id)
+                qty = Decimal(str(line.quantity))
+                if qty < 0 and posting_engine.layers.uses_layers(item_data):
+                    layer_plans[idx] = posting_engine.layers.plan_consumption(
+                        transaction, line.item_id, data.warehouse_id, -qty,
+                        item_data["costing_method"], line.batch_number, planned
+                    )
             
-            for line in data.items:
+            for idx, line in enumerate(data.items):
                 qty = Decimal(str(line.quantity))
                 item_id = line.item_id
                 item_data = items_data.get(item_id)
@@ -395,7 +649,9 @@ class InventoryService:
                     transaction, item_id, data.warehouse_id, qty, Decimal(item_data["current_wac"]),
                     doc_id, "ADJ", item_data, 
                     batch_number=line.batch_number, 
-                    customer_id=data.customer_id
+                    customer_id=data.customer_id,
+                    consumed_layers=layer_plans.get(idx),
+                    balances=balances
                 )
             return True
             
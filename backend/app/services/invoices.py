@@ -1,4 +1,4 @@
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from typing import List, Optional
 from google.cloud import firestore
 from app.core.firebase import get_db
@@ -223,12 +223,14 @@ class InvoiceService:
             je_ref = self.db.collection("journal_entries").document()
             je_lines_dict = [line.model_dump() for line in lines]
             
+            # The entry is dated like the invoice (rollups, periods and the GL follow the document)
+            entry_date = data.get("issue_date") or datetime.now(timezone.utc)
             transaction.set(je_ref, {
                 "number": f"JE-INV-{data['invoice_number']}",
-                "date": firestore.SERVER_TIMESTAMP,
+                "date": entry_date,
                 "description": f"Invoice {data['invoice_number']} to {data['customer_name']}",
                 "status": "POSTED",
-                "lines": je_lines_dict,
+                "lines": self.posting_engine.journal_lines.inline(je_lines_dict),
                 "company_id": company_id,
                 "source_doc_id": invoice_id,
                 "source_doc_type": "INV"
@@ -240,7 +242,11 @@ class InvoiceService:
             account_ids = list(set(line["account_id"] for line in je_lines_dict))
             accounts_data = self.posting_engine.get_accounts_for_transaction(transaction, account_ids)
             
-            self.posting_engine.post_journal_entry(transaction, je_ref.id, je_lines_dict, accounts_data)
+            self.posting_engine.post_journal_entry(
+                transaction, je_ref.id, je_lines_dict, accounts_data,
+                entry_date=entry_date, company_id=company_id, source_type="INV",
+                dimensions={"customer_id": data.get("customer_id"), "warehouse_id": data.get("warehouse_id")}
+            )
 
             # 5. Lock Invoice
             update_data = {
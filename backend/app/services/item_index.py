@@ -0,0 +1,207 @@
+"""
+Item Lookup Index
+In-memory barcode / SKU / name-prefix index of each company's item catalog,
+so a warehouse scanner resolves a code without a Firestore query:
+
+    barcode -> item id        exact
+    SKU     -> item id        case-insensitive
+    name    -> item ids       prefix of any word of the name (or of the SKU)
+
+Each company's index is loaded once and kept fresh by a snapshot listener on
+its items, applying the changed documents only. If a listener cannot be
+started, the index is reloaded after FALLBACK_TTL_SECONDS instead (the
+version counter tells callers that a reload happened). The item routes
+upsert a saved item immediately, so the writer never reads a stale index.
+"""
+from bisect import bisect_left, insort
+from threading import Lock
+from time import monotonic
+from typing import Any, Dict, List, Optional, Tuple
+from app.core.firebase import get_db
+
+# Fields kept per item (enough to show a scanned line without another read)
+INDEXED_FIELDS = ("sku", "barcode", "name", "unit", "storage_type", "customer_id", "selling_price", "costing_method")
+
+
+def _norm(value: Optional[str]) -> str:
+    return (value or "").strip().casefold()
+
+
+class _CompanyIndex:
+    def __init__(self):
+        self.items: Dict[str, Dict[str, Any]] = {}
+        self.by_barcode: Dict[str, str] = {}
+        self.by_sku: Dict[str, str] = {}
+        # Sorted (token, item id) pairs for prefix search
+        self.tokens: List[Tuple[str, str]] = []
+        self.version = 0
+
+    @staticmethod
+    def _tokens_of(record: Dict[str, Any]) -> List[str]:
+        words = _norm(record.get("name")).split()
+        if record.get("sku"):
+            words.append(_norm(record["sku"]))
+        return sorted(set(words))
+
+    def remove(self, item_id: str):
+        record = self.items.pop(item_id, None)
+        if not record:
+            return
+        barcode = str(record.get("barcode") or "").strip()
+        if barcode and self.by_barcode.get(barcode) == item_id:
+            del self.by_barcode[barcode]
+        if record.get("sku") and self.by_sku.get(_norm(record["sku"])) == item_id:
+            del self.by_sku[_norm(record["sku"])]
+        for token in self._tokens_of(record):
+            pos = bisect_left(self.tokens, (token, item_id))
+            if pos < len(self.tokens) and self.tokens[pos] == (token, item_id):
+                del self.tokens[pos]
+
+    def _add(self, item_id: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        record = {"id": item_id, **{f: data.get(f) for f in INDEXED_FIELDS}}
+        self.items[item_id] = record
+        if record.get("barcode"):
+            self.by_barcode[str(record["barcode"]).strip()] = item_id
+        if record.get("sku"):
+            self.by_sku[_norm(record["sku"])] = item_id
+        return record
+
+    @classmethod
+    def build(cls, snapshots) -> "_CompanyIndex":
+        """Full load: one sort of the token list instead of an insert per token."""
+        index = cls()
+        for snap in snapshots:
+            record = index._add(snap.id, snap.to_dict() or {})
+            index.tokens.extend((token, snap.id) for token in cls._tokens_of(record))
+        index.tokens.sort()
+        return index
+
+    def upsert(self, item_id: str, data: Dict[str, Any]):
+        self.remove(item_id)
+        record = self._add(item_id, data)
+        for token in self._tokens_of(record):
+            insort(self.tokens, (token, item_id))
+
+
+class ItemIndexRegistry:
+    COLLECTION = "items"
+    FALLBACK_TTL_SECONDS = 120
+    REBUILD_CHANGES = 200
+
+    def __init__(self):
+        self._indexes: Dict[str, _CompanyIndex] = {}
+        self._loaded_at: Dict[str, float] = {}
+        self._watches: Dict[str, object] = {}
+        self._lock = Lock()
+        # Serializes listener registration so concurrent loads start one watch per company
+        self._watch_lock = Lock()
+
+    def _query(self, company_id: str):
+        return get_db().collection(self.COLLECTION).where("company_id", "==", company_id)
+
+    def _load(self, company_id: str):
+        index = _CompanyIndex.build(self._query(company_id).stream())
+        with self._lock:
+            previous = self._indexes.get(company_id)
+            index.version = (previous.version + 1) if previous else 1
+            self._indexes[company_id] = index
+            self._loaded_at[company_id] = monotonic()
+
+        with self._watch_lock:
+            with self._lock:
+                if company_id in self._watches:
+                    return
+            try:
+                def _on_snapshot(snapshots, changes, read_time):
+                    # The first callback (and any large change set) delivers the catalog: rebuild it
+                    rebuilt = _CompanyIndex.build(snapshots) if len(changes) > self.REBUILD_CHANGES else None
+                    with self._lock:
+                        current = self._indexes.get(company_id)
+                        if current is None:
+                            return
+                        if rebuilt is not None:
+                            rebuilt.version = current.version + 1
+                            self._indexes[company_id] = rebuilt
+                            self._loaded_at[company_id] = monotonic()
+                            return
+                        for change in changes:
+                            if change.type.name == "REMOVED":
+                                current.remove(change.document.id)
+                            else:
+                                current.upsert(change.document.id, change.document.to_dict() or {})
+                        current.version += 1
+                        self._loaded_at[company_id] = monotonic()
+
+                watch = self._query(company_id).on_snapshot(_on_snapshot)
+            except Exception as e:
+                print(f"[ItemIndex] Snapshot listener unavailable for {company_id}, using TTL reload: {e}")
+                watch = None
+            with self._lock:
+                self._watches[company_id] = watch
+
+    def _index(self, company_id: str) -> _CompanyIndex:
+        with self._lock:
+            cached = self._indexes.get(company_id)
+            watched = self._watches.get(company_id) is not None
+            fresh = watched or monotonic() - self._loaded_at.get(company_id, 0) < self.FALLBACK_TTL_SECONDS
+        if cached is None or not fresh:
+            self._load(company_id)
+            with self._lock:
+                cached = self._indexes[company_id]
+        return cached
+
+    # ==========================================================================
+    # LOOKUPS (no Firestore read when warm)
+    # ==========================================================================
+    def resolve(self, company_id: str, codes: List[str]) -> Dict[str, Optional[Dict[str, Any]]]:
+        """Scanned code -> item record: barcode first, then SKU, then item id."""
+        index = self._index(company_id)
+        with self._lock:
+            found = {}
+            for code in codes:
+                key = str(code or "").strip()
+                item_id = index.by_barcode.get(key) or index.by_sku.get(_norm(key)) or (key if key in index.items else None)
+                found[code] = dict(index.items[item_id]) if item_id else None
+            return found
+
+    def search(self, company_id: str, prefix: str, limit: int = 20) -> List[Dict[str, Any]]:
+        """Items whose name has a word (or whose SKU) starting with `prefix`, in token order."""
+        needle = _norm(prefix)
+        if not needle:
+            return []
+        index = self._index(company_id)
+        with self._lock:
+            results, seen = [], set()
+            pos = bisect_left(index.tokens, (needle, ""))
+            while pos < len(index.tokens) and len(results) < limit:
+                token, item_id = index.tokens[pos]
+                if not token.startswith(needle):
+                    break
+                if item_id not in seen:
+                    seen.add(item_id)
+                    results.append(dict(index.items[item_id]))
+                pos += 1
+            return results
+
+    def version(self, company_id: str) -> int:
+        return self._index(company_id).version
+
+    def upsert(self, company_id: str, item_id: str, data: Dict[str, Any]):
+        """Apply a saved item to the local index immediately (the listener catches up for other processes)."""
+        with self._lock:
+            index = self._indexes.get(company_id)
+            if index is None:
+                return
+            index.upsert(item_id, data)
+            index.version += 1
+
+
+_REGISTRY: Optional[ItemIndexRegistry] = None
+
+
+def get_item_index() -> ItemIndexRegistry:
+    """Process-wide index (shared by every request)."""
+    global _REGISTRY
+    if _REGISTRY is None:
+        _REGISTRY = ItemIndexRegistry()
+    return _REGISTRY
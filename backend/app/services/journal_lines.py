@@ -0,0 +1,153 @@
+"""
+Journal Line Storage
+Journal entries keep their lines inline (the `lines` array) up to INLINE_LINES.
+Larger entries (depreciation runs, imports, revaluations, bulk receipts) would
+hit the 1 MiB document cap, so PostingEngine stores their lines in chunks:
+
+    journal_entries/{id}                        header: lines = [], lines_chunked,
+                                                line_count, line_chunks, totals,
+                                                account_totals, account_chunks
+    journal_entries/{id}/line_chunks/{seq}      seq, lines (<= CHUNK_LINES), account_ids
+
+The header is the account index: account_chunks maps an account to the chunks
+holding its lines, so a ledger for one account reads only those chunks.
+
+Readers never touch `lines` directly; they use `iter_lines`, which yields the
+inline lines or streams the chunks lazily (a few per round trip). Writers that
+may build large entries store `inline(lines)` on the document they create and
+let post_journal_entry write the chunks in the same transaction.
+
+Chunks outlive their header when a closed period is archived (the archived
+header still points at them) and are read again after a restore.
+"""
+import json
+from decimal import Decimal
+from typing import Any, Dict, Iterator, List, Optional
+from app.core.firebase import get_db
+
+ZERO = Decimal("0")
+
+
+class JournalLineStore:
+    COLLECTION = "journal_entries"
+    CHUNKS = "line_chunks"
+    INLINE_LINES = 250
+    CHUNK_LINES = 500
+    # Stay well below the 1 MiB document cap even with long memos
+    CHUNK_BYTES = 600_000
+    FETCH_CHUNKS = 10
+
+    def __init__(self):
+        self.db = get_db()
+
+    def _chunk_ref(self, entry_id: str, seq: int):
+        return self.db.collection(self.COLLECTION).document(entry_id).collection(self.CHUNKS).document(f"{seq:05d}")
+
+    @classmethod
+    def inline(cls, lines_data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """What a writer stores in `lines` when it creates the entry (empty when the lines get chunked)."""
+        return lines_data if len(lines_data or []) <= cls.INLINE_LINES else []
+
+    @staticmethod
+    def totals(lines_data: List[Dict[str, Any]]) -> Dict[str, Dict[str, Decimal]]:
+        totals: Dict[str, Dict[str, Decimal]] = {}
+        for line in lines_data:
+            bucket = totals.setdefault(line.get("account_id"), {"debit": ZERO, "credit": ZERO})
+            bucket["debit"] += Decimal(str(line.get("debit", "0") or "0"))
+            bucket["credit"] += Decimal(str(line.get("credit", "0") or "0"))
+        return totals
+
+    def _split(self, lines_data: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+        chunks, current, size = [], [], 0
+        for line in lines_data:
+            line_bytes = len(json.dumps(line, default=str))
+            if current and (len(current) >= self.CHUNK_LINES or size + line_bytes > self.CHUNK_BYTES):
+                chunks.append(current)
+                current, size = [], 0
+            current.append(line)
+            size += line_bytes
+        if current:
+            chunks.append(current)
+        return chunks
+
+    # ==========================================================================
+    # WRITE (inside the posting transaction)
+    # ==========================================================================
+    def write(self, transaction, entry_id: str, lines_data: List[Dict[str, Any]],
+              totals: Optional[Dict[str, Dict[str, Decimal]]] = None) -> Dict[str, Any]:
+        """
+        Header fields for a posted entry. Above INLINE_LINES the lines are written
+        to line_chunks and the header gets the account index instead of the array.
+        """
+        totals = totals if totals is not None else self.totals(lines_data)
+        header = {
+            "flat_account_ids": sorted(a for a in totals if a),
+            "line_count": len(lines_data),
+            "total_debit": str(sum((t["debit"] for t in totals.values()), ZERO)),
+            "total_credit": str(sum((t["credit"] for t in totals.values()), ZERO)),
+        }
+        if len(lines_data) <= self.INLINE_LINES:
+            return header
+
+        account_chunks: Dict[str, List[int]] = {}
+        chunks = self._split(lines_data)
+        for seq, chunk in enumerate(chunks):
+            account_ids = sorted({l.get("account_id") for l in chunk if l.get("account_id")})
+            for acc_id in account_ids:
+                account_chunks.setdefault(acc_id, []).append(seq)
+            transaction.set(self._chunk_ref(entry_id, seq), {"seq": seq, "lines": chunk, "account_ids": account_ids})
+        header.update({
+            "lines": [],
+            "lines_chunked": True,
+            "line_chunks": len(chunks),
+            "account_chunks": account_chunks,
+            "account_totals": {
+                acc_id: {"debit": str(t["debit"]), "credit": str(t["credit"])} for acc_id, t in totals.items() if acc_id
+            }
+        })
+        return header
+
+    # ==========================================================================
+    # READ
+    # ==========================================================================
+    def iter_lines(self, entry_id: str, data: Dict[str, Any], account_id: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """Lines of an entry (only `account_id`'s when given), in posting order."""
+        if not data.get("lines_chunked"):
+            for line in data.get("lines", []):
+                if account_id is None or line.get("account_id") == account_id:
+                    yield line
+            return
+
+        if account_id is None:
+            seqs = list(range(data.get("line_chunks", 0)))
+        else:
+            seqs = data.get("account_chunks", {}).get(account_id, [])
+        for start in range(0, len(seqs), self.FETCH_CHUNKS):
+            refs = [self._chunk_ref(entry_id, seq) for seq in seqs[start:start + self.FETCH_CHUNKS]]
+            snaps = sorted((s for s in self.db.get_all(refs) if s.exists), key=lambda s: s.to_dict()["seq"])
+            for snap in snaps:
+                for line in snap.to_dict().get("lines", []):
+                    if account_id is None or line.get("account_id") == account_id:
+                        yield line
+
+    def lines_of(self, entry_id: str, data: Dict[str, Any]) -> List[Dict[str, Any]]:
+        return list(self.iter_lines(entry_id, data))
+
+    def account_totals(self, entry_id: str, data: Dict[str, Any]) -> Dict[str, Dict[str, Decimal]]:
+        """Debit/credit per account, from the header when the lines are chunked."""
+        if data.get("lines_chunked") and "account_totals" in data:
+            return {
+                acc_id: {"debit": Decimal(t["debit"]), "credit": Decimal(t["credit"])}
+                for acc_id, t in data["account_totals"].items()
+            }
+        return self.totals(list(self.iter_lines(entry_id, data)))
+
+
+_STORE: Optional[JournalLineStore] = None
+
+
+def get_journal_line_store() -> JournalLineStore:
+    global _STORE
+    if _STORE is None:
+        _STORE = JournalLineStore()
+    return _STORE
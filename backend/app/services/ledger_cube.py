@@ -0,0 +1,408 @@
+"""
+Ledger Cube Service
+Monthly debit/credit totals per account and dimension values:
+
+    ledger_cube/{company}_{account}_{yyyy-mm}_{dimension key}
+        account_id, account_type, month
+        cost_center_id, warehouse_id, customer_id, supplier_id, project_id   ("" when not set)
+        debit, credit, line_count
+
+A journal line carries its own dimensions; the entry's `dimensions` (set by the
+posting document, e.g. the customer of an invoice) fill the ones it leaves
+empty. PostingEngine increments the cube inside the posting transaction (one
+write per account and dimension combination), so management reports read a
+few documents per account and month instead of streaming journal entries:
+
+    income statement by branch     REVENUE/EXPENSE totals grouped by a dimension
+    budget vs actual               budgets/{id} lines against the cube
+    expenses by category           EXPENSE totals per account (or parent account)
+
+Year-end closing entries are left out (as in the daily rollups) so closed
+years still show their income and expenses. `rebuild` recomputes the cube
+from the journals, e.g. after dimensions were added to history.
+"""
+import hashlib
+from datetime import date, datetime, time, timedelta, timezone
+from decimal import Decimal
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from google.cloud import firestore
+from app.core.firebase import get_db, stream_paged
+from .rollups import RollupService, as_day
+from .journal_lines import get_journal_line_store
+
+ZERO = Decimal("0")
+DIMENSIONS = ("cost_center_id", "warehouse_id", "customer_id", "supplier_id", "project_id")
+PL_TYPES = ("REVENUE", "EXPENSE")
+
+
+def line_dimensions(line: Dict[str, Any], defaults: Optional[Dict[str, Any]] = None) -> Tuple[str, ...]:
+    """Dimension values of a line (entry-level defaults fill the empty ones)."""
+    defaults = defaults or {}
+    return tuple(str(line.get(d) or defaults.get(d) or "") for d in DIMENSIONS)
+
+
+def _month(value: str) -> str:
+    """'YYYY-MM' or an ISO date -> 'YYYY-MM' (validated)."""
+    month = str(value)[:7]
+    datetime.strptime(month, "%Y-%m")
+    return month
+
+
+class LedgerCubeService:
+    COLLECTION = "ledger_cube"
+    BUDGETS_COLLECTION = "budgets"
+    # Budget lines live on the budget document, which is capped at 1 MiB
+    MAX_BUDGET_LINES = 5000
+    EXCLUDED_JOURNAL_TYPES = RollupService.EXCLUDED_JOURNAL_TYPES
+
+    def __init__(self):
+        self.db = get_db()
+
+    @staticmethod
+    def cube_key(company_id: str, account_id: str, month: str, dims: Tuple[str, ...]) -> str:
+        if not any(dims):
+            return f"{company_id}_{account_id}_{month}_-"
+        digest = hashlib.sha1("|".join(dims).encode("utf-8")).hexdigest()[:16]
+        return f"{company_id}_{account_id}_{month}_{digest}"
+
+    # ==========================================================================
+    # DELTA CALCULATION (pure, shared by live posting and rebuild)
+    # ==========================================================================
+    @classmethod
+    def journal_cells(cls, lines_data: Iterable[Dict[str, Any]], dimensions: Optional[Dict[str, Any]] = None,
+                      source_type: Optional[str] = None) -> Dict[Tuple[str, Tuple[str, ...]], List[Decimal]]:
+        """(account, dimension values) -> [debit, credit, line count] for one entry."""
+        if source_type in cls.EXCLUDED_JOURNAL_TYPES:
+            return {}
+        cells: Dict[Tuple[str, Tuple[str, ...]], List[Decimal]] = {}
+        for line in lines_data:
+            acc_id = line.get("account_id")
+            if not acc_id:
+                continue
+            cell = cells.setdefault((acc_id, line_dimensions(line, dimensions)), [ZERO, ZERO, 0])
+            cell[0] += Decimal(str(line.get("debit", "0") or "0"))
+            cell[1] += Decimal(str(line.get("credit", "0") or "0"))
+            cell[2] += 1
+        return cells
+
+    @staticmethod
+    def _header(company_id: str, account_id: str, month: str, dims: Tuple[str, ...],
+                accounts_data: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "company_id": company_id,
+            "account_id": account_id,
+            "account_type": (accounts_data.get(account_id) or {}).get("type", ""),
+            "month": month,
+            **dict(zip(DIMENSIONS, dims))
+        }
+
+    # ==========================================================================
+    # TRANSACTIONAL WRITES (no reads: safe after any other write)
+    # ==========================================================================
+    def apply_journal(self, transaction, company_id: str, entry_date, lines_data: list, accounts_data: Dict[str, Any],
+                      source_type: Optional[str] = None, dimensions: Optional[Dict[str, Any]] = None):
+        """Add a posted journal entry to its month's cube cells inside the posting transaction."""
+        if not company_id:
+            return
+        month = as_day(entry_date).isoformat()[:7]
+        for (acc_id, dims), (debit, credit, count) in self.journal_cells(lines_data, dimensions, source_type).items():
+            ref = self.db.collection(self.COLLECTION).document(self.cube_key(company_id, acc_id, month, dims))
+            transaction.set(ref, {
+                **self._header(company_id, acc_id, month, dims, accounts_data),
+                "debit": firestore.Increment(float(debit)),
+                "credit": firestore.Increment(float(credit)),
+                "line_count": firestore.Increment(count),
+                "updated_at": firestore.SERVER_TIMESTAMP
+            }, merge=True)
+
+    # ==========================================================================
+    # READS
+    # ==========================================================================
+    def _cells(self, company_id: str, start: str, end: str, dimension: Optional[str] = None,
+               value: Optional[str] = None, account_types: Optional[Iterable[str]] = None) -> Iterable[Dict[str, Any]]:
+        """Cube documents of the months [start, end] (optionally one dimension value)."""
+        query = self.db.collection(self.COLLECTION).where("company_id", "==", company_id)
+        if dimension and value is not None:
+            query = query.where(dimension, "==", value)
+        query = query.where("month", ">=", start).where("month", "<=", end)
+        types = set(account_types) if account_types else None
+        for snap in stream_paged(query, page_size=1000):
+            cell = snap.to_dict()
+            if types is None or cell.get("account_type") in types:
+                yield cell
+
+    @staticmethod
+    def _check_dimension(dimension: Optional[str]):
+        if dimension and dimension not in DIMENSIONS:
+            raise ValueError(f"dimension must be one of {list(DIMENSIONS)}")
+
+    @staticmethod
+    def natural(account_type: str, debit: Decimal, credit: Decimal) -> Decimal:
+        """Amount in the account's natural direction (income positive for REVENUE, cost for EXPENSE)."""
+        return credit - debit if account_type in ("REVENUE", "LIABILITY", "EQUITY") else debit - credit
+
+    def _account_names(self, company_id: str) -> Dict[str, Dict[str, Any]]:
+        fields = ["code", "name_en", "name_ar", "type", "parent_id"]
+        query = self.db.collection("accounts").where("company_id", "==", company_id).select(fields)
+        return {snap.id: {k: (snap.to_dict() or {}).get(k) for k in fields} for snap in stream_paged(query)}
+
+    def get_income_statement_by(self, company_id: str, start: str, end: str, dimension: str = "cost_center_id") -> Dict[str, Any]:
+        """Revenue, expense and net income per value of `dimension` ("" = untagged) for the months [start, end]."""
+        self._check_dimension(dimension)
+        start, end = _month(start), _month(end)
+        groups: Dict[str, Dict[str, Any]] = {}
+        reads = 0
+        for cell in self._cells(company_id, start, end, account_types=PL_TYPES):
+            reads += 1
+            amount = self.natural(cell["account_type"], Decimal(str(cell.get("debit", 0))), Decimal(str(cell.get("credit", 0))))
+            group = groups.setdefault(cell.get(dimension, ""), {"revenue": ZERO, "expense": ZERO, "accounts": {}})
+            group["revenue" if cell["account_type"] == "REVENUE" else "expense"] += amount
+            group["accounts"][cell["account_id"]] = group["accounts"].get(cell["account_id"], ZERO) + amount
+
+        names = self._account_names(company_id) if groups else {}
+        rows = []
+        for value, group in sorted(groups.items()):
+            rows.append({
+                dimension: value or None,
+                "revenue": str(group["revenue"]),
+                "expense": str(group["expense"]),
+                "net_income": str(group["revenue"] - group["expense"]),
+                "accounts": [
+                    {"account_id": acc_id, **names.get(acc_id, {}), "amount": str(amount)}
+                    for acc_id, amount in sorted(group["accounts"].items(), key=lambda a: names.get(a[0], {}).get("code") or "")
+                ]
+            })
+        return {
+            "company_id": company_id,
+            "from": start,
+            "to": end,
+            "dimension": dimension,
+            "rows": rows,
+            "total_net_income": str(sum((Decimal(r["net_income"]) for r in rows), ZERO)),
+            "cube_reads": reads
+        }
+
+    def get_expense_by_category(self, company_id: str, start: str, end: str, group_by: str = "account",
+                                dimension: Optional[str] = None, value: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Expense totals per expense account (the category of an expense) or per
+        parent account, optionally for one dimension value (e.g. one cost center).
+        """
+        if group_by not in ("account", "parent"):
+            raise ValueError("group_by must be 'account' or 'parent'")
+        self._check_dimension(dimension)
+        start, end = _month(start), _month(end)
+        totals: Dict[str, Dict[str, Decimal]] = {}
+        for cell in self._cells(company_id, start, end, dimension, value, account_types=("EXPENSE",)):
+            by_month = totals.setdefault(cell["account_id"], {})
+            amount = self.natural("EXPENSE", Decimal(str(cell.get("debit", 0))), Decimal(str(cell.get("credit", 0))))
+            by_month[cell["month"]] = by_month.get(cell["month"], ZERO) + amount
+
+        names = self._account_names(company_id) if totals else {}
+        categories: Dict[str, Dict[str, Decimal]] = {}
+        for acc_id, by_month in totals.items():
+            key = acc_id if group_by == "account" else (names.get(acc_id, {}).get("parent_id") or acc_id)
+            bucket = categories.setdefault(key, {})
+            for month, amount in by_month.items():
+                bucket[month] = bucket.get(month, ZERO) + amount
+
+        grand_total = sum((sum(m.values(), ZERO) for m in categories.values()), ZERO)
+        rows = []
+        for key, by_month in categories.items():
+            total = sum(by_month.values(), ZERO)
+            rows.append({
+                "category_id": key,
+                **{k: names.get(key, {}).get(k) for k in ("code", "name_en", "name_ar")},
+                "total": str(total),
+                "share": str((total / grand_total * 100).quantize(Decimal("0.01"))) if grand_total else "0",
+                "by_month": {m: str(a) for m, a in sorted(by_month.items())}
+            })
+        rows.sort(key=lambda r: Decimal(r["total"]), reverse=True)
+        return {
+            "company_id": company_id,
+            "from": start,
+            "to": end,
+            "group_by": group_by,
+            "dimension": dimension,
+            "value": value,
+            "rows": rows,
+            "total": str(grand_total)
+        }
+
+    # ==========================================================================
+    # BUDGETS
+    # ==========================================================================
+    def save_budget(self, company_id: str, data: Dict[str, Any], budget_id: Optional[str] = None) -> Dict[str, Any]:
+        """Create or replace a budget: lines of (account, month, amount, optional dimension values)."""
+        lines = []
+        for line in data.get("lines", []):
+            entry = {
+                "account_id": line["account_id"],
+                "month": _month(line["month"]),
+                "amount": str(Decimal(str(line.get("amount") or "0")))
+            }
+            entry.update({d: line[d] for d in DIMENSIONS if line.get(d)})
+            lines.append(entry)
+        if len(lines) > self.MAX_BUDGET_LINES:
+            raise ValueError(f"A budget holds at most {self.MAX_BUDGET_LINES} lines; split it by fiscal year or branch")
+        ref = self.db.collection(self.BUDGETS_COLLECTION).document(budget_id) if budget_id \
+            else self.db.collection(self.BUDGETS_COLLECTION).document()
+        if budget_id:
+            snap = ref.get()
+            if snap.exists and snap.to_dict().get("company_id") != company_id:
+                raise ValueError("Budget not found")
+        payload = {
+            "company_id": company_id,
+            "name": data.get("name") or "Budget",
+            "fiscal_year": data.get("fiscal_year"),
+            "lines": lines,
+            "updated_at": firestore.SERVER_TIMESTAMP
+        }
+        ref.set(payload)
+        return {"id": ref.id, **{k: v for k, v in payload.items() if k != "updated_at"}}
+
+    def list_budgets(self, company_id: str) -> List[Dict[str, Any]]:
+        query = self.db.collection(self.BUDGETS_COLLECTION).where("company_id", "==", company_id)
+        return [
+            {"id": s.id, "name": s.to_dict().get("name"), "fiscal_year": s.to_dict().get("fiscal_year"),
+             "line_count": len(s.to_dict().get("lines", []))}
+            for s in query.stream()
+        ]
+
+    def get_budget_vs_actual(self, company_id: str, budget_id: str, start: Optional[str] = None,
+                             end: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Each budget line against the cube: actual is the account's natural amount
+        in the line's month, restricted to the dimension values the line sets.
+        """
+        snap = self.db.collection(self.BUDGETS_COLLECTION).document(budget_id).get()
+        if not snap.exists or snap.to_dict().get("company_id") != company_id:
+            raise ValueError("Budget not found")
+        budget = snap.to_dict()
+        lines = [l for l in budget.get("lines", [])
+                 if (not start or l["month"] >= _month(start)) and (not end or l["month"] <= _month(end))]
+        if not lines:
+            return {"id": budget_id, "name": budget.get("name"), "rows": [], "total_budget": "0", "total_actual": "0"}
+
+        accounts = {l["account_id"] for l in lines}
+        lo, hi = min(l["month"] for l in lines), max(l["month"] for l in lines)
+        cells: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+        for cell in self._cells(company_id, lo, hi):
+            if cell["account_id"] in accounts:
+                cells.setdefault((cell["account_id"], cell["month"]), []).append(cell)
+
+        names = self._account_names(company_id)
+        rows = []
+        total_budget = total_actual = ZERO
+        for line in sorted(lines, key=lambda l: (l["month"], names.get(l["account_id"], {}).get("code") or "")):
+            wanted = {d: line[d] for d in DIMENSIONS if line.get(d)}
+            account_type = names.get(line["account_id"], {}).get("type") or ""
+            actual = ZERO
+            for cell in cells.get((line["account_id"], line["month"]), []):
+                if all(cell.get(d) == v for d, v in wanted.items()):
+                    actual += self.natural(account_type, Decimal(str(cell.get("debit", 0))), Decimal(str(cell.get("credit", 0))))
+            budgeted = Decimal(line["amount"])
+            total_budget += budgeted
+            total_actual += actual
+            rows.append({
+                **line,
+                **{k: names.get(line["account_id"], {}).get(k) for k in ("code", "name_en", "name_ar")},
+                "actual": str(actual),
+                "variance": str(actual - budgeted),
+                "used_pct": str((actual / budgeted * 100).quantize(Decimal("0.01"))) if budgeted else None
+            })
+        return {
+            "id": budget_id,
+            "name": budget.get("name"),
+            "from": lo,
+            "to": hi,
+            "rows": rows,
+            "total_budget": str(total_budget),
+            "total_actual": str(total_actual),
+            "total_variance": str(total_actual - total_budget)
+        }
+
+    # ==========================================================================
+    # BACKFILL
+    # ==========================================================================
+    def rebuild(self, company_id: str, start: Optional[str] = None, end: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Recompute the cube from posted journals for the months [start, end] (all
+        history by default). Cells in the range with no lines left are deleted.
+        """
+        from .archive import ArchiveService
+        start = _month(start) if start else None
+        end = _month(end) if end else None
+
+        def in_range(month: str) -> bool:
+            return (start is None or month >= start) and (end is None or month <= end)
+
+        accounts = self._account_names(company_id)
+        lo = datetime.combine(date.fromisoformat(f"{start}-01"), time.min, tzinfo=timezone.utc) if start else None
+        hi = None
+        if end:
+            year, month = int(end[:4]), int(end[5:7])
+            hi = datetime(year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc) - timedelta(microseconds=1)
+
+        lines_store = get_journal_line_store()
+        cube: Dict[str, Dict[str, Any]] = {}
+        entries = 0
+        query = self.db.collection("journal_entries").where("company_id", "==", company_id)
+        for je in ArchiveService().read_through(company_id, "journal_entries", stream_paged(query, page_size=1000), lo, hi):
+            data = je.to_dict()
+            if data.get("status") not in ("POSTED", "VOIDED"):
+                continue
+            month = as_day(data.get("date")).isoformat()[:7]
+            if not in_range(month):
+                continue
+            source_type = data.get("source_doc_type") or data.get("source_document_type")
+            cells = self.journal_cells(lines_store.iter_lines(je.id, data), data.get("dimensions"), source_type)
+            for (acc_id, dims), (debit, credit, count) in cells.items():
+                key = self.cube_key(company_id, acc_id, month, dims)
+                doc = cube.setdefault(key, {**self._header(company_id, acc_id, month, dims, accounts),
+                                            "debit": ZERO, "credit": ZERO, "line_count": 0})
+                doc["debit"] += debit
+                doc["credit"] += credit
+                doc["line_count"] += count
+            entries += 1
+
+        ref = self.db.collection(self.COLLECTION)
+        stale = [
+            snap.id for snap in stream_paged(ref.where("company_id", "==", company_id).select(["month"]), page_size=1000)
+            if snap.id not in cube and in_range(snap.to_dict().get("month", ""))
+        ]
+        written = cleared = 0
+        batch, pending = self.db.batch(), 0
+        ops = [(key, doc) for key, doc in cube.items()] + [(key, None) for key in stale]
+        for key, doc in ops:
+            if doc is None:
+                batch.delete(ref.document(key))
+                cleared += 1
+            else:
+                batch.set(ref.document(key), {
+                    **doc,
+                    "debit": float(doc["debit"]),
+                    "credit": float(doc["credit"]),
+                    "updated_at": firestore.SERVER_TIMESTAMP
+                })
+                written += 1
+            pending += 1
+            if pending >= 450:
+                batch.commit()
+                batch, pending = self.db.batch(), 0
+        if pending:
+            batch.commit()
+
+        return {
+            "company_id": company_id,
+            "from": start,
+            "to": end,
+            "entries_scanned": entries,
+            "cells": len(cube),
+            "documents_written": written,
+            "documents_cleared": cleared
+        }
+
+
+def get_ledger_cube_service() -> LedgerCubeService:
+    return LedgerCubeService()
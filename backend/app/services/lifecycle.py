@@ -2,13 +2,15 @@
 Document Lifecycle & Integrity Service
 Handles document state machine (DRAFT -> POSTED -> VOIDED) and reversals.
 """
-from datetime import datetime
+from datetime import datetime, timezone
 from decimal import Decimal
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 from google.cloud import firestore
 from app.core.firebase import get_db
 from app.core.audit import get_audit_logger
 from app.models.core import DocumentStatus
+from .posting import PostingEngine
+from .ledger_cube import DIMENSIONS
 
 class LifecycleService:
     """Manages document lifecycle and reversal logic."""
@@ -19,9 +21,42 @@ class LifecycleService:
         self.user_id = user_id
         self.company_id = company_id
     
+    # Source documents that follow their journal entry into VOIDED
+    SOURCE_COLLECTIONS = {
+        "INV": "invoices",
+        "BILL": "bills",
+        "PV": "payment_vouchers",
+        "RV": "receipt_vouchers",
+        "EXPENSE": "expenses",
+        "CREDIT_NOTE": "credit_notes",
+    }
+    # Journals whose stock_ledger rows reference the JE id itself
+    STOCK_DOC_TYPES = {"GRN", "DO"}
+    # Source documents settled by vouchers: they cannot be voided while payments are allocated
+    SETTLED_DOC_TYPES = {"INV", "BILL"}
+    # Writes per void transaction (Firestore limit is 500)
+    MAX_WRITES_PER_TRANSACTION = PostingEngine.WRITE_LIMIT
+    # Writes of one void besides posting the reversal and moving stock back: the reversal's
+    # set, its reversal-count rollup, the original's VOIDED update and the source document's
+    VOID_WRITES = 4
+
+    @classmethod
+    def void_writes(cls, data: Dict[str, Any], stock_rows: int = 0, settlements: int = 0) -> int:
+        """
+        Upper bound of the writes voiding one entry stages: VOID_WRITES, the reversal's
+        posting (PostingEngine.journal_writes), one stock movement per stock_ledger row
+        and one update per invoice/bill its voucher settled.
+        """
+        lines = data.get("line_count") or len(data.get("lines", []))
+        return (cls.VOID_WRITES + PostingEngine.journal_writes(lines)
+                + stock_rows * PostingEngine.STOCK_MOVEMENT_WRITES + settlements)
+
     def void_journal_entry(self, je_id: str, reason: str = "") -> str:
         """
         Void a posted journal entry by creating a reversal entry.
+        The reversal is posted through PostingEngine (account balances and rollups
+        move back) and the void cascades to the linked source document in the
+        same transaction.
         
         Args:
             je_id: Journal Entry ID to void
@@ -30,70 +65,278 @@ class LifecycleService:
         Returns:
             Reversal Journal Entry ID
         """
+        results = self._void_group([je_id], reason, strict=True)
+        return results["voided"][je_id]
+
+    def void_journal_entries(self, je_ids: List[str], reason: str = "") -> Dict[str, Any]:
+        """
+        Bulk void: JEs are grouped into transactions sized by their line counts.
+        Entries that cannot be voided (missing, not POSTED, other company) are
+        reported as skipped without failing the rest of their group.
+        """
+        je_ids = list(dict.fromkeys(je_ids))
+        refs = [self.db.collection("journal_entries").document(jid) for jid in je_ids]
+        entries = {snap.id: snap.to_dict() or {} for snap in self.db.get_all(refs)}
+
+        # Voucher sources settle invoices/bills that the void re-opens (one write each)
+        source_refs = {}
+        for jid, data in entries.items():
+            doc_type = data.get("source_doc_type") or data.get("source_document_type")
+            if doc_type in ("RV", "PV") and data.get("source_doc_id"):
+                source_refs[jid] = self.db.collection(self.SOURCE_COLLECTIONS[doc_type]).document(data["source_doc_id"])
+        settlements = {}
+        if source_refs:
+            by_path = {ref.path: jid for jid, ref in source_refs.items()}
+            for snap in self.db.get_all(list(source_refs.values())):
+                src = snap.to_dict() or {}
+                settlements[by_path[snap.reference.path]] = len(src.get("linked_invoices", [])) + len(src.get("linked_bills", []))
+
+        sizes = {}
+        for jid, data in entries.items():
+            stock_rows = 0
+            if (data.get("source_doc_type") or data.get("source_document_type")) in self.STOCK_DOC_TYPES:
+                # GRN/DO voids move every stock_ledger row of the entry back
+                query = self.db.collection("stock_ledger").where("source_document_id", "==", jid)
+                stock_rows = query.count().get()[0][0].value
+            sizes[jid] = self.void_writes(data, stock_rows, settlements.get(jid, 0))
+
+        voided, skipped, failed = {}, {}, {}
+        group, group_writes = [], 0
+        groups = []
+        for jid in je_ids:
+            writes = sizes.get(jid, self.VOID_WRITES)
+            if group and group_writes + writes > self.MAX_WRITES_PER_TRANSACTION:
+                groups.append(group)
+                group, group_writes = [], 0
+            group.append(jid)
+            group_writes += writes
+        if group:
+            groups.append(group)
+
+        for group in groups:
+            try:
+                result = self._void_group(group, reason, strict=False)
+                voided.update(result["voided"])
+                skipped.update(result["skipped"])
+            except Exception as e:
+                for jid in group:
+                    failed[jid] = str(e)
+
+        return {"voided": voided, "skipped": skipped, "failed": failed}
+
+    def _void_group(self, je_ids: List[str], reason: str, strict: bool) -> Dict[str, Any]:
+        """Void a group of JEs in one transaction (reads first, then all writes)."""
         transaction = self.db.transaction()
-        
+        posting_engine = PostingEngine()
+
         @firestore.transactional
         def _execute(transaction, db):
-            # 1. Read original JE
-            je_ref = db.collection("journal_entries").document(je_id)
-            je_snap = je_ref.get(transaction=transaction)
-            
-            if not je_snap.exists:
-                raise ValueError(f"Journal Entry {je_id} not found")
-            
-            je_data = je_snap.to_dict()
-            
-            # 2. Verify it's posted (can only void posted documents)
-            if je_data.get("status") != DocumentStatus.POSTED:
-                raise ValueError(f"Can only void POSTED documents. Current status: {je_data.get('status')}")
-            
-            # 3. Create reversal entry (swap debits and credits)
-            reversal_lines = []
-            for line in je_data.get("lines", []):
-                reversal_lines.append({
-                    "account_id": line["account_id"],
-                    "debit": line.get("credit", "0.0000"),
-                    "credit": line.get("debit", "0.0000"),
-                    "description": f"Reversal: {line.get('description', '')}"
+            # ==================================================================
+            # PHASE 1: READ (JEs, source docs, linked settlements, stock, accounts)
+            # ==================================================================
+            je_refs = [db.collection("journal_entries").document(jid) for jid in je_ids]
+            originals = {}
+            skipped = {}
+            for snap in db.get_all(je_refs, transaction=transaction):
+                if not snap.exists:
+                    skipped[snap.id] = f"Journal Entry {snap.id} not found"
+                    continue
+                data = snap.to_dict()
+                if data.get("status") != DocumentStatus.POSTED:
+                    skipped[snap.id] = f"Can only void POSTED documents. Current status: {data.get('status')}"
+                elif self.company_id != "default" and data.get("company_id") not in (None, self.company_id):
+                    skipped[snap.id] = f"Journal Entry {snap.id} belongs to another company"
+                else:
+                    originals[snap.id] = data
+            if strict and skipped:
+                raise ValueError(next(iter(skipped.values())))
+            # Posted lines never change, so chunked ones are read outside the transaction
+            original_lines = {jid: posting_engine.journal_lines.lines_of(jid, data) for jid, data in originals.items()}
+
+            source_refs = {}
+            stock_rows = {}
+            for jid, data in originals.items():
+                doc_type = data.get("source_doc_type") or data.get("source_document_type")
+                if doc_type in self.SOURCE_COLLECTIONS and data.get("source_doc_id"):
+                    source_refs[jid] = db.collection(self.SOURCE_COLLECTIONS[doc_type]).document(data["source_doc_id"])
+                elif doc_type in self.STOCK_DOC_TYPES:
+                    ledger_query = db.collection("stock_ledger").where("source_document_id", "==", jid)
+                    stock_rows[jid] = [r.to_dict() for r in ledger_query.get(transaction=transaction)]
+
+            sources = {}
+            if source_refs:
+                by_path = {ref.path: jid for jid, ref in source_refs.items()}
+                for snap in db.get_all(list(source_refs.values()), transaction=transaction):
+                    if snap.exists:
+                        sources[by_path[snap.reference.path]] = snap.to_dict()
+
+            # A paid invoice/bill keeps its receipts/payments allocated: void those vouchers first
+            for jid, src in list(sources.items()):
+                doc_type = originals[jid].get("source_doc_type") or originals[jid].get("source_document_type")
+                paid = Decimal(str(src.get("paid_amount") or "0"))
+                if doc_type in self.SETTLED_DOC_TYPES and paid > 0:
+                    number = src.get("invoice_number") or src.get("bill_number") or originals[jid].get("number")
+                    skipped[jid] = f"Cannot void {number}: {paid} is allocated from vouchers; void them first"
+                    for collection in (originals, original_lines, source_refs, sources):
+                        collection.pop(jid, None)
+            if strict and skipped:
+                raise ValueError(next(iter(skipped.values())))
+
+            # Invoices/bills settled by voided vouchers
+            settlement_refs = {}
+            for jid, src in sources.items():
+                doc_type = originals[jid].get("source_doc_type")
+                if doc_type == "RV":
+                    for s in src.get("linked_invoices", []):
+                        settlement_refs[("invoices", s["invoice_id"])] = db.collection("invoices").document(s["invoice_id"])
+                elif doc_type == "PV":
+                    for s in src.get("linked_bills", []):
+                        settlement_refs[("bills", s["invoice_id"])] = db.collection("bills").document(s["invoice_id"])
+            settlements = {}
+            if settlement_refs:
+                for snap in db.get_all(list(settlement_refs.values()), transaction=transaction):
+                    if snap.exists:
+                        settlements[(snap.reference.parent.id, snap.id)] = snap.to_dict()
+
+            account_ids = [l["account_id"] for lines in original_lines.values() for l in lines if l.get("account_id")]
+            accounts_data = posting_engine.get_accounts_for_transaction(transaction, account_ids)
+            # Every moved item is read here: record_stock_movement must not read after the writes start
+            item_ids = [r["item_id"] for rows in stock_rows.values() for r in rows]
+            items_data = posting_engine.get_items_for_transaction(transaction, item_ids)
+            missing = sorted(i for i in set(item_ids) if not items_data.get(i))
+            if missing:
+                raise ValueError(f"Cannot reverse stock: item {missing[0]} not found")
+            balances = posting_engine.balances.get_for_transaction(
+                transaction, [(r["item_id"], r.get("warehouse_id")) for rows in stock_rows.values() for r in rows]
+            )
+
+            # FIFO/FEFO receipts are taken back out of the layers they opened
+            grn_layers = {}
+            for jid, rows in stock_rows.items():
+                doc_type = originals[jid].get("source_doc_type") or originals[jid].get("source_document_type")
+                if doc_type != "GRN" or not any(posting_engine.layers.uses_layers(items_data.get(r["item_id"])) for r in rows):
+                    continue
+                layer_query = db.collection(posting_engine.layers.COLLECTION).where("source_document_id", "==", jid)
+                for snap in layer_query.get(transaction=transaction):
+                    layer = snap.to_dict()
+                    remaining = Decimal(str(layer.get("remaining_qty", "0")))
+                    if remaining < Decimal(str(layer.get("original_qty", "0"))):
+                        raise ValueError(f"Cannot void {originals[jid].get('number')}: stock of layer {snap.id} was already issued")
+                    grn_layers.setdefault((jid, layer["item_id"], layer["warehouse_id"]), []).append({
+                        "layer_id": snap.id, "quantity": remaining, "unit_cost": Decimal(str(layer.get("unit_cost", "0"))),
+                        "remaining_qty": remaining, "batch_number": layer.get("batch_number"),
+                        "expiry_date": layer.get("expiry_date")
+                    })
+
+            # ==================================================================
+            # PHASE 3: WRITE
+            # ==================================================================
+            now = datetime.now(timezone.utc)
+            voided = {}
+            for jid, je_data in originals.items():
+                company_id = je_data.get("company_id") or (None if self.company_id == "default" else self.company_id)
+                doc_type = je_data.get("source_doc_type") or je_data.get("source_document_type")
+
+                # 1. Reversal entry (swap debits and credits), posted through the engine
+                reversal_lines = []
+                for line in original_lines[jid]:
+                    reversal_lines.append({
+                        "account_id": line["account_id"],
+                        "debit": line.get("credit", "0.0000"),
+                        "credit": line.get("debit", "0.0000"),
+                        "description": f"Reversal: {line.get('description') or line.get('memo') or ''}",
+                        **{d: line[d] for d in DIMENSIONS if line.get(d)}
+                    })
+
+                reversal_ref = db.collection("journal_entries").document()
+                transaction.set(reversal_ref, {
+                    "number": f"REV-{je_data.get('number', jid)}",
+                    "date": now,
+                    "description": f"Reversal of {je_data.get('number')}: {reason}",
+                    "status": DocumentStatus.DRAFT,
+                    "source_document_type": "REVERSAL",
+                    "original_je_id": jid,
+                    "reversed_doc_type": doc_type,
+                    "lines": posting_engine.journal_lines.inline(reversal_lines),
+                    "company_id": company_id
                 })
-            
-            reversal_ref = db.collection("journal_entries").document()
-            reversal_data = {
-                "number": f"REV-{je_data.get('number', je_id)}",
-                "date": firestore.SERVER_TIMESTAMP,
-                "description": f"Reversal of {je_data.get('number')}: {reason}",
-                "status": DocumentStatus.POSTED,
-                "source_document_type": "REVERSAL",
-                "original_je_id": je_id,
-                "lines": reversal_lines,
-                "company_id": self.company_id
-            }
-            
-            # 4. Write reversal
-            transaction.set(reversal_ref, reversal_data)
-            
-            # 5. Mark original as VOIDED (not deleted)
-            transaction.update(je_ref, {
-                "status": DocumentStatus.VOIDED,
-                "voided_at": firestore.SERVER_TIMESTAMP,
-                "voided_by": self.user_id,
-                "voided_reason": reason,
-                "reversal_je_id": reversal_ref.id
-            })
-            
-            return reversal_ref.id, je_data
-        
-        reversal_id, original_data = _execute(transaction, self.db)
-        
-        # 6. Log to audit trail
-        self.audit.log_void(
-            collection="journal_entries",
-            doc_id=je_id,
-            original=original_data,
-            description=f"Voided JE {original_data.get('number')} - Reason: {reason}"
-        )
-        
-        return reversal_id
+                posting_engine.post_journal_entry(
+                    transaction, reversal_ref.id, reversal_lines, accounts_data,
+                    entry_date=now, company_id=company_id, source_type="REVERSAL",
+                    dimensions=je_data.get("dimensions")
+                )
+                posting_engine.rollups.apply_reversal_count(transaction, company_id, now, doc_type)
+
+                # 2. Mark original as VOIDED (not deleted)
+                transaction.update(je_refs[je_ids.index(jid)], {
+                    "status": DocumentStatus.VOIDED,
+                    "voided_at": firestore.SERVER_TIMESTAMP,
+                    "voided_by": self.user_id,
+                    "voided_reason": reason,
+                    "reversal_je_id": reversal_ref.id
+                })
+
+                # 3. Cascade to the source document
+                if jid in sources:
+                    transaction.update(source_refs[jid], {
+                        "status": DocumentStatus.VOIDED,
+                        "void_reason": reason,
+                        "voided_at": firestore.SERVER_TIMESTAMP,
+                        "voided_by": self.user_id
+                    })
+                    linked_field, collection, open_status = {
+                        "RV": ("linked_invoices", "invoices", "ISSUED"),
+                        "PV": ("linked_bills", "bills", "POSTED"),
+                    }.get(doc_type, (None, None, None))
+                    for s in sources[jid].get(linked_field, []) if linked_field else []:
+                        key = (collection, s["invoice_id"])
+                        if key not in settlements:
+                            continue
+                        doc = settlements[key]
+                        paid = Decimal(str(doc.get("paid_amount", "0"))) - Decimal(str(s["amount"]))
+                        remaining = Decimal(str(doc.get("total", "0"))) - paid
+                        doc.update({"paid_amount": str(paid), "remaining_amount": str(remaining)})
+                        transaction.update(settlement_refs[key], {
+                            "paid_amount": str(paid),
+                            "remaining_amount": str(remaining),
+                            "status": open_status if remaining > Decimal("0.0001") else doc.get("status"),
+                            "updated_at": firestore.SERVER_TIMESTAMP
+                        })
+
+                # 4. Reverse GRN/DO stock movements
+                for row in stock_rows.get(jid, []):
+                    qty = Decimal(str(row.get("quantity", "0")))
+                    rate = Decimal(str(row.get("unit_cost") if qty > 0 else row.get("valuation_rate") or "0"))
+                    # Each receipt row takes back the layer it opened (same quantity)
+                    candidates = grn_layers.get((jid, row["item_id"], row.get("warehouse_id")), [])
+                    layer = next((l for l in candidates if l["quantity"] == qty), None)
+                    if layer:
+                        candidates.remove(layer)
+                    layers = [layer] if layer else None
+                    posting_engine.record_stock_movement(
+                        transaction, row["item_id"], row.get("warehouse_id"), -qty, rate,
+                        doc_id=reversal_ref.id, doc_type=f"{doc_type}_VOID",
+                        item_data=items_data[row["item_id"]], movement_date=now,
+                        batch_number=row.get("batch_number"), expiry_date=row.get("expiry_date"),
+                        consumed_layers=layers, balances=balances
+                    )
+
+                voided[jid] = reversal_ref.id
+
+            return voided, skipped, originals
+
+        voided, skipped, originals = _execute(transaction, self.db)
+
+        # Log to audit trail
+        for jid in voided:
+            self.audit.log_void(
+                collection="journal_entries",
+                doc_id=jid,
+                original=originals[jid],
+                description=f"Voided JE {originals[jid].get('number')} - Reason: {reason}"
+            )
+
+        return {"voided": voided, "skipped": skipped}
     
     def can_edit_document(self, doc_id: str, collection: str) -> bool:
         """Check if a document can still be edited (only DRAFT status)."""
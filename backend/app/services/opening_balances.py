@@ -0,0 +1,429 @@
+"""
+Opening Balance Loader
+Migrates opening balances from CSV/XLSX files in two streamed passes:
+
+1. Validate: every row is parsed and resolved (account codes, customers,
+   suppliers, SKUs) through maps loaded once per import; GL totals must
+   balance. Nothing is written if any row fails.
+2. Post: rows are posted in chunks, each in its own transaction/batch that
+   also advances the import checkpoint. A failed import is restarted with the
+   same job_id and file and continues from the first unposted chunk.
+
+Kinds:
+    gl      account_code, debit, credit             -> balanced JEs via PostingEngine
+    ar      customer_id, invoice_number, amount, issue_date, due_date
+                                                    -> open ISSUED invoices (sub-ledger only)
+    ap      supplier_id, bill_number, amount, date, due_date
+                                                    -> open POSTED bills (sub-ledger only)
+    stock   sku, warehouse_id, quantity, unit_cost  -> stock movements (OPENING)
+
+AR/AP/stock rows only create sub-ledger records; their GL control balances
+(122/21/121) come from the gl file, so nothing is counted twice.
+"""
+import csv
+import hashlib
+import io
+from datetime import datetime, date, timezone
+from decimal import Decimal, InvalidOperation
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple
+from google.cloud import firestore
+from app.core.firebase import get_db
+from .posting import PostingEngine
+from .valuation import get_valuation_service
+
+
+class OpeningBalanceLoader:
+    JOBS_COLLECTION = "opening_balance_imports"
+    SOURCE_TYPE = "OPENING_BALANCE"
+    KINDS = ("gl", "ar", "ap", "stock")
+
+    # Rows per chunk (posting transaction / batch), sized for the 500-write limit
+    # (gl: one JE set, the posting's writes for the rows plus the clearing line, and the job
+    # checkpoint; stock: every row is a full stock movement, plus the job checkpoint)
+    CHUNK_SIZE = {
+        "gl": PostingEngine.max_journal_lines(other_writes=2) - 1, "ar": 450, "ap": 450,
+        "stock": (PostingEngine.WRITE_LIMIT - 1) // PostingEngine.STOCK_MOVEMENT_WRITES
+    }
+    MAX_ERRORS = 100
+
+    REQUIRED_COLUMNS = {
+        "gl": ("account_code",),
+        "ar": ("customer_id", "amount"),
+        "ap": ("supplier_id", "amount"),
+        "stock": ("sku", "warehouse_id", "quantity"),
+    }
+
+    def __init__(self, company_id: str, user_email: Optional[str] = None):
+        self.db = get_db()
+        self.company_id = company_id
+        self.user_email = user_email
+        self.posting_engine = PostingEngine()
+        self._maps: Dict[str, Dict[str, Any]] = {}
+
+    # ==========================================================================
+    # FILE STREAMING
+    # ==========================================================================
+    @staticmethod
+    def iter_file(file: BinaryIO, filename: str) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """Yield (row_number, row) with lower-cased headers from a CSV or XLSX stream."""
+        file.seek(0)
+        if filename.lower().endswith((".xlsx", ".xlsm")):
+            from openpyxl import load_workbook
+            workbook = load_workbook(file, read_only=True, data_only=True)
+            try:
+                rows = workbook.active.iter_rows(values_only=True)
+                header = [str(h or "").strip().lower() for h in next(rows, [])]
+                for idx, values in enumerate(rows, start=2):
+                    if not any(v not in (None, "") for v in values):
+                        continue
+                    yield idx, dict(zip(header, values))
+            finally:
+                workbook.close()
+        else:
+            text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+            try:
+                reader = csv.DictReader(text)
+                reader.fieldnames = [(h or "").strip().lower() for h in (reader.fieldnames or [])]
+                for idx, row in enumerate(reader, start=2):
+                    if not any((v or "").strip() for v in row.values() if isinstance(v, str)):
+                        continue
+                    yield idx, row
+            finally:
+                text.detach()
+
+    @staticmethod
+    def file_hash(file: BinaryIO) -> str:
+        file.seek(0)
+        digest = hashlib.sha256()
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+        file.seek(0)
+        return digest.hexdigest()
+
+    # ==========================================================================
+    # LOOKUP MAPS (loaded once per import)
+    # ==========================================================================
+    def _map(self, name: str) -> Dict[str, Any]:
+        if name in self._maps:
+            return self._maps[name]
+        if name == "accounts":
+            query = self.db.collection("accounts").where("company_id", "==", self.company_id)
+            mapping = {}
+            for doc in query.stream():
+                data = doc.to_dict()
+                if data.get("code") and not data.get("is_group"):
+                    mapping[str(data["code"])] = doc.id
+        elif name == "items":
+            query = self.db.collection("items").where("company_id", "==", self.company_id)
+            mapping = {str(doc.to_dict().get("sku")): doc.id for doc in query.stream() if doc.to_dict().get("sku")}
+        else:  # customers / suppliers: id -> name
+            query = self.db.collection(name).where("company_id", "==", self.company_id)
+            mapping = {doc.id: doc.to_dict().get("name") for doc in query.stream()}
+        self._maps[name] = mapping
+        return mapping
+
+    @staticmethod
+    def _decimal(value) -> Decimal:
+        if value in (None, ""):
+            return Decimal("0")
+        return Decimal(str(value).replace(",", "").strip())
+
+    @staticmethod
+    def _date(value, default: datetime) -> datetime:
+        if value in (None, ""):
+            return default
+        if isinstance(value, datetime):
+            return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+        if isinstance(value, date):
+            return datetime(value.year, value.month, value.day, tzinfo=timezone.utc)
+        parsed = datetime.fromisoformat(str(value).strip())
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+    def _parse(self, kind: str, row: Dict[str, Any], effective: datetime) -> Dict[str, Any]:
+        """Resolve one row into a posting record. Raises ValueError with a readable message."""
+        for column in self.REQUIRED_COLUMNS[kind]:
+            if row.get(column) in (None, ""):
+                raise ValueError(f"missing {column}")
+
+        if kind == "gl":
+            code = str(row["account_code"]).strip()
+            account_id = self._map("accounts").get(code)
+            if not account_id:
+                raise ValueError(f"unknown account code {code}")
+            debit, credit = self._decimal(row.get("debit")), self._decimal(row.get("credit"))
+            if debit < 0 or credit < 0 or (debit and credit) or not (debit or credit):
+                raise ValueError("exactly one of debit/credit must be a positive amount")
+            return {"account_id": account_id, "debit": debit, "credit": credit, "code": code}
+
+        if kind in ("ar", "ap"):
+            partner_field, collection = ("customer_id", "customers") if kind == "ar" else ("supplier_id", "suppliers")
+            partner_id = str(row[partner_field]).strip()
+            partners = self._map(collection)
+            if partner_id not in partners:
+                raise ValueError(f"unknown {partner_field} {partner_id}")
+            amount = self._decimal(row["amount"])
+            if amount <= 0:
+                raise ValueError("amount must be positive")
+            doc_date = self._date(row.get("issue_date") or row.get("date"), effective)
+            return {
+                "partner_id": partner_id,
+                "partner_name": partners[partner_id],
+                "number": str(row.get("invoice_number") or row.get("bill_number") or "").strip(),
+                "amount": amount,
+                "currency": str(row.get("currency") or "IQD").strip(),
+                "date": doc_date,
+                "due_date": self._date(row.get("due_date"), doc_date),
+            }
+
+        sku = str(row["sku"]).strip()
+        item_id = self._map("items").get(sku)
+        if not item_id:
+            raise ValueError(f"unknown sku {sku}")
+        quantity = self._decimal(row["quantity"])
+        unit_cost = self._decimal(row.get("unit_cost"))
+        if quantity <= 0 or unit_cost < 0:
+            raise ValueError("quantity must be positive and unit_cost non-negative")
+        return {"item_id": item_id, "warehouse_id": str(row["warehouse_id"]).strip(), "quantity": quantity, "unit_cost": unit_cost}
+
+    # ==========================================================================
+    # PASS 1: VALIDATION
+    # ==========================================================================
+    def validate(self, kind: str, file: BinaryIO, filename: str, effective_date: date, clearing_account_id: Optional[str] = None) -> Dict[str, Any]:
+        """Stream the file once; return row count, totals and errors (nothing is written)."""
+        if kind not in self.KINDS:
+            raise ValueError(f"kind must be one of {', '.join(self.KINDS)}")
+        effective = self._date(effective_date, datetime.now(timezone.utc))
+
+        errors: List[Dict[str, Any]] = []
+        rows = 0
+        total_debit = Decimal("0")
+        total_credit = Decimal("0")
+        total_amount = Decimal("0")
+
+        for row_number, row in self.iter_file(file, filename):
+            try:
+                record = self._parse(kind, row, effective)
+            except (ValueError, InvalidOperation, TypeError) as e:
+                if len(errors) < self.MAX_ERRORS:
+                    errors.append({"row": row_number, "error": str(e) or "invalid number"})
+                continue
+            rows += 1
+            if kind == "gl":
+                total_debit += record["debit"]
+                total_credit += record["credit"]
+            elif kind == "stock":
+                total_amount += record["quantity"] * record["unit_cost"]
+            else:
+                total_amount += record["amount"]
+
+        if kind == "gl":
+            if total_debit != total_credit:
+                errors.append({"row": None, "error": f"Opening balances do not balance: D:{total_debit} C:{total_credit}"})
+            if rows > self.CHUNK_SIZE["gl"] and not clearing_account_id:
+                errors.append({"row": None, "error": f"More than {self.CHUNK_SIZE['gl']} lines: clearing_account_id is required to balance each chunk"})
+            if clearing_account_id and clearing_account_id not in self._map("accounts").values():
+                errors.append({"row": None, "error": "clearing_account_id not found"})
+
+        return {
+            "kind": kind,
+            "rows": rows,
+            "valid": not errors,
+            "errors": errors,
+            "total_debit": str(total_debit),
+            "total_credit": str(total_credit),
+            "total_amount": str(total_amount),
+            "chunks": -(-rows // self.CHUNK_SIZE[kind]) if rows else 0
+        }
+
+    # ==========================================================================
+    # PASS 2: CHUNKED POSTING
+    # ==========================================================================
+    def load(
+        self,
+        kind: str,
+        file: BinaryIO,
+        filename: str,
+        effective_date: date,
+        clearing_account_id: Optional[str] = None,
+        job_id: Optional[str] = None,
+        validate_only: bool = False
+    ) -> Dict[str, Any]:
+        """
+        Validate then post an opening balance file. Pass the job_id of a failed
+        import (with the same file) to resume after its last committed chunk.
+        """
+        report = self.validate(kind, file, filename, effective_date, clearing_account_id)
+        if validate_only or not report["valid"]:
+            return report
+
+        digest = self.file_hash(file)
+        jobs = self.db.collection(self.JOBS_COLLECTION)
+        job_ref = jobs.document(job_id) if job_id else jobs.document()
+        job_snap = job_ref.get()
+        if job_snap.exists:
+            job = job_snap.to_dict()
+            if job.get("company_id") != self.company_id or job.get("file_hash") != digest or job.get("kind") != kind:
+                raise ValueError("Resume requires the same company, kind and file as the original import")
+            if job.get("status") == "COMPLETED":
+                return {**report, "job_id": job_ref.id, "status": "COMPLETED", "already_completed": True}
+            next_chunk = int(job.get("next_chunk", 0))
+            # Chunk boundaries must match the run that committed next_chunk
+            size = int(job.get("chunk_size") or self.CHUNK_SIZE[kind])
+            if not next_chunk and size != self.CHUNK_SIZE[kind]:
+                # Nothing committed yet: re-chunk with the current size
+                size = self.CHUNK_SIZE[kind]
+                job_ref.update({"chunk_size": size, "chunks": report["chunks"]})
+        else:
+            next_chunk = 0
+            size = self.CHUNK_SIZE[kind]
+            job_ref.set({
+                "company_id": self.company_id,
+                "kind": kind,
+                "filename": filename,
+                "file_hash": digest,
+                "rows": report["rows"],
+                "chunks": report["chunks"],
+                "chunk_size": size,
+                "next_chunk": 0,
+                "status": "RUNNING",
+                "effective_date": str(effective_date),
+                "created_by": self.user_email,
+                "created_at": firestore.SERVER_TIMESTAMP
+            })
+
+        effective = self._date(effective_date, datetime.now(timezone.utc))
+        post_chunk = {"gl": self._post_gl_chunk, "ar": self._post_open_items_chunk,
+                      "ap": self._post_open_items_chunk, "stock": self._post_stock_chunk}[kind]
+
+        chunk_index = 0
+        chunk: List[Tuple[int, Dict[str, Any]]] = []
+        try:
+            for row_number, row in self.iter_file(file, filename):
+                chunk.append((row_number, self._parse(kind, row, effective)))
+                if len(chunk) == size:
+                    if chunk_index >= next_chunk:
+                        post_chunk(kind, job_ref, chunk_index, chunk, effective, clearing_account_id)
+                    chunk_index += 1
+                    chunk = []
+            if chunk and chunk_index >= next_chunk:
+                post_chunk(kind, job_ref, chunk_index, chunk, effective, clearing_account_id)
+        except Exception as e:
+            job_ref.update({"status": "FAILED", "error": str(e), "failed_at": firestore.SERVER_TIMESTAMP})
+            raise
+
+        job_ref.update({"status": "COMPLETED", "completed_at": firestore.SERVER_TIMESTAMP})
+        if kind == "stock":
+            # Stock snapshots taken after the effective date no longer include these rows
+            get_valuation_service().invalidate_from(self.company_id, effective)
+        return {**report, "job_id": job_ref.id, "status": "COMPLETED", "resumed_from_chunk": next_chunk}
+
+    def _post_gl_chunk(self, kind, job_ref, chunk_index: int, chunk: list, effective: datetime, clearing_account_id: Optional[str]):
+        lines = [
+            {"account_id": r["account_id"], "debit": str(r["debit"]), "credit": str(r["credit"]), "memo": f"Opening balance {r['code']}"}
+            for _, r in chunk
+        ]
+        offset = sum((r["debit"] - r["credit"] for _, r in chunk), Decimal("0"))
+        if offset:
+            # Per-chunk clearing line; nets to zero over the whole (balanced) file
+            lines.append({
+                "account_id": clearing_account_id,
+                "debit": str(-offset) if offset < 0 else "0",
+                "credit": str(offset) if offset > 0 else "0",
+                "memo": "Opening balance clearing"
+            })
+
+        je_ref = self.db.collection("journal_entries").document(f"OB_{job_ref.id}_{chunk_index:05d}")
+        transaction = self.db.transaction()
+
+        @firestore.transactional
+        def _execute(transaction):
+            # PHASE 1: READ
+            accounts_data = self.posting_engine.get_accounts_for_transaction(transaction, [l["account_id"] for l in lines])
+
+            # PHASE 3: WRITE (JE + balances + checkpoint commit together)
+            transaction.set(je_ref, {
+                "number": f"JE-OB-{job_ref.id[:6]}-{chunk_index + 1:05d}",
+                "date": effective,
+                "description": f"Opening balances as of {effective.date().isoformat()} (part {chunk_index + 1})",
+                "status": "DRAFT",
+                "lines": self.posting_engine.journal_lines.inline(lines),
+                "company_id": self.company_id,
+                "source_doc_id": job_ref.id,
+                "source_doc_type": self.SOURCE_TYPE,
+                "created_by": self.user_email,
+                "created_at": firestore.SERVER_TIMESTAMP
+            })
+            self.posting_engine.post_journal_entry(
+                transaction, je_ref.id, lines, accounts_data,
+                entry_date=effective, company_id=self.company_id, source_type=self.SOURCE_TYPE
+            )
+            transaction.update(job_ref, {"next_chunk": chunk_index + 1})
+
+        _execute(transaction)
+
+    def _post_open_items_chunk(self, kind, job_ref, chunk_index: int, chunk: list, effective: datetime, clearing_account_id: Optional[str]):
+        batch = self.db.batch()
+        collection = self.db.collection("invoices" if kind == "ar" else "bills")
+        for row_number, r in chunk:
+            amount = float(r["amount"])
+            doc = {
+                "company_id": self.company_id,
+                "currency": r["currency"],
+                "due_date": r["due_date"],
+                "subtotal": amount,
+                "discount_total": 0.0,
+                "total": amount,
+                "paid_amount": 0.0,
+                "remaining_amount": amount,
+                "lines": [],
+                "notes": "Opening balance",
+                "opening_balance_import": job_ref.id,
+                "created_at": firestore.SERVER_TIMESTAMP,
+                "created_by": self.user_email
+            }
+            if kind == "ar":
+                doc.update({
+                    "customer_id": r["partner_id"],
+                    "customer_name": r["partner_name"],
+                    "invoice_number": r["number"] or f"OB-{job_ref.id[:6]}-{row_number}",
+                    "issue_date": r["date"],
+                    "status": "ISSUED"
+                })
+            else:
+                doc.update({
+                    "supplier_id": r["partner_id"],
+                    "supplier_name": r["partner_name"],
+                    "bill_number": r["number"] or f"OB-{job_ref.id[:6]}-{row_number}",
+                    "date": r["date"],
+                    "status": "POSTED"
+                })
+            # Deterministic ids keep a re-posted chunk idempotent
+            batch.set(collection.document(f"OB_{job_ref.id}_{row_number}"), doc)
+        batch.update(job_ref, {"next_chunk": chunk_index + 1})
+        batch.commit()
+
+    def _post_stock_chunk(self, kind, job_ref, chunk_index: int, chunk: list, effective: datetime, clearing_account_id: Optional[str]):
+        transaction = self.db.transaction()
+
+        @firestore.transactional
+        def _execute(transaction):
+            # PHASE 1: READ
+            items_data = self.posting_engine.get_items_for_transaction(transaction, [r["item_id"] for _, r in chunk])
+            balances = self.posting_engine.balances.get_for_transaction(
+                transaction, [(r["item_id"], r["warehouse_id"]) for _, r in chunk]
+            )
+
+            # PHASE 3: WRITE (movements + checkpoint commit together)
+            for _, r in chunk:
+                self.posting_engine.record_stock_movement(
+                    transaction, r["item_id"], r["warehouse_id"], r["quantity"], r["unit_cost"],
+                    doc_id=job_ref.id, doc_type=self.SOURCE_TYPE,
+                    item_data=items_data[r["item_id"]], movement_date=effective, balances=balances
+                )
+            transaction.update(job_ref, {"next_chunk": chunk_index + 1})
+
+        _execute(transaction)
+
+
+def get_opening_balance_loader(company_id: str, user_email: Optional[str] = None) -> OpeningBalanceLoader:
+    return OpeningBalanceLoader(company_id, user_email)
@@ -1,114 +1,455 @@
+"""
+PDF Rendering Service
+Renders invoices/statements off the event loop in a process pool.
+Styles and fonts are compiled once per worker process, and rendered output is
+cached by a content hash of the source document so re-downloads are free.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from io import BytesIO
+from threading import Lock
+from typing import Any, Dict, List, Optional, Tuple
+
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, PageBreak
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import inch
-from io import BytesIO
-from datetime import datetime
+from starlette.concurrency import run_in_threadpool
 
-class PDFService:
-    def generate_invoice(self, data: dict, type: str = "INVOICE") -> bytes:
-        buffer = BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=A4)
-        elements = []
-        styles = getSampleStyleSheet()
+from app.core.config import settings
+
+# Bump when the layout changes so cached PDFs are not served for the old template
+TEMPLATE_VERSION = "2"
+
+# ==============================================================================
+# WORKER-SIDE (runs inside pool processes)
+# ==============================================================================
+_STYLES: Optional[Dict[str, Any]] = None
+_TABLE_STYLE: Optional[TableStyle] = None
+_BASE_FONT = "Helvetica"
+_BOLD_FONT = "Helvetica-Bold"
+
+
+def _init_worker():
+    """Precompile styles and register fonts once per worker process."""
+    global _STYLES, _TABLE_STYLE, _BASE_FONT, _BOLD_FONT
 
-        # Define custom styles
-        title_style = ParagraphStyle(
+    if settings.PDF_FONT_PATH and os.path.exists(settings.PDF_FONT_PATH):
+        # Optional TTF (e.g. an Arabic-capable font) for customer/item names
+        from reportlab.pdfbase import pdfmetrics
+        from reportlab.pdfbase.ttfonts import TTFont
+        pdfmetrics.registerFont(TTFont("ERPFont", settings.PDF_FONT_PATH))
+        _BASE_FONT = _BOLD_FONT = "ERPFont"
+
+    styles = getSampleStyleSheet()
+    _STYLES = {
+        "title": ParagraphStyle(
             'Title',
             parent=styles['Heading1'],
+            fontName=_BOLD_FONT,
             fontSize=24,
             textColor=colors.HexColor("#2563eb"),
             spaceAfter=12
-        )
-        
-        header_style = ParagraphStyle(
+        ),
+        "header": ParagraphStyle(
             'Header',
             parent=styles['Normal'],
+            fontName=_BASE_FONT,
             fontSize=10,
             textColor=colors.gray
-        )
-
-        # --- Header Section ---
-        elements.append(Paragraph(f"OpenGate ERP - {type}", title_style))
-        elements.append(Paragraph(f"Date: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", header_style))
-        elements.append(Paragraph(f"Reference: {data.get('id', 'N/A')}", header_style))
-        
-        # Support both 'customer' and 'customer_name'
-        customer = data.get("customer") or data.get("customer_name")
-        if customer:
-            elements.append(Paragraph(f"Customer: {customer}", header_style))
-            
-        # Support both 'vendor' and 'supplier_name'
-        vendor = data.get("vendor") or data.get("supplier_name")
-        if vendor:
-             elements.append(Paragraph(f"Vendor: {vendor}", header_style))
-        
-        elements.append(Spacer(1, 0.5 * inch))
-
-        # --- Items Table ---
-        # Table Header
-        table_data = [['Item', 'Qty', 'Price', 'Total']]
-        
-        # Table Rows
-        total_amount = 0
-        # Support both 'items' and 'lines'
-        items = data.get('items') or data.get('lines', [])
-        
-        for item in items:
-            # Handle different field names for qty and price
+        ),
+        "normal": styles['Normal'],
+        "heading4": styles['Heading4'],
+        "italic": styles['Italic'],
+    }
+
+    _TABLE_STYLE = TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor("#f1f5f9")),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.HexColor("#1e293b")),
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('ALIGN', (0, 0), (0, -1), 'LEFT'), # Align items left
+        ('FONTNAME', (0, 0), (-1, 0), _BOLD_FONT),
+        ('FONTSIZE', (0, 0), (-1, 0), 12),
+        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+        ('BACKGROUND', (0, -1), (-1, -1), colors.HexColor("#f8fafc")), # Footer background
+        ('FONTNAME', (0, -1), (-1, -1), _BOLD_FONT),
+        ('GRID', (0, 0), (-1, -2), 1, colors.HexColor("#e2e8f0")),
+        ('LINEBELOW', (0, -1), (-1, -1), 2, colors.HexColor("#2563eb")),
+    ])
+
+
+def _styles() -> Dict[str, Any]:
+    if _STYLES is None:
+        _init_worker()
+    return _STYLES
+
+
+def _document_date(data: dict) -> str:
+    """Use the document's own date so identical documents render identically (cacheable)."""
+    for field in ("issue_date", "date", "created_at"):
+        value = data.get(field)
+        if value:
+            return str(value)[:19].replace("T", " ")
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _invoice_elements(data: dict, type: str) -> list:
+    styles = _styles()
+    elements = []
+
+    # --- Header Section ---
+    elements.append(Paragraph(f"OpenGate ERP - {type}", styles["title"]))
+    elements.append(Paragraph(f"Date: {_document_date(data)}", styles["header"]))
+    elements.append(Paragraph(f"Reference: {data.get('id', 'N/A')}", styles["header"]))
+
+    # Support both 'customer' and 'customer_name'
+    customer = data.get("customer") or data.get("customer_name")
+    if customer:
+        elements.append(Paragraph(f"Customer: {customer}", styles["header"]))
+
+    # Support both 'vendor' and 'supplier_name'
+    vendor = data.get("vendor") or data.get("supplier_name")
+    if vendor:
+        elements.append(Paragraph(f"Vendor: {vendor}", styles["header"]))
+
+    elements.append(Spacer(1, 0.5 * inch))
+
+    # --- Items Table ---
+    table_data = [['Item', 'Qty', 'Price', 'Total']]
+    total_amount = 0
+    # Support both 'items' and 'lines'
+    items = data.get('items') or data.get('lines', [])
+
+    for item in items:
+        # Handle different field names for qty and price
+        try:
+            raw_qty = item.get('quantity') or item.get('qty', 0)
+            raw_price = item.get('unit_price') or item.get('price', 0)
+            qty = float(raw_qty)
+            price = float(raw_price)
+            total = qty * price
+            total_amount += total
+
+            # Handle different field names for item name
+            name = item.get('item_name') or item.get('name', 'Unknown Item')
+
+            table_data.append([
+                name,
+                f"{qty:,.2f}",
+                f"${price:,.2f}",
+                f"${total:,.2f}"
+            ])
+        except (ValueError, TypeError):
+            continue
+
+    # Total Row
+    table_data.append(['', '', 'Grand Total:', f"${total_amount:,.2f}"])
+
+    table = Table(table_data, colWidths=[3 * inch, 1 * inch, 1.5 * inch, 1.5 * inch])
+    table.setStyle(_TABLE_STYLE)
+    elements.append(table)
+    elements.append(Spacer(1, 0.5 * inch))
+
+    # --- Footer / Signature Section ---
+    elements.append(Paragraph("Authorized Signature:", styles['heading4']))
+    elements.append(Spacer(1, 0.3 * inch))
+    elements.append(Paragraph("___________________________", styles['normal']))
+    elements.append(Paragraph(f"Generated by: {data.get('created_by_email', 'Admin')}", styles['normal']))
+    elements.append(Paragraph("OpenGate ERP System", styles['italic']))
+    return elements
+
+
+def _statement_elements(data: dict, type: str) -> list:
+    styles = _styles()
+    elements = [
+        Paragraph(f"OpenGate ERP - {type}", styles["title"]),
+        Paragraph(f"Customer: {data.get('customer_name', '')}", styles["header"]),
+        Paragraph(f"Account: {data.get('account_name', '')} ({data.get('currency', 'IQD')})", styles["header"]),
+        Paragraph(f"Opening Balance: {data.get('opening_balance', '0')}", styles["header"]),
+        Spacer(1, 0.3 * inch),
+    ]
+
+    table_data = [['Date', 'Number', 'Debit', 'Credit']]
+    for line in data.get("period_lines", []):
+        table_data.append([
+            str(line.get("date", ""))[:10],
+            line.get("number") or "",
+            f"{float(line.get('debit', 0)):,.2f}",
+            f"{float(line.get('credit', 0)):,.2f}",
+        ])
+    table_data.append(['', 'Closing Balance:', '', f"{float(data.get('closing_balance', 0)):,.2f}"])
+
+    table = Table(table_data, colWidths=[1.5 * inch, 2.5 * inch, 1.5 * inch, 1.5 * inch], repeatRows=1)
+    table.setStyle(_TABLE_STYLE)
+    elements.append(table)
+    return elements
+
+
+_TEMPLATES = {
+    "invoice": _invoice_elements,
+    "statement": _statement_elements,
+}
+
+
+def _render(kind: str, data: dict, type: str) -> bytes:
+    """Render one document to PDF bytes (top-level so it can run in a worker process)."""
+    buffer = BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4)
+    doc.build(_TEMPLATES[kind](data, type))
+    return buffer.getvalue()
+
+
+def _render_merged(documents: List[Tuple[str, dict, str]]) -> bytes:
+    """Render several documents into one PDF, one document per page group."""
+    buffer = BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4)
+    elements = []
+    for idx, (kind, data, type) in enumerate(documents):
+        if idx:
+            elements.append(PageBreak())
+        elements.extend(_TEMPLATES[kind](data, type))
+    doc.build(elements)
+    return buffer.getvalue()
+
+
+def _concat_pdfs(parts: List[bytes]) -> bytes:
+    from pypdf import PdfWriter, PdfReader
+
+    writer = PdfWriter()
+    for part in parts:
+        for page in PdfReader(BytesIO(part)).pages:
+            writer.add_page(page)
+    buffer = BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+def _zip_pdfs(entries: List[Tuple[str, bytes]]) -> bytes:
+    """One archive member per (name, PDF); repeated names get a " (2)", " (3)" ... suffix."""
+    buffer = BytesIO()
+    used = set()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, content in entries:
+            candidate, seq = name, 1
+            while candidate in used:
+                seq += 1
+                candidate = f"{name} ({seq})"
+            used.add(candidate)
+            archive.writestr(f"{candidate}.pdf", content)
+    return buffer.getvalue()
+
+
+# ==============================================================================
+# PROCESS POOL & CACHE (API side)
+# ==============================================================================
+_POOL: Optional[ProcessPoolExecutor] = None
+_POOL_LOCK = Lock()
+
+
+def get_pdf_pool() -> ProcessPoolExecutor:
+    """Lazily start the shared render pool (one per API process)."""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = ProcessPoolExecutor(max_workers=settings.PDF_WORKERS or None, initializer=_init_worker)
+        return _POOL
+
+
+def shutdown_pdf_pool():
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.shutdown(wait=False, cancel_futures=True)
+            _POOL = None
+
+
+class PDFCache:
+    """
+    Two-level cache of rendered PDFs keyed by content hash: in-memory LRU + local disk.
+    The disk tier is capped at max_disk_bytes and evicts least recently used files;
+    disk reads and writes run in the threadpool so they never block the event loop.
+    """
+
+    def __init__(self, max_items: int, directory: str, max_disk_bytes: int):
+        self.max_items = max_items
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        # key -> file size, least recently used first; built from the directory on first disk access
+        self._disk: Optional["OrderedDict[str, int]"] = None
+        self._disk_bytes = 0
+        self._lock = Lock()
+        self._disk_lock = Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.pdf")
+
+    async def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+        content = await run_in_threadpool(self._read, key)
+        if content is not None:
+            self._remember(key, content)
+        return content
+
+    async def put(self, key: str, content: bytes):
+        self._remember(key, content)
+        await run_in_threadpool(self._write, key, content)
+
+    def _remember(self, key: str, content: bytes):
+        with self._lock:
+            self._memory[key] = content
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_items:
+                self._memory.popitem(last=False)
+
+    # ==========================================================================
+    # DISK TIER (threadpool)
+    # ==========================================================================
+    def _index_disk(self):
+        """Called with _disk_lock held. Oldest files (by mtime) are evicted first."""
+        if self._disk is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.endswith(".pdf"):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, entry.name[:-len(".pdf")], stat.st_size))
+        self._disk = OrderedDict((key, size) for _, key, size in sorted(files))
+        self._disk_bytes = sum(self._disk.values())
+        self._evict()
+
+    def _read(self, key: str) -> Optional[bytes]:
+        with self._disk_lock:
+            self._index_disk()
+            if key not in self._disk:
+                return None
+            self._disk.move_to_end(key)
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            # Removed behind our back (tmp cleaner, another worker's eviction)
+            with self._disk_lock:
+                self._disk_bytes -= self._disk.pop(key, 0)
+            return None
+
+    def _write(self, key: str, content: bytes):
+        if len(content) > self.max_disk_bytes:
+            return
+        tmp_path = f"{self._path(key)}.tmp{os.getpid()}"
+        with self._disk_lock:
+            self._index_disk()
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, self._path(key))
+        with self._disk_lock:
+            self._disk_bytes += len(content) - self._disk.pop(key, 0)
+            self._disk[key] = len(content)
+            self._evict()
+
+    def _evict(self):
+        """Called with _disk_lock held."""
+        while self._disk and self._disk_bytes > self.max_disk_bytes:
+            key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
             try:
-                raw_qty = item.get('quantity') or item.get('qty', 0)
-                raw_price = item.get('unit_price') or item.get('price', 0)
-                qty = float(raw_qty)
-                price = float(raw_price)
-                total = qty * price
-                total_amount += total
-                
-                # Handle different field names for item name
-                name = item.get('item_name') or item.get('name', 'Unknown Item')
-                
-                table_data.append([
-                    name,
-                    f"{qty:,.2f}",
-                    f"${price:,.2f}",
-                    f"${total:,.2f}"
-                ])
-            except (ValueError, TypeError):
-                continue
-            
-        # Total Row
-        table_data.append(['', '', 'Grand Total:', f"${total_amount:,.2f}"])
-
-        # Create Table
-        table = Table(table_data, colWidths=[3 * inch, 1 * inch, 1.5 * inch, 1.5 * inch])
-        
-        # Style Table
-        table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor("#f1f5f9")),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.HexColor("#1e293b")),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('ALIGN', (0, 0), (0, -1), 'LEFT'), # Align items left
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 12),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('BACKGROUND', (0, -1), (-1, -1), colors.HexColor("#f8fafc")), # Footer background
-            ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
-            ('GRID', (0, 0), (-1, -2), 1, colors.HexColor("#e2e8f0")),
-            ('LINEBELOW', (0, -1), (-1, -1), 2, colors.HexColor("#2563eb")),
-        ]))
-
-        elements.append(table)
-        elements.append(Spacer(1, 0.5 * inch))
-
-        # --- Footer / Signature Section ---
-        elements.append(Paragraph("Authorized Signature:", styles['Heading4']))
-        elements.append(Spacer(1, 0.3 * inch))
-        elements.append(Paragraph("___________________________", styles['Normal']))
-        elements.append(Paragraph(f"Generated by: {data.get('created_by_email', 'Admin')}", styles['Normal']))
-        elements.append(Paragraph("OpenGate ERP System", styles['Italic']))
-
-        # Build PDF
-        doc.build(elements)
-        buffer.seek(0)
-        return buffer.getvalue()
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+
+_CACHE: Optional[PDFCache] = None
+
+
+def get_pdf_cache() -> PDFCache:
+    global _CACHE
+    if _CACHE is None:
+        directory = settings.PDF_CACHE_DIR or os.path.join(tempfile.gettempdir(), "opengate_pdf_cache")
+        _CACHE = PDFCache(settings.PDF_CACHE_MAX_ITEMS, directory, settings.PDF_CACHE_MAX_DISK_MB * 1024 * 1024)
+    return _CACHE
+
+
+def _canonical(data: dict) -> dict:
+    """JSON round-trip: picklable for workers and stable for hashing (timestamps -> str)."""
+    return json.loads(json.dumps(data, sort_keys=True, default=str))
+
+
+def content_hash(kind: str, data: dict, type: str) -> str:
+    payload = json.dumps([TEMPLATE_VERSION, kind, type, data], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class PDFService:
+    def generate_invoice(self, data: dict, type: str = "INVOICE") -> bytes:
+        """Synchronous render in the calling process (scripts/tests). API handlers use render()."""
+        return _render("invoice", _canonical(data), type)
+
+    async def render(self, data: dict, type: str = "INVOICE", kind: str = "invoice") -> bytes:
+        """Render in the process pool, serving identical documents from cache."""
+        data = _canonical(data)
+        key = content_hash(kind, data, type)
+        cache = get_pdf_cache()
+
+        cached = await cache.get(key)
+        if cached is not None:
+            return cached
+
+        loop = asyncio.get_running_loop()
+        content = await loop.run_in_executor(get_pdf_pool(), _render, kind, data, type)
+        await cache.put(key, content)
+        return content
+
+    async def render_batch(self, documents: List[Tuple[str, dict, str]], mode: str = "zip") -> bytes:
+        """
+        Render many documents in parallel.
+
+        Args:
+            documents: list of (kind, data, type) where kind is 'invoice' or 'statement'
+            mode: 'zip' (one PDF per document) or 'merged' (single PDF)
+        """
+        if mode not in ("zip", "merged"):
+            raise ValueError("mode must be 'zip' or 'merged'")
+        if not documents:
+            raise ValueError("No documents to render")
+
+        if mode == "merged":
+            docs = [(kind, _canonical(data), type) for kind, data, type in documents]
+            key = hashlib.sha256("".join(content_hash(*d) for d in docs).encode()).hexdigest()
+            cache = get_pdf_cache()
+            cached = await cache.get(key)
+            if cached is not None:
+                return cached
+            # Split into one slice per worker, render slices in parallel, then concatenate pages
+            workers = settings.PDF_WORKERS or os.cpu_count() or 1
+            size = max(1, -(-len(docs) // workers))
+            slices = [docs[i:i + size] for i in range(0, len(docs), size)]
+            loop = asyncio.get_running_loop()
+            parts = await asyncio.gather(*[
+                loop.run_in_executor(get_pdf_pool(), _render_merged, part) for part in slices
+            ])
+            # Merging is CPU-bound pure Python: keep it off the event loop too
+            content = parts[0] if len(parts) == 1 else await loop.run_in_executor(get_pdf_pool(), _concat_pdfs, parts)
+            await cache.put(key, content)
+            return content
+
+        rendered = await asyncio.gather(*[self.render(data, type, kind) for kind, data, type in documents])
+        entries = [
+            (str(data.get("number") or data.get("invoice_number") or data.get("id") or f"{kind}_{idx + 1}"), content)
+            for idx, ((kind, data, type), content) in enumerate(zip(documents, rendered))
+        ]
+        # Deflating hundreds of PDFs is CPU-bound: build the archive in the pool
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_pdf_pool(), _zip_pdfs, entries)
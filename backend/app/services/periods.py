@@ -0,0 +1,114 @@
+"""
+Closed-Period Registry
+In-memory set of closed fiscal periods per company, so PostingEngine can enforce
+period locks without reading fiscal_periods inside every posting transaction.
+
+Each company's set is loaded once and kept fresh by a Firestore snapshot
+listener. If a listener cannot be started, the set is reloaded after
+FALLBACK_TTL_SECONDS instead. FiscalService updates the local set as soon as a
+close/reopen is written, so the closing process never sees a stale state.
+"""
+from threading import Lock
+from time import monotonic
+from typing import Dict, Set, Optional
+from app.core.firebase import get_db
+from .rollups import as_day
+
+
+def period_key(year: int, month: int) -> str:
+    return f"{year}-{month:02d}"
+
+
+class ClosedPeriodRegistry:
+    COLLECTION = "fiscal_periods"
+    FALLBACK_TTL_SECONDS = 60
+
+    def __init__(self):
+        self._closed: Dict[str, Set[str]] = {}
+        self._loaded_at: Dict[str, float] = {}
+        self._watches: Dict[str, object] = {}
+        self._lock = Lock()
+        # Serializes listener registration so concurrent loads start one watch per company
+        self._watch_lock = Lock()
+
+    def _query(self, company_id: str):
+        return get_db().collection(self.COLLECTION).where("company_id", "==", company_id)
+
+    @staticmethod
+    def _closed_keys(snapshots) -> Set[str]:
+        keys = set()
+        for snap in snapshots:
+            data = snap.to_dict() or {}
+            if data.get("status") == "CLOSED":
+                keys.add(period_key(int(data["year"]), int(data["month"])))
+        return keys
+
+    def _load(self, company_id: str):
+        keys = self._closed_keys(self._query(company_id).stream())
+        with self._lock:
+            self._closed[company_id] = keys
+            self._loaded_at[company_id] = monotonic()
+
+        with self._watch_lock:
+            with self._lock:
+                if company_id in self._watches:
+                    return
+            try:
+                def _on_snapshot(snapshots, changes, read_time):
+                    fresh = self._closed_keys(snapshots)
+                    with self._lock:
+                        self._closed[company_id] = fresh
+                        self._loaded_at[company_id] = monotonic()
+
+                watch = self._query(company_id).on_snapshot(_on_snapshot)
+            except Exception as e:
+                print(f"[Periods] Snapshot listener unavailable for {company_id}, using TTL reload: {e}")
+                watch = None
+            with self._lock:
+                self._watches[company_id] = watch
+
+    def closed_periods(self, company_id: str) -> Set[str]:
+        """Closed 'YYYY-MM' keys of a company (no Firestore read when warm)."""
+        with self._lock:
+            cached = self._closed.get(company_id)
+            watched = self._watches.get(company_id) is not None
+            fresh = watched or monotonic() - self._loaded_at.get(company_id, 0) < self.FALLBACK_TTL_SECONDS
+        if cached is None or not fresh:
+            self._load(company_id)
+            with self._lock:
+                cached = self._closed[company_id]
+        return cached
+
+    def is_closed(self, company_id: Optional[str], value=None) -> bool:
+        if not company_id:
+            return False
+        day = as_day(value)
+        return period_key(day.year, day.month) in self.closed_periods(company_id)
+
+    def assert_open(self, company_id: Optional[str], value=None):
+        """Raise ValueError if the date falls in a closed period of the company."""
+        if self.is_closed(company_id, value):
+            day = as_day(value)
+            raise ValueError(f"Fiscal period {period_key(day.year, day.month)} is closed")
+
+    def mark(self, company_id: str, year: int, month: int, closed: bool):
+        """Apply a close/reopen to the local set immediately (listener catches up for other processes)."""
+        with self._lock:
+            keys = self._closed.get(company_id)
+            if keys is None:
+                return
+            if closed:
+                keys.add(period_key(year, month))
+            else:
+                keys.discard(period_key(year, month))
+
+
+_REGISTRY: Optional[ClosedPeriodRegistry] = None
+
+
+def get_period_registry() -> ClosedPeriodRegistry:
+    """Process-wide registry (shared by every PostingEngine)."""
+    global _REGISTRY
+    if _REGISTRY is None:
+        _REGISTRY = ClosedPeriodRegistry()
+    return _REGISTRY
@@ -3,10 +3,53 @@ from typing import Optional, Dict, Any
 from google.cloud import firestore
 from app.core.firebase import get_db
 from app.models.core import JournalEntry, DocumentStatus
+from .rollups import RollupService, as_datetime
+from .periods import get_period_registry
+from .cost_layers import CostLayerService
+from .stock_rollups import StockRollupService
+from .stock_balances import StockBalanceService
+from .journal_lines import JournalLineStore
+from .ledger_cube import LedgerCubeService, DIMENSIONS
 
 class PostingEngine:
+    # Firestore's per-commit write limit
+    WRITE_LIMIT = 500
+    # Writes one record_stock_movement stages (IN movement): item, ledger row, cost layer,
+    # KPI rollup, item daily + monthly rollups (field transforms count as extra writes),
+    # stock balance and its alert
+    STOCK_MOVEMENT_WRITES = 10
+    # Writes post_journal_entry stages once per entry: the entry update and the daily KPI rollup
+    JOURNAL_ENTRY_WRITES = 2
+    # Writes post_journal_entry stages per line at most (every line on its own account and
+    # dimensions): the account update and the line's ledger_cube cell
+    JOURNAL_LINE_WRITES = 2
+
     def __init__(self):
         self.db = get_db()
+        self.rollups = RollupService()
+        self.periods = get_period_registry()
+        self.layers = CostLayerService()
+        self.stock_rollups = StockRollupService()
+        self.balances = StockBalanceService()
+        self.journal_lines = JournalLineStore()
+        self.cube = LedgerCubeService()
+
+    @classmethod
+    def journal_writes(cls, line_count: int) -> int:
+        """Upper bound of the writes post_journal_entry stages for an entry of line_count lines
+        (the caller's own set of the entry document is not included)."""
+        line_chunks = 0
+        if line_count > JournalLineStore.INLINE_LINES:
+            line_chunks = -(-line_count // JournalLineStore.CHUNK_LINES)
+        return cls.JOURNAL_ENTRY_WRITES + line_count * cls.JOURNAL_LINE_WRITES + line_chunks
+
+    @classmethod
+    def max_journal_lines(cls, other_writes: int = 0) -> int:
+        """Most lines one entry can have when its transaction also stages other_writes writes."""
+        lines = (cls.WRITE_LIMIT - other_writes - cls.JOURNAL_ENTRY_WRITES) // cls.JOURNAL_LINE_WRITES
+        while lines > 0 and cls.journal_writes(lines) + other_writes > cls.WRITE_LIMIT:
+            lines -= 1
+        return max(lines, 0)
 
     def get_accounts_for_transaction(self, transaction, account_ids: list[str]) -> Dict[str, Dict[str, Any]]:
         """Pre-fetches accounts for a transaction to avoid Read-after-Write violations."""
@@ -17,31 +60,58 @@ class PostingEngine:
         snapshots = self.db.get_all(refs, transaction=transaction)
         return {snap.id: snap.to_dict() or {} for snap in snapshots}
 
-    def post_journal_entry(self, transaction, entry_id: str, lines_data: list = None, accounts_data: Dict[str, Any] = None):
-        """Finalizes a journal entry using Firestore Transaction."""
+    def post_journal_entry(
+        self,
+        transaction,
+        entry_id: str,
+        lines_data: list = None,
+        accounts_data: Dict[str, Any] = None,
+        entry_date=None,
+        company_id: Optional[str] = None,
+        source_type: Optional[str] = None,
+        allow_closed_period: bool = False,
+        dimensions: Optional[Dict[str, Any]] = None
+    ):
+        """Finalizes a journal entry using Firestore Transaction.
+        entry_date/source_type feed the daily rollups (entry_date defaults to today).
+        Raises ValueError if entry_date falls in a closed fiscal period, unless
+        allow_closed_period is set (year-end closing/reversal entries).
+        Entries above JournalLineStore.INLINE_LINES get their lines written to
+        line_chunks here; the caller stores JournalLineStore.inline(lines) on the entry.
+        dimensions (cost center, warehouse, customer, supplier, project) apply to
+        the lines that do not set their own; they feed the ledger cube.
+        """
         entry_ref = self.db.collection("journal_entries").document(entry_id)
+
+        if not company_id and accounts_data:
+            company_id = next((a.get("company_id") for a in accounts_data.values() if a.get("company_id")), None)
+        if not allow_closed_period:
+            self.periods.assert_open(company_id, entry_date)
         
         # Validate balance
+        totals = self.journal_lines.totals(lines_data) if lines_data else {}
         if lines_data:
-            total_debit = Decimal("0")
-            total_credit = Decimal("0")
-            for line in lines_data:
-                total_debit += Decimal(str(line.get("debit", "0")))
-                total_credit += Decimal(str(line.get("credit", "0")))
+            total_debit = sum((t["debit"] for t in totals.values()), Decimal("0"))
+            total_credit = sum((t["credit"] for t in totals.values()), Decimal("0"))
             if abs(total_debit - total_credit) > Decimal("0.0001"):
                 raise ValueError(f"Journal does not balance: D:{total_debit} C:{total_credit}")
 
-        # Update status
-        transaction.update(entry_ref, {"status": "POSTED"})
+        # Update status (+ header: flat account index used by ledger queries/exports, totals, line chunks)
+        entry_update = {"status": "POSTED"}
+        if lines_data:
+            entry_update.update(self.journal_lines.write(transaction, entry_id, lines_data, totals))
+        dimensions = {d: v for d, v in (dimensions or {}).items() if d in DIMENSIONS and v}
+        if dimensions:
+            entry_update["dimensions"] = dimensions
+        transaction.update(entry_ref, entry_update)
 
-        # Update Account Balances (Read-Modify-Write for String Fields)
+        # Update Account Balances (Read-Modify-Write for String Fields), one write per account
         if lines_data and accounts_data:
-            for line in lines_data:
-                acc_id = line.get("account_id")
+            for acc_id, account_total in totals.items():
                 if not acc_id or acc_id not in accounts_data: continue
                 
-                debit = Decimal(str(line.get("debit", "0")))
-                credit = Decimal(str(line.get("credit", "0")))
+                debit = account_total["debit"]
+                credit = account_total["credit"]
                 
                 # Get current values from pre-fetched data
                 current_acc = accounts_data[acc_id]
@@ -64,10 +134,15 @@ class PostingEngine:
                     "balance": str(new_balance)
                 })
                 
-                # Update local cache in case multiple lines touch same account
+                # Update local cache in case a later posting in this transaction touches the same account
                 accounts_data[acc_id]["total_debit"] = str(new_debit)
                 accounts_data[acc_id]["total_credit"] = str(new_credit)
                 accounts_data[acc_id]["balance"] = str(new_balance)
+
+            # Daily KPI rollups (write-only increments, no extra reads)
+            self.rollups.apply_journal(transaction, company_id, entry_date, lines_data, accounts_data, source_type)
+            # Monthly account x dimension cube (write-only increments)
+            self.cube.apply_journal(transaction, company_id, entry_date, lines_data, accounts_data, source_type, dimensions)
         
         return True
 
@@ -98,11 +173,22 @@ class PostingEngine:
         doc_type: Optional[str] = None,
         item_data: Optional[Dict[str, Any]] = None,
         batch_number: Optional[str] = None,
-        customer_id: Optional[str] = None
+        customer_id: Optional[str] = None,
+        movement_date=None,
+        allow_closed_period: bool = False,
+        expiry_date=None,
+        consumed_layers: Optional[list] = None,
+        balances: Optional[Dict[str, Dict[str, Any]]] = None
     ):
         """Records stock movement in Firestore transaction and updates WAC.
         IMPORTANT: This must be called from within a @firestore.transactional function.
         To avoid Read-after-Write errors, pass item_data (pre-fetched via get_items_for_transaction).
+        Raises ValueError if movement_date (default today) falls in a closed fiscal period.
+        movement_date is stored as the row's posting_date; a back-dated movement is costed
+        at the current WAC and must be followed by StockRecostService.recost_items.
+        FIFO/FEFO items: an IN opens a cost layer; an OUT is costed from consumed_layers
+        (planned in the read phase with CostLayerService.plan_consumption), or at WAC if
+        no plan is given.
         """
         item_ref = self.db.collection("items").document(item_id)
         
@@ -111,6 +197,12 @@ class PostingEngine:
         if item_data is None:
             snapshot = item_ref.get(transaction=transaction)
             item_data = snapshot.to_dict() or {}
+        # Same rule for the per-warehouse balance (pre-fetch with balances.get_for_transaction)
+        if balances is None:
+            balances = self.balances.get_for_transaction(transaction, [(item_id, warehouse_id)])
+
+        if not allow_closed_period:
+            self.periods.assert_open(item_data.get("company_id"), movement_date)
         
         current_qty = Decimal(item_data.get("current_qty", "0"))
         current_value = Decimal(item_data.get("total_value", "0"))
@@ -120,37 +212,64 @@ class PostingEngine:
         if quantity > 0: # IN
             new_value = current_value + (quantity * unit_cost)
             new_valuation_rate = new_value / new_qty if new_qty != 0 else unit_cost
+        elif consumed_layers: # OUT from FIFO/FEFO layers
+            issued_cost = self.layers.plan_cost(consumed_layers)
+            new_valuation_rate = issued_cost / -quantity
+            new_value = current_value - issued_cost
         else: # OUT
             new_valuation_rate = Decimal(item_data.get("current_wac", str(unit_cost)))
             new_value = current_value + (quantity * new_valuation_rate) # quantity is negative
+        new_wac = new_value / new_qty if consumed_layers and new_qty else new_valuation_rate
 
         # Update Item metadata in the transaction
         transaction.update(item_ref, {
             "current_qty": str(new_qty),
             "total_value": str(new_value),
-            "current_wac": str(new_valuation_rate)
+            "current_wac": str(new_wac)
         })
 
         # Add Ledger Entry
         movement_ref = self.db.collection("stock_ledger").document()
         transaction.set(movement_ref, {
             "timestamp": firestore.SERVER_TIMESTAMP,
+            "posting_date": as_datetime(movement_date),
             "item_id": item_id,
             "warehouse_id": warehouse_id,
             "quantity": str(quantity),
             "unit_cost": str(unit_cost),
             "valuation_rate": str(new_valuation_rate),
+            "running_qty": str(new_qty),
+            "running_value": str(new_value),
             "source_document_id": doc_id,
             "source_document_type": doc_type,
             "batch_number": batch_number,
+            "expiry_date": expiry_date,
             "customer_id": customer_id,
-            "company_id": item_data.get("company_id")
+            "company_id": item_data.get("company_id"),
+            "cost_layers": [
+                {"layer_id": l["layer_id"], "quantity": str(l["quantity"]), "unit_cost": str(l["unit_cost"])}
+                for l in consumed_layers or []
+            ]
         })
+
+        if consumed_layers:
+            self.layers.apply_consumption(transaction, consumed_layers)
+        elif quantity > 0 and self.layers.uses_layers(item_data):
+            self.layers.add_layer(
+                transaction, item_data, item_id, warehouse_id, quantity, unit_cost,
+                received_at=movement_date, batch_number=batch_number, expiry_date=expiry_date,
+                source_document_id=doc_id
+            )
         
         # Update the provided item_data dictionary so subsequent calls in the same transaction
         # see the updated values without re-reading from Firestore.
         item_data["current_qty"] = str(new_qty)
         item_data["total_value"] = str(new_value)
-        item_data["current_wac"] = str(new_valuation_rate)
+        item_data["current_wac"] = str(new_wac)
+
+        unit_value = unit_cost if quantity > 0 else new_valuation_rate
+        self.rollups.apply_stock(transaction, item_data.get("company_id"), movement_date, quantity, unit_value, doc_type)
+        self.stock_rollups.apply(transaction, item_data.get("company_id"), item_id, warehouse_id, movement_date, quantity, unit_value, doc_type)
+        self.balances.apply(transaction, balances, item_data.get("company_id"), item_id, warehouse_id, quantity, item_data)
         
         return new_valuation_rate
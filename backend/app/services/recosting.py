@@ -0,0 +1,397 @@
+"""
+Stock Re-costing Service
+Repairs moving-average (WAC) costs after a back-dated stock movement.
+
+A back-dated GRN/DO is first posted like any other movement (at the current
+WAC), with its posting_date set to the document date. recost_items then walks
+only the suffix of each item's ledger (rows with posting_date >= the back-dated
+point) in posting order, starting from the running qty/value just before it:
+
+    IN rows                 keep their cost (transfer INs follow the running WAC)
+    OUT rows                are re-issued at the running WAC at their position
+    reversal rows (*_VOID)  keep their original cost (they undo a posted movement)
+    every row               gets fresh running_qty / running_value
+
+The difference of re-issued sales (DO, PURCHASE_RETURN) is booked against COGS
+and that of cycle-count shortages against the inventory variance account, as
+one summarized journal entry (offset vs Inventory per account pair); the item
+totals move by the value difference, all in a single transaction.
+
+The run document (recost_runs/{run_id}) is written PENDING before any work and
+stores the opening state before any row is rewritten; rewritten rows keep their
+previous cost, so a failed or interrupted run can be finished with
+resume(run_id) without double-booking.
+
+Rows written before posting_date existed are treated as history that precedes
+every dated row. FIFO/FEFO items are skipped (their issues are costed from
+cost layers).
+"""
+import uuid
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import Any, Dict, List, Optional, Tuple
+from google.cloud import firestore
+from app.core.firebase import get_db, stream_paged
+from app.models.core import DocumentStatus
+from .posting import PostingEngine
+from .cost_layers import CostLayerService
+from .cycle_counts import DOC_TYPE as CYCLE_COUNT_TYPE, VARIANCE_ACCOUNT_CODE
+from .rollups import as_datetime, as_day
+
+ZERO = Decimal("0")
+
+
+class StockRecostService:
+    RUNS_COLLECTION = "recost_runs"
+    SOURCE_TYPE = "COGS_ADJUSTMENT"
+    BATCH_SIZE = 400
+    # OUT movements whose journal booked the issue cost (difference goes to COGS)
+    GL_COST_TYPES = {"DO", "PURCHASE_RETURN"}
+    # OUT movements whose journal booked the issue cost against the variance account
+    VARIANCE_TYPES = {CYCLE_COUNT_TYPE}
+    # Voids reverse a movement at the cost it was posted with
+    REVERSAL_SUFFIX = "_VOID"
+    # Internal movements: IN side follows the running WAC, no stock-out value
+    TRANSFER_TYPES = {"TRF", "TRANSFER_IN", "TRANSFER_OUT"}
+
+    def __init__(self):
+        self.db = get_db()
+        self.posting_engine = PostingEngine()
+
+    # ==========================================================================
+    # LEDGER QUERIES
+    # ==========================================================================
+    def _suffix_query(self, item_id: str, from_date: datetime):
+        return (self.db.collection("stock_ledger")
+                .where("item_id", "==", item_id)
+                .where("posting_date", ">=", from_date)
+                .order_by("posting_date")
+                .order_by("timestamp"))
+
+    @staticmethod
+    def _stored_value(row: Dict[str, Any]) -> Decimal:
+        """Value a row contributed when it was posted (IN at cost, OUT at its issue rate)."""
+        qty = Decimal(str(row.get("quantity", "0") or "0"))
+        rate = row.get("unit_cost") if qty > 0 else row.get("valuation_rate")
+        return qty * Decimal(str(rate or "0"))
+
+    def _opening_state(self, item_id: str, item_data: Dict[str, Any], from_date: datetime) -> Tuple[Decimal, Decimal]:
+        """Running qty/value just before from_date."""
+        previous = list(
+            self.db.collection("stock_ledger")
+            .where("item_id", "==", item_id)
+            .where("posting_date", "<", from_date)
+            .order_by("posting_date", direction=firestore.Query.DESCENDING)
+            .order_by("timestamp", direction=firestore.Query.DESCENDING)
+            .limit(1).stream()
+        )
+        if previous:
+            row = previous[0].to_dict()
+            if row.get("running_qty") is not None and row.get("running_value") is not None:
+                return Decimal(str(row["running_qty"])), Decimal(str(row["running_value"]))
+
+        # No running totals yet: current totals minus everything in the suffix
+        qty = Decimal(str(item_data.get("current_qty", "0") or "0"))
+        value = Decimal(str(item_data.get("total_value", "0") or "0"))
+        for snap in stream_paged(self._suffix_query(item_id, from_date), page_size=1000):
+            row = snap.to_dict()
+            qty -= Decimal(str(row.get("quantity", "0") or "0"))
+            value -= self._stored_value(row)
+        return qty, value
+
+    # ==========================================================================
+    # SUFFIX PASS
+    # ==========================================================================
+    def _replay_item(self, run_id: str, item_id: str, state: Dict[str, Any]) -> Dict[str, Any]:
+        """Re-cost one item's suffix in posting order and rewrite the rows that changed."""
+        qty = Decimal(state["opening_qty"])
+        value = Decimal(state["opening_value"])
+        wac: Optional[Decimal] = value / qty if qty else None
+
+        value_delta = ZERO
+        cogs_delta = ZERO
+        variance_delta = ZERO
+        out_value_by_day: Dict[str, Decimal] = {}
+        # (day, warehouse, doc type) -> in/out value change for the item movement rollups
+        movement_value_changes: Dict[Tuple[str, str, str], Dict[str, Decimal]] = {}
+        rows = changed = 0
+        batch = self.db.batch()
+        pending = 0
+
+        for snap in stream_paged(self._suffix_query(item_id, state["from_date"]), page_size=500):
+            row = snap.to_dict()
+            rows += 1
+            # A row already rewritten by this run is diffed against its pre-run cost
+            prev = row.get("recost_prev") if row.get("recost_run_id") == run_id else None
+            original = prev or row
+            old_cost = Decimal(str(original.get("unit_cost") or "0"))
+            old_rate = Decimal(str(original.get("valuation_rate") or "0"))
+            q = Decimal(str(row.get("quantity", "0") or "0"))
+            doc_type = row.get("source_document_type")
+            is_reversal = (doc_type or "").endswith(self.REVERSAL_SUFFIX)
+
+            if q > 0:
+                cost = wac if doc_type in self.TRANSFER_TYPES and wac is not None else old_cost
+                old_value, new_value = q * old_cost, q * cost
+                qty += q
+                value += new_value
+                wac = value / qty if qty else cost
+                update = {"unit_cost": str(cost), "valuation_rate": str(wac)}
+            else:
+                rate = old_rate if is_reversal or wac is None else wac
+                old_value, new_value = q * old_rate, q * rate
+                qty += q
+                value += new_value
+                if is_reversal:
+                    wac = value / qty if qty else wac
+                else:
+                    wac = rate
+                update = {"valuation_rate": str(rate)}
+                # More negative value = more cost issued
+                issued_diff = old_value - new_value
+                if doc_type in self.GL_COST_TYPES:
+                    cogs_delta += issued_diff
+                elif doc_type in self.VARIANCE_TYPES:
+                    variance_delta += issued_diff
+                if doc_type not in self.TRANSFER_TYPES and issued_diff:
+                    day = as_day(row.get("posting_date")).isoformat()
+                    out_value_by_day[day] = out_value_by_day.get(day, ZERO) + issued_diff
+
+            value_delta += new_value - old_value
+            if new_value != old_value:
+                change_key = (as_day(row.get("posting_date")).isoformat(), row.get("warehouse_id") or "", doc_type or "")
+                changes = movement_value_changes.setdefault(change_key, {"in": ZERO, "out": ZERO})
+                if q > 0:
+                    changes["in"] += new_value - old_value
+                else:
+                    changes["out"] += old_value - new_value
+            update["running_qty"] = str(qty)
+            update["running_value"] = str(value)
+
+            is_changed = new_value != old_value or prev is not None
+            if is_changed:
+                changed += 1
+                update["recost_run_id"] = run_id
+                update["recost_prev"] = {"unit_cost": str(old_cost), "valuation_rate": str(old_rate)}
+            elif all(str(row.get(k)) == v for k, v in update.items()):
+                continue
+
+            batch.update(snap.reference, update)
+            pending += 1
+            if pending >= self.BATCH_SIZE:
+                batch.commit()
+                batch = self.db.batch()
+                pending = 0
+        if pending:
+            batch.commit()
+
+        return {
+            "rows": rows,
+            "changed_rows": changed,
+            "value_delta": value_delta,
+            "cogs_delta": cogs_delta,
+            "variance_delta": variance_delta,
+            "out_value_by_day": out_value_by_day,
+            "movement_value_changes": movement_value_changes,
+        }
+
+    # ==========================================================================
+    # FINALIZE (one transaction: item totals + summarized COGS journal)
+    # ==========================================================================
+    def _finalize(self, run_id: str, company_id: str, results: Dict[str, Dict[str, Any]], reference: str) -> Optional[str]:
+        run_ref = self.db.collection(self.RUNS_COLLECTION).document(run_id)
+        je_id = f"RCST_{run_id}"
+        variance_account = None
+        if any(res["variance_delta"] for res in results.values()):
+            docs = list(self.db.collection("accounts")
+                        .where("company_id", "==", company_id)
+                        .where("code", "==", VARIANCE_ACCOUNT_CODE)
+                        .limit(1).stream())
+            variance_account = docs[0].id if docs else None
+        transaction = self.db.transaction()
+
+        @firestore.transactional
+        def _execute(transaction):
+            # ==================================================================
+            # PHASE 1: READ
+            # ==================================================================
+            run_snap = run_ref.get(transaction=transaction)
+            if (run_snap.to_dict() or {}).get("status") == "COMPLETED":
+                return run_snap.to_dict().get("journal_entry_id")
+            items_data = self.posting_engine.get_items_for_transaction(transaction, list(results))
+
+            # ==================================================================
+            # PHASE 2: CALCULATE
+            # ==================================================================
+            # (offset account, inventory account, label) -> amount issued in excess
+            pairs: Dict[Tuple[str, str, str], Decimal] = {}
+            for item_id, res in results.items():
+                item = items_data[item_id]
+                inv_acc = item.get("inventory_account_id")
+                if not inv_acc:
+                    continue
+                # Cycle counts book against the variance account (items' COGS account otherwise)
+                for amount, offset, label in ((res["cogs_delta"], item.get("cogs_account_id"), "COGS"),
+                                              (res["variance_delta"], variance_account or item.get("cogs_account_id"), "Variance")):
+                    if amount and offset:
+                        key = (offset, inv_acc, label)
+                        pairs[key] = pairs.get(key, ZERO) + amount
+
+            lines = []
+            for (offset_acc, inv_acc, label), amount in pairs.items():
+                if not amount:
+                    continue
+                debit_acc, credit_acc = (offset_acc, inv_acc) if amount > 0 else (inv_acc, offset_acc)
+                lines.append({"account_id": debit_acc, "debit": str(abs(amount)), "credit": "0.0000",
+                              "description": f"{label} re-costing: {reference}"})
+                lines.append({"account_id": credit_acc, "debit": "0.0000", "credit": str(abs(amount)),
+                              "description": f"{label} re-costing: {reference}"})
+            accounts_data = self.posting_engine.get_accounts_for_transaction(
+                transaction, [l["account_id"] for l in lines]
+            )
+
+            # ==================================================================
+            # PHASE 3: WRITE
+            # ==================================================================
+            for item_id, res in results.items():
+                for day, diff in res["out_value_by_day"].items():
+                    self.posting_engine.rollups.apply_stock_revaluation(transaction, company_id, day, diff)
+                for (day, wh, doc_type), change in res["movement_value_changes"].items():
+                    self.posting_engine.stock_rollups.apply_revaluation(
+                        transaction, company_id, item_id, wh, day, doc_type or None,
+                        in_value_delta=change["in"], out_value_delta=change["out"]
+                    )
+                if not res["value_delta"]:
+                    continue
+                item = items_data[item_id]
+                item_qty = Decimal(str(item.get("current_qty", "0") or "0"))
+                new_value = Decimal(str(item.get("total_value", "0") or "0")) + res["value_delta"]
+                update = {"total_value": str(new_value)}
+                if item_qty:
+                    update["current_wac"] = str(new_value / item_qty)
+                transaction.update(self.db.collection("items").document(item_id), update)
+
+            posted_id = None
+            if lines:
+                transaction.set(self.db.collection("journal_entries").document(je_id), {
+                    "number": f"JE-RCST-{run_id}",
+                    "date": datetime.now(timezone.utc),
+                    "description": f"Inventory re-costing after back-dated movement ({reference})",
+                    "status": DocumentStatus.DRAFT,
+                    "source_document_type": self.SOURCE_TYPE,
+                    "source_document_id": run_id,
+                    "company_id": company_id,
+                    "lines": self.posting_engine.journal_lines.inline(lines)
+                })
+                self.posting_engine.post_journal_entry(
+                    transaction, je_id, lines, accounts_data,
+                    company_id=company_id, source_type=self.SOURCE_TYPE
+                )
+                posted_id = je_id
+
+            transaction.update(run_ref, {
+                "status": "COMPLETED",
+                "journal_entry_id": posted_id,
+                "value_delta": {k: str(v["value_delta"]) for k, v in results.items()},
+                "cogs_delta": str(sum((v["cogs_delta"] for v in results.values()), ZERO)),
+                "variance_delta": str(sum((v["variance_delta"] for v in results.values()), ZERO)),
+                "completed_at": firestore.SERVER_TIMESTAMP
+            })
+            return posted_id
+
+        return _execute(transaction)
+
+    # ==========================================================================
+    # PUBLIC
+    # ==========================================================================
+    def has_later_rows(self, item_id: str, after) -> bool:
+        """Whether the item has ledger rows dated after `after` (only those need re-costing)."""
+        query = (self.db.collection("stock_ledger")
+                 .where("item_id", "==", item_id)
+                 .where("posting_date", ">", as_datetime(after))
+                 .order_by("posting_date")
+                 .order_by("timestamp")
+                 .limit(1))
+        return bool(list(query.stream()))
+
+    def queue(self, company_id: str, item_ids: List[str], from_date, reference: str = "") -> str:
+        """Record a PENDING run; its opening state is computed when it runs (see resume)."""
+        run_id = uuid.uuid4().hex[:12]
+        self.db.collection(self.RUNS_COLLECTION).document(run_id).set({
+            "company_id": company_id,
+            "reference": reference,
+            "item_ids": sorted(set(item_ids)),
+            "from_date": as_datetime(from_date),
+            "status": "PENDING",
+            "created_at": firestore.SERVER_TIMESTAMP
+        })
+        return run_id
+
+    def recost_items(self, company_id: str, item_ids: List[str], from_date, reference: str = "") -> Dict[str, Any]:
+        """Re-cost the ledger of each item from `from_date` forward and book the COGS difference."""
+        run_id = self.queue(company_id, item_ids, from_date, reference)
+        return self._start(run_id, company_id, sorted(set(item_ids)), as_datetime(from_date), reference)
+
+    def _start(self, run_id: str, company_id: str, item_ids: List[str], from_dt: datetime, reference: str) -> Dict[str, Any]:
+        snaps = {snap.id: snap.to_dict() or {} for snap in
+                 self.db.get_all([self.db.collection("items").document(i) for i in item_ids]) if snap.exists}
+        states = {}
+        for item_id in item_ids:
+            if item_id not in snaps:
+                raise ValueError(f"Item {item_id} not found")
+            if CostLayerService.uses_layers(snaps[item_id]):
+                # FIFO/FEFO issues are costed from their layers, not the running WAC
+                continue
+            qty, value = self._opening_state(item_id, snaps[item_id], from_dt)
+            states[item_id] = {"from_date": from_dt, "opening_qty": str(qty), "opening_value": str(value)}
+
+        # Opening state is saved before any row is rewritten (see resume)
+        self.db.collection(self.RUNS_COLLECTION).document(run_id).update({"items": states})
+        return self._run(run_id, company_id, states, reference)
+
+    def resume(self, run_id: str) -> Dict[str, Any]:
+        """Finish a run that was queued or interrupted (after its opening state was saved, rows are not re-read)."""
+        snap = self.db.collection(self.RUNS_COLLECTION).document(run_id).get()
+        if not snap.exists:
+            raise ValueError(f"Re-costing run {run_id} not found")
+        data = snap.to_dict()
+        if data.get("status") == "COMPLETED":
+            return {"run_id": run_id, "status": "COMPLETED", "journal_entry_id": data.get("journal_entry_id")}
+        if data.get("items") is None:
+            return self._start(run_id, data["company_id"], data.get("item_ids", []), as_datetime(data["from_date"]),
+                               data.get("reference", ""))
+        return self._run(run_id, data["company_id"], data["items"], data.get("reference", ""))
+
+    def list_pending(self, company_id: str) -> List[Dict[str, Any]]:
+        """Runs that have not completed (failed after a back-dated posting, or interrupted)."""
+        query = self.db.collection(self.RUNS_COLLECTION)\
+            .where("company_id", "==", company_id)\
+            .where("status", "==", "PENDING")
+        return [
+            {"run_id": s.id, "reference": s.to_dict().get("reference"), "item_ids": s.to_dict().get("item_ids", []),
+             "from_date": s.to_dict().get("from_date"), "error": s.to_dict().get("error")}
+            for s in query.stream()
+        ]
+
+    def _run(self, run_id: str, company_id: str, states: Dict[str, Dict[str, Any]], reference: str) -> Dict[str, Any]:
+        results = {item_id: self._replay_item(run_id, item_id, state) for item_id, state in states.items()}
+        je_id = self._finalize(run_id, company_id, results, reference)
+        return {
+            "run_id": run_id,
+            "status": "COMPLETED",
+            "journal_entry_id": je_id,
+            "items": {
+                item_id: {
+                    "rows": res["rows"],
+                    "changed_rows": res["changed_rows"],
+                    "value_delta": str(res["value_delta"]),
+                    "cogs_delta": str(res["cogs_delta"]),
+                    "variance_delta": str(res["variance_delta"])
+                }
+                for item_id, res in results.items()
+            }
+        }
+
+
+def get_recost_service() -> StockRecostService:
+    return StockRecostService()
@@ -0,0 +1,373 @@
+"""
+Reorder Service
+Reorder points and suggested purchase quantities per item and warehouse.
+
+A run loads the daily issued quantity of every (item, warehouse) over the
+history window from stock_daily_rollups into one NumPy matrix (series x days)
+and computes, in a single vectorized pass:
+
+    moving average      mean daily issue over the last ma_window days (28)
+    forecast            simple exponential smoothing of the daily issue
+    safety stock        z(service level) * std(daily issue) * sqrt(lead time)
+    reorder point       forecast * lead time + safety stock
+    target level        reorder point + forecast * review period
+
+A series whose stock position (on hand + open purchase orders) is at or below
+its reorder point gets a suggestion that brings it back to the target level,
+rounded up to the item's order_multiple. PO lines without a warehouse count
+for the item's default warehouse (or its only series); the rest are reported
+in the run's unassigned_on_order. Suggestions are stored per run in
+reorder_suggestions and can be turned into draft purchase orders, one per
+supplier (items.supplier_account_id).
+"""
+import uuid
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from statistics import NormalDist
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+from google.cloud import firestore
+from app.core.firebase import get_db, stream_paged
+from .rollups import as_day
+from .stock_rollups import StockRollupService
+
+Key = Tuple[str, str]
+
+
+def plan_replenishment(
+    demand: np.ndarray,
+    on_hand: np.ndarray,
+    on_order: np.ndarray,
+    lead_time: np.ndarray,
+    order_multiple: np.ndarray,
+    method: str = "SES",
+    alpha: float = 0.3,
+    ma_window: int = 28,
+    service_level: float = 0.95,
+    review_days: int = 14
+) -> Dict[str, np.ndarray]:
+    """
+    Vectorized reorder calculation. `demand` is (series, days) daily issued
+    quantity, oldest day first; every other array has one value per series.
+    """
+    series, days = demand.shape
+    if days == 0:
+        raise ValueError("Demand history is empty")
+
+    moving_average = demand[:, -min(ma_window, days):].mean(axis=1)
+
+    # SES level after the last day as one weighted sum: level_T = sum(a(1-a)^(T-1-t) x_t) + (1-a)^T level_0
+    decay = (1 - alpha) ** np.arange(days - 1, -1, -1, dtype=np.float64)
+    initial = demand[:, :min(7, days)].mean(axis=1)
+    smoothed = demand @ (alpha * decay) + (1 - alpha) ** days * initial
+
+    forecast = smoothed if method == "SES" else moving_average
+    sigma = demand.std(axis=1, ddof=1) if days > 1 else np.zeros(series)
+    z = NormalDist().inv_cdf(service_level)
+
+    safety_stock = z * sigma * np.sqrt(lead_time)
+    reorder_point = forecast * lead_time + safety_stock
+    target_level = reorder_point + forecast * review_days
+    position = on_hand + on_order
+
+    need = np.where((forecast > 0) & (position <= reorder_point), target_level - position, 0.0)
+    need = np.clip(need, 0.0, None)
+    multiple = np.where(order_multiple > 0, order_multiple, 1.0)
+    suggested = np.where(need > 0, np.ceil(need / multiple - 1e-9) * multiple, 0.0)
+
+    return {
+        "moving_average": moving_average,
+        "forecast": forecast,
+        "sigma": sigma,
+        "safety_stock": safety_stock,
+        "reorder_point": reorder_point,
+        "target_level": target_level,
+        "position": position,
+        "suggested_qty": suggested,
+    }
+
+
+def _num(value: float, places: int = 4) -> str:
+    return str(round(float(value), places))
+
+
+class ReorderService:
+    RUNS_COLLECTION = "reorder_runs"
+    SUGGESTIONS_COLLECTION = "reorder_suggestions"
+    METHODS = {"SES", "MA"}
+    DEFAULT_LEAD_TIME_DAYS = 7
+    # Purchase orders whose quantities are still on their way
+    OPEN_PO_STATUSES = ["DRAFT", "APPROVED"]
+
+    def __init__(self):
+        self.db = get_db()
+
+    # ==========================================================================
+    # LOAD
+    # ==========================================================================
+    def _load_demand(self, company_id: str, start, end) -> Tuple[List[Key], np.ndarray]:
+        """Daily issued quantity per (item, warehouse) over [start, end] from the item rollups."""
+        days = (end - start).days + 1
+        index: Dict[Key, int] = {}
+        rows: List[int] = []
+        cols: List[int] = []
+        qtys: List[float] = []
+
+        query = self.db.collection(StockRollupService.DAILY_COLLECTION)\
+            .where("company_id", "==", company_id)\
+            .where("date", ">=", start.isoformat())\
+            .where("date", "<=", end.isoformat())
+        for snap in stream_paged(query, page_size=1000):
+            doc = snap.to_dict()
+            qty, _ = StockRollupService.issue_totals(doc.get("by_type") or {})
+            if not qty:
+                continue
+            key = (doc["item_id"], doc.get("warehouse_id") or "")
+            rows.append(index.setdefault(key, len(index)))
+            cols.append((as_day(doc["date"]) - start).days)
+            qtys.append(float(qty))
+
+        demand = np.zeros((len(index), days), dtype=np.float64)
+        if qtys:
+            np.add.at(demand, (np.array(rows), np.array(cols)), np.array(qtys))
+        keys = sorted(index, key=index.get)
+        return keys, demand
+
+    def _load_on_order(self, company_id: str, keys: List[Key],
+                       items: Dict[str, Dict[str, Any]]) -> Tuple[Dict[Key, float], Dict[str, float]]:
+        """
+        Open purchase order quantity per (item, warehouse). A line without a warehouse
+        counts for the item's default_warehouse_id, or for its only series when it has
+        one; otherwise it is returned per item as unassigned (reported by the run).
+        """
+        series_warehouses: Dict[str, List[str]] = {}
+        for item_id, wh in keys:
+            series_warehouses.setdefault(item_id, []).append(wh)
+
+        on_order: Dict[Key, float] = {}
+        unassigned: Dict[str, float] = {}
+        query = self.db.collection("purchase_orders")\
+            .where("company_id", "==", company_id)\
+            .where("status", "in", self.OPEN_PO_STATUSES)
+        for snap in query.stream():
+            for line in snap.to_dict().get("lines", []):
+                item_id = line.get("item_id")
+                if not item_id:
+                    continue
+                qty = float(line.get("quantity", 0) or 0)
+                wh = line.get("warehouse_id") or (items.get(item_id) or {}).get("default_warehouse_id")
+                if not wh and len(series_warehouses.get(item_id, [])) == 1:
+                    wh = series_warehouses[item_id][0]
+                if not wh:
+                    if item_id in series_warehouses:
+                        unassigned[item_id] = unassigned.get(item_id, 0.0) + qty
+                    continue
+                on_order[(item_id, wh)] = on_order.get((item_id, wh), 0.0) + qty
+        return on_order, unassigned
+
+    def _load_items(self, item_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        items = {}
+        refs = [self.db.collection("items").document(i) for i in item_ids]
+        for start in range(0, len(refs), 300):
+            for snap in self.db.get_all(refs[start:start + 300]):
+                if snap.exists:
+                    items[snap.id] = snap.to_dict()
+        return items
+
+    # ==========================================================================
+    # RUN
+    # ==========================================================================
+    def run(
+        self,
+        company_id: str,
+        history_days: int = 90,
+        method: str = "SES",
+        alpha: float = 0.3,
+        service_level: float = 0.95,
+        review_days: int = 14,
+        as_of=None
+    ) -> Dict[str, Any]:
+        """Compute reorder points for every item and warehouse with recent issues and store the suggestions."""
+        if method not in self.METHODS:
+            raise ValueError(f"method must be one of {sorted(self.METHODS)}")
+        if history_days < 7:
+            raise ValueError("history_days must be at least 7")
+        if not 0 < alpha < 1:
+            raise ValueError("alpha must be between 0 and 1")
+        if not 0.5 <= service_level < 1:
+            raise ValueError("service_level must be in [0.5, 1)")
+
+        end = as_day(as_of)
+        start = end - timedelta(days=history_days - 1)
+        keys, demand = self._load_demand(company_id, start, end)
+
+        from .valuation import get_valuation_service
+        positions, _ = get_valuation_service().positions_as_of(company_id, end)
+        items = self._load_items(sorted({item_id for item_id, _ in keys}))
+        on_order, unassigned_on_order = self._load_on_order(company_id, keys, items)
+
+        def item_field(item_id: str, field: str, default: float) -> float:
+            value = (items.get(item_id) or {}).get(field)
+            return float(value) if value not in (None, "") else default
+
+        result = plan_replenishment(
+            demand,
+            on_hand=np.array([float(positions.get(k, {}).get("qty", 0)) for k in keys], dtype=np.float64),
+            on_order=np.array([on_order.get(k, 0.0) for k in keys], dtype=np.float64),
+            lead_time=np.array([item_field(k[0], "lead_time_days", self.DEFAULT_LEAD_TIME_DAYS) for k in keys], dtype=np.float64),
+            order_multiple=np.array([item_field(k[0], "order_multiple", 0.0) for k in keys], dtype=np.float64),
+            method=method,
+            alpha=alpha,
+            service_level=service_level,
+            review_days=review_days
+        )
+
+        run_id = uuid.uuid4().hex[:12]
+        suggestions = 0
+        batch = self.db.batch()
+        pending = 0
+        for i in np.flatnonzero(result["suggested_qty"] > 0):
+            item_id, wh = keys[i]
+            item = items.get(item_id) or {}
+            batch.set(self.db.collection(self.SUGGESTIONS_COLLECTION).document(f"{run_id}_{item_id}_{wh or '-'}"), {
+                "run_id": run_id,
+                "company_id": company_id,
+                "item_id": item_id,
+                "warehouse_id": wh,
+                "sku": item.get("sku"),
+                "name": item.get("name"),
+                "moving_average": _num(result["moving_average"][i]),
+                "forecast_daily": _num(result["forecast"][i]),
+                "demand_std": _num(result["sigma"][i]),
+                "lead_time_days": _num(item_field(item_id, "lead_time_days", self.DEFAULT_LEAD_TIME_DAYS), 2),
+                "safety_stock": _num(result["safety_stock"][i]),
+                "reorder_point": _num(result["reorder_point"][i]),
+                "target_level": _num(result["target_level"][i]),
+                "on_hand": _num(positions.get((item_id, wh), {}).get("qty", 0)),
+                "on_order": _num(on_order.get((item_id, wh), 0.0)),
+                "suggested_qty": _num(result["suggested_qty"][i]),
+                "unit_cost": str(item.get("current_wac", "0")),
+                "supplier_account_id": item.get("supplier_account_id"),
+                "status": "OPEN",
+                "purchase_order_id": None
+            })
+            suggestions += 1
+            pending += 1
+            if pending >= 450:
+                batch.commit()
+                batch = self.db.batch()
+                pending = 0
+
+        summary = {
+            "run_id": run_id,
+            "company_id": company_id,
+            "as_of": end.isoformat(),
+            "history_days": history_days,
+            "method": method,
+            "alpha": alpha,
+            "service_level": service_level,
+            "review_days": review_days,
+            "series": len(keys),
+            "suggestions": suggestions,
+            # Open PO quantity without a warehouse that could not be attributed (not counted as on order)
+            "unassigned_on_order": {item_id: _num(qty) for item_id, qty in sorted(unassigned_on_order.items())}
+        }
+        batch.set(self.db.collection(self.RUNS_COLLECTION).document(run_id), {
+            **summary, "created_at": firestore.SERVER_TIMESTAMP
+        })
+        batch.commit()
+        return summary
+
+    # ==========================================================================
+    # SUGGESTIONS -> PURCHASE ORDERS
+    # ==========================================================================
+    def _latest_run_id(self, company_id: str) -> Optional[str]:
+        query = self.db.collection(self.RUNS_COLLECTION)\
+            .where("company_id", "==", company_id)\
+            .order_by("created_at", direction=firestore.Query.DESCENDING)\
+            .limit(1)
+        docs = list(query.stream())
+        return docs[0].id if docs else None
+
+    def get_suggestions(self, company_id: str, run_id: Optional[str] = None, status: Optional[str] = "OPEN") -> Dict[str, Any]:
+        """Suggestions of a run (default: the latest run of the company)."""
+        run_id = run_id or self._latest_run_id(company_id)
+        if not run_id:
+            return {"run_id": None, "suggestions": []}
+        query = self.db.collection(self.SUGGESTIONS_COLLECTION)\
+            .where("company_id", "==", company_id)\
+            .where("run_id", "==", run_id)
+        if status:
+            query = query.where("status", "==", status)
+        rows = [{"id": d.id, **d.to_dict()} for d in query.stream()]
+        rows.sort(key=lambda r: (r.get("supplier_account_id") or "", r.get("sku") or "", r.get("warehouse_id") or ""))
+        return {"run_id": run_id, "suggestions": rows}
+
+    def create_purchase_orders(
+        self,
+        company_id: str,
+        run_id: str,
+        suggestion_ids: Optional[List[str]] = None,
+        created_by: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Turn OPEN suggestions of a run into draft purchase orders, one per supplier."""
+        from .sales import get_purchase_order_service
+
+        open_rows = self.get_suggestions(company_id, run_id)["suggestions"]
+        if suggestion_ids is not None:
+            wanted = set(suggestion_ids)
+            open_rows = [r for r in open_rows if r["id"] in wanted]
+        if not open_rows:
+            raise ValueError("No open suggestions to order")
+
+        groups: Dict[Optional[str], List[Dict[str, Any]]] = {}
+        for row in open_rows:
+            groups.setdefault(row.get("supplier_account_id"), []).append(row)
+
+        po_service = get_purchase_order_service()
+        orders = []
+        for supplier_account_id, rows in groups.items():
+            supplier_name = None
+            if supplier_account_id:
+                acc = self.db.collection("accounts").document(supplier_account_id).get().to_dict() or {}
+                supplier_name = acc.get("name_en") or acc.get("name_ar") or acc.get("name")
+            lines = []
+            total = Decimal("0")
+            for row in rows:
+                qty = Decimal(row["suggested_qty"])
+                cost = Decimal(str(row.get("unit_cost") or "0"))
+                total += qty * cost
+                lines.append({
+                    "item_id": row["item_id"],
+                    "item_name": row.get("name"),
+                    "warehouse_id": row.get("warehouse_id") or None,
+                    "quantity": str(qty),
+                    "unit_cost": str(cost)
+                })
+            po_id = po_service.create_purchase_order({
+                "number": f"PO-RO-{run_id}-{len(orders) + 1}",
+                "supplier_name": supplier_name or "Unassigned supplier",
+                "supplier_account_id": supplier_account_id,
+                "lines": lines,
+                "total": str(total),
+                "notes": f"Reorder suggestions, run {run_id}",
+                "created_by": created_by or "system"
+            }, company_id=company_id)
+
+            for start in range(0, len(rows), 450):
+                batch = self.db.batch()
+                for row in rows[start:start + 450]:
+                    batch.update(self.db.collection(self.SUGGESTIONS_COLLECTION).document(row["id"]), {
+                        "status": "ORDERED",
+                        "purchase_order_id": po_id,
+                        "ordered_at": datetime.now(timezone.utc)
+                    })
+                batch.commit()
+            orders.append({"purchase_order_id": po_id, "supplier_account_id": supplier_account_id,
+                           "lines": len(lines), "total": str(total)})
+
+        return {"run_id": run_id, "purchase_orders": orders}
+
+
+def get_reorder_service() -> ReorderService:
+    return ReorderService()
@@ -0,0 +1,346 @@
+"""
+Ledger Replay Engine
+Recomputes derived state from the sources of truth and repairs drift:
+
+    accounts.total_debit / total_credit / balance  <- journal_entries (POSTED + VOIDED)
+    items.current_qty / total_value / current_wac  <- stock_ledger
+    invoices / bills remaining_amount               <- total - paid_amount
+                                                       (voucher settlements are cross-checked)
+
+The journal and stock ledger scans are partitioned by document-id range and run
+in a process pool: each worker streams its slice once and returns per-account /
+per-item aggregates. The aggregates do not depend on order (stock OUT rows carry
+the valuation rate they used), so the slices merge by simple addition.
+Finished partitions are checkpointed to local disk, so an interrupted run
+resumes with the same run_id. Closed months moved to the period archive are
+summed from the archive chunks as one extra partition.
+
+Run it in a quiet window: postings that land during a replay show up as
+transient diffs.
+"""
+import os
+import pickle
+import tempfile
+import uuid
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+from typing import Any, Dict, List, Optional, Tuple
+from google.cloud import firestore
+from google.cloud.firestore_v1.field_path import FieldPath
+from app.core.firebase import get_db, stream_paged
+from .journal_lines import get_journal_line_store
+
+# Firestore auto-ids are drawn from this alphabet (ASCII order)
+ID_ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+ZERO = Decimal("0")
+
+
+def key_ranges(partitions: int) -> List[Tuple[Optional[str], Optional[str]]]:
+    """Split the document-id keyspace into contiguous [lo, hi) ranges covering every id."""
+    partitions = max(1, min(partitions, len(ID_ALPHABET)))
+    step = len(ID_ALPHABET) / partitions
+    bounds = [ID_ALPHABET[int(i * step)] for i in range(1, partitions)]
+    edges = [None] + bounds + [None]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def _range_query(collection: str, company_id: Optional[str], lo: Optional[str], hi: Optional[str]):
+    """One id range of a collection, restricted to a company (None = every document)."""
+    db = get_db()
+    ref = db.collection(collection)
+    query = ref if company_id is None else ref.where("company_id", "==", company_id)
+    if lo is not None:
+        query = query.where(FieldPath.document_id(), ">=", ref.document(lo))
+    if hi is not None:
+        query = query.where(FieldPath.document_id(), "<", ref.document(hi))
+    return query.order_by(FieldPath.document_id())
+
+
+# ==============================================================================
+# WORKERS (top-level so they can run in spawned processes)
+# ==============================================================================
+def _add_journal(totals: Dict[str, List[Decimal]], snap) -> bool:
+    data = snap.to_dict()
+    # VOIDED originals and their POSTED reversals both stay in the ledger
+    if data.get("status") not in ("POSTED", "VOIDED"):
+        return False
+    # Chunked entries are summed from their line chunks, not from the header totals
+    for line in get_journal_line_store().iter_lines(snap.id, data):
+        acc_id = line.get("account_id")
+        if not acc_id:
+            continue
+        bucket = totals.setdefault(acc_id, [ZERO, ZERO])
+        bucket[0] += Decimal(str(line.get("debit", "0") or "0"))
+        bucket[1] += Decimal(str(line.get("credit", "0") or "0"))
+    return True
+
+
+def _add_stock(totals: Dict[str, Dict[str, Any]], snap) -> bool:
+    data = snap.to_dict()
+    item_id = data.get("item_id")
+    if not item_id:
+        return False
+    qty = Decimal(str(data.get("quantity", "0") or "0"))
+    # IN at its cost; OUT at the valuation rate it was issued at
+    rate = data.get("unit_cost") if qty > 0 else data.get("valuation_rate")
+    value = qty * Decimal(str(rate or "0"))
+    bucket = totals.setdefault(item_id, {"qty": ZERO, "value": ZERO, "last_ts": None, "last_rate": None})
+    bucket["qty"] += qty
+    bucket["value"] += value
+    ts = data.get("timestamp")
+    if ts is not None and (bucket["last_ts"] is None or ts > bucket["last_ts"]):
+        bucket["last_ts"] = ts
+        bucket["last_rate"] = data.get("valuation_rate")
+    return True
+
+
+def scan_journals(company_id: str, lo: Optional[str], hi: Optional[str]) -> Dict[str, Any]:
+    """Sum debit/credit per account over one id range of journal_entries."""
+    totals: Dict[str, List[Decimal]] = {}
+    count = 0
+    for je in stream_paged(_range_query("journal_entries", company_id, lo, hi), page_size=1000):
+        count += _add_journal(totals, je)
+    return {"rows": count, "totals": totals}
+
+
+def scan_stock(company_id: str, lo: Optional[str], hi: Optional[str]) -> Dict[str, Any]:
+    """Sum quantity/value per item over one id range of stock_ledger."""
+    totals: Dict[str, Dict[str, Any]] = {}
+    count = 0
+    for row in stream_paged(_range_query("stock_ledger", company_id, lo, hi), page_size=1000):
+        count += _add_stock(totals, row)
+    return {"rows": count, "totals": totals}
+
+
+def scan_archive(company_id: str, kind: str) -> Dict[str, Any]:
+    """Same sums over the archived (closed, purged) months; their rows are no longer in the hot ranges."""
+    from .archive import ArchiveService
+    collection, add = ("journal_entries", _add_journal) if kind == "journals" else ("stock_ledger", _add_stock)
+    totals: Dict[str, Any] = {}
+    count = 0
+    for snap in ArchiveService().iter_archived(company_id, collection):
+        count += add(totals, snap)
+    return {"rows": count, "totals": totals}
+
+
+SCANNERS = {"journals": scan_journals, "stock": scan_stock}
+
+
+class ReplayService:
+    RUNS_COLLECTION = "replay_runs"
+    BATCH_SIZE = 400
+    TOLERANCE = Decimal("0.0001")
+    # Diffs listed in the report (all diffs are counted and corrected)
+    REPORT_LIMIT = 500
+
+    def __init__(self, company_id: str, workers: Optional[int] = None, partitions: Optional[int] = None):
+        self.db = get_db()
+        self.company_id = company_id
+        self.workers = workers or min(8, os.cpu_count() or 2)
+        self.partitions = partitions or self.workers * 2
+        self.checkpoint_root = os.path.join(tempfile.gettempdir(), "opengate_replay")
+
+    # ==========================================================================
+    # SCAN (parallel, checkpointed)
+    # ==========================================================================
+    def _checkpoint_path(self, run_id: str, kind: str, index: int) -> str:
+        return os.path.join(self.checkpoint_root, run_id, f"{kind}_{index:03d}.pkl")
+
+    def _scan(self, run_id: str, kind: str) -> Tuple[Dict[str, Any], int]:
+        ranges = key_ranges(self.partitions)
+        results: Dict[int, Dict[str, Any]] = {}
+        pending = []
+        for idx in range(len(ranges)):
+            path = self._checkpoint_path(run_id, kind, idx)
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    results[idx] = pickle.load(f)
+            else:
+                pending.append(idx)
+
+        if pending:
+            os.makedirs(os.path.join(self.checkpoint_root, run_id), exist_ok=True)
+            # spawn: gRPC channels of the parent's Firestore client are not fork-safe
+            ctx = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx) as pool:
+                futures = {idx: pool.submit(SCANNERS[kind], self.company_id, *ranges[idx]) for idx in pending}
+                for idx, future in futures.items():
+                    results[idx] = future.result()
+                    tmp = self._checkpoint_path(run_id, kind, idx) + ".tmp"
+                    with open(tmp, "wb") as f:
+                        pickle.dump(results[idx], f)
+                    os.replace(tmp, self._checkpoint_path(run_id, kind, idx))
+
+        # Archived months are not in any id range of the hot collections
+        results[len(ranges)] = scan_archive(self.company_id, kind)
+
+        merged: Dict[str, Any] = {}
+        rows = 0
+        for idx in sorted(results):
+            rows += results[idx]["rows"]
+            for key, value in results[idx]["totals"].items():
+                if kind == "journals":
+                    bucket = merged.setdefault(key, [ZERO, ZERO])
+                    bucket[0] += value[0]
+                    bucket[1] += value[1]
+                else:
+                    bucket = merged.setdefault(key, {"qty": ZERO, "value": ZERO, "last_ts": None, "last_rate": None})
+                    bucket["qty"] += value["qty"]
+                    bucket["value"] += value["value"]
+                    if value["last_ts"] is not None and (bucket["last_ts"] is None or value["last_ts"] > bucket["last_ts"]):
+                        bucket["last_ts"] = value["last_ts"]
+                        bucket["last_rate"] = value["last_rate"]
+        return merged, rows
+
+    # ==========================================================================
+    # DIFF
+    # ==========================================================================
+    def _differs(self, stored, expected: Decimal) -> bool:
+        try:
+            return abs(Decimal(str(stored if stored not in (None, "") else "0")) - expected) > self.TOLERANCE
+        except Exception:
+            return True
+
+    def _diff_accounts(self, totals: Dict[str, List[Decimal]]) -> List[Tuple[Any, Dict[str, str], Dict[str, Any]]]:
+        diffs = []
+        query = self.db.collection("accounts").where("company_id", "==", self.company_id)
+        for snap in stream_paged(query):
+            data = snap.to_dict()
+            debit, credit = totals.get(snap.id, [ZERO, ZERO])
+            expected = {"total_debit": debit, "total_credit": credit, "balance": debit - credit}
+            if any(self._differs(data.get(field), value) for field, value in expected.items()):
+                diffs.append((snap.reference, {k: str(v) for k, v in expected.items()},
+                              {k: data.get(k) for k in expected}))
+        return diffs
+
+    def _diff_items(self, totals: Dict[str, Dict[str, Any]]) -> List[Tuple[Any, Dict[str, str], Dict[str, Any]]]:
+        diffs = []
+        query = self.db.collection("items").where("company_id", "==", self.company_id)
+        for snap in stream_paged(query):
+            data = snap.to_dict()
+            t = totals.get(snap.id, {"qty": ZERO, "value": ZERO, "last_rate": None})
+            if t["qty"]:
+                wac = t["value"] / t["qty"]
+            else:
+                wac = Decimal(str(t["last_rate"] or data.get("current_wac") or "0"))
+            expected = {"current_qty": t["qty"], "total_value": t["value"], "current_wac": wac}
+            if any(self._differs(data.get(field), value) for field, value in expected.items()):
+                diffs.append((snap.reference, {k: str(v) for k, v in expected.items()},
+                              {k: data.get(k) for k in expected}))
+        return diffs
+
+    def _diff_open_items(self) -> Tuple[List[Tuple[Any, Dict[str, Any], Dict[str, Any]]], List[Dict[str, Any]]]:
+        """
+        remaining_amount is corrected to total - paid_amount. Voucher settlements
+        are compared with paid_amount but only reported: invoices can also be
+        paid directly (mark_paid) without a voucher.
+        """
+        diffs, mismatches = [], []
+        for voucher_collection, linked_field, target, closed_status, open_status in (
+            ("receipt_vouchers", "linked_invoices", "invoices", "PAID", "ISSUED"),
+            ("payment_vouchers", "linked_bills", "bills", "PAID", "POSTED"),
+        ):
+            settled: Dict[str, Decimal] = {}
+            query = self.db.collection(voucher_collection).where("company_id", "==", self.company_id)
+            for snap in stream_paged(query):
+                data = snap.to_dict()
+                if data.get("status") == "VOIDED":
+                    continue
+                for s in data.get(linked_field, []):
+                    settled[s["invoice_id"]] = settled.get(s["invoice_id"], ZERO) + Decimal(str(s.get("amount", "0")))
+
+            query = self.db.collection(target).where("company_id", "==", self.company_id)
+            for snap in stream_paged(query):
+                data = snap.to_dict()
+                if data.get("status") in ("DRAFT", "VOIDED"):
+                    continue
+                total = Decimal(str(data.get("total", "0") or "0"))
+                paid = Decimal(str(data.get("paid_amount", "0") or "0"))
+                if settled.get(snap.id, ZERO) > paid + self.TOLERANCE:
+                    mismatches.append({"path": snap.reference.path, "paid_amount": str(paid), "voucher_settlements": str(settled[snap.id])})
+
+                remaining = total - paid
+                if self._differs(data.get("remaining_amount"), remaining):
+                    update = {"remaining_amount": str(remaining)}
+                    if data.get("status") in (closed_status, open_status):
+                        update["status"] = closed_status if remaining <= self.TOLERANCE else open_status
+                    diffs.append((snap.reference, update, {k: data.get(k) for k in update}))
+        return diffs, mismatches
+
+    # ==========================================================================
+    # RUN
+    # ==========================================================================
+    def run(self, dry_run: bool = True, run_id: Optional[str] = None, include_open_items: bool = True) -> Dict[str, Any]:
+        """Scan, diff and (unless dry_run) correct all derived state of the company."""
+        run_id = run_id or uuid.uuid4().hex[:12]
+        run_ref = self.db.collection(self.RUNS_COLLECTION).document(run_id)
+        run_ref.set({
+            "company_id": self.company_id,
+            "dry_run": dry_run,
+            "status": "SCANNING",
+            "started_at": firestore.SERVER_TIMESTAMP
+        }, merge=True)
+
+        account_totals, journal_rows = self._scan(run_id, "journals")
+        item_totals, stock_rows = self._scan(run_id, "stock")
+
+        sections = {
+            "accounts": self._diff_accounts(account_totals),
+            "items": self._diff_items(item_totals),
+        }
+        settlement_mismatches = []
+        if include_open_items:
+            sections["open_items"], settlement_mismatches = self._diff_open_items()
+
+        report = {
+            "run_id": run_id,
+            "company_id": self.company_id,
+            "dry_run": dry_run,
+            "journals_scanned": journal_rows,
+            "stock_rows_scanned": stock_rows,
+            "partitions": self.partitions,
+            "diff_counts": {name: len(diffs) for name, diffs in sections.items()},
+            "diffs": {
+                name: [{"path": ref.path, "stored": stored, "expected": expected}
+                       for ref, expected, stored in diffs[:self.REPORT_LIMIT]]
+                for name, diffs in sections.items()
+            },
+            "settlement_mismatches": settlement_mismatches[:self.REPORT_LIMIT]
+        }
+
+        if not dry_run:
+            run_ref.update({"status": "APPLYING"})
+            applied = 0
+            batch = self.db.batch()
+            for diffs in sections.values():
+                for ref, expected, _ in diffs:
+                    batch.update(ref, {**expected, "replayed_at": firestore.SERVER_TIMESTAMP})
+                    applied += 1
+                    if applied % self.BATCH_SIZE == 0:
+                        batch.commit()
+                        batch = self.db.batch()
+            if applied % self.BATCH_SIZE:
+                batch.commit()
+            report["corrections_applied"] = applied
+
+        run_ref.update({
+            "status": "COMPLETED",
+            "diff_counts": report["diff_counts"],
+            "corrections_applied": report.get("corrections_applied", 0),
+            "completed_at": firestore.SERVER_TIMESTAMP
+        })
+        self._clear_checkpoints(run_id)
+        return report
+
+    def _clear_checkpoints(self, run_id: str):
+        directory = os.path.join(self.checkpoint_root, run_id)
+        if not os.path.isdir(directory):
+            return
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+def get_replay_service(company_id: str, workers: Optional[int] = None) -> ReplayService:
+    return ReplayService(company_id, workers=workers)
@@ -1,12 +1,74 @@
-from datetime import datetime, time
+from datetime import datetime, time, timedelta, timezone
 from decimal import Decimal
 from typing import List, Dict, Any, Optional
 from google.cloud import firestore
-from app.core.firebase import get_db
+from app.core.firebase import get_db, stream_paged
+from .rollups import RollupService
+from .stock_balances import StockBalanceService
+from .archive import ArchiveService
+from .journal_lines import get_journal_line_store
 
 class ReportingService:
     def __init__(self):
         self.db = get_db()
+        self.rollups = RollupService()
+        self.balances = StockBalanceService()
+        self.archive = ArchiveService()
+        self.journal_lines = get_journal_line_store()
+
+    async def get_dashboard_stats(self, company_id: str) -> Dict[str, Any]:
+        """
+        Dashboard KPIs served from pre-aggregated daily rollups.
+        Reads at most 31 rollup docs + the company's cash accounts + two count aggregations.
+        """
+        today = datetime.now(timezone.utc).date()
+        month_rows = self.rollups.get_range(company_id, today.replace(day=1), today)
+
+        month_sales = sum(Decimal(str(r["revenue"])) for r in month_rows)
+        month_cogs = sum(Decimal(str(r["cogs"])) for r in month_rows)
+        today_row = month_rows[-1]
+
+        # Cash & Bank balances (code 123*) - small per-company account list
+        cash_balance = Decimal("0")
+        accounts = self.db.collection("accounts")\
+            .where("company_id", "==", company_id)\
+            .where("type", "==", "ASSET")\
+            .stream()
+        for acc in accounts:
+            data = acc.to_dict()
+            if str(data.get("code", "")).startswith(RollupService.CASH_CODE_PREFIX) and not data.get("is_group"):
+                cash_balance += Decimal(str(data.get("balance", "0")))
+
+        # Pending invoices via server-side count aggregation (no document reads)
+        pending_query = self.db.collection("invoices")\
+            .where("company_id", "==", company_id)\
+            .where("status", "==", "ISSUED")
+        pending_invoices = pending_query.count().get()[0][0].value
+
+        return {
+            "cashBalance": str(cash_balance),
+            "lowStock": self.balances.count_low_stock(company_id),
+            "todaySales": str(month_sales),
+            "pendingInvoices": pending_invoices,
+            "monthGrossProfit": str(month_sales - month_cogs),
+            "today": today_row
+        }
+
+    async def get_weekly_revenue(self, company_id: str) -> List[Dict[str, Any]]:
+        """Last 7 days of revenue for the dashboard chart (7 rollup docs)."""
+        today = datetime.now(timezone.utc).date()
+        rows = self.rollups.get_range(company_id, today - timedelta(days=6), today)
+        return [
+            {
+                "name": datetime.fromisoformat(r["date"]).strftime("%a"),
+                "date": r["date"],
+                "sales": r["revenue"],
+                "cogs": r["cogs"],
+                "receipts": r["receipts"],
+                "payments": r["payments"]
+            }
+            for r in rows
+        ]
     
     async def get_trial_balance(self, company_id: str, as_of_date: Optional[datetime] = None) -> List[Dict[str, Any]]:
         """
@@ -112,7 +174,7 @@ class ReportingService:
             .where("company_id", "==", company_id)\
             .where("status", "==", "POSTED")
             
-        jes = list(je_query.stream())
+        jes = list(self.archive.read_through(company_id, "journal_entries", je_query.stream(), start_date, account_id=ar_account_id))
         
         report_lines = []
         period_net_change = Decimal("0")
@@ -128,7 +190,7 @@ class ReportingService:
                 je_date = je_date.replace(tzinfo=timezone.utc)
                 
             # Find lines for this account
-            relevant_lines = [l for l in data.get("lines", []) if l.get("account_id") == ar_account_id]
+            relevant_lines = self.journal_lines.iter_lines(je.id, data, ar_account_id)
             
             for line in relevant_lines:
                 debit = Decimal(str(line.get("debit", "0")))
@@ -218,7 +280,7 @@ class ReportingService:
         # "flat_account_ids": account_ids
         je_query = je_query.where("flat_account_ids", "array_contains", account_id)
         
-        jes = list(je_query.stream())
+        jes = list(self.archive.read_through(company_id, "journal_entries", je_query.stream(), from_date, account_id=account_id))
         
         report_lines = []
         period_net_change = Decimal("0")
@@ -231,7 +293,7 @@ class ReportingService:
                 je_date = je_date.replace(tzinfo=timezone.utc)
             
             # Find relevant lines in this JE
-            lines = [l for l in data.get("lines", []) if l.get("account_id") == account_id]
+            lines = self.journal_lines.iter_lines(je.id, data, account_id)
             for l in lines:
                 debit = Decimal(str(l.get("debit", "0")))
                 credit = Decimal(str(l.get("credit", "0")))
@@ -285,3 +347,171 @@ class ReportingService:
             "total_credit": str(sum(Decimal(l["credit"]) for l in final_lines)),
             "closing_balance": str(running)
         }
+
+    # ==========================================================================
+    # ROW GENERATORS (constant memory - shared by report exports)
+    # ==========================================================================
+    def iter_trial_balance(self, company_id: str):
+        """Yield trial balance rows (one per account) sorted by code."""
+        query = self.db.collection("accounts")\
+            .where("company_id", "==", company_id)\
+            .order_by("code")
+        for doc in stream_paged(query):
+            data = doc.to_dict()
+            bal = Decimal(str(data.get("balance", "0")))
+            yield {
+                "account_id": doc.id,
+                "code": data.get("code"),
+                "name": data.get("name_en"),
+                "type": data.get("type"),
+                "debit": str(bal) if bal > 0 else "0.00",
+                "credit": str(abs(bal)) if bal < 0 else "0.00",
+                "net_balance": str(bal)
+            }
+
+    def _iter_account_entries(self, company_id: str, account_id: str, from_date: Optional[datetime] = None, to_date: Optional[datetime] = None):
+        """Yield (je_snapshot, data, line) for every line of account_id, ordered by date."""
+        query = self.db.collection("journal_entries")\
+            .where("company_id", "==", company_id)\
+            .where("flat_account_ids", "array_contains", account_id)
+        if from_date:
+            query = query.where("date", ">=", from_date)
+        if to_date:
+            query = query.where("date", "<=", to_date)
+        query = query.order_by("date")
+
+        # Closed months that were archived come first (read through the archive)
+        for je in self.archive.read_through(company_id, "journal_entries", stream_paged(query), from_date, to_date, account_id=account_id):
+            data = je.to_dict()
+            # VOIDED originals stay in the ledger next to their POSTED reversal
+            if data.get("status") not in ("POSTED", "VOIDED"):
+                continue
+            # Chunked entries read only the chunks holding this account's lines
+            for line in self.journal_lines.iter_lines(je.id, data, account_id):
+                yield je, data, line
+
+    def iter_general_ledger(self, company_id: str, account_id: str, from_date: Optional[datetime] = None, to_date: Optional[datetime] = None):
+        """
+        General ledger rows with running balance, streamed in two passes:
+        1. Sum movements since from_date to back-calculate the opening balance.
+        2. Stream the period lines and carry the running balance.
+        The account is checked here, before the row generator starts, so an error
+        surfaces before a streamed response does.
+        """
+        acc_snap = self.db.collection("accounts").document(account_id).get()
+        if not acc_snap.exists or acc_snap.to_dict().get("company_id") not in (None, company_id):
+            raise ValueError("Account not found")
+        current_balance = Decimal(str(acc_snap.to_dict().get("balance", "0")))
+        return self._general_ledger_rows(company_id, account_id, current_balance, from_date, to_date)
+
+    def _general_ledger_rows(self, company_id: str, account_id: str, current_balance: Decimal,
+                             from_date: Optional[datetime], to_date: Optional[datetime]):
+        if from_date and from_date.tzinfo is None:
+            from_date = from_date.replace(tzinfo=timezone.utc)
+        if to_date and to_date.tzinfo is None:
+            to_date = to_date.replace(tzinfo=timezone.utc)
+
+        since_from = Decimal("0")
+        for _, _, line in self._iter_account_entries(company_id, account_id, from_date):
+            since_from += Decimal(str(line.get("debit", "0"))) - Decimal(str(line.get("credit", "0")))
+
+        running = current_balance - since_from
+        yield {
+            "journal_id": "",
+            "date": from_date.isoformat() if from_date else "",
+            "number": "",
+            "description": "Opening Balance",
+            "memo": "",
+            "debit": "0",
+            "credit": "0",
+            "balance": str(running)
+        }
+
+        for je, data, line in self._iter_account_entries(company_id, account_id, from_date, to_date):
+            debit = Decimal(str(line.get("debit", "0")))
+            credit = Decimal(str(line.get("credit", "0")))
+            running += debit - credit
+            je_date = data.get("date")
+            yield {
+                "journal_id": je.id,
+                "date": je_date.isoformat() if hasattr(je_date, "isoformat") else str(je_date or ""),
+                "number": data.get("number", ""),
+                "description": data.get("description", ""),
+                "memo": line.get("memo") or line.get("description") or "",
+                "debit": str(debit),
+                "credit": str(credit),
+                "balance": str(running)
+            }
+
+    def iter_customer_statement(self, company_id: str, customer_id: str, from_date: Optional[datetime] = None, to_date: Optional[datetime] = None):
+        """Yield statement rows for a customer (the ledger of its linked AR account)."""
+        cust_snap = self.db.collection("customers").document(customer_id).get()
+        if not cust_snap.exists:
+            raise ValueError("Customer not found")
+        ar_account_id = cust_snap.to_dict().get("ar_account_id")
+        if not ar_account_id:
+            raise ValueError("Customer does NOT have a linked AR Account configured.")
+        return self.iter_general_ledger(company_id, ar_account_id, from_date, to_date)
+
+    # Aging buckets: (field, max days overdue inclusive)
+    AGING_BUCKETS = (("current", 0), ("d30", 30), ("d60", 60), ("d90", 90), ("over90", None))
+
+    def iter_aging(self, company_id: str, report_type: str = "AR", as_of: Optional[datetime] = None):
+        """
+        Yield one aging row per partner from open invoices (AR) or bills (AP).
+        Only the per-partner bucket totals are kept in memory.
+        """
+        report_type = report_type.upper()
+        if report_type == "AR":
+            collection, statuses = "invoices", ["ISSUED", "OVERDUE"]
+            partner_id_field, partner_name_field = "customer_id", "customer_name"
+        elif report_type == "AP":
+            collection, statuses = "bills", ["POSTED", "OVERDUE"]
+            partner_id_field, partner_name_field = "supplier_id", "supplier_name"
+        else:
+            raise ValueError("Aging report type must be AR or AP")
+
+        as_of = as_of or datetime.now(timezone.utc)
+        if as_of.tzinfo is None:
+            as_of = as_of.replace(tzinfo=timezone.utc)
+
+        query = self.db.collection(collection)\
+            .where("company_id", "==", company_id)\
+            .where("status", "in", statuses)
+
+        partners: Dict[str, Dict[str, Any]] = {}
+        for doc in stream_paged(query):
+            data = doc.to_dict()
+            remaining = Decimal(str(data.get("remaining_amount", "0") or "0"))
+            if remaining <= 0:
+                continue
+
+            due = data.get("due_date") or data.get("issue_date") or data.get("date")
+            days_overdue = 0
+            if hasattr(due, "tzinfo"):
+                if due.tzinfo is None:
+                    due = due.replace(tzinfo=timezone.utc)
+                days_overdue = max((as_of - due).days, 0)
+
+            bucket = "over90"
+            for field, limit in self.AGING_BUCKETS:
+                if limit is not None and days_overdue <= limit:
+                    bucket = field
+                    break
+
+            partner_id = data.get(partner_id_field) or "UNKNOWN"
+            row = partners.setdefault(partner_id, {
+                "partner_id": partner_id,
+                "partner_name": data.get(partner_name_field) or partner_id,
+                "total": Decimal("0"),
+                **{field: Decimal("0") for field, _ in self.AGING_BUCKETS}
+            })
+            row["total"] += remaining
+            row[bucket] += remaining
+
+        for row in sorted(partners.values(), key=lambda r: r["total"], reverse=True):
+            yield {k: (str(v) if isinstance(v, Decimal) else v) for k, v in row.items()}
+
+    async def get_aging_report(self, company_id: str, report_type: str = "AR") -> List[Dict[str, Any]]:
+        """AR/AP aging per partner (current, 1-30, 31-60, 61-90, 90+)."""
+        return list(self.iter_aging(company_id, report_type))
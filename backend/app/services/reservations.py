@@ -0,0 +1,223 @@
+"""
+Reservations Service
+Stock promised to open documents, held against the per-warehouse balances:
+
+    stock_reservations/{source_type}_{source_id}
+        direction   OUT  intents of type GIVE, sales orders, draft delivery notes
+                    IN   intents of type GET (expected receipts)
+        lines       [{item_id, warehouse_id, quantity}] (one line per item/warehouse)
+        status      ACTIVE -> CONSUMED (posted) | RELEASED (cancelled, done)
+
+Placing, replacing or releasing a reservation adjusts reserved_qty /
+inbound_qty (and so atp) of the balances in the same transaction. An OUT
+reservation is refused when it exceeds the stock not already promised to other
+documents. A delivery note consumes its reservation inside the posting
+transaction (see InventoryService.create_delivery_note); a partial delivery
+releases only what it delivered and leaves the rest of the reservation ACTIVE.
+"""
+from decimal import Decimal
+from typing import Any, Dict, List, Optional, Tuple
+from google.cloud import firestore
+from app.core.firebase import get_db
+from .stock_balances import StockBalanceService
+
+ZERO = Decimal("0")
+Key = Tuple[str, str]
+
+
+class ReservationService:
+    COLLECTION = "stock_reservations"
+    DIRECTIONS = {"OUT", "IN"}
+
+    def __init__(self):
+        self.db = get_db()
+        self.balances = StockBalanceService()
+
+    @staticmethod
+    def reservation_id(source_type: str, source_id: str) -> str:
+        return f"{source_type}_{source_id}"
+
+    @staticmethod
+    def totals(lines: List[Dict[str, Any]]) -> Dict[Key, Decimal]:
+        """Quantity per (item, warehouse); lines without a warehouse cannot be reserved."""
+        totals: Dict[Key, Decimal] = {}
+        for line in lines or []:
+            if not line.get("item_id") or not line.get("warehouse_id"):
+                continue
+            key = (line["item_id"], line["warehouse_id"])
+            totals[key] = totals.get(key, ZERO) + Decimal(str(line.get("quantity") or "0"))
+        return {k: v for k, v in totals.items() if v > 0}
+
+    @staticmethod
+    def _active_totals(reservation: Optional[Dict[str, Any]]) -> Dict[Key, Decimal]:
+        if not reservation or reservation.get("status") != "ACTIVE":
+            return {}
+        return {(l["item_id"], l["warehouse_id"]): Decimal(l["quantity"]) for l in reservation.get("lines", [])}
+
+    # ==========================================================================
+    # INSIDE POSTING TRANSACTIONS
+    # ==========================================================================
+    def read_for_transaction(self, transaction, reservation_ids: List[str], company_id: Optional[str]) -> Dict[str, Dict[str, Any]]:
+        """Read phase: the company's reservations a posting will consume (missing ones are skipped)."""
+        refs = [self.db.collection(self.COLLECTION).document(i) for i in dict.fromkeys(reservation_ids) if i]
+        if not refs:
+            return {}
+        snaps = {snap.id: snap for snap in self.db.get_all(refs, transaction=transaction)}
+        # Keep the caller's order: consume() releases from the first reservation first
+        return {
+            ref.id: snaps[ref.id].to_dict() for ref in refs
+            if ref.id in snaps and snaps[ref.id].exists and snaps[ref.id].to_dict().get("company_id") == company_id
+        }
+
+    def own_reserved(self, reservations: Dict[str, Dict[str, Any]]) -> Dict[Key, Decimal]:
+        """Active OUT quantity the given reservations hold per (item, warehouse)."""
+        held: Dict[Key, Decimal] = {}
+        for reservation in reservations.values():
+            if reservation.get("direction") != "OUT":
+                continue
+            for key, qty in self._active_totals(reservation).items():
+                held[key] = held.get(key, ZERO) + qty
+        return held
+
+    def consume(self, transaction, balances: Dict[str, Dict[str, Any]], reservations: Dict[str, Dict[str, Any]],
+                company_id: str, delivered: Dict[Key, Decimal]):
+        """
+        Write phase: release what the posting delivered from the reservations (in the
+        order given) and mark them CONSUMED. An OUT reservation holding more than was
+        delivered stays ACTIVE with the remainder; IN reservations are consumed whole.
+        """
+        remaining = dict(delivered)
+        for reservation_id, reservation in reservations.items():
+            held = self._active_totals(reservation)
+            if not held:
+                continue
+            out = reservation.get("direction") == "OUT"
+            left: Dict[Key, Decimal] = {}
+            for (item_id, wh), qty in held.items():
+                released = min(qty, remaining.get((item_id, wh), ZERO)) if out else qty
+                if out:
+                    remaining[(item_id, wh)] = remaining.get((item_id, wh), ZERO) - released
+                if qty - released > 0:
+                    left[(item_id, wh)] = qty - released
+                if released:
+                    self.balances.apply(transaction, balances, company_id, item_id, wh, ZERO,
+                                        reserved_delta=-released if out else ZERO,
+                                        inbound_delta=ZERO if out else -released)
+            ref = self.db.collection(self.COLLECTION).document(reservation_id)
+            if left:
+                lines = [{"item_id": i, "warehouse_id": w, "quantity": str(q)} for (i, w), q in sorted(left.items())]
+                transaction.update(ref, {"lines": lines, "updated_at": firestore.SERVER_TIMESTAMP})
+                reservation["lines"] = lines
+                continue
+            transaction.update(ref, {
+                "status": "CONSUMED",
+                "consumed_at": firestore.SERVER_TIMESTAMP
+            })
+            reservation["status"] = "CONSUMED"
+
+    # ==========================================================================
+    # STANDALONE (own transaction)
+    # ==========================================================================
+    def place(
+        self,
+        company_id: str,
+        source_type: str,
+        source_id: str,
+        lines: List[Dict[str, Any]],
+        direction: str = "OUT",
+        enforce: bool = True
+    ) -> Dict[str, Any]:
+        """
+        Create or replace the reservation of a document. OUT reservations are
+        checked against the stock not promised elsewhere unless enforce=False.
+        Raises ValueError when stock is short.
+        """
+        if direction not in self.DIRECTIONS:
+            raise ValueError(f"direction must be one of {sorted(self.DIRECTIONS)}")
+        wanted = self.totals(lines)
+        ref = self.db.collection(self.COLLECTION).document(self.reservation_id(source_type, source_id))
+        transaction = self.db.transaction()
+
+        @firestore.transactional
+        def _execute(transaction):
+            # PHASE 1: READ
+            snap = ref.get(transaction=transaction)
+            existing = snap.to_dict() if snap.exists else None
+            if existing and existing.get("company_id") != company_id:
+                raise ValueError("Reservation belongs to another company")
+            if existing and existing.get("status") == "CONSUMED":
+                raise ValueError(f"{source_type} {source_id} was already posted")
+            if existing and existing.get("status") == "ACTIVE" and existing.get("direction") != direction:
+                raise ValueError(f"{source_type} {source_id} holds an {existing.get('direction')} reservation; release it first")
+            previous = self._active_totals(existing)
+            keys = set(wanted) | set(previous)
+            balances = self.balances.get_for_transaction(transaction, keys)
+
+            # PHASE 2: CALCULATE
+            if direction == "OUT" and enforce:
+                for (item_id, wh), qty in wanted.items():
+                    balance = balances.get(self.balances.balance_id(item_id, wh), {})
+                    free = self.balances.free_qty(balance) + previous.get((item_id, wh), ZERO)
+                    if qty > free:
+                        raise ValueError(
+                            f"Insufficient available stock for item {item_id} in warehouse {wh} "
+                            f"(requested {qty}, available {free})"
+                        )
+
+            # PHASE 3: WRITE
+            for item_id, wh in keys:
+                delta = wanted.get((item_id, wh), ZERO) - previous.get((item_id, wh), ZERO)
+                if not delta:
+                    continue
+                self.balances.apply(
+                    transaction, balances, company_id, item_id, wh, ZERO,
+                    reserved_delta=delta if direction == "OUT" else ZERO,
+                    inbound_delta=delta if direction == "IN" else ZERO
+                )
+            payload = {
+                "company_id": company_id,
+                "source_type": source_type,
+                "source_id": source_id,
+                "direction": direction,
+                "lines": [{"item_id": i, "warehouse_id": w, "quantity": str(q)} for (i, w), q in sorted(wanted.items())],
+                "status": "ACTIVE" if wanted else "RELEASED",
+                "updated_at": firestore.SERVER_TIMESTAMP
+            }
+            if not existing:
+                payload["created_at"] = firestore.SERVER_TIMESTAMP
+            transaction.set(ref, payload, merge=True)
+            return {"id": ref.id, **{k: v for k, v in payload.items() if k not in ("updated_at", "created_at")}}
+
+        return _execute(transaction)
+
+    def release(self, company_id: str, source_type: str, source_id: str) -> Optional[Dict[str, Any]]:
+        """Give back an ACTIVE reservation (document cancelled or completed). No-op when none is active."""
+        ref = self.db.collection(self.COLLECTION).document(self.reservation_id(source_type, source_id))
+        transaction = self.db.transaction()
+
+        @firestore.transactional
+        def _execute(transaction):
+            # PHASE 1: READ
+            snap = ref.get(transaction=transaction)
+            reservation = snap.to_dict() if snap.exists else None
+            if not reservation or reservation.get("company_id") != company_id or reservation.get("status") != "ACTIVE":
+                return None
+            held = self._active_totals(reservation)
+            balances = self.balances.get_for_transaction(transaction, held.keys())
+
+            # PHASE 3: WRITE
+            out = reservation.get("direction") == "OUT"
+            for (item_id, wh), qty in held.items():
+                self.balances.apply(
+                    transaction, balances, company_id, item_id, wh, ZERO,
+                    reserved_delta=-qty if out else ZERO,
+                    inbound_delta=ZERO if out else -qty
+                )
+            transaction.update(ref, {"status": "RELEASED", "released_at": firestore.SERVER_TIMESTAMP})
+            return {"id": ref.id, "status": "RELEASED"}
+
+        return _execute(transaction)
+
+
+def get_reservation_service() -> ReservationService:
+    return ReservationService()
@@ -0,0 +1,298 @@
+"""
+Daily Rollups Service
+Pre-aggregated per-company daily KPIs: daily_rollups/{company}_{yyyy-mm-dd}.
+Updated incrementally inside the posting transactions so the dashboard reads
+at most one small document per day instead of scanning invoices and journals.
+"""
+from datetime import datetime, date, timedelta, timezone
+from decimal import Decimal
+from typing import Dict, Any, List, Optional
+from google.cloud import firestore
+from app.core.firebase import get_db
+from .journal_lines import get_journal_line_store
+
+# Fields maintained on every daily rollup document
+ROLLUP_FIELDS = (
+    "revenue",
+    "cogs",
+    "receipts",
+    "payments",
+    "invoice_count",
+    "stock_in_value",
+    "stock_out_value",
+)
+
+
+def as_day(value=None) -> date:
+    """Normalize a datetime/date/ISO string (or None = today UTC) into a calendar day."""
+    if value is None:
+        return datetime.now(timezone.utc).date()
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc)
+        return value.date()
+    if isinstance(value, date):
+        return value
+    if isinstance(value, str):
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).date()
+    # Firestore sentinels (SERVER_TIMESTAMP) resolve to "now"
+    return datetime.now(timezone.utc).date()
+
+
+def as_datetime(value=None) -> datetime:
+    """Normalize a datetime/date/ISO string (or None = now) into a UTC datetime (posting dates)."""
+    if value is None:
+        return datetime.now(timezone.utc)
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if isinstance(value, datetime):
+        return value.astimezone(timezone.utc) if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day, tzinfo=timezone.utc)
+    return datetime.now(timezone.utc)
+
+
+class RollupService:
+    """Maintains and reads the daily_rollups collection."""
+
+    COLLECTION = "daily_rollups"
+
+    # Account classification (Iraqi Unified COA codes, see seeding.py)
+    REVENUE_TYPE = "REVENUE"
+    COGS_CODE_PREFIX = "51"
+    CASH_CODE_PREFIX = "123"
+
+    # Source document types counted as issued invoices
+    INVOICE_DOC_TYPES = {"INV"}
+    # Void reversals (lifecycle); they store the voided entry's type as reversed_doc_type
+    REVERSAL_TYPE = "REVERSAL"
+    # Internal movements excluded from stock in/out value
+    TRANSFER_DOC_TYPES = {"TRF", "TRANSFER_IN", "TRANSFER_OUT"}
+    # Journals that move balances between periods rather than record activity
+    EXCLUDED_JOURNAL_TYPES = {"YEAR_END_CLOSE"}
+
+    def __init__(self):
+        self.db = get_db()
+
+    @staticmethod
+    def rollup_key(company_id: str, day: date) -> str:
+        return f"{company_id}_{day.isoformat()}"
+
+    # ==========================================================================
+    # DELTA CALCULATION (pure, shared by live posting and backfill)
+    # ==========================================================================
+    @classmethod
+    def journal_deltas(cls, lines_data: list, accounts_data: Dict[str, Any], source_type: Optional[str] = None,
+                       reversed_type: Optional[str] = None) -> Dict[str, Decimal]:
+        """Compute the rollup contribution of one journal entry's lines (reversed_type: type of the entry a reversal voids)."""
+        if source_type in cls.EXCLUDED_JOURNAL_TYPES:
+            return {}
+        deltas = {}
+
+        for line in lines_data or []:
+            acc = accounts_data.get(line.get("account_id")) or {}
+            debit = Decimal(str(line.get("debit", "0")))
+            credit = Decimal(str(line.get("credit", "0")))
+            code = str(acc.get("code", ""))
+
+            if acc.get("type") == cls.REVENUE_TYPE:
+                deltas["revenue"] = deltas.get("revenue", Decimal("0")) + credit - debit
+            elif code.startswith(cls.COGS_CODE_PREFIX):
+                deltas["cogs"] = deltas.get("cogs", Decimal("0")) + debit - credit
+
+            if code.startswith(cls.CASH_CODE_PREFIX):
+                if debit:
+                    deltas["receipts"] = deltas.get("receipts", Decimal("0")) + debit
+                if credit:
+                    deltas["payments"] = deltas.get("payments", Decimal("0")) + credit
+
+        if source_type in cls.INVOICE_DOC_TYPES:
+            deltas["invoice_count"] = Decimal("1")
+        elif source_type == cls.REVERSAL_TYPE and reversed_type in cls.INVOICE_DOC_TYPES:
+            # A voided invoice leaves the count on the day it is voided
+            deltas["invoice_count"] = Decimal("-1")
+
+        return {k: v for k, v in deltas.items() if v}
+
+    @classmethod
+    def stock_deltas(cls, quantity: Decimal, unit_value: Decimal, doc_type: Optional[str] = None) -> Dict[str, Decimal]:
+        """Compute the rollup contribution of one stock movement."""
+        if doc_type in cls.TRANSFER_DOC_TYPES or not quantity:
+            return {}
+        value = abs(quantity * unit_value)
+        return {"stock_in_value": value} if quantity > 0 else {"stock_out_value": value}
+
+    @classmethod
+    def stock_row_deltas(cls, row: Dict[str, Any]) -> Dict[str, Decimal]:
+        """stock_deltas of a stock_ledger row, valued as record_stock_movement posted it
+        (IN at its unit_cost, OUT at the valuation rate it was issued at)."""
+        qty = Decimal(str(row.get("quantity", "0") or "0"))
+        rate = row.get("unit_cost") if qty > 0 else row.get("valuation_rate")
+        return cls.stock_deltas(qty, Decimal(str(rate or "0")), row.get("source_document_type"))
+
+    # ==========================================================================
+    # TRANSACTIONAL WRITES (no reads: safe after any other write)
+    # ==========================================================================
+    def _increment(self, transaction, company_id: str, day: date, deltas: Dict[str, Decimal]):
+        if not company_id or not deltas:
+            return
+        ref = self.db.collection(self.COLLECTION).document(self.rollup_key(company_id, day))
+        payload = {
+            "company_id": company_id,
+            "date": day.isoformat(),
+            "updated_at": firestore.SERVER_TIMESTAMP
+        }
+        for field, value in deltas.items():
+            if field == "invoice_count":
+                payload[field] = firestore.Increment(int(value))
+            else:
+                payload[field] = firestore.Increment(float(value))
+        transaction.set(ref, payload, merge=True)
+
+    def apply_journal(self, transaction, company_id: str, entry_date, lines_data: list, accounts_data: Dict[str, Any], source_type: Optional[str] = None):
+        """Add a posted journal entry to its day's rollup inside the posting transaction."""
+        deltas = self.journal_deltas(lines_data, accounts_data, source_type)
+        self._increment(transaction, company_id, as_day(entry_date), deltas)
+
+    def apply_reversal_count(self, transaction, company_id: str, entry_date, reversed_type: Optional[str]):
+        """Take a voided document back out of the counts (the reversal's amounts go through apply_journal)."""
+        deltas = self.journal_deltas([], {}, self.REVERSAL_TYPE, reversed_type)
+        self._increment(transaction, company_id, as_day(entry_date), deltas)
+
+    def apply_stock(self, transaction, company_id: str, movement_date, quantity: Decimal, unit_value: Decimal, doc_type: Optional[str] = None):
+        """Add a stock movement to its day's rollup inside the posting transaction."""
+        deltas = self.stock_deltas(quantity, unit_value, doc_type)
+        self._increment(transaction, company_id, as_day(movement_date), deltas)
+
+    def apply_stock_revaluation(self, transaction, company_id: str, movement_date, out_value_delta: Decimal):
+        """Correct a day's stock-out value after its movements were re-costed."""
+        if out_value_delta:
+            self._increment(transaction, company_id, as_day(movement_date), {"stock_out_value": out_value_delta})
+
+    # ==========================================================================
+    # READS
+    # ==========================================================================
+    def get_range(self, company_id: str, start: date, end: date) -> List[Dict[str, Any]]:
+        """Read one rollup per day in [start, end] with a single batched get."""
+        days = []
+        day = start
+        while day <= end:
+            days.append(day)
+            day += timedelta(days=1)
+
+        refs = [self.db.collection(self.COLLECTION).document(self.rollup_key(company_id, d)) for d in days]
+        snaps = {snap.id: snap.to_dict() for snap in self.db.get_all(refs) if snap.exists}
+
+        results = []
+        for d in days:
+            data = snaps.get(self.rollup_key(company_id, d)) or {}
+            row = {"date": d.isoformat()}
+            for field in ROLLUP_FIELDS:
+                row[field] = data.get(field, 0)
+            results.append(row)
+        return results
+
+    # ==========================================================================
+    # BACKFILL
+    # ==========================================================================
+    def rebuild(self, company_id: str, from_date: Optional[date] = None, to_date: Optional[date] = None) -> Dict[str, Any]:
+        """
+        Rebuild rollups from history (journal_entries + stock_ledger).
+        Streams both collections once, aggregates per day in memory and
+        overwrites the affected rollup documents in batched writes.
+        """
+        accounts_data = {
+            doc.id: doc.to_dict()
+            for doc in self.db.collection("accounts").where("company_id", "==", company_id).stream()
+        }
+
+        def in_range(day: date) -> bool:
+            if from_date and day < from_date:
+                return False
+            if to_date and day > to_date:
+                return False
+            return True
+
+        totals: Dict[date, Dict[str, Decimal]] = {}
+
+        def add(day: date, deltas: Dict[str, Decimal]):
+            bucket = totals.setdefault(day, {})
+            for field, value in deltas.items():
+                bucket[field] = bucket.get(field, Decimal("0")) + value
+
+        # 1. Journals (reversals are POSTED entries themselves, so VOIDED originals still count)
+        from .archive import ArchiveService
+        archive = ArchiveService()
+        lo = datetime.combine(from_date, datetime.min.time(), tzinfo=timezone.utc) if from_date else None
+        hi = datetime.combine(to_date + timedelta(days=1), datetime.min.time(), tzinfo=timezone.utc) if to_date else None
+
+        je_query = self.db.collection("journal_entries").where("company_id", "==", company_id)
+        je_count = 0
+        for je in archive.read_through(company_id, "journal_entries", je_query.stream(), lo, hi):
+            data = je.to_dict()
+            if data.get("status") not in ("POSTED", "VOIDED"):
+                continue
+            day = as_day(data.get("date"))
+            if not in_range(day):
+                continue
+            source_type = data.get("source_doc_type") or data.get("source_document_type")
+            add(day, self.journal_deltas(get_journal_line_store().lines_of(je.id, data), accounts_data, source_type,
+                                         data.get("reversed_doc_type")))
+            je_count += 1
+
+        # 2. Stock movements
+        ledger_query = self.db.collection("stock_ledger").where("company_id", "==", company_id)
+        move_count = 0
+        for move in archive.read_through(company_id, "stock_ledger", ledger_query.stream(), lo, hi):
+            data = move.to_dict()
+            day = as_day(data.get("posting_date") or data.get("timestamp"))
+            if not in_range(day):
+                continue
+            add(day, self.stock_row_deltas(data))
+            move_count += 1
+
+        # 3. Overwrite rollups (and clear stale days inside the range)
+        collection = self.db.collection(self.COLLECTION)
+        stale_ids = set()
+        for doc in collection.where("company_id", "==", company_id).stream():
+            if in_range(as_day(doc.to_dict().get("date"))):
+                stale_ids.add(doc.id)
+
+        batch = self.db.batch()
+        pending = 0
+        for day, bucket in totals.items():
+            key = self.rollup_key(company_id, day)
+            stale_ids.discard(key)
+            payload = {"company_id": company_id, "date": day.isoformat(), "updated_at": firestore.SERVER_TIMESTAMP}
+            for field in ROLLUP_FIELDS:
+                value = bucket.get(field, Decimal("0"))
+                payload[field] = int(value) if field == "invoice_count" else float(value)
+            batch.set(collection.document(key), payload)
+            pending += 1
+            if pending >= 450:
+                batch.commit()
+                batch = self.db.batch()
+                pending = 0
+
+        for doc_id in stale_ids:
+            batch.delete(collection.document(doc_id))
+            pending += 1
+            if pending >= 450:
+                batch.commit()
+                batch = self.db.batch()
+                pending = 0
+
+        if pending:
+            batch.commit()
+
+        return {
+            "company_id": company_id,
+            "days_written": len(totals),
+            "days_cleared": len(stale_ids),
+            "journals_scanned": je_count,
+            "movements_scanned": move_count
+        }
+
+
+def get_rollup_service() -> RollupService:
+    return RollupService()
@@ -2,6 +2,7 @@ from decimal import Decimal
 from datetime import datetime
 from app.core.firebase import get_db
 from google.cloud import firestore
+from .reservations import ReservationService
 
 class QuotationService:
     """Service for managing sales quotations and orders."""
@@ -44,8 +45,8 @@ class QuotationService:
         })
         return {"status": "updated", "new_status": new_status}
     
-    def convert_to_sales_order(self, quotation_id: str) -> str:
-        """Convert accepted quotation to a Sales Order."""
+    def convert_to_sales_order(self, quotation_id: str, company_id: str = None) -> str:
+        """Convert accepted quotation to a Sales Order, reserving the stock of its lines."""
         quo_doc = self.db.collection("quotations").document(quotation_id).get()
         if not quo_doc.exists:
             raise ValueError("Quotation not found")
@@ -54,6 +55,9 @@ class QuotationService:
         
         # Create Sales Order
         so_ref = self.db.collection("sales_orders").document()
+        if company_id:
+            # Lines carrying item_id + warehouse_id are held; raises ValueError when stock is short
+            ReservationService().place(company_id, "SO", so_ref.id, quo_data.get("lines", []), "OUT")
         sales_order = {
             "number": f"SO-{datetime.now().strftime('%Y%m%d%H%M%S')}",
             "quotation_id": quotation_id,
@@ -61,7 +65,8 @@ class QuotationService:
             "lines": quo_data.get("lines", []),
             "total": quo_data.get("total"),
             "currency": quo_data.get("currency", "IQD"),
-            "status": "PENDING",  # PENDING -> APPROVED -> DELIVERED -> INVOICED
+            "status": "PENDING",  # PENDING -> APPROVED -> DELIVERED -> INVOICED | CANCELLED
+            "company_id": company_id,
             "created_at": firestore.SERVER_TIMESTAMP
         }
         so_ref.set(sales_order)
@@ -74,6 +79,18 @@ class QuotationService:
         
         return so_ref.id
     
+    def cancel_sales_order(self, so_id: str, company_id: str) -> dict:
+        """Cancel a sales order and release its stock reservation."""
+        so_ref = self.db.collection("sales_orders").document(so_id)
+        so_doc = so_ref.get()
+        if not so_doc.exists or so_doc.to_dict().get("company_id") not in (None, company_id):
+            raise ValueError("Sales order not found")
+        if so_doc.to_dict().get("status") in ("DELIVERED", "INVOICED"):
+            raise ValueError("Delivered sales orders cannot be cancelled")
+        ReservationService().release(company_id, "SO", so_id)
+        so_ref.update({"status": "CANCELLED", "updated_at": firestore.SERVER_TIMESTAMP})
+        return {"status": "cancelled", "id": so_id}
+
     def list_sales_orders(self, status: str = None, limit: int = 50) -> list:
         """List sales orders."""
         query = self.db.collection("sales_orders").order_by("created_at", direction=firestore.Query.DESCENDING)
@@ -89,11 +106,12 @@ class PurchaseOrderService:
     def __init__(self):
         self.db = get_db()
     
-    def create_purchase_order(self, data: dict) -> str:
-        """Create a new purchase order (طلب شراء)."""
+    def create_purchase_order(self, data: dict, company_id: str = None) -> str:
+        """Create a new purchase order (طلب شراء) for the caller's company (overrides any company_id in data)."""
         doc_ref = self.db.collection("purchase_orders").document()
         po = {
             "number": data.get("number", f"PO-{datetime.now().strftime('%Y%m%d%H%M%S')}"),
+            "company_id": company_id or data.get("company_id"),
             "supplier_name": data.get("supplier_name"),
             "supplier_account_id": data.get("supplier_account_id"),
             "lines": data.get("lines", []),
@@ -26,6 +26,7 @@ def seed_iraqi_coa():
         {"code": "5", "name_en": "Expenses", "name_ar": "المصروفات", "type": "EXPENSE", "is_group": True},
         {"code": "51", "name_en": "Cost of Goods Sold (COGS)", "name_ar": "كلفة البضاعة المباعة", "type": "EXPENSE", "is_group": False, "parent_code": "5"},
         {"code": "52", "name_en": "Administrative Expenses", "name_ar": "المصروفات الإدارية", "type": "EXPENSE", "is_group": False, "parent_code": "5"},
+        {"code": "53", "name_en": "Inventory Variance", "name_ar": "فروقات الجرد", "type": "EXPENSE", "is_group": False, "parent_code": "5"},
     ]
     
     created_count = 0
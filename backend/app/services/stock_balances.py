@@ -0,0 +1,314 @@
+"""
+Stock Balances Service
+Per item and warehouse quantity with min/max levels and low-stock alerts:
+
+    stock_balances/{item}_{warehouse}     qty, min_qty, max_qty, below_min,
+                                          reserved_qty, inbound_qty, atp
+    stock_alerts/{item}_{warehouse}       raised when qty falls below min_qty,
+                                          cleared when it is back at or above it
+
+reserved_qty and inbound_qty are the open outbound / inbound reservations
+(see ReservationService); atp = qty - reserved_qty + inbound_qty is kept in
+step with every change, so an ATP lookup is a plain document read.
+
+Balances are updated by every stock movement inside its posting transaction
+(PostingEngine.record_stock_movement and the GRN/DO write phases), so the
+low-stock list is one indexed query on (company_id, below_min) and the alert
+feed one query on stock_alerts - neither scans the item catalog.
+
+Like items, a balance must be read in the read phase of the transaction
+(get_for_transaction) and is then updated in place by apply(), so several
+movements of one transaction chain correctly.
+"""
+from decimal import Decimal
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from google.cloud import firestore
+from app.core.firebase import get_db, stream_paged
+
+ZERO = Decimal("0")
+
+
+class StockBalanceService:
+    COLLECTION = "stock_balances"
+    ALERTS_COLLECTION = "stock_alerts"
+
+    def __init__(self):
+        self.db = get_db()
+
+    @staticmethod
+    def balance_id(item_id: str, warehouse_id: Optional[str]) -> str:
+        return f"{item_id}_{warehouse_id or '-'}"
+
+    @staticmethod
+    def _level(value) -> Optional[Decimal]:
+        return Decimal(str(value)) if value not in (None, "") else None
+
+    @classmethod
+    def is_below_min(cls, qty: Decimal, min_qty) -> bool:
+        level = cls._level(min_qty)
+        return level is not None and qty < level
+
+    @staticmethod
+    def figure(balance: Dict[str, Any], field: str) -> Decimal:
+        return Decimal(str(balance.get(field) or "0"))
+
+    @classmethod
+    def free_qty(cls, balance: Dict[str, Any]) -> Decimal:
+        """On hand not promised to an open reservation (what an unreserved issue may take)."""
+        return cls.figure(balance, "qty") - cls.figure(balance, "reserved_qty")
+
+    @classmethod
+    def atp(cls, balance: Dict[str, Any]) -> Decimal:
+        return cls.free_qty(balance) + cls.figure(balance, "inbound_qty")
+
+    # ==========================================================================
+    # READ PHASE
+    # ==========================================================================
+    def get_for_transaction(self, transaction, pairs: Iterable[Tuple[str, Optional[str]]]) -> Dict[str, Dict[str, Any]]:
+        """Pre-fetch the balances of (item_id, warehouse_id) pairs; missing balances map to {}."""
+        ids = sorted({self.balance_id(item_id, wh) for item_id, wh in pairs if item_id})
+        if not ids:
+            return {}
+        refs = [self.db.collection(self.COLLECTION).document(i) for i in ids]
+        return {snap.id: snap.to_dict() or {} for snap in self.db.get_all(refs, transaction=transaction)}
+
+    # ==========================================================================
+    # WRITE PHASE (no reads)
+    # ==========================================================================
+    def _write_alert(self, transaction, balance_id: str, balance: Dict[str, Any], raised: bool):
+        ref = self.db.collection(self.ALERTS_COLLECTION).document(balance_id)
+        if raised:
+            min_qty = self._level(balance.get("min_qty"))
+            max_qty = self._level(balance.get("max_qty"))
+            qty = Decimal(balance["qty"])
+            transaction.set(ref, {
+                "company_id": balance.get("company_id"),
+                "item_id": balance.get("item_id"),
+                "warehouse_id": balance.get("warehouse_id"),
+                "sku": balance.get("sku"),
+                "name": balance.get("name"),
+                "qty": str(qty),
+                "min_qty": str(min_qty),
+                "max_qty": str(max_qty) if max_qty is not None else None,
+                "suggested_qty": str(max(max_qty - qty, ZERO)) if max_qty is not None else str(min_qty - qty),
+                "status": "OPEN",
+                "is_open": True,
+                "raised_at": firestore.SERVER_TIMESTAMP,
+                "cleared_at": None
+            })
+        else:
+            transaction.set(ref, {
+                "qty": balance["qty"],
+                "status": "CLEARED",
+                "is_open": False,
+                "cleared_at": firestore.SERVER_TIMESTAMP
+            }, merge=True)
+
+    def _write(self, transaction, balance_id: str, balance: Dict[str, Any], fields: Dict[str, Any]):
+        """Store a balance, keep below_min in sync and raise/clear its alert on a crossing."""
+        was_below = bool(balance.get("below_min"))
+        balance.update(fields)
+        balance["below_min"] = self.is_below_min(Decimal(balance.get("qty", "0")), balance.get("min_qty"))
+        balance["atp"] = str(self.atp(balance))
+        transaction.set(self.db.collection(self.COLLECTION).document(balance_id), {
+            **fields,
+            "below_min": balance["below_min"],
+            "atp": balance["atp"],
+            "updated_at": firestore.SERVER_TIMESTAMP
+        }, merge=True)
+        if balance["below_min"] != was_below:
+            self._write_alert(transaction, balance_id, balance, balance["below_min"])
+
+    def apply(
+        self,
+        transaction,
+        balances: Dict[str, Dict[str, Any]],
+        company_id: Optional[str],
+        item_id: str,
+        warehouse_id: Optional[str],
+        quantity: Decimal,
+        item_data: Optional[Dict[str, Any]] = None,
+        reserved_delta: Decimal = ZERO,
+        inbound_delta: Decimal = ZERO
+    ):
+        """
+        Add a movement (and/or a change of reserved / inbound quantity) to its
+        balance, pre-fetched into `balances` and updated in place.
+        """
+        if not company_id or not item_id:
+            return
+        balance_id = self.balance_id(item_id, warehouse_id)
+        balance = balances.setdefault(balance_id, {})
+        fields = {
+            "company_id": company_id,
+            "item_id": item_id,
+            "warehouse_id": warehouse_id or "",
+            "qty": str(self.figure(balance, "qty") + Decimal(str(quantity)))
+        }
+        if reserved_delta:
+            fields["reserved_qty"] = str(max(self.figure(balance, "reserved_qty") + reserved_delta, ZERO))
+        if inbound_delta:
+            fields["inbound_qty"] = str(max(self.figure(balance, "inbound_qty") + inbound_delta, ZERO))
+        if item_data:
+            fields["sku"] = item_data.get("sku")
+            fields["name"] = item_data.get("name")
+        self._write(transaction, balance_id, balance, fields)
+
+    # ==========================================================================
+    # SETTINGS
+    # ==========================================================================
+    def set_levels(self, company_id: str, item_id: str, warehouse_id: Optional[str], min_qty=None, max_qty=None) -> Dict[str, Any]:
+        """Set min/max for an item in a warehouse (None clears a level) and re-evaluate its alert."""
+        min_level, max_level = self._level(min_qty), self._level(max_qty)
+        if min_level is not None and min_level < 0:
+            raise ValueError("min_qty cannot be negative")
+        if min_level is not None and max_level is not None and max_level < min_level:
+            raise ValueError("max_qty must be greater than or equal to min_qty")
+
+        item_ref = self.db.collection("items").document(item_id)
+        transaction = self.db.transaction()
+
+        @firestore.transactional
+        def _execute(transaction):
+            # PHASE 1: READ
+            item_data = item_ref.get(transaction=transaction).to_dict()
+            if not item_data or item_data.get("company_id") != company_id:
+                raise ValueError(f"Item {item_id} not found")
+            balances = self.get_for_transaction(transaction, [(item_id, warehouse_id)])
+
+            # PHASE 3: WRITE
+            balance_id = self.balance_id(item_id, warehouse_id)
+            balance = balances.setdefault(balance_id, {})
+            self._write(transaction, balance_id, balance, {
+                "company_id": company_id,
+                "item_id": item_id,
+                "warehouse_id": warehouse_id or "",
+                "sku": item_data.get("sku"),
+                "name": item_data.get("name"),
+                "qty": balance.get("qty", "0"),
+                "min_qty": str(min_level) if min_level is not None else None,
+                "max_qty": str(max_level) if max_level is not None else None
+            })
+            return {"id": balance_id, **balance}
+
+        return _execute(transaction)
+
+    def rebuild(self, company_id: str) -> Dict[str, Any]:
+        """
+        Reset every balance of the company to the ledger position as of today
+        (for balances that predate this collection); levels are kept and
+        alerts re-evaluated.
+        """
+        from .valuation import get_valuation_service
+        positions, meta = get_valuation_service().positions_as_of(company_id)
+
+        existing = {
+            snap.id: snap.to_dict()
+            for snap in stream_paged(self.db.collection(self.COLLECTION).where("company_id", "==", company_id), page_size=1000)
+        }
+        targets: Dict[str, Dict[str, Any]] = {}
+        for (item_id, wh), pos in positions.items():
+            info = meta.get(item_id, {})
+            targets[self.balance_id(item_id, wh)] = {
+                "company_id": company_id, "item_id": item_id, "warehouse_id": wh,
+                "sku": info.get("sku"), "name": info.get("name"), "qty": str(pos["qty"])
+            }
+        for balance_id in existing:
+            # Balances with no ledger movement left (or levels set before any movement) drop to zero
+            targets.setdefault(balance_id, {"qty": "0"})
+
+        changed = alerts = 0
+        ids = sorted(targets)
+        for start in range(0, len(ids), 200):
+            batch = self.db.batch()
+            for balance_id in ids[start:start + 200]:
+                balance = dict(existing.get(balance_id, {}))
+                fields = targets[balance_id]
+                if balance and balance.get("qty") == fields["qty"]:
+                    continue
+                was_below = bool(balance.get("below_min"))
+                self._write(batch, balance_id, balance, fields)
+                changed += 1
+                alerts += balance["below_min"] != was_below
+            batch.commit()
+        return {"company_id": company_id, "balances": len(ids), "updated": changed, "alerts_changed": alerts}
+
+    # ==========================================================================
+    # READS
+    # ==========================================================================
+    def get_low_stock(self, company_id: str, warehouse_id: Optional[str] = None, limit: int = 500) -> List[Dict[str, Any]]:
+        """Balances currently below their minimum (one indexed query)."""
+        query = self.db.collection(self.COLLECTION)\
+            .where("company_id", "==", company_id)\
+            .where("below_min", "==", True)
+        if warehouse_id:
+            query = query.where("warehouse_id", "==", warehouse_id)
+        return [{"id": d.id, **d.to_dict()} for d in query.limit(limit).stream()]
+
+    def get_atp(self, company_id: str, pairs: List[Tuple[str, str]]) -> List[Dict[str, Any]]:
+        """On hand, reserved, inbound and ATP for (item_id, warehouse_id) pairs from one batched read."""
+        ids = [self.balance_id(item_id, wh) for item_id, wh in pairs]
+        refs = [self.db.collection(self.COLLECTION).document(i) for i in dict.fromkeys(ids)]
+        found = {}
+        for snap in self.db.get_all(refs):
+            data = snap.to_dict() or {}
+            if snap.exists and data.get("company_id") == company_id:
+                found[snap.id] = data
+        results = []
+        for (item_id, wh), balance_id in zip(pairs, ids):
+            balance = found.get(balance_id, {})
+            results.append({
+                "item_id": item_id,
+                "warehouse_id": wh,
+                "on_hand": str(self.figure(balance, "qty")),
+                "reserved": str(self.figure(balance, "reserved_qty")),
+                "inbound": str(self.figure(balance, "inbound_qty")),
+                "available": str(self.free_qty(balance)),
+                "atp": str(self.atp(balance)),
+                "tracked": bool(balance)
+            })
+        return results
+
+    def get_for_items(self, company_id: str, item_ids: List[str], warehouse_id: Optional[str] = None) -> Dict[str, List[Dict[str, Any]]]:
+        """Item id -> its balances (every warehouse, or only warehouse_id), with available/ATP."""
+        if warehouse_id:
+            refs = [self.db.collection(self.COLLECTION).document(self.balance_id(i, warehouse_id)) for i in dict.fromkeys(item_ids)]
+            snaps = [s for s in self.db.get_all(refs) if s.exists] if refs else []
+        else:
+            snaps = []
+            ids = list(dict.fromkeys(item_ids))
+            for start in range(0, len(ids), 30):
+                query = self.db.collection(self.COLLECTION)\
+                    .where("company_id", "==", company_id)\
+                    .where("item_id", "in", ids[start:start + 30])
+                snaps.extend(query.stream())
+        stock: Dict[str, List[Dict[str, Any]]] = {}
+        for snap in snaps:
+            balance = snap.to_dict() or {}
+            if balance.get("company_id") != company_id:
+                continue
+            stock.setdefault(balance["item_id"], []).append({
+                "warehouse_id": balance.get("warehouse_id"),
+                "on_hand": str(self.figure(balance, "qty")),
+                "available": str(self.free_qty(balance)),
+                "atp": str(self.atp(balance))
+            })
+        return stock
+
+    def count_low_stock(self, company_id: str) -> int:
+        query = self.db.collection(self.COLLECTION)\
+            .where("company_id", "==", company_id)\
+            .where("below_min", "==", True)
+        return query.count().get()[0][0].value
+
+    def get_alerts(self, company_id: str, open_only: bool = False, limit: int = 50) -> List[Dict[str, Any]]:
+        """Alert feed, most recently raised first."""
+        query = self.db.collection(self.ALERTS_COLLECTION).where("company_id", "==", company_id)
+        if open_only:
+            query = query.where("is_open", "==", True)
+        query = query.order_by("raised_at", direction=firestore.Query.DESCENDING).limit(limit)
+        return [{"id": d.id, **d.to_dict()} for d in query.stream()]
+
+
+def get_stock_balance_service() -> StockBalanceService:
+    return StockBalanceService()
@@ -0,0 +1,417 @@
+"""
+Stock Movement Rollups Service
+Per item and warehouse movement totals, by day and by month:
+
+    stock_daily_rollups/{company}_{item}_{warehouse}_{yyyy-mm-dd}
+    stock_monthly_rollups/{company}_{item}_{warehouse}_{yyyy-mm}
+
+Each document carries in/out quantity and value plus the same four figures per
+source_document_type (by_type.GRN.in_qty, by_type.DO.out_value, ...). Both
+levels are incremented inside the posting transactions next to daily_rollups,
+so movement, turnover and dead-stock reports read one small document per item,
+warehouse and period instead of streaming stock_ledger.
+
+A report over [start, end] reads monthly documents for the whole months in the
+range and daily documents only for the partial months at its edges, so years of
+history cost a few hundred reads per item at most.
+"""
+from datetime import date, datetime, time, timedelta, timezone
+from decimal import Decimal
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from google.cloud import firestore
+from app.core.firebase import get_db, stream_paged
+from .rollups import as_day
+
+ZERO = Decimal("0")
+MOVEMENT_FIELDS = ("in_qty", "in_value", "out_qty", "out_value")
+Key = Tuple[str, str]
+
+
+def _month_start(day: date) -> date:
+    return day.replace(day=1)
+
+
+def _next_month(day: date) -> date:
+    return (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+def split_range(start: date, end: date) -> List[Tuple[str, str, str]]:
+    """
+    Split [start, end] into ("day", from, to) edges and one ("month", from, to)
+    span of whole months, as inclusive ISO keys of the matching collection.
+    """
+    first_full = start if start.day == 1 else _next_month(start)
+    after_last_full = _month_start(end) if _next_month(end) - timedelta(days=1) != end else _next_month(end)
+    if first_full >= after_last_full:
+        return [("day", start.isoformat(), end.isoformat())]
+
+    segments = []
+    if start < first_full:
+        segments.append(("day", start.isoformat(), (first_full - timedelta(days=1)).isoformat()))
+    last_full = after_last_full - timedelta(days=1)
+    segments.append(("month", first_full.isoformat()[:7], last_full.isoformat()[:7]))
+    if after_last_full <= end:
+        segments.append(("day", after_last_full.isoformat(), end.isoformat()))
+    return segments
+
+
+class StockRollupService:
+    DAILY_COLLECTION = "stock_daily_rollups"
+    MONTHLY_COLLECTION = "stock_monthly_rollups"
+
+    # Internal movements: shown in movement reports, ignored by turnover
+    TRANSFER_DOC_TYPES = {"TRF", "TRANSFER_IN", "TRANSFER_OUT"}
+    # Outbound movements that send stock back rather than consume it
+    NON_CONSUMPTION_OUT_TYPES = {"PURCHASE_RETURN", "GRN_VOID"}
+    # Inbound movements that undo an issue (customer returns, voided deliveries)
+    ISSUE_REVERSAL_TYPES = {"RETURN", "DO_VOID"}
+
+    def __init__(self):
+        self.db = get_db()
+
+    @staticmethod
+    def daily_key(company_id: str, item_id: str, warehouse_id: Optional[str], day: date) -> str:
+        return f"{company_id}_{item_id}_{warehouse_id or '-'}_{day.isoformat()}"
+
+    @staticmethod
+    def monthly_key(company_id: str, item_id: str, warehouse_id: Optional[str], day: date) -> str:
+        return f"{company_id}_{item_id}_{warehouse_id or '-'}_{day.isoformat()[:7]}"
+
+    # ==========================================================================
+    # DELTA CALCULATION (pure, shared by live posting and rebuild)
+    # ==========================================================================
+    @staticmethod
+    def movement_deltas(quantity: Decimal, unit_value: Decimal) -> Dict[str, Decimal]:
+        """In/out quantity and value of one movement (both reported positive)."""
+        quantity = Decimal(str(quantity))
+        if not quantity:
+            return {}
+        value = abs(quantity * Decimal(str(unit_value)))
+        if quantity > 0:
+            return {"in_qty": quantity, "in_value": value}
+        return {"out_qty": -quantity, "out_value": value}
+
+    # ==========================================================================
+    # TRANSACTIONAL WRITES (no reads: safe after any other write)
+    # ==========================================================================
+    def _increment(self, transaction, company_id: str, item_id: str, warehouse_id: Optional[str], day: date,
+                   doc_type: Optional[str], deltas: Dict[str, Decimal], count: int):
+        type_key = doc_type or "OTHER"
+        base = {"company_id": company_id, "item_id": item_id, "warehouse_id": warehouse_id or ""}
+        increments = {field: firestore.Increment(float(value)) for field, value in deltas.items()}
+        if count:
+            increments["movement_count"] = firestore.Increment(count)
+
+        targets = (
+            (self.DAILY_COLLECTION, self.daily_key(company_id, item_id, warehouse_id, day), {"date": day.isoformat()}),
+            (self.MONTHLY_COLLECTION, self.monthly_key(company_id, item_id, warehouse_id, day), {"month": day.isoformat()[:7]}),
+        )
+        for collection, key, period in targets:
+            transaction.set(self.db.collection(collection).document(key), {
+                **base,
+                **period,
+                **increments,
+                "by_type": {type_key: dict(increments)},
+                "updated_at": firestore.SERVER_TIMESTAMP
+            }, merge=True)
+
+    def apply(self, transaction, company_id: str, item_id: str, warehouse_id: Optional[str], movement_date,
+              quantity: Decimal, unit_value: Decimal, doc_type: Optional[str] = None):
+        """Add a stock movement to its item's daily and monthly rollups inside the posting transaction."""
+        deltas = self.movement_deltas(quantity, unit_value)
+        if not company_id or not item_id or not deltas:
+            return
+        self._increment(transaction, company_id, item_id, warehouse_id, as_day(movement_date), doc_type, deltas, 1)
+
+    def apply_revaluation(self, transaction, company_id: str, item_id: str, warehouse_id: Optional[str], movement_date,
+                          doc_type: Optional[str], in_value_delta: Decimal = ZERO, out_value_delta: Decimal = ZERO):
+        """Correct the values of already counted movements after they were re-costed."""
+        deltas = {k: v for k, v in (("in_value", in_value_delta), ("out_value", out_value_delta)) if v}
+        if not company_id or not item_id or not deltas:
+            return
+        self._increment(transaction, company_id, item_id, warehouse_id, as_day(movement_date), doc_type, deltas, 0)
+
+    # ==========================================================================
+    # READS
+    # ==========================================================================
+    def _read_segment(self, company_id: str, level: str, lo: str, hi: str, item_id: Optional[str]) -> Iterable[Dict[str, Any]]:
+        collection, field = (self.DAILY_COLLECTION, "date") if level == "day" else (self.MONTHLY_COLLECTION, "month")
+        query = self.db.collection(collection).where("company_id", "==", company_id)
+        if item_id:
+            query = query.where("item_id", "==", item_id)
+        query = query.where(field, ">=", lo).where(field, "<=", hi)
+        for snap in stream_paged(query, page_size=1000):
+            yield snap.to_dict()
+
+    def _aggregate(self, company_id: str, start: date, end: date, item_id: Optional[str] = None,
+                   warehouse_id: Optional[str] = None) -> Tuple[Dict[Key, Dict[str, Any]], int]:
+        """Sum the rollups of [start, end] per (item, warehouse), with per-type detail."""
+        totals: Dict[Key, Dict[str, Any]] = {}
+        reads = 0
+        for level, lo, hi in split_range(start, end):
+            for doc in self._read_segment(company_id, level, lo, hi, item_id):
+                reads += 1
+                wh = doc.get("warehouse_id") or ""
+                if warehouse_id and wh != warehouse_id:
+                    continue
+                bucket = totals.setdefault((doc["item_id"], wh), {"movement_count": 0, "by_type": {}})
+                bucket["movement_count"] += int(doc.get("movement_count", 0) or 0)
+                for field in MOVEMENT_FIELDS:
+                    bucket[field] = bucket.get(field, ZERO) + Decimal(str(doc.get(field, 0) or 0))
+                for doc_type, figures in (doc.get("by_type") or {}).items():
+                    type_bucket = bucket["by_type"].setdefault(doc_type, {})
+                    for field in MOVEMENT_FIELDS:
+                        type_bucket[field] = type_bucket.get(field, ZERO) + Decimal(str(figures.get(field, 0) or 0))
+        return totals, reads
+
+    @classmethod
+    def issue_totals(cls, by_type: Dict[str, Dict[str, Any]]) -> Tuple[Decimal, Decimal]:
+        """Quantity and cost issued to consumption, net of returns and voided deliveries."""
+        qty = value = ZERO
+
+        def figure(figures: Dict[str, Any], field: str) -> Decimal:
+            return Decimal(str(figures.get(field, 0) or 0))
+
+        for doc_type, figures in by_type.items():
+            if doc_type in cls.TRANSFER_DOC_TYPES:
+                continue
+            if doc_type not in cls.NON_CONSUMPTION_OUT_TYPES:
+                qty += figure(figures, "out_qty")
+                value += figure(figures, "out_value")
+            if doc_type in cls.ISSUE_REVERSAL_TYPES:
+                qty -= figure(figures, "in_qty")
+                value -= figure(figures, "in_value")
+        return qty, value
+
+    def get_movement_report(self, company_id: str, start, end, item_id: Optional[str] = None,
+                            warehouse_id: Optional[str] = None) -> Dict[str, Any]:
+        """In/out quantity and value per item and warehouse over [start, end], split by source document type."""
+        start, end = as_day(start), as_day(end)
+        if start > end:
+            raise ValueError("start must be on or before end")
+        totals, reads = self._aggregate(company_id, start, end, item_id, warehouse_id)
+
+        rows = []
+        for (item, wh), bucket in sorted(totals.items()):
+            rows.append({
+                "item_id": item,
+                "warehouse_id": wh,
+                "movement_count": bucket["movement_count"],
+                **{field: str(bucket.get(field, ZERO)) for field in MOVEMENT_FIELDS},
+                "by_type": {
+                    doc_type: {field: str(v) for field, v in figures.items()}
+                    for doc_type, figures in sorted(bucket["by_type"].items())
+                }
+            })
+        return {"from": start.isoformat(), "to": end.isoformat(), "rollups_read": reads, "rows": rows}
+
+    def _item_stats(self, company_id: str, start: date, end: date, warehouse_id: Optional[str]) -> Dict[str, Dict[str, Any]]:
+        """Per item: closing position (end of `end`), net movement and issues over [start, end]."""
+        from .valuation import get_valuation_service
+        positions, meta = get_valuation_service().positions_as_of(company_id, end)
+        totals, _ = self._aggregate(company_id, start, end, warehouse_id=warehouse_id)
+
+        stats: Dict[str, Dict[str, Any]] = {}
+
+        def entry(item_id: str) -> Dict[str, Any]:
+            return stats.setdefault(item_id, {
+                "closing_qty": ZERO, "closing_value": ZERO, "net_qty": ZERO, "net_value": ZERO,
+                "issue_qty": ZERO, "issue_value": ZERO, "movement_count": 0
+            })
+
+        for (item_id, wh), pos in positions.items():
+            if warehouse_id and wh != warehouse_id:
+                continue
+            s = entry(item_id)
+            s["closing_qty"] += pos["qty"]
+            s["closing_value"] += pos["value"]
+        for (item_id, _), bucket in totals.items():
+            s = entry(item_id)
+            s["net_qty"] += bucket.get("in_qty", ZERO) - bucket.get("out_qty", ZERO)
+            s["net_value"] += bucket.get("in_value", ZERO) - bucket.get("out_value", ZERO)
+            qty, value = self.issue_totals(bucket["by_type"])
+            s["issue_qty"] += qty
+            s["issue_value"] += value
+            s["movement_count"] += bucket["movement_count"]
+
+        days = (end - start).days + 1
+        for item_id, s in stats.items():
+            info = meta.get(item_id, {})
+            s["sku"] = info.get("sku")
+            s["name"] = info.get("name")
+            s["opening_qty"] = s["closing_qty"] - s["net_qty"]
+            s["opening_value"] = s["closing_value"] - s["net_value"]
+            avg_value = (s["opening_value"] + s["closing_value"]) / 2
+            s["average_value"] = avg_value
+            s["turnover"] = s["issue_value"] / avg_value if avg_value > 0 else None
+            daily_issue = s["issue_qty"] / days
+            s["days_of_cover"] = s["closing_qty"] / daily_issue if daily_issue > 0 else None
+        return stats
+
+    @staticmethod
+    def _row(item_id: str, s: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "item_id": item_id,
+            "sku": s.get("sku"),
+            "name": s.get("name"),
+            "opening_qty": str(s["opening_qty"]),
+            "closing_qty": str(s["closing_qty"]),
+            "closing_value": str(s["closing_value"]),
+            "average_value": str(s["average_value"]),
+            "issue_qty": str(s["issue_qty"]),
+            "issue_value": str(s["issue_value"]),
+            "turnover": str(round(s["turnover"], 4)) if s["turnover"] is not None else None,
+            "days_of_cover": str(round(s["days_of_cover"], 1)) if s["days_of_cover"] is not None else None
+        }
+
+    def get_turnover_report(self, company_id: str, start, end, warehouse_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Inventory turnover (cost issued / average stock value) and days of cover
+        (closing quantity / average daily issue) per item over [start, end].
+        """
+        start, end = as_day(start), as_day(end)
+        if start > end:
+            raise ValueError("start must be on or before end")
+        stats = self._item_stats(company_id, start, end, warehouse_id)
+        rows = [self._row(item_id, s) for item_id, s in sorted(stats.items())
+                if s["closing_qty"] or s["opening_qty"] or s["issue_qty"]]
+
+        issue_value = sum((s["issue_value"] for s in stats.values()), ZERO)
+        avg_value = sum((s["average_value"] for s in stats.values()), ZERO)
+        return {
+            "from": start.isoformat(),
+            "to": end.isoformat(),
+            "warehouse_id": warehouse_id,
+            "rows": rows,
+            "total_issue_value": str(issue_value),
+            "total_average_value": str(avg_value),
+            "turnover": str(round(issue_value / avg_value, 4)) if avg_value > 0 else None
+        }
+
+    def get_slow_movers(self, company_id: str, as_of=None, window_days: int = 90, min_cover_days: int = 180,
+                        warehouse_id: Optional[str] = None) -> Dict[str, Any]:
+        """Items in stock that did move in the window, but whose stock covers at least `min_cover_days`."""
+        if window_days < 1:
+            raise ValueError("window_days must be at least 1")
+        end = as_day(as_of)
+        start = end - timedelta(days=window_days - 1)
+        stats = self._item_stats(company_id, start, end, warehouse_id)
+        rows = [
+            self._row(item_id, s) for item_id, s in stats.items()
+            if s["closing_qty"] > 0 and s["days_of_cover"] is not None and s["days_of_cover"] >= min_cover_days
+        ]
+        rows.sort(key=lambda r: Decimal(r["days_of_cover"]), reverse=True)
+        return {"as_of": end.isoformat(), "window_days": window_days, "min_cover_days": min_cover_days, "rows": rows}
+
+    def get_dead_stock(self, company_id: str, as_of=None, window_days: int = 365,
+                       warehouse_id: Optional[str] = None) -> Dict[str, Any]:
+        """Items still in stock with no issue at all during the `window_days` up to `as_of`."""
+        if window_days < 1:
+            raise ValueError("window_days must be at least 1")
+        end = as_day(as_of)
+        start = end - timedelta(days=window_days - 1)
+        stats = self._item_stats(company_id, start, end, warehouse_id)
+        rows = [self._row(item_id, s) for item_id, s in stats.items() if s["closing_qty"] > 0 and s["issue_qty"] <= 0]
+        rows.sort(key=lambda r: Decimal(r["closing_value"]), reverse=True)
+        return {
+            "as_of": end.isoformat(),
+            "window_days": window_days,
+            "rows": rows,
+            "total_value": str(sum((Decimal(r["closing_value"]) for r in rows), ZERO))
+        }
+
+    # ==========================================================================
+    # BACKFILL
+    # ==========================================================================
+    def rebuild(self, company_id: str, from_date: Optional[date] = None, to_date: Optional[date] = None) -> Dict[str, Any]:
+        """
+        Rebuild item rollups from stock_ledger. The range is widened to whole
+        months so monthly documents stay complete; rollups inside it with no
+        movement left are deleted.
+        """
+        lo = _month_start(from_date) if from_date else None
+        hi = _next_month(to_date) - timedelta(days=1) if to_date else None
+
+        def in_range(day: date) -> bool:
+            return (lo is None or day >= lo) and (hi is None or day <= hi)
+
+        daily: Dict[str, Dict[str, Any]] = {}
+        monthly: Dict[str, Dict[str, Any]] = {}
+
+        def add(docs: Dict[str, Dict[str, Any]], key: str, header: Dict[str, Any], doc_type: str, deltas: Dict[str, Decimal]):
+            doc = docs.setdefault(key, {**header, "movement_count": 0, "by_type": {}})
+            doc["movement_count"] += 1
+            type_doc = doc["by_type"].setdefault(doc_type, {"movement_count": 0})
+            type_doc["movement_count"] += 1
+            for field, value in deltas.items():
+                doc[field] = doc.get(field, ZERO) + value
+                type_doc[field] = type_doc.get(field, ZERO) + value
+
+        moves = 0
+        from .archive import ArchiveService
+        query = self.db.collection("stock_ledger").where("company_id", "==", company_id)
+        bounds = [datetime.combine(d, time.min, tzinfo=timezone.utc) if d else None for d in (lo, hi and hi + timedelta(days=1))]
+        for snap in ArchiveService().read_through(company_id, "stock_ledger", stream_paged(query, page_size=1000), *bounds):
+            row = snap.to_dict()
+            day = as_day(row.get("posting_date") or row.get("timestamp"))
+            item_id = row.get("item_id")
+            if not item_id or not in_range(day):
+                continue
+            qty = Decimal(str(row.get("quantity", "0") or "0"))
+            rate = row.get("unit_cost") if qty > 0 else row.get("valuation_rate")
+            deltas = self.movement_deltas(qty, Decimal(str(rate or "0")))
+            if not deltas:
+                continue
+            wh = row.get("warehouse_id")
+            header = {"company_id": company_id, "item_id": item_id, "warehouse_id": wh or ""}
+            doc_type = row.get("source_document_type") or "OTHER"
+            add(daily, self.daily_key(company_id, item_id, wh, day), {**header, "date": day.isoformat()}, doc_type, deltas)
+            add(monthly, self.monthly_key(company_id, item_id, wh, day), {**header, "month": day.isoformat()[:7]}, doc_type, deltas)
+            moves += 1
+
+        def to_payload(doc: Dict[str, Any]) -> Dict[str, Any]:
+            return {k: float(v) if isinstance(v, Decimal) else (to_payload(v) if isinstance(v, dict) else v)
+                    for k, v in doc.items()}
+
+        written = cleared = 0
+        batch = self.db.batch()
+        pending = 0
+        for collection, docs, field in ((self.DAILY_COLLECTION, daily, "date"), (self.MONTHLY_COLLECTION, monthly, "month")):
+            ref = self.db.collection(collection)
+            stale = []
+            for snap in stream_paged(ref.where("company_id", "==", company_id), page_size=1000):
+                period = snap.to_dict().get(field, "")
+                day = date.fromisoformat(period if field == "date" else f"{period}-01")
+                if snap.id not in docs and in_range(day):
+                    stale.append(snap.id)
+
+            ops = [(key, payload) for key, payload in docs.items()] + [(key, None) for key in stale]
+            for key, payload in ops:
+                if payload is None:
+                    batch.delete(ref.document(key))
+                    cleared += 1
+                else:
+                    batch.set(ref.document(key), {**to_payload(payload), "updated_at": firestore.SERVER_TIMESTAMP})
+                    written += 1
+                pending += 1
+                if pending >= 450:
+                    batch.commit()
+                    batch = self.db.batch()
+                    pending = 0
+        if pending:
+            batch.commit()
+
+        return {
+            "company_id": company_id,
+            "from": lo.isoformat() if lo else None,
+            "to": hi.isoformat() if hi else None,
+            "movements_scanned": moves,
+            "daily_rollups": len(daily),
+            "monthly_rollups": len(monthly),
+            "documents_written": written,
+            "documents_cleared": cleared
+        }
+
+
+def get_stock_rollup_service() -> StockRollupService:
+    return StockRollupService()
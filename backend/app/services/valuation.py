@@ -0,0 +1,274 @@
+"""
+Inventory Valuation Service
+As-of-date stock valuation per item, warehouse and storage type.
+
+items.current_qty / total_value only describe today, so historical valuation is
+built from stock snapshots plus the stock ledger:
+
+    stock_snapshots/{company}_{YYYY-MM-DD}            header (status, row count)
+    stock_snapshots/{id}/chunks/{0000..}              rows: item, warehouse, qty, value
+                                                      (+ sku/name/storage type/account)
+
+A valuation as of day D loads the latest READY snapshot on or before D (a few
+chunk reads, no item reads) and replays only the stock_ledger rows posted
+after it, up to the end of D. Row values follow the ledger (IN at unit_cost,
+OUT at the rate it was issued), so per-warehouse values add up to items.total_value.
+
+Snapshots are taken when a fiscal period is closed (as of its last day) or on
+demand. A back-dated movement marks the snapshots it falls before as STALE;
+they are skipped until taken again.
+"""
+from datetime import date, datetime, time, timedelta, timezone
+from decimal import Decimal
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from google.cloud import firestore
+from app.core.firebase import get_db, stream_paged
+from .rollups import as_day
+from .archive import ArchiveService
+from .journal_lines import get_journal_line_store
+
+ZERO = Decimal("0")
+Key = Tuple[str, str]
+
+
+def _day_end(day: date) -> datetime:
+    """Exclusive upper bound of a calendar day (UTC)."""
+    return datetime.combine(day + timedelta(days=1), time.min, tzinfo=timezone.utc)
+
+
+class InventoryValuationService:
+    SNAPSHOTS_COLLECTION = "stock_snapshots"
+    CHUNK_ROWS = 1500
+    INVENTORY_CODE_PREFIX = "121"
+    TOLERANCE = Decimal("0.01")
+
+    def __init__(self):
+        self.db = get_db()
+        self.archive = ArchiveService()
+
+    @staticmethod
+    def snapshot_id(company_id: str, day: date) -> str:
+        return f"{company_id}_{day.isoformat()}"
+
+    # ==========================================================================
+    # LEDGER REPLAY
+    # ==========================================================================
+    @staticmethod
+    def _movement(row: Dict[str, Any]) -> Tuple[Decimal, Decimal]:
+        qty = Decimal(str(row.get("quantity", "0") or "0"))
+        rate = row.get("unit_cost") if qty > 0 else row.get("valuation_rate")
+        return qty, qty * Decimal(str(rate or "0"))
+
+    def _ledger_rows(self, company_id: str, after: Optional[date], until: date) -> Iterable[Dict[str, Any]]:
+        """Ledger rows of the company posted after `after` (exclusive) up to the end of `until`."""
+        ref = self.db.collection("stock_ledger").where("company_id", "==", company_id)
+        if after is None:
+            # Full history: rows from before posting_date existed only have a timestamp
+            snaps = self.archive.read_through(company_id, "stock_ledger", stream_paged(ref, page_size=1000), end=_day_end(until))
+            for snap in snaps:
+                row = snap.to_dict()
+                if as_day(row.get("posting_date") or row.get("timestamp")) <= until:
+                    yield row
+            return
+        query = ref.where("posting_date", ">=", _day_end(after)).where("posting_date", "<", _day_end(until))
+        snaps = self.archive.read_through(company_id, "stock_ledger", stream_paged(query, page_size=1000), _day_end(after), _day_end(until))
+        for snap in snaps:
+            row = snap.to_dict()
+            # Archived ranges are inclusive at the end; keep the [after, until] day window
+            if after < as_day(row.get("posting_date")) <= until:
+                yield row
+
+    def _replay(self, positions: Dict[Key, Dict[str, Any]], rows: Iterable[Dict[str, Any]]) -> int:
+        count = 0
+        for row in rows:
+            item_id = row.get("item_id")
+            if not item_id:
+                continue
+            qty, value = self._movement(row)
+            pos = positions.setdefault((item_id, row.get("warehouse_id") or ""), {"qty": ZERO, "value": ZERO})
+            pos["qty"] += qty
+            pos["value"] += value
+            count += 1
+        return count
+
+    # ==========================================================================
+    # SNAPSHOTS
+    # ==========================================================================
+    def _latest_snapshot(self, company_id: str, day: date, inclusive: bool = True) -> Optional[Dict[str, Any]]:
+        query = self.db.collection(self.SNAPSHOTS_COLLECTION)\
+            .where("company_id", "==", company_id)\
+            .where("status", "==", "READY")\
+            .where("date", "<=" if inclusive else "<", day.isoformat())\
+            .order_by("date", direction=firestore.Query.DESCENDING)\
+            .limit(1)
+        docs = list(query.stream())
+        return {"id": docs[0].id, **docs[0].to_dict()} if docs else None
+
+    def _load_snapshot(self, snapshot: Dict[str, Any]) -> Tuple[Dict[Key, Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+        positions: Dict[Key, Dict[str, Any]] = {}
+        meta: Dict[str, Dict[str, Any]] = {}
+        chunks = self.db.collection(self.SNAPSHOTS_COLLECTION).document(snapshot["id"]).collection("chunks").stream()
+        for chunk in chunks:
+            for r in chunk.to_dict().get("rows", []):
+                positions[(r["item_id"], r["warehouse_id"])] = {"qty": Decimal(r["qty"]), "value": Decimal(r["value"])}
+                meta.setdefault(r["item_id"], {k: r.get(k) for k in ("sku", "name", "storage_type", "inventory_account_id")})
+        return positions, meta
+
+    def _item_meta(self, item_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        meta = {}
+        refs = [self.db.collection("items").document(i) for i in item_ids]
+        for start in range(0, len(refs), 300):
+            for snap in self.db.get_all(refs[start:start + 300]):
+                data = snap.to_dict() or {}
+                meta[snap.id] = {
+                    "sku": data.get("sku"),
+                    "name": data.get("name"),
+                    "storage_type": data.get("storage_type") or "OTHER",
+                    "inventory_account_id": data.get("inventory_account_id"),
+                }
+        return meta
+
+    def _positions_as_of(self, company_id: str, day: date, use_same_day: bool = True) -> Tuple[Dict[Key, Dict[str, Any]], Dict[str, Dict[str, Any]], Optional[str], int]:
+        snapshot = self._latest_snapshot(company_id, day, inclusive=use_same_day)
+        if snapshot:
+            positions, meta = self._load_snapshot(snapshot)
+            replayed = self._replay(positions, self._ledger_rows(company_id, date.fromisoformat(snapshot["date"]), day))
+        else:
+            positions, meta = {}, {}
+            replayed = self._replay(positions, self._ledger_rows(company_id, None, day))
+        missing = sorted({item_id for item_id, _ in positions if item_id not in meta})
+        if missing:
+            meta.update(self._item_meta(missing))
+        return positions, meta, snapshot["id"] if snapshot else None, replayed
+
+    def positions_as_of(self, company_id: str, as_of=None) -> Tuple[Dict[Key, Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+        """(item, warehouse) -> {qty, value} at the end of `as_of`, with item sku/name/storage type."""
+        positions, meta, _, _ = self._positions_as_of(company_id, as_day(as_of))
+        return positions, meta
+
+    def take_snapshot(self, company_id: str, as_of) -> Dict[str, Any]:
+        """Write the per-(item, warehouse) position at the end of `as_of` (replaces an existing one)."""
+        day = as_day(as_of)
+        positions, meta, base, replayed = self._positions_as_of(company_id, day, use_same_day=False)
+        snap_ref = self.db.collection(self.SNAPSHOTS_COLLECTION).document(self.snapshot_id(company_id, day))
+
+        # Readers skip the snapshot while it is rebuilt; drop chunks of a previous version
+        snap_ref.set({"company_id": company_id, "date": day.isoformat(), "status": "BUILDING"}, merge=True)
+        for old in snap_ref.collection("chunks").stream():
+            old.reference.delete()
+
+        rows = [
+            {"item_id": item_id, "warehouse_id": wh, "qty": str(pos["qty"]), "value": str(pos["value"]),
+             **meta.get(item_id, {})}
+            for (item_id, wh), pos in sorted(positions.items())
+            if pos["qty"] or pos["value"]
+        ]
+        batch = self.db.batch()
+        for n, start in enumerate(range(0, len(rows), self.CHUNK_ROWS)):
+            batch.set(snap_ref.collection("chunks").document(f"{n:04d}"), {"rows": rows[start:start + self.CHUNK_ROWS]})
+            if (n + 1) % 20 == 0:
+                batch.commit()
+                batch = self.db.batch()
+        batch.set(snap_ref, {
+            "company_id": company_id,
+            "date": day.isoformat(),
+            "status": "READY",
+            "row_count": len(rows),
+            "chunk_count": (len(rows) + self.CHUNK_ROWS - 1) // self.CHUNK_ROWS,
+            "based_on": base,
+            "ledger_rows_replayed": replayed,
+            "taken_at": firestore.SERVER_TIMESTAMP
+        })
+        batch.commit()
+        return {"snapshot_id": snap_ref.id, "date": day.isoformat(), "rows": len(rows), "based_on": base}
+
+    def invalidate_from(self, company_id: str, movement_date):
+        """Mark snapshots on or after a back-dated movement as STALE."""
+        query = self.db.collection(self.SNAPSHOTS_COLLECTION)\
+            .where("company_id", "==", company_id)\
+            .where("status", "==", "READY")\
+            .where("date", ">=", as_day(movement_date).isoformat())
+        for snap in query.stream():
+            snap.reference.update({"status": "STALE", "stale_since": firestore.SERVER_TIMESTAMP})
+
+    # ==========================================================================
+    # REPORT
+    # ==========================================================================
+    def _gl_balance_as_of(self, company_id: str, day: date) -> Tuple[Decimal, List[str]]:
+        """Balance of the inventory accounts (code 121*) at the end of `day`."""
+        accounts = self.db.collection("accounts").where("company_id", "==", company_id).stream()
+        inv_accounts = {}
+        for acc in accounts:
+            data = acc.to_dict()
+            if str(data.get("code", "")).startswith(self.INVENTORY_CODE_PREFIX) and not data.get("is_group"):
+                inv_accounts[acc.id] = Decimal(str(data.get("balance", "0")))
+
+        balance = sum(inv_accounts.values(), ZERO)
+        for acc_id in inv_accounts:
+            # Back out movements after the as-of date
+            query = self.db.collection("journal_entries")\
+                .where("company_id", "==", company_id)\
+                .where("flat_account_ids", "array_contains", acc_id)\
+                .where("date", ">=", _day_end(day))
+            for je in self.archive.read_through(company_id, "journal_entries", stream_paged(query), _day_end(day), account_id=acc_id):
+                data = je.to_dict()
+                if data.get("status") not in ("POSTED", "VOIDED"):
+                    continue
+                for line in get_journal_line_store().iter_lines(je.id, data, acc_id):
+                    balance -= Decimal(str(line.get("debit", "0"))) - Decimal(str(line.get("credit", "0")))
+        return balance, sorted(inv_accounts)
+
+    def get_valuation(self, company_id: str, as_of=None, warehouse_id: Optional[str] = None, reconcile: bool = True) -> Dict[str, Any]:
+        """Quantity, WAC and value by item and warehouse at the end of `as_of` (default today)."""
+        day = as_day(as_of)
+        positions, meta, snapshot_id, replayed = self._positions_as_of(company_id, day)
+
+        rows = []
+        by_warehouse: Dict[str, Decimal] = {}
+        by_storage: Dict[str, Decimal] = {}
+        total_value = ZERO
+        for (item_id, wh), pos in sorted(positions.items()):
+            if warehouse_id and wh != warehouse_id:
+                continue
+            if not pos["qty"] and not pos["value"]:
+                continue
+            info = meta.get(item_id, {})
+            storage = info.get("storage_type") or "OTHER"
+            rows.append({
+                "item_id": item_id,
+                "sku": info.get("sku"),
+                "name": info.get("name"),
+                "warehouse_id": wh,
+                "storage_type": storage,
+                "quantity": str(pos["qty"]),
+                "wac": str(pos["value"] / pos["qty"]) if pos["qty"] else "0",
+                "value": str(pos["value"])
+            })
+            by_warehouse[wh] = by_warehouse.get(wh, ZERO) + pos["value"]
+            by_storage[storage] = by_storage.get(storage, ZERO) + pos["value"]
+            total_value += pos["value"]
+
+        report = {
+            "as_of": day.isoformat(),
+            "snapshot_id": snapshot_id,
+            "ledger_rows_replayed": replayed,
+            "rows": rows,
+            "by_warehouse": {k: str(v) for k, v in sorted(by_warehouse.items())},
+            "by_storage_type": {k: str(v) for k, v in sorted(by_storage.items())},
+            "total_value": str(total_value)
+        }
+        if reconcile and not warehouse_id:
+            gl_balance, accounts = self._gl_balance_as_of(company_id, day)
+            difference = total_value - gl_balance
+            report["reconciliation"] = {
+                "inventory_account_ids": accounts,
+                "gl_balance": str(gl_balance),
+                "stock_value": str(total_value),
+                "difference": str(difference),
+                "reconciled": abs(difference) <= self.TOLERANCE
+            }
+        return report
+
+
+def get_valuation_service() -> InventoryValuationService:
+    return InventoryValuationService()
@@ -66,14 +66,17 @@ class VoucherService:
                 "date": firestore.SERVER_TIMESTAMP,
                 "description": f"Payment Voucher {data.voucher_number} - {data.payee}",
                 "status": "POSTED",
-                "lines": je_lines_dict,
+                "lines": engine.journal_lines.inline(je_lines_dict),
                 "company_id": data.company_id,
                 "source_doc_id": pv_ref.id,
                 "source_doc_type": "PV"
             })
 
             # Post using account data fetched earlier
-            engine.post_journal_entry(transaction, je_ref.id, je_lines_dict, accounts_data)
+            engine.post_journal_entry(
+                transaction, je_ref.id, je_lines_dict, accounts_data,
+                company_id=data.company_id, source_type="PV"
+            )
             
             # AP Settlement Logic
             from .bills import BillService
@@ -201,14 +204,17 @@ class VoucherService:
                 "date": firestore.SERVER_TIMESTAMP,
                 "description": f"Receipt Voucher {data.receipt_number}",
                 "status": "POSTED",
-                "lines": je_lines_dict,
+                "lines": engine.journal_lines.inline(je_lines_dict),
                 "company_id": data.company_id,
                 "source_doc_id": rv_ref.id,
                 "source_doc_type": "RV"
             })
 
             # Post using account data
-            engine.post_journal_entry(transaction, je_ref.id, je_lines_dict, accounts_data)
+            engine.post_journal_entry(
+                transaction, je_ref.id, je_lines_dict, accounts_data,
+                company_id=data.company_id, source_type="RV"
+            )
             
             # Settlement Logic: Update linked invoices
             for settlement in data.linked_invoices:
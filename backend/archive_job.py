@@ -0,0 +1,36 @@
+"""
+Monthly archival of closed periods.
+
+    python archive_job.py OPENGATE_CORP                    # every closed month older than 3 months
+    python archive_job.py OPENGATE_CORP --keep-months 6
+    python archive_job.py OPENGATE_CORP --period 2025-01   # one closed month
+    python archive_job.py OPENGATE_CORP --restore 2025-01  # bring a month back to the hot collections
+
+Archived months stay readable through reports, valuation and exports
+(read-through); see GET /fiscal/archives.
+"""
+import argparse
+import json
+from app.services.archive import get_archive_service
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("company_id")
+    parser.add_argument("--keep-months", type=int, default=3)
+    parser.add_argument("--period", metavar="YYYY-MM")
+    parser.add_argument("--restore", metavar="YYYY-MM")
+    args = parser.parse_args()
+
+    service = get_archive_service()
+    if args.restore:
+        result = service.restore_period(args.company_id, args.restore)
+    elif args.period:
+        result = service.archive_period(args.company_id, args.period)
+    else:
+        result = service.archive_closed_periods(args.company_id, args.keep_months)
+    print(json.dumps(result, indent=2, default=str))
+
+
+if __name__ == "__main__":
+    main()
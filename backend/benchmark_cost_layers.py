@@ -0,0 +1,123 @@
+"""
+Benchmark FIFO/FEFO layer consumption against the configured Firestore project.
+
+Seeds one throwaway item with N open cost layers, then times planning (and
+applying, in a transaction that is rolled back by raising) issues that touch a
+growing number of layers. Planning reads one page of PAGE_SIZE layers at a
+time, so the cost should track the layers consumed, not the layers open.
+
+    python benchmark_cost_layers.py --layers 5000
+    python benchmark_cost_layers.py --layers 5000 --method FEFO --keep
+"""
+import argparse
+import time
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from google.cloud import firestore
+from app.core.firebase import get_db
+from app.services.cost_layers import CostLayerService
+
+COMPANY_ID = "BENCH_COST_LAYERS"
+ITEM_ID = "bench_cost_layer_item"
+WAREHOUSE_ID = "bench_wh"
+
+
+class _Rollback(Exception):
+    pass
+
+
+def seed(db, service, count):
+    print(f"Seeding {count} open layers...")
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    batch = db.batch()
+    for i in range(count):
+        ref = db.collection(service.COLLECTION).document(f"{ITEM_ID}_{i:06d}")
+        expiry = start + timedelta(days=365 + (i * 7919) % 1000)
+        batch.set(ref, {
+            "company_id": COMPANY_ID,
+            "item_id": ITEM_ID,
+            "warehouse_id": WAREHOUSE_ID,
+            "batch_number": f"B{i:06d}",
+            "expiry_date": expiry,
+            "expiry_key": service.expiry_key(expiry),
+            "received_at": start + timedelta(hours=i),
+            "unit_cost": str(Decimal("10") + Decimal(i % 50) / 10),
+            "original_qty": "10",
+            "remaining_qty": "10",
+            "is_open": True,
+            "source_document_id": "benchmark"
+        })
+        if (i + 1) % 400 == 0:
+            batch.commit()
+            batch = db.batch()
+    batch.commit()
+
+
+def cleanup(db, service):
+    query = db.collection(service.COLLECTION).where("item_id", "==", ITEM_ID)
+    deleted = 0
+    while True:
+        docs = list(query.limit(400).stream())
+        if not docs:
+            break
+        batch = db.batch()
+        for doc in docs:
+            batch.delete(doc.reference)
+        batch.commit()
+        deleted += len(docs)
+    print(f"Removed {deleted} benchmark layers")
+
+
+def run_case(db, service, quantity, method, apply):
+    result = {}
+
+    @firestore.transactional
+    def _execute(transaction):
+        t0 = time.perf_counter()
+        slices = service.plan_consumption(transaction, ITEM_ID, WAREHOUSE_ID, quantity, method)
+        result["plan_ms"] = (time.perf_counter() - t0) * 1000
+        result["layers"] = len(slices)
+        result["cost"] = service.plan_cost(slices)
+        if apply:
+            service.apply_consumption(transaction, slices)
+        # Never commit: the seeded layers stay open for the next case
+        raise _Rollback()
+
+    t0 = time.perf_counter()
+    try:
+        _execute(db.transaction())
+    except _Rollback:
+        pass
+    result["total_ms"] = (time.perf_counter() - t0) * 1000
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--layers", type=int, default=5000)
+    parser.add_argument("--method", choices=["FIFO", "FEFO"], default="FIFO")
+    parser.add_argument("--apply", action="store_true", help="also stage the layer updates")
+    parser.add_argument("--keep", action="store_true", help="keep the seeded layers")
+    parser.add_argument("--skip-seed", action="store_true")
+    args = parser.parse_args()
+
+    db = get_db()
+    service = CostLayerService()
+    if not args.skip_seed:
+        seed(db, service, args.layers)
+
+    print(f"\n{args.method} issues against {args.layers} open layers (10 units each)")
+    print(f"{'quantity':>10} {'layers':>8} {'plan ms':>10} {'total ms':>10} {'cost':>14}")
+    for touched in (1, 10, 100, 1000):
+        if touched > args.layers:
+            break
+        quantity = Decimal(touched * 10 - 5)
+        r = run_case(db, service, quantity, args.method, args.apply)
+        print(f"{quantity:>10} {r['layers']:>8} {r['plan_ms']:>10.1f} {r['total_ms']:>10.1f} {r['cost']:>14.2f}")
+
+    if not args.keep:
+        cleanup(db, service)
+
+
+if __name__ == "__main__":
+    main()
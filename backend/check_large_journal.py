@@ -0,0 +1,147 @@
+"""
+Post one very large journal entry against the configured Firestore project.
+
+Seeds two throwaway accounts, posts an N-line manual entry through
+AccountingService (the same path as POST /journal-entries) and checks that the
+lines landed in line_chunks: the header keeps no lines, line_count and the
+totals match, and reading the entry back (whole and for one account) returns
+every line.
+
+    python check_large_journal.py --lines 20000
+    python check_large_journal.py --lines 20000 --keep
+"""
+import argparse
+import time
+from datetime import datetime, timezone
+from decimal import Decimal
+from app.core.firebase import get_db
+from app.schemas.accounting import JournalEntryCreate, JournalLineBase
+from app.services.accounting import AccountingService
+from app.services.journal_lines import get_journal_line_store
+
+COMPANY_ID = "CHECK_LARGE_JOURNAL"
+DEBIT_ACCOUNT = "check_large_journal_dr"
+CREDIT_ACCOUNT = "check_large_journal_cr"
+CLEANUP_COLLECTIONS = ["daily_rollups", "ledger_cube"]
+
+
+def seed(db):
+    for acc_id, acc_type in ((DEBIT_ACCOUNT, "EXPENSE"), (CREDIT_ACCOUNT, "LIABILITY")):
+        db.collection("accounts").document(acc_id).set({
+            "code": acc_id,
+            "name_ar": acc_id,
+            "name_en": acc_id,
+            "type": acc_type,
+            "company_id": COMPANY_ID,
+            "is_group": False,
+            "balance": "0",
+            "total_debit": "0",
+            "total_credit": "0"
+        })
+
+
+def _delete_all(db, query):
+    deleted = 0
+    while True:
+        docs = list(query.limit(400).stream())
+        if not docs:
+            return deleted
+        batch = db.batch()
+        for doc in docs:
+            batch.delete(doc.reference)
+        batch.commit()
+        deleted += len(docs)
+
+
+def cleanup(db, entry_id):
+    if entry_id:
+        entry_ref = db.collection("journal_entries").document(entry_id)
+        chunks = _delete_all(db, entry_ref.collection(get_journal_line_store().CHUNKS))
+        entry_ref.delete()
+        print(f"Removed entry {entry_id} and {chunks} line chunks")
+    for acc_id in (DEBIT_ACCOUNT, CREDIT_ACCOUNT):
+        db.collection("accounts").document(acc_id).delete()
+    for collection in CLEANUP_COLLECTIONS:
+        _delete_all(db, db.collection(collection).where("company_id", "==", COMPANY_ID))
+
+
+def build_entry(count):
+    # One credit line balances count - 1 debit lines of 1.0000 each
+    lines = [
+        JournalLineBase(account_id=DEBIT_ACCOUNT, debit="1.0000", memo=f"Check line {i}")
+        for i in range(count - 1)
+    ]
+    lines.append(JournalLineBase(account_id=CREDIT_ACCOUNT, credit=str(Decimal(count - 1))))
+    return JournalEntryCreate(
+        number=f"JE-CHECK-{count}",
+        date=datetime.now(timezone.utc),
+        description=f"Large journal check ({count} lines)",
+        lines=lines,
+        company_id=COMPANY_ID
+    )
+
+
+def check(db, entry_id, count):
+    store = get_journal_line_store()
+    data = db.collection("journal_entries").document(entry_id).get().to_dict()
+    expected = Decimal(count - 1)
+    failures = []
+    if data.get("status") != "POSTED":
+        failures.append(f"status is {data.get('status')}")
+    if data.get("lines"):
+        failures.append(f"header still holds {len(data['lines'])} lines")
+    if not data.get("lines_chunked"):
+        failures.append("lines_chunked is not set")
+    if data.get("line_count") != count:
+        failures.append(f"line_count is {data.get('line_count')}")
+    if Decimal(data.get("total_debit", "0")) != expected or Decimal(data.get("total_credit", "0")) != expected:
+        failures.append(f"totals are D:{data.get('total_debit')} C:{data.get('total_credit')}")
+
+    t0 = time.perf_counter()
+    read_back = sum(1 for _ in store.iter_lines(entry_id, data))
+    read_ms = (time.perf_counter() - t0) * 1000
+    if read_back != count:
+        failures.append(f"iter_lines returned {read_back} lines")
+    credit_lines = list(store.iter_lines(entry_id, data, account_id=CREDIT_ACCOUNT))
+    if len(credit_lines) != 1:
+        failures.append(f"account read returned {len(credit_lines)} credit lines")
+    totals = store.account_totals(entry_id, data)
+    if totals.get(DEBIT_ACCOUNT, {}).get("debit") != expected:
+        failures.append(f"account totals are {totals.get(DEBIT_ACCOUNT)}")
+
+    balance = db.collection("accounts").document(DEBIT_ACCOUNT).get().to_dict().get("balance")
+    if Decimal(str(balance)) != expected:
+        failures.append(f"debit account balance is {balance}")
+
+    print(f"{data.get('line_chunks')} chunks, read back {read_back} lines in {read_ms:.0f} ms")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=20000)
+    parser.add_argument("--keep", action="store_true", help="keep the entry and the seeded accounts")
+    args = parser.parse_args()
+
+    db = get_db()
+    entry_id = None
+    seed(db)
+    try:
+        entry = build_entry(args.lines)
+        t0 = time.perf_counter()
+        entry_id = AccountingService().create_journal_entry(entry)
+        print(f"Posted {args.lines}-line entry {entry_id} in {(time.perf_counter() - t0) * 1000:.0f} ms")
+        failures = check(db, entry_id, args.lines)
+    finally:
+        if not args.keep:
+            cleanup(db, entry_id)
+
+    if failures:
+        for failure in failures:
+            print(f"FAIL: {failure}")
+        raise SystemExit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
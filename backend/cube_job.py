@@ -0,0 +1,27 @@
+"""
+Rebuild of the monthly ledger cube (account x month x dimensions).
+
+    python cube_job.py OPENGATE_CORP                          # all history
+    python cube_job.py OPENGATE_CORP --from 2025-01 --to 2025-12
+
+Run it once after deploying the cube, and again for a range whose journals
+were tagged with dimensions after posting.
+"""
+import argparse
+import json
+from app.services.ledger_cube import get_ledger_cube_service
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("company_id")
+    parser.add_argument("--from", dest="from_month", metavar="YYYY-MM")
+    parser.add_argument("--to", dest="to_month", metavar="YYYY-MM")
+    args = parser.parse_args()
+
+    summary = get_ledger_cube_service().rebuild(args.company_id, args.from_month, args.to_month)
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
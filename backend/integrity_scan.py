@@ -0,0 +1,36 @@
+"""
+Nightly double-entry integrity scan.
+
+    python integrity_scan.py                 # every company
+    python integrity_scan.py OPENGATE_CORP   # one company
+    python integrity_scan.py --out report.json
+
+Exits with status 1 when issues are found, so a cron wrapper can alert on it.
+"""
+import sys
+import json
+from app.services.integrity import get_integrity_service
+
+
+def main(argv):
+    out = None
+    if "--out" in argv:
+        idx = argv.index("--out")
+        out = argv[idx + 1]
+        argv = argv[:idx] + argv[idx + 2:]
+    company_id = argv[0] if argv else None
+
+    service = get_integrity_service(company_id or "default")
+    report = service.scan(global_scan=company_id is None)
+    payload = json.dumps(report, indent=2, default=str)
+    if out:
+        with open(out, "w") as f:
+            f.write(payload)
+    else:
+        print(payload)
+    print(f"Integrity scan {report['scan_id']}: {report['total_issues']} issue(s) {report['issue_counts']}", file=sys.stderr)
+    return 1 if report["total_issues"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
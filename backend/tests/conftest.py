@@ -0,0 +1,96 @@
+"""
+Unit tests run without Firestore: the shared client is replaced by FakeDb, which
+only hands out references (paths), and transactions/batches record their writes.
+Anything that would query Firestore is monkeypatched in the test itself.
+"""
+import pytest
+from app.core import firebase
+
+
+class FakeRef:
+    def __init__(self, path: str):
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def collection(self, name: str) -> "FakeCollection":
+        return FakeCollection(f"{self.path}/{name}")
+
+    def __eq__(self, other):
+        return isinstance(other, FakeRef) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def __repr__(self):
+        return f"FakeRef({self.path!r})"
+
+
+class FakeCollection:
+    def __init__(self, path: str):
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def document(self, doc_id: str) -> FakeRef:
+        return FakeRef(f"{self.path}/{doc_id}")
+
+    # Query builders chain; tests patch whatever streams the query
+    def where(self, *args, **kwargs) -> "FakeCollection":
+        return self
+
+    order_by = limit = select = start_after = where
+
+
+class FakeSnap:
+    def __init__(self, doc_id: str, data: dict, collection: str = "docs"):
+        self.id = doc_id
+        self.reference = FakeRef(f"{collection}/{doc_id}")
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class FakeWriter:
+    """Records what a transaction or batch stages: (op, ref path, data)."""
+
+    def __init__(self):
+        self.writes = []
+
+    def set(self, ref, data, merge=False):
+        self.writes.append(("set", ref.path, data))
+
+    def update(self, ref, data):
+        self.writes.append(("update", ref.path, data))
+
+    def delete(self, ref):
+        self.writes.append(("delete", ref.path, None))
+
+    def commit(self):
+        pass
+
+    def of(self, path: str):
+        return [data for op, p, data in self.writes if p == path]
+
+
+class FakeDb:
+    def __init__(self):
+        self.batches = []
+
+    def collection(self, name: str) -> FakeCollection:
+        return FakeCollection(name)
+
+    def batch(self) -> FakeWriter:
+        self.batches.append(FakeWriter())
+        return self.batches[-1]
+
+    def batched_writes(self):
+        return [w for b in self.batches for w in b.writes]
+
+
+@pytest.fixture(autouse=True)
+def fake_db(monkeypatch):
+    db = FakeDb()
+    monkeypatch.setattr(firebase, "_db", db)
+    monkeypatch.setattr(firebase, "_initialized", True)
+    return db
@@ -0,0 +1,65 @@
+from decimal import Decimal
+import pytest
+from conftest import FakeSnap, FakeWriter
+from app.services.cost_layers import CostLayerService
+
+
+class PagedLayers:
+    """Open layers in costing order, served page by page like the Firestore query."""
+
+    def __init__(self, layers, size=None, start=0):
+        self.layers, self.size, self.start = layers, size, start
+
+    def limit(self, size):
+        return PagedLayers(self.layers, size, self.start)
+
+    def start_after(self, snap):
+        return PagedLayers(self.layers, self.size, self.layers.index(snap) + 1)
+
+    def get(self, transaction=None):
+        return self.layers[self.start:self.start + self.size]
+
+
+@pytest.fixture
+def service(monkeypatch):
+    service = CostLayerService()
+    monkeypatch.setattr(service, "PAGE_SIZE", 2)
+    layers = [
+        FakeSnap("L1", {"remaining_qty": "3", "unit_cost": "10", "batch_number": "A"}, "cost_layers"),
+        FakeSnap("L2", {"remaining_qty": "0", "unit_cost": "11"}, "cost_layers"),
+        FakeSnap("L3", {"remaining_qty": "5", "unit_cost": "12", "batch_number": "B"}, "cost_layers"),
+        FakeSnap("L4", {"remaining_qty": "4", "unit_cost": "13"}, "cost_layers"),
+    ]
+    monkeypatch.setattr(service, "_open_query", lambda *args, **kwargs: PagedLayers(layers))
+    return service
+
+
+def test_plan_takes_layers_in_order_across_pages(service):
+    slices = service.plan_consumption(None, "item", "main", Decimal("9"), "FIFO")
+    assert [(s["layer_id"], s["quantity"]) for s in slices] == [("L1", 3), ("L3", 5), ("L4", 1)]
+    assert service.plan_cost(slices) == Decimal("3") * 10 + Decimal("5") * 12 + Decimal("1") * 13
+
+
+def test_plans_of_one_transaction_share_layers(service):
+    planned = {}
+    first = service.plan_consumption(None, "item", "main", Decimal("2"), "FIFO", planned=planned)
+    second = service.plan_consumption(None, "item", "main", Decimal("2"), "FIFO", planned=planned)
+    assert [(s["layer_id"], s["quantity"]) for s in first] == [("L1", 2)]
+    assert [(s["layer_id"], s["quantity"], s["remaining_qty"]) for s in second] == [("L1", 1, 1), ("L3", 1, 5)]
+
+    transaction = FakeWriter()
+    service.apply_consumption(transaction, first + second)
+    assert transaction.of("cost_layers/L1")[-1]["remaining_qty"] == "0"
+    assert transaction.of("cost_layers/L1")[-1]["is_open"] is False
+    assert transaction.of("cost_layers/L3")[-1]["remaining_qty"] == "4"
+
+
+def test_plan_refuses_short_stock(service):
+    with pytest.raises(ValueError, match="short 1"):
+        service.plan_consumption(None, "item", "main", Decimal("13"), "FIFO")
+
+
+def test_only_fifo_and_fefo_items_use_layers():
+    assert CostLayerService.uses_layers({"costing_method": "FEFO"})
+    assert not CostLayerService.uses_layers({"costing_method": "WAC"})
+    assert not CostLayerService.uses_layers(None)
@@ -0,0 +1,51 @@
+from decimal import Decimal
+import pytest
+from google.cloud import firestore
+from conftest import FakeSnap
+from app.services.cycle_counts import CycleCountService
+
+
+@pytest.fixture
+def service(monkeypatch, fake_db):
+    service = CycleCountService()
+    monkeypatch.setattr(service, "_session", lambda *args: {"id": "CC1", "warehouse_id": "W", "status": "COUNTING"})
+    lines = {"A": {"item_id": "A", "counted_units": 0}, "OLD": {"item_id": "OLD", "counted_qty": 0.30000000000000004}}
+    monkeypatch.setattr(fake_db, "get_all", lambda refs: [FakeSnap(r.id, lines.get(r.id)) for r in refs], raising=False)
+    return service
+
+
+def line_write(fake_db, item_id):
+    return [data for op, path, data in fake_db.batched_writes() if path == f"cycle_counts/CC1/lines/{item_id}"][-1]
+
+
+def test_fractional_scans_add_up_exactly(service, fake_db):
+    service.record_scans("ACME", "CC1", [{"item_id": "A", "quantity": "0.1"}] * 3)
+    write = line_write(fake_db, "A")
+    assert write["counted_units"].value == 3000
+    assert write["scan_count"].value == 3
+    assert CycleCountService.counted_quantity({"counted_units": 3000}) == Decimal("0.3")
+
+
+def test_manual_recount_replaces_count_and_scan_count(service, fake_db):
+    service.record_scans("ACME", "CC1", [{"item_id": "A", "quantity": "7"}, {"item_id": "A", "quantity": "2.5"}], mode="set")
+    write = line_write(fake_db, "A")
+    assert write["counted_units"] == 25000
+    assert write["scan_count"] == 1
+
+
+def test_legacy_float_count_is_carried_over(service, fake_db):
+    service.record_scans("ACME", "CC1", [{"item_id": "OLD", "quantity": "1"}])
+    write = line_write(fake_db, "OLD")
+    assert write["counted_units"].value == 13000
+    assert write["counted_qty"] is firestore.DELETE_FIELD
+
+
+def test_quantities_finer_than_four_places_are_refused(service):
+    with pytest.raises(ValueError, match="4 decimal places"):
+        service.record_scans("ACME", "CC1", [{"item_id": "A", "quantity": "0.00001"}])
+
+
+def test_legacy_float_drift_is_rounded_off():
+    assert CycleCountService.counted_quantity({"counted_qty": 0.30000000000000004}) == Decimal("0.3")
+    assert str(CycleCountService.counted_quantity({"counted_qty": 10.0})) == "10"
+    assert str(CycleCountService.counted_quantity({"counted_units": 20000})) == "2"
@@ -0,0 +1,51 @@
+from conftest import FakeSnap
+from app.services import integrity
+
+
+def run_journal_scan(monkeypatch, entries, owners, company_id="ACME"):
+    def reload_owners(company):
+        raise AssertionError("workers must use the owners loaded once by scan()")
+
+    monkeypatch.setattr(integrity, "_range_query", lambda *args: None)
+    monkeypatch.setattr(integrity, "stream_paged", lambda query, page_size=500: iter(entries))
+    monkeypatch.setattr(integrity, "_account_owners", reload_owners)
+    integrity._init_scan_worker(owners)
+    try:
+        return integrity.scan_journal_range(company_id, None, None)
+    finally:
+        integrity._init_scan_worker(None)
+
+
+def test_journal_scan_flags_broken_entries(monkeypatch):
+    owners = {"cash": "ACME", "sales": "ACME", "other": "GLOBEX"}
+    entries = [
+        FakeSnap("ok", {"status": "POSTED", "company_id": "ACME", "lines": [
+            {"account_id": "cash", "debit": "5", "credit": "0"}, {"account_id": "sales", "debit": "0", "credit": "5"}]}),
+        FakeSnap("unbalanced", {"status": "POSTED", "company_id": "ACME", "number": "JE-2", "lines": [
+            {"account_id": "cash", "debit": "5", "credit": "0"}, {"account_id": "sales", "debit": "0", "credit": "4"}]}),
+        FakeSnap("foreign", {"status": "VOIDED", "company_id": "ACME", "lines": [
+            {"account_id": "other", "debit": "1", "credit": "0"}, {"account_id": "gone", "debit": "0", "credit": "1"}]}),
+        FakeSnap("draft", {"status": "DRAFT", "company_id": "ACME", "lines": [{"account_id": "gone", "debit": "1"}]}),
+    ]
+    result = run_journal_scan(monkeypatch, entries, owners)
+
+    assert result["rows"] == 4
+    assert result["counts"] == {"unbalanced_entry": 1, "foreign_account": 1, "missing_account": 1}
+    assert result["issues"]["unbalanced_entry"][0]["difference"] == "1"
+    assert result["issues"]["foreign_account"][0]["account_company_id"] == "GLOBEX"
+
+
+def test_issue_samples_are_capped_but_counted(monkeypatch):
+    monkeypatch.setattr(integrity, "ISSUE_LIMIT", 3)
+    issues = integrity._Issues()
+    for i in range(10):
+        issues.add("missing_account", journal_entry_id=str(i))
+    result = issues.result(10)
+    assert result["counts"]["missing_account"] == 10
+    assert len(result["issues"]["missing_account"]) == 3
+
+
+def test_endpoint_has_no_global_mode():
+    import inspect
+    from app.api import run_integrity_scan
+    assert "global_scan" not in inspect.signature(run_integrity_scan).parameters
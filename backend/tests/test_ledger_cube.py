@@ -0,0 +1,70 @@
+from decimal import Decimal
+import pytest
+from conftest import FakeWriter
+from app.services.ledger_cube import DIMENSIONS, LedgerCubeService, line_dimensions
+from app.services.posting import PostingEngine
+
+
+def test_cube_key_without_dimensions_is_readable():
+    assert LedgerCubeService.cube_key("ACME", "4110", "2026-03", ("",) * len(DIMENSIONS)) == "ACME_4110_2026-03_-"
+
+
+def test_cube_key_separates_dimension_values():
+    a = LedgerCubeService.cube_key("ACME", "4110", "2026-03", ("BR1", "", "", "", ""))
+    b = LedgerCubeService.cube_key("ACME", "4110", "2026-03", ("", "BR1", "", "", ""))
+    assert a != b
+    assert a == LedgerCubeService.cube_key("ACME", "4110", "2026-03", ("BR1", "", "", "", ""))
+    assert a.startswith("ACME_4110_2026-03_")
+
+
+def test_line_dimensions_fall_back_to_entry_dimensions():
+    line = {"account_id": "4110", "cost_center_id": "BR2"}
+    dims = line_dimensions(line, {"cost_center_id": "BR1", "customer_id": "C9"})
+    assert dict(zip(DIMENSIONS, dims)) == {
+        "cost_center_id": "BR2", "warehouse_id": "", "customer_id": "C9", "supplier_id": "", "project_id": ""
+    }
+
+
+def test_journal_cells_group_lines_by_account_and_dimensions():
+    lines = [
+        {"account_id": "cash", "debit": "100", "credit": "0"},
+        {"account_id": "sales", "debit": "0", "credit": "60", "cost_center_id": "BR1"},
+        {"account_id": "sales", "debit": "0", "credit": "40", "cost_center_id": "BR1"},
+        {"account_id": "sales", "debit": "0", "credit": "0", "cost_center_id": "BR2"},
+        {"debit": "5"},
+    ]
+    cells = LedgerCubeService.journal_cells(lines, {"customer_id": "C1"})
+    empty = ("", "", "C1", "", "")
+    assert cells[("cash", empty)] == [Decimal("100"), Decimal("0"), 1]
+    assert cells[("sales", ("BR1", "", "C1", "", ""))] == [Decimal("0"), Decimal("100"), 2]
+    assert len(cells) == 3
+
+
+def test_year_end_closing_stays_out_of_the_cube():
+    assert LedgerCubeService.journal_cells([{"account_id": "cash", "debit": "1"}], source_type="YEAR_END_CLOSE") == {}
+
+
+def posting_lines(count):
+    # Worst case for the budget: every line on its own account and dimensions
+    lines = [{"account_id": f"acc{i}", "debit": "1", "credit": "0", "project_id": f"P{i}"} for i in range(count - 1)]
+    lines.append({"account_id": "clearing", "debit": "0", "credit": str(count - 1)})
+    return lines
+
+
+@pytest.mark.parametrize("count", [2, 60, 248, 600])
+def test_posting_stays_within_its_write_estimate(count):
+    engine = PostingEngine()
+    lines = posting_lines(count)
+    accounts = {l["account_id"]: {"type": "EXPENSE", "code": "61", "company_id": "ACME"} for l in lines}
+    transaction = FakeWriter()
+    engine.post_journal_entry(transaction, "JE1", lines, accounts, entry_date="2026-03-31",
+                              company_id="ACME", source_type="OPENING_BALANCE", allow_closed_period=True)
+
+    cube_writes = [p for op, p, data in transaction.writes if p.startswith("ledger_cube/")]
+    assert len(cube_writes) == count
+    assert len(transaction.writes) <= PostingEngine.journal_writes(count)
+
+
+def test_largest_single_entry_fits_one_commit():
+    lines = PostingEngine.max_journal_lines(other_writes=1)
+    assert PostingEngine.journal_writes(lines) + 1 <= PostingEngine.WRITE_LIMIT
@@ -0,0 +1,40 @@
+from conftest import FakeSnap
+from app.services.lifecycle import LifecycleService
+from app.services.posting import PostingEngine
+
+
+def test_invoice_void_estimate():
+    # reversal set + update, 3 accounts, 3 cube cells, daily rollup, reversal count,
+    # original VOIDED update, invoice VOIDED update
+    assert LifecycleService.void_writes({"line_count": 3}) == 12
+
+
+def test_stock_void_estimate_counts_every_movement():
+    base = LifecycleService.void_writes({"lines": [{}, {}]})
+    with_stock = LifecycleService.void_writes({"lines": [{}, {}]}, stock_rows=5)
+    assert with_stock - base == 5 * PostingEngine.STOCK_MOVEMENT_WRITES
+
+
+def test_voucher_void_estimate_counts_settlements():
+    assert LifecycleService.void_writes({"line_count": 2}, settlements=3) == LifecycleService.void_writes({"line_count": 2}) + 3
+
+
+def test_bulk_void_groups_fit_one_commit(monkeypatch):
+    service = LifecycleService("tester", "ACME")
+    entries = {f"JE{i:03d}": {"line_count": 3, "source_doc_type": "INV"} for i in range(120)}
+    monkeypatch.setattr(service.db, "get_all", lambda refs: [FakeSnap(r.id, entries[r.id]) for r in refs], raising=False)
+    groups = []
+
+    def fake_void_group(je_ids, reason, strict):
+        groups.append(list(je_ids))
+        return {"voided": {jid: f"REV_{jid}" for jid in je_ids}, "skipped": {}}
+
+    monkeypatch.setattr(service, "_void_group", fake_void_group)
+    result = service.void_journal_entries(list(entries), "cleanup")
+
+    assert len(result["voided"]) == 120 and not result["failed"]
+    assert [jid for group in groups for jid in group] == list(entries)
+    for group in groups:
+        assert sum(LifecycleService.void_writes(entries[jid]) for jid in group) <= PostingEngine.WRITE_LIMIT
+    # The old 400-write budget let ~50 of these (about 600 real writes) into one group
+    assert max(len(group) for group in groups) * 12 <= PostingEngine.WRITE_LIMIT
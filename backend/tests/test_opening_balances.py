@@ -0,0 +1,41 @@
+from app.services.journal_lines import JournalLineStore
+from app.services.opening_balances import OpeningBalanceLoader
+from app.services.posting import PostingEngine
+
+
+def gl_chunk_writes(rows: int) -> int:
+    # JE set + posting (rows plus the clearing line) + job checkpoint
+    return 1 + PostingEngine.journal_writes(rows + 1) + 1
+
+
+def test_gl_chunk_fits_one_commit():
+    size = OpeningBalanceLoader.CHUNK_SIZE["gl"]
+    assert gl_chunk_writes(size) <= PostingEngine.WRITE_LIMIT
+    # ...and is as large as it can be
+    assert gl_chunk_writes(size + 1) > PostingEngine.WRITE_LIMIT
+
+
+def test_gl_chunk_counts_ledger_cube_cells():
+    # An account update and a cube cell per line: 400-row chunks staged ~800 writes
+    assert gl_chunk_writes(400) > PostingEngine.WRITE_LIMIT
+    assert OpeningBalanceLoader.CHUNK_SIZE["gl"] * 2 < PostingEngine.WRITE_LIMIT
+
+
+def test_stock_chunk_fits_one_commit():
+    size = OpeningBalanceLoader.CHUNK_SIZE["stock"]
+    assert size * PostingEngine.STOCK_MOVEMENT_WRITES + 1 <= PostingEngine.WRITE_LIMIT
+
+
+def test_journal_writes_include_line_chunks():
+    inline = JournalLineStore.INLINE_LINES
+    assert PostingEngine.journal_writes(inline) == PostingEngine.JOURNAL_ENTRY_WRITES + inline * PostingEngine.JOURNAL_LINE_WRITES
+    lines = 1200
+    chunks = -(-lines // JournalLineStore.CHUNK_LINES)
+    assert PostingEngine.journal_writes(lines) == PostingEngine.JOURNAL_ENTRY_WRITES + lines * PostingEngine.JOURNAL_LINE_WRITES + chunks
+
+
+def test_max_journal_lines_respects_other_writes():
+    for other in (0, 2, 50, 499):
+        lines = PostingEngine.max_journal_lines(other)
+        assert PostingEngine.journal_writes(lines) + other <= PostingEngine.WRITE_LIMIT or lines == 0
+        assert PostingEngine.journal_writes(lines + 1) + other > PostingEngine.WRITE_LIMIT
@@ -0,0 +1,66 @@
+from datetime import datetime, timezone
+from decimal import Decimal
+from conftest import FakeSnap
+from app.services import recosting
+from app.services.recosting import StockRecostService
+
+
+def row(doc_id, day, doc_type, qty, unit_cost="0", rate="0"):
+    return FakeSnap(doc_id, {
+        "item_id": "item", "warehouse_id": "main", "source_document_type": doc_type,
+        "posting_date": datetime(2026, 3, day, tzinfo=timezone.utc), "quantity": qty,
+        "unit_cost": unit_cost, "valuation_rate": rate
+    }, collection="stock_ledger")
+
+
+def replay(monkeypatch, rows, opening_qty="0", opening_value="0"):
+    monkeypatch.setattr(recosting, "stream_paged", lambda query, page_size=500: iter(rows))
+    service = StockRecostService()
+    state = {"opening_qty": opening_qty, "opening_value": opening_value,
+             "from_date": datetime(2026, 3, 1, tzinfo=timezone.utc)}
+    return service, service._replay_item("run1", "item", state)
+
+
+def test_back_dated_receipt_recosts_later_issues(monkeypatch, fake_db):
+    rows = [
+        row("r1", 1, "GRN", "10", unit_cost="5", rate="5"),
+        # Issued at 8 before the receipt was back-dated in front of it
+        row("r2", 2, "DO", "-4", unit_cost="8", rate="8"),
+    ]
+    service, result = replay(monkeypatch, rows)
+
+    assert result["rows"] == 2 and result["changed_rows"] == 1
+    # 4 units now cost 5 instead of 8: 12 less COGS
+    assert result["cogs_delta"] == Decimal("-12")
+    assert result["value_delta"] == Decimal("12")
+    assert result["out_value_by_day"] == {"2026-03-02": Decimal("-12")}
+    updates = {path: data for op, path, data in fake_db.batched_writes()}
+    assert updates["stock_ledger/r2"]["valuation_rate"] == "5"
+    assert updates["stock_ledger/r2"]["recost_prev"] == {"unit_cost": "8", "valuation_rate": "8"}
+    assert updates["stock_ledger/r2"]["running_qty"] == "6"
+
+
+def test_void_keeps_its_rate_and_variance_is_split_out(monkeypatch, fake_db):
+    rows = [
+        row("r1", 1, "GRN", "10", unit_cost="5", rate="5"),
+        # Reversal of another receipt: leaves at the cost it came in with
+        row("r2", 2, "GRN_VOID", "-2", unit_cost="7", rate="7"),
+        row("r3", 3, "CYCLE_COUNT", "-1", unit_cost="6", rate="6"),
+    ]
+    service, result = replay(monkeypatch, rows)
+
+    updates = {path: data for op, path, data in fake_db.batched_writes()}
+    assert updates["stock_ledger/r2"]["valuation_rate"] == "7"
+    # WAC after the void: (50 - 14) / 8 = 4.5
+    assert Decimal(updates["stock_ledger/r3"]["valuation_rate"]) == Decimal("4.5")
+    assert result["variance_delta"] == Decimal("-1.5")
+    assert result["cogs_delta"] == Decimal("0")
+
+
+def test_unchanged_suffix_writes_nothing(monkeypatch, fake_db):
+    rows = [row("r1", 1, "GRN", "10", unit_cost="5", rate="5"), row("r2", 2, "DO", "-4", unit_cost="0", rate="5")]
+    for snap, (qty, value) in zip(rows, (("10", "50"), ("6", "30"))):
+        snap._data.update({"running_qty": qty, "running_value": value})
+    service, result = replay(monkeypatch, rows)
+    assert result["changed_rows"] == 0
+    assert fake_db.batched_writes() == []
@@ -0,0 +1,54 @@
+import random
+from decimal import Decimal
+import pytest
+from conftest import FakeSnap
+from app.services.replay import ID_ALPHABET, _add_journal, _add_stock, key_ranges
+
+
+def owner(ranges, doc_id):
+    hits = [i for i, (lo, hi) in enumerate(ranges) if (lo is None or doc_id >= lo) and (hi is None or doc_id < hi)]
+    assert len(hits) == 1, f"{doc_id} falls in ranges {hits}"
+    return hits[0]
+
+
+@pytest.mark.parametrize("partitions", [1, 2, 3, 7, 16, 62])
+def test_key_ranges_are_contiguous_and_open_ended(partitions):
+    ranges = key_ranges(partitions)
+    assert len(ranges) == partitions
+    assert ranges[0][0] is None and ranges[-1][1] is None
+    for (_, hi), (lo, _) in zip(ranges, ranges[1:]):
+        assert hi == lo
+    bounds = [lo for lo, _ in ranges[1:]]
+    assert bounds == sorted(bounds) and len(set(bounds)) == len(bounds)
+
+
+def test_key_ranges_cover_every_id_once():
+    rng = random.Random(7)
+    ranges = key_ranges(8)
+    ids = ["".join(rng.choice(ID_ALPHABET) for _ in range(20)) for _ in range(2000)]
+    ids += ["0", "z" * 20, "OB_job_00001", "DEP_ACME_2026-01_a_b", "_leading"]
+    used = {owner(ranges, doc_id) for doc_id in ids}
+    assert used == set(range(8))
+
+
+def test_key_ranges_clamps_partition_count():
+    assert key_ranges(0) == [(None, None)]
+    assert len(key_ranges(1000)) == len(ID_ALPHABET)
+
+
+def test_journal_sums_posted_and_voided_only():
+    totals = {}
+    lines = [{"account_id": "cash", "debit": "10", "credit": "0"}, {"account_id": "sales", "debit": "0", "credit": "10"}]
+    assert _add_journal(totals, FakeSnap("a", {"status": "POSTED", "lines": lines}))
+    assert _add_journal(totals, FakeSnap("b", {"status": "VOIDED", "lines": lines}))
+    assert not _add_journal(totals, FakeSnap("c", {"status": "DRAFT", "lines": lines}))
+    assert totals == {"cash": [Decimal("20"), Decimal("0")], "sales": [Decimal("0"), Decimal("20")]}
+
+
+def test_stock_values_in_at_cost_and_out_at_rate():
+    totals = {}
+    _add_stock(totals, FakeSnap("r1", {"item_id": "i", "quantity": "10", "unit_cost": "5", "valuation_rate": "6", "timestamp": 1}))
+    _add_stock(totals, FakeSnap("r2", {"item_id": "i", "quantity": "-4", "unit_cost": "5", "valuation_rate": "6", "timestamp": 2}))
+    assert totals["i"]["qty"] == Decimal("6")
+    assert totals["i"]["value"] == Decimal("50") - Decimal("24")
+    assert totals["i"]["last_rate"] == "6"
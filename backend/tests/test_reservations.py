@@ -0,0 +1,67 @@
+from decimal import Decimal
+from conftest import FakeWriter
+from app.services.reservations import ReservationService
+from app.services.stock_balances import StockBalanceService
+
+
+def reservation(direction, *lines):
+    return {"status": "ACTIVE", "direction": direction, "company_id": "ACME",
+            "lines": [{"item_id": i, "warehouse_id": w, "quantity": q} for i, w, q in lines]}
+
+
+def balance(reserved="0", inbound="0"):
+    return {"qty": "20", "reserved_qty": reserved, "inbound_qty": inbound}
+
+
+def test_partial_delivery_releases_only_what_was_delivered():
+    service = ReservationService()
+    bid = StockBalanceService.balance_id
+    balances = {bid("A", "W"): balance(reserved="8"), bid("B", "W"): balance(reserved="2")}
+    reservations = {
+        "SO_1": reservation("OUT", ("A", "W", "5"), ("B", "W", "2")),
+        "SO_2": reservation("OUT", ("A", "W", "3")),
+    }
+    transaction = FakeWriter()
+    service.consume(transaction, balances, reservations, "ACME", {("A", "W"): Decimal("6"), ("B", "W"): Decimal("2")})
+
+    # Released in the order given: SO_1 whole, then 1 of SO_2's 3
+    assert reservations["SO_1"]["status"] == "CONSUMED"
+    assert reservations["SO_2"]["status"] == "ACTIVE"
+    assert reservations["SO_2"]["lines"] == [{"item_id": "A", "warehouse_id": "W", "quantity": "2"}]
+    assert transaction.of("stock_reservations/SO_2")[-1]["lines"][0]["quantity"] == "2"
+    assert balances[bid("A", "W")]["reserved_qty"] == "2"
+    assert balances[bid("B", "W")]["reserved_qty"] == "0"
+
+
+def test_undelivered_reservation_is_left_untouched():
+    service = ReservationService()
+    bid = StockBalanceService.balance_id
+    balances = {bid("A", "W"): balance(reserved="4")}
+    reservations = {"SO_1": reservation("OUT", ("A", "W", "4"))}
+    transaction = FakeWriter()
+    service.consume(transaction, balances, reservations, "ACME", {("C", "W"): Decimal("1")})
+
+    assert reservations["SO_1"]["status"] == "ACTIVE"
+    assert reservations["SO_1"]["lines"][0]["quantity"] == "4"
+    assert balances[bid("A", "W")]["reserved_qty"] == "4"
+
+
+def test_inbound_reservation_is_consumed_whole():
+    service = ReservationService()
+    bid = StockBalanceService.balance_id
+    balances = {bid("A", "W"): balance(inbound="10")}
+    reservations = {"GET_1": reservation("IN", ("A", "W", "10"))}
+    service.consume(FakeWriter(), balances, reservations, "ACME", {("A", "W"): Decimal("4")})
+
+    assert reservations["GET_1"]["status"] == "CONSUMED"
+    assert balances[bid("A", "W")]["inbound_qty"] == "0"
+
+
+def test_totals_merge_lines_and_skip_unreservable():
+    totals = ReservationService.totals([
+        {"item_id": "A", "warehouse_id": "W", "quantity": "1.5"},
+        {"item_id": "A", "warehouse_id": "W", "quantity": "2"},
+        {"item_id": "B", "quantity": "3"},
+        {"item_id": "C", "warehouse_id": "W", "quantity": "0"},
+    ])
+    assert totals == {("A", "W"): Decimal("3.5")}
@@ -0,0 +1,36 @@
+from decimal import Decimal
+from app.services.rollups import RollupService
+
+
+def test_rebuild_values_receipts_at_their_cost():
+    # valuation_rate of an IN row is the WAC after the receipt, not what the receipt cost
+    row = {"quantity": "10", "unit_cost": "5", "valuation_rate": "7", "source_document_type": "GRN"}
+    assert RollupService.stock_row_deltas(row) == {"stock_in_value": Decimal("50")}
+
+
+def test_rebuild_values_issues_at_their_rate():
+    row = {"quantity": "-4", "unit_cost": "5", "valuation_rate": "7", "source_document_type": "DO"}
+    assert RollupService.stock_row_deltas(row) == {"stock_out_value": Decimal("28")}
+
+
+def test_rebuild_matches_live_posting():
+    # record_stock_movement feeds apply_stock with unit_cost for IN, the issue rate for OUT
+    rows = [
+        {"quantity": "3", "unit_cost": "2.5", "valuation_rate": "4"},
+        {"quantity": "-2", "unit_cost": "9", "valuation_rate": "4"},
+    ]
+    for row in rows:
+        qty = Decimal(row["quantity"])
+        live_rate = Decimal(row["unit_cost"] if qty > 0 else row["valuation_rate"])
+        assert RollupService.stock_row_deltas(row) == RollupService.stock_deltas(qty, live_rate)
+
+
+def test_rebuild_skips_transfers_and_empty_rows():
+    assert RollupService.stock_row_deltas({"quantity": "5", "unit_cost": "1", "source_document_type": "TRF"}) == {}
+    assert RollupService.stock_row_deltas({"quantity": "0", "unit_cost": "1"}) == {}
+
+
+def test_voided_invoice_leaves_invoice_count():
+    issued = RollupService.journal_deltas([], {}, "INV")
+    voided = RollupService.journal_deltas([], {}, RollupService.REVERSAL_TYPE, "INV")
+    assert issued["invoice_count"] + voided["invoice_count"] == 0
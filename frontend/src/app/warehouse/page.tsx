@@ -21,16 +21,18 @@ export default function WarehousePage() {
                 fetchWithAuth("/api/warehouse/products"),
                 fetchWithAuth("/api/warehouse/warehouses"),
                 fetchWithAuth("/api/warehouse/intents"),
-                fetchWithAuth("/api/warehouse/ops/adjustments")
-            ]).then(async ([prodRes, whRes, intRes, adjRes]) => {
+                fetchWithAuth("/api/warehouse/ops/adjustments"),
+                fetchWithAuth("/api/warehouse/low-stock")
+            ]).then(async ([prodRes, whRes, intRes, adjRes, lowRes]) => {
                 const prods = prodRes.ok ? await prodRes.json() : [];
                 const whs = whRes.ok ? await whRes.json() : [];
                 const ints = intRes.ok ? await intRes.json() : [];
                 const adjs = adjRes.ok ? await adjRes.json() : [];
+                const low = lowRes.ok ? await lowRes.json() : [];
 
                 setStats({
                     totalItems: prods.length,
-                    lowStock: prods.filter((p: any) => Number(p.current_qty) < 10).length,
+                    lowStock: low.length,
                     totalWarehouses: whs.length
                 });
                 setRecentIntents(ints.slice(0, 5));